@@ -160,6 +160,13 @@ CREATE TABLE annotations ( id INTEGER PRIMARY KEY,
     UNIQUE(book, user_type, user, format, annot_type, annot_id)
 );
 
+CREATE TABLE change_log ( seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	book INTEGER NOT NULL,
+	kind TEXT NOT NULL,
+	fields TEXT NOT NULL DEFAULT '',
+	timestamp REAL NOT NULL
+);
+
 CREATE VIRTUAL TABLE annotations_fts USING fts5(searchable_text, content = 'annotations', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2');
 CREATE VIRTUAL TABLE annotations_fts_stemmed USING fts5(searchable_text, content = 'annotations', content_rowid = 'id', tokenize = 'porter unicode61 remove_diacritics 2');
 
@@ -336,6 +343,7 @@ CREATE INDEX custom_columns_idx ON custom_columns (label);
 CREATE INDEX data_idx ON data (book);
 CREATE INDEX lrp_idx ON last_read_positions (book);
 CREATE INDEX annot_idx ON annotations (book);
+CREATE INDEX change_log_idx ON change_log (timestamp);
 CREATE INDEX formats_idx ON data (format);
 CREATE INDEX languages_idx ON languages (lang_code COLLATE NOCASE);
 CREATE INDEX publishers_idx ON publishers (name COLLATE NOCASE);
@@ -638,4 +646,4 @@ CREATE TRIGGER series_update_trg
         BEGIN
           UPDATE series SET sort=title_sort(NEW.name) WHERE id=NEW.id;
         END;
-pragma user_version=26;
+pragma user_version=27;
@@ -449,6 +449,13 @@ def set_metadata(self, stream, mi, ftype):
         set_metadata(stream, mi, apply_null=self.apply_null, force_identifiers=self.force_identifiers, ftype=ftype,
                      add_missing_cover='disable-add-missing-cover' != q or ftype == 'kepub')
 
+    def metadata_replacements(self, reader, mi, ftype):
+        ' Return the new OPF and the other files that set_metadata() would change, without changing the EPUB '
+        from calibre.ebooks.metadata.epub import metadata_replacements
+        q = self.site_customization or ''
+        return metadata_replacements(reader, mi, apply_null=self.apply_null, force_identifiers=self.force_identifiers, ftype=ftype,
+                                     add_missing_cover='disable-add-missing-cover' != q or ftype == 'kepub')
+
     def customization_help(self, gui=False):
         h = 'disable-add-missing-cover'
         if gui:
@@ -523,6 +523,18 @@ def set_file_type_metadata(stream, mi, ftype, report_error=None):
                             report_error(mi, ftype, traceback.format_exc())
 
 
+def configured_metadata_writer(ftype):
+    ' Return the plugin that set_file_type_metadata() would try first for ftype, configured as it would be, or None '
+    ftype = ftype.lower().strip()
+    customization = config['plugin_customization']
+    for plugin in _metadata_writers.get(ftype, ()):
+        if not is_disabled(plugin):
+            plugin.apply_null = apply_null_metadata.apply_null
+            plugin.force_identifiers = force_identifiers.force_identifiers
+            plugin.site_customization = customization.get(plugin.name, '')
+            return plugin
+
+
 def can_set_metadata(ftype):
     ftype = ftype.lower().strip()
     for plugin in _metadata_writers.get(ftype, ()):
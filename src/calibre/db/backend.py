@@ -13,10 +13,12 @@
 import shutil
 import stat
 import sys
+import tempfile
 import time
 import uuid
-from contextlib import closing, suppress
+from contextlib import closing, contextmanager, suppress
 from functools import partial
+from threading import RLock
 
 import apsw
 
@@ -34,6 +36,7 @@
     TrashEntry,
 )
 from calibre.db.errors import NoSuchFormat
+from calibre.db.listeners import change_log_entry
 from calibre.db.schema_upgrades import SchemaUpgrade
 from calibre.db.tables import (
     AuthorsTable,
@@ -78,6 +81,12 @@
 
 CUSTOM_DATA_TYPES = frozenset(('rating', 'text', 'comments', 'datetime',
     'int', 'float', 'bool', 'series', 'composite', 'enumeration'))
+CHANGE_LOG_RETENTION = 90 * 24 * 60 * 60  # seconds
+# Old entries are pruned from the change log after this many changes have
+# been recorded, so that it does not grow without bound in long running
+# processes such as the server
+CHANGE_LOG_PRUNE_INTERVAL = 10000
+REPLACING_FILE_SUFFIX = '.calibre-tmp'
 WINDOWS_RESERVED_NAMES = frozenset('CON PRN AUX NUL COM1 COM2 COM3 COM4 COM5 COM6 COM7 COM8 COM9 LPT1 LPT2 LPT3 LPT4 LPT5 LPT6 LPT7 LPT8 LPT9'.split())
 
 
@@ -372,6 +381,10 @@ def __init__(self, path):
         super().__init__(path)
         plugins.load_apsw_extension(self, 'sqlite_extension')
         self.fts_dbpath = self.notes_dbpath = None
+        # Queries of the change log are made from many threads at once, under
+        # the read lock of the Cache, and by the writer that records changes,
+        # so they are run one at a time
+        self.query_lock = RLock()
 
         self.setbusytimeout(self.BUSY_TIMEOUT)
         self.execute('PRAGMA cache_size=-5000; PRAGMA temp_store=2; PRAGMA foreign_keys=ON;')
@@ -466,6 +479,7 @@ def __init__(self, library_path, default_prefs=None, read_only=False,
                  restore_all_prefs=False, progress_callback=lambda x, y:True,
                  load_user_formatter_functions=True, temp_db_path=None):
         self.is_closed = False
+        self.changes_since_prune = 0
         if isbytestring(library_path):
             library_path = library_path.decode(filesystem_encoding)
         self.field_metadata = FieldMetadata()
@@ -1031,6 +1045,9 @@ def unretire_note_for(self, field, item_id) -> int:
     def add_notes_resource(self, path_or_stream, name, mtime=None) -> int:
         return self.notes.add_resource(self.conn, path_or_stream, name, mtime=mtime)
 
+    def add_notes_resources(self, resources):
+        return self.notes.add_resources(self.conn, resources)
+
     def get_notes_resource(self, resource_hash) -> dict | None:
         return self.notes.get_resource_data(self.conn, resource_hash)
 
@@ -1044,11 +1061,12 @@ def unretire_note(self, field, item_id, item_val):
         return self.notes.unretire(self.conn, field, item_id, item_val)
 
     def search_notes(self,
-        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_fields, return_text, process_each_result, limit
+        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_fields, return_text, process_each_result, limit,
+        offset=0
     ):
         yield from self.notes.search(
             self.conn, fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_fields, return_text,
-            process_each_result, limit)
+            process_each_result, limit, offset)
 
     def export_notes_data(self, outfile):
         import zipfile
@@ -1072,9 +1090,9 @@ def export_notes_data(self, outfile):
     def restore_notes(self, report_progress):
         self.notes.restore(self.conn, self.tables, report_progress)
 
-    def import_note(self, field, item_id, html, basedir, ctime, mtime):
+    def import_note(self, field, item_id, html, basedir, ctime, mtime, resource_cache=None):
         id_val = self.tables[field].id_map[item_id]
-        return self.notes.import_note(self.conn, field, item_id, id_val, html, basedir, ctime, mtime)
+        return self.notes.import_note(self.conn, field, item_id, id_val, html, basedir, ctime, mtime, resource_cache)
 
     def export_note(self, field, item_id):
         return self.notes.export_note(self.conn, field, item_id)
@@ -1663,9 +1681,48 @@ def apply_to_format(self, book_id, path, fname, fmt, func, missing_value=None):
         path = self.format_abspath(book_id, fmt, fname, path)
         if path is None:
             return missing_value
-        with open(path, 'r+b') as f:
+        with self.replacing_file(path, copy_existing=True) as f:
             return func(f)
 
+    @contextmanager
+    def replacing_file(self, path, copy_existing=False):
+        ''' Yield a file object to write the new contents of the file at path
+        to. Except on Windows, where open files cannot be replaced, this is a
+        temporary file in the same folder that replaces path when done, so that
+        anything reading from path, such as the Content server, which serves
+        files directly from the library, continues to read the old contents.
+        The temporary file gets the permissions, owner and extended attributes
+        of path, where possible. If copy_existing is True, the file contains
+        the existing contents of path, note that this means the whole file is
+        copied before it is changed. Temporary files left behind for path, by
+        a crash for instance, are removed. Callers must hold the write lock. '''
+        if iswindows or not os.path.exists(path):
+            with open(path, 'r+b' if copy_existing else 'wb') as f:
+                yield f
+            return
+        dirpath, fname = os.path.split(path)
+        for x in os.listdir(dirpath):
+            if x.endswith(REPLACING_FILE_SUFFIX) and x.startswith(fname + '.'):
+                with suppress(OSError):
+                    os.remove(os.path.join(dirpath, x))
+        fd, tpath = tempfile.mkstemp(prefix=fname + '.', suffix=REPLACING_FILE_SUFFIX, dir=dirpath)
+        try:
+            with open(fd, 'r+b') as f:
+                st = os.stat(path)
+                shutil.copystat(path, tpath)
+                with suppress(OSError):
+                    os.chown(tpath, st.st_uid, st.st_gid)
+                if copy_existing:
+                    with open(path, 'rb') as src:
+                        shutil.copyfileobj(src, f)
+                    f.seek(0)
+                yield f
+            os.replace(tpath, path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tpath)
+            raise
+
     def format_hash(self, book_id, fmt, fname, path):
         path = self.format_abspath(book_id, fmt, fname, path)
         if path is None:
@@ -1892,7 +1949,7 @@ def windows_check_if_files_in_use(self, paths):
                 if os.path.exists(spath):
                     windows_check_if_files_in_use(spath)
 
-    def add_format(self, book_id, fmt, stream, title, author, path, current_name, mtime=None):
+    def add_format(self, book_id, fmt, stream, title, author, path, current_name, mtime=None, use_hardlink=False):
         fmt = ('.' + fmt.lower()) if fmt else ''
         fname = self.construct_file_name(book_id, title, author, len(fmt))
         path = os.path.join(self.library_path, path)
@@ -1927,8 +1984,10 @@ def add_format(self, book_id, fmt, stream, title, author, path, current_name, mt
                 else:
                     raise
             size = os.path.getsize(dest)
+        elif use_hardlink and getattr(stream, 'name', False) and not samefile(dest, stream.name) and self.hardlink_into_place(stream.name, dest):
+            size = os.path.getsize(dest)
         elif (not getattr(stream, 'name', False) or not samefile(dest, stream.name)):
-            with open(dest, 'wb') as f:
+            with self.replacing_file(dest) as f:
                 shutil.copyfileobj(stream, f)
                 size = f.tell()
             if mtime is not None:
@@ -2140,7 +2199,23 @@ def rename_extra_file(self, relpath, newrelpath, book_path, replace=True):
             os.replace(src, dest)
         return True
 
-    def add_extra_file(self, relpath, stream, book_path, replace=True, auto_rename=False):
+    def hardlink_into_place(self, src, dest):
+        ''' Replace dest with a hardlink to src. Returns False if the hardlink
+        could not be created, for example, because src and dest are on
+        different filesystems. '''
+        tdest = dest + '.calibre-link'
+        try:
+            hardlink_file(src, tdest)
+        except OSError:
+            return False
+        try:
+            atomic_rename(tdest, dest)
+        except OSError:
+            os.remove(tdest)
+            return False
+        return True
+
+    def add_extra_file(self, relpath, stream, book_path, replace=True, auto_rename=False, use_hardlink=False):
         bookdir = os.path.join(self.library_path, book_path)
         dest = os.path.abspath(os.path.join(bookdir, relpath))
         if not self.normpath(dest).startswith(self.normpath(bookdir)):
@@ -2160,6 +2235,10 @@ def add_extra_file(self, relpath, stream, book_path, replace=True, auto_rename=F
                     break
                 num += 1
         if isinstance(stream, str):
+            if use_hardlink:
+                os.makedirs(make_long_path_useable(os.path.dirname(dest)), exist_ok=True)
+                if self.hardlink_into_place(stream, dest):
+                    return os.path.relpath(dest, bookdir).replace(os.sep, '/')
             try:
                 shutil.copy2(make_long_path_useable(stream), make_long_path_useable(dest))
             except FileNotFoundError:
@@ -2423,6 +2502,62 @@ def mark_book_as_clean(self, book_id):
     def get_ids_for_custom_book_data(self, name):
         return frozenset(r[0] for r in self.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
 
+    # Change log {{{
+    def record_change_event(self, event_type, args):
+        entry = change_log_entry(event_type, args)
+        if entry is not None:
+            self.record_changes(*entry)
+
+    def record_changes(self, kind, book_ids, fields=()):
+        fields = ','.join(fields)
+        now = time.time()
+        book_ids = tuple(book_ids)
+        with self.conn.query_lock:
+            self.executemany(
+                'INSERT INTO change_log (book, kind, fields, timestamp) VALUES (?, ?, ?, ?)', ((book_id, kind, fields, now) for book_id in book_ids))
+            self.changes_since_prune += len(book_ids)
+            if self.changes_since_prune >= CHANGE_LOG_PRUNE_INTERVAL:
+                self.prune_change_log()
+
+    def last_change_seq(self):
+        with self.conn.query_lock:
+            return self.get("SELECT seq FROM sqlite_sequence WHERE name='change_log'", all=False) or 0
+
+    def changes_since(self, seq, limit=None):
+        with self.conn.query_lock:
+            latest = self.last_change_seq()
+            oldest = self.get('SELECT MIN(seq) FROM change_log', all=False) or (latest + 1)
+            if seq > latest or seq + 1 < oldest:
+                # Either seq is from some other database or the changes after it
+                # have been pruned
+                return {'latest_seq': latest, 'reset': True, 'changes': []}
+            query = 'SELECT seq, book, kind, fields, timestamp FROM change_log WHERE seq > ? ORDER BY seq'
+            if limit is not None:
+                query += f' LIMIT {int(limit)}'
+            rows = self.get(query, (seq,))
+        changes = [
+            {'seq': cseq, 'book_id': book_id, 'kind': kind, 'fields': fields.split(',') if fields else [], 'timestamp': timestamp}
+            for cseq, book_id, kind, fields, timestamp in rows]
+        return {'latest_seq': changes[-1]['seq'] if changes else seq, 'reset': False, 'changes': changes}
+
+    def schema_signature(self):
+        ''' Changes when the schema of the database or its custom columns change '''
+        return self.user_version, tuple(self.get('SELECT * FROM custom_columns ORDER BY id'))
+
+    def prune_change_log(self, before=None):
+        if before is None:
+            before = time.time() - CHANGE_LOG_RETENTION
+        with self.conn.query_lock:
+            self.execute('DELETE FROM change_log WHERE timestamp < ?', (before,))
+            self.changes_since_prune = 0
+    # }}}
+
+    def book_ids_for_annotations(self, annot_ids):
+        ans = set()
+        for annot_id in annot_ids:
+            ans |= {r[0] for r in self.execute('SELECT book FROM annotations WHERE id=?', (annot_id,))}
+        return ans
+
     def annotations_for_book(self, book_id, fmt, user_type, user):
         yield from annotations_for_book(self.conn, book_id, fmt, user_type, user)
 
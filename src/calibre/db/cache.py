@@ -13,8 +13,9 @@
 import sys
 import traceback
 import weakref
-from collections import defaultdict
+from collections import defaultdict, deque
 from collections.abc import Iterable, MutableSet, Set
+from contextlib import suppress
 from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from queue import Queue
@@ -53,6 +54,12 @@
 from calibre.utils.localization import canonicalize_lang
 from polyglot.builtins import cmp, iteritems, itervalues, string_or_bytes
 
+EMBEDDED_METADATA_DIGESTS = 'embedded_metadata_digests'
+# The number of increments of clear_search_cache_count for which the changed
+# books are remembered and the largest number of books remembered for one
+SEARCH_CACHE_CLEARS_HISTORY = 100
+MAX_SEARCH_CACHE_CLEAR_BOOKS = 1000
+
 
 class ExtraFile(NamedTuple):
     relpath: str
@@ -146,6 +153,9 @@ class Cache:
     '''
     EventType = EventType
     fts_indexing_sleep_time = 4  # seconds
+    # Set to False in processes that should not index books for full text
+    # search because some other process indexes the same libraries
+    index_fts_in_background = True
 
     def __init__(self, backend, library_database_instance=None):
         self.shutting_down = False
@@ -156,6 +166,7 @@ def __init__(self, backend, library_database_instance=None):
         self.database_instance = (weakref.ref(self) if library_database_instance is None else
                                   weakref.ref(library_database_instance))
         self.event_dispatcher = EventDispatcher()
+        self.event_dispatcher.recorder = self.backend.record_change_event
         self.fields = {}
         self.composites = {}
         self.read_lock, self.write_lock = create_locks()
@@ -169,7 +180,13 @@ def __init__(self, backend, library_database_instance=None):
         self.vls_cache_lock = Lock()
         self.dirtied_sequence = 0
         self.cover_caches = set()
-        self.clear_search_cache_count = 0
+        # clear_search_cache_count is incremented whenever search results may
+        # have changed and clear_all_search_caches_count only when the change
+        # is not limited to some books, for example, a saved search changed
+        self.clear_search_cache_count = self.clear_all_search_caches_count = 0
+        # The books whose search results may have changed, for the most recent
+        # increments of clear_search_cache_count, None for all books
+        self.search_cache_clears = deque(maxlen=SEARCH_CACHE_CLEARS_HISTORY)
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -278,11 +295,37 @@ def clear_composite_caches(self, book_ids=None):
 
     @write_api
     def clear_search_caches(self, book_ids=None):
-        self.clear_search_cache_count += 1
+        self._record_search_cache_clear(book_ids)
+        if not book_ids:
+            self.clear_all_search_caches_count += 1
         self._search_api.update_or_clear(self, book_ids)
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
 
+    def _record_search_cache_clear(self, book_ids):
+        self.clear_search_cache_count += 1
+        book_ids = frozenset(book_ids or ())
+        self.search_cache_clears.append(book_ids if 0 < len(book_ids) <= MAX_SEARCH_CACHE_CLEAR_BOOKS else None)
+
+    @read_api
+    def books_with_changed_search_results(self, clear_search_cache_count):
+        '''
+        Return the ids of the books whose search results may have changed
+        since clear_search_cache_count had the specified value, or None if
+        they are not known, for example, because the search results of all
+        books may have changed.
+        '''
+        n = self.clear_search_cache_count - clear_search_cache_count
+        if n < 0 or n > len(self.search_cache_clears):
+            return None
+        ans = set()
+        for i in range(1, n + 1):
+            book_ids = self.search_cache_clears[-i]
+            if book_ids is None:
+                return None
+            ans |= book_ids
+        return ans
+
     @write_api
     def clear_extra_files_cache(self, book_id=None):
         if book_id is None:
@@ -461,6 +504,8 @@ def init(self):
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
+        with self.write_lock:
+            self.backend.prune_change_log()
 
     # FTS API {{{
     def initialize_fts(self):
@@ -470,7 +515,7 @@ def initialize_fts(self):
         self.fts_job_queue = Queue()
         self.fts_indexing_left = self.fts_indexing_total = 0
         fts = self.backend.initialize_fts(weakref.ref(self))
-        if self.is_fts_enabled():
+        if self.is_fts_enabled() and self.index_fts_in_background:
             self.start_fts_pool()
         return fts
 
@@ -726,11 +771,42 @@ def set_notes_for(self, field, item_id, doc: str, searchable_text: str = copy_ma
         self.event_dispatcher(EventType.notes_changed, field, frozenset({item_id}))
         return ans
 
+    @write_api
+    def set_notes_in_bulk(self, field, notes_map, batch_size=1000, report_progress=None) -> dict[int, int]:
+        '''
+        Set the notes for many items in field at once. notes_map maps item ids to either the notes document or a tuple of
+        (doc, searchable_text, resource_hashes), see :meth:`set_notes_for`. The notes are committed in transactions of
+        batch_size notes. report_progress, if specified, is called with the number of notes set so far and the total.
+        Returns a dict mapping item ids to note ids.
+        '''
+        ans = {}
+        items = tuple(notes_map.items())
+        for start in range(0, len(items), batch_size):
+            with self.backend.conn:  # Disable autocommit mode, for performance
+                for item_id, val in items[start:start+batch_size]:
+                    if isinstance(val, str):
+                        val = val, copy_marked_up_text, ()
+                    ans[item_id] = self.backend.set_notes_for(field, item_id, val[0], val[1], val[2], False)
+            if report_progress is not None:
+                report_progress(len(ans), len(items))
+        if ans:
+            self.event_dispatcher(EventType.notes_changed, field, frozenset(ans))
+        return ans
+
     @write_api
     def add_notes_resource(self, path_or_stream_or_data, name: str, mtime: float = None) -> int:
         ' Add the specified resource so it can be referenced by notes and return its content hash '
         return self.backend.add_notes_resource(path_or_stream_or_data, name, mtime)
 
+    @write_api
+    def add_notes_resources(self, resources) -> tuple[str, ...]:
+        '''
+        Add many resources at once, in a single transaction. resources is an iterable of (path_or_stream_or_data, name)
+        or (path_or_stream_or_data, name, mtime) tuples. Identical resources are stored only once and the names of
+        existing resources are not changed. Returns the content hashes in the same order as resources.
+        '''
+        return self.backend.add_notes_resources(resources)
+
     @read_api
     def get_notes_resource(self, resource_hash) -> dict | None:
         ' Return a dict containing the resource data and name or None if no resource with the specified hash is found '
@@ -770,6 +846,30 @@ def import_note(self, field, item_id, path_to_html_file, path_is_data=False):
         self.event_dispatcher(EventType.notes_changed, field, frozenset({item_id}))
         return ans
 
+    @write_api
+    def import_notes(self, field, item_path_map, batch_size=1000, report_progress=None) -> dict[int, int]:
+        '''
+        Import many HTML files as notes, see :meth:`import_note`. item_path_map maps item ids to paths of HTML files. The
+        notes are committed in transactions of batch_size notes and images used by more than one note are read and stored
+        only once. report_progress, if specified, is called with the number of notes imported so far and the total.
+        Returns a dict mapping item ids to note ids.
+        '''
+        ans, resource_cache = {}, {}
+        items = tuple(item_path_map.items())
+        for start in range(0, len(items), batch_size):
+            with self.backend.conn:  # Disable autocommit mode, for performance
+                for item_id, path in items[start:start+batch_size]:
+                    with open(path, 'rb') as f:
+                        html = f.read()
+                        st = os.stat(f.fileno())
+                    ans[item_id] = self.backend.import_note(
+                        field, item_id, html, os.path.dirname(os.path.abspath(path)), st.st_ctime, st.st_mtime, resource_cache)
+            if report_progress is not None:
+                report_progress(len(ans), len(items))
+        if ans:
+            self.event_dispatcher(EventType.notes_changed, field, frozenset(ans))
+        return ans
+
     @write_api  # we need to use write locking as SQLITE gives a locked table error if multiple FTS queries are made at the same time
     def search_notes(
         self,
@@ -783,8 +883,12 @@ def search_notes(
         result_type=tuple,
         process_each_result=None,
         limit=None,
+        offset=0,
     ):
-        ' Search the text of notes using an FTS index. If the query is empty return all notes. '
+        '''
+        Search the text of notes using an FTS index. If the query is empty return all notes. Use limit and offset to
+        fetch the results a page at a time. The text, snippets and highlights are only generated for the returned page.
+        '''
         return result_type(self.backend.search_notes(
             fts_engine_query,
             use_stemming=use_stemming,
@@ -795,6 +899,7 @@ def search_notes(
             restrict_to_fields=restrict_to_fields,
             process_each_result=process_each_result,
             limit=limit,
+            offset=offset,
         ))
     # }}}
 
@@ -1554,13 +1659,18 @@ def number_of_books_in_virtual_library(self, vl=None, search_restriction=None):
 
     @api
     def get_categories(self, sort='name', book_ids=None, already_fixed=None,
-                       first_letter_sort=False, uncollapsed_categories=None):
-        ' Used internally to implement the Tag Browser '
+                       first_letter_sort=False, uncollapsed_categories=None, reuse=None):
+        '''
+        Used internally to implement the Tag Browser. reuse can be a map of
+        category to items from a previous call with the same arguments, for
+        categories that have not changed since, see
+        :func:`calibre.db.categories.categories_affected_by`.
+        '''
         try:
             with self.safe_read_lock:
                 return get_categories(self, sort=sort, book_ids=book_ids,
                                       first_letter_sort=first_letter_sort,
-                                      uncollapsed_categories=uncollapsed_categories)
+                                      uncollapsed_categories=uncollapsed_categories, reuse=reuse)
         except InvalidLinkTable as err:
             bad_field = err.field_name
             if bad_field == already_fixed:
@@ -1933,7 +2043,7 @@ def protected_set_field(name, val):
             raise
         return dirtied
 
-    def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
+    def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None, use_hardlink=False):
         path = self._field_for('path', book_id)
         if path is None:
             # Theoretically, this should never happen, but apparently it
@@ -1948,17 +2058,20 @@ def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
         except IndexError:
             author = _('Unknown')
 
-        size, fname = self.backend.add_format(book_id, fmt, stream, title, author, path, name, mtime=mtime)
+        size, fname = self.backend.add_format(book_id, fmt, stream, title, author, path, name, mtime=mtime, use_hardlink=use_hardlink)
         return size, fname
 
     @api
-    def add_format(self, book_id, fmt, stream_or_path, replace=True, run_hooks=True, dbapi=None):
+    def add_format(self, book_id, fmt, stream_or_path, replace=True, run_hooks=True, dbapi=None, use_hardlink=False):
         '''
         Add a format to the specified book. Return True if the format was added successfully.
 
         :param replace: If True replace existing format, otherwise if the format already exists, return False.
         :param run_hooks: If True, file type plugins are run on the format before and after being added.
         :param dbapi: Internal use only.
+        :param use_hardlink: If True and stream_or_path is a path on the same filesystem as the library, the format
+            file is hardlinked into the library instead of being copied. Only use this when nothing else will modify
+            the file at stream_or_path, as the data is shared.
         '''
         needs_close = False
         if run_hooks:
@@ -1992,7 +2105,7 @@ def add_format(self, book_id, fmt, stream_or_path, replace=True, run_hooks=True,
                 stream = open(make_long_path_useable(stream_or_path), 'rb')
                 needs_close = True
             try:
-                size, fname = self._do_add_format(book_id, fmt, stream, name)
+                size, fname = self._do_add_format(book_id, fmt, stream, name, use_hardlink=use_hardlink)
             finally:
                 if needs_close:
                     stream.close()
@@ -2189,7 +2302,7 @@ def create_book_entry(self, mi, cover=None, add_duplicates=True, force_id=None,
         return book_id
 
     @api
-    def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False, run_hooks=True, dbapi=None):
+    def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False, run_hooks=True, dbapi=None, use_hardlink=False):
         '''
         Add the specified books to the library. Books should be an iterable of
         2-tuples, each 2-tuple of the form :code:`(mi, format_map)` where mi is a
@@ -2199,6 +2312,8 @@ def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve
         Returns a pair of lists: :code:`ids, duplicates`. ``ids`` contains the book ids for all newly created books in the
         database. ``duplicates`` contains the :code:`(mi, format_map)` for all books that already exist in the database
         as per the simple duplicate detection heuristic used by :meth:`has_book`.
+
+        If use_hardlink is True, format files are hardlinked into the library when possible, see :meth:`add_format`.
         '''
         duplicates, ids = [], []
         for mi, format_map in books:
@@ -2209,7 +2324,7 @@ def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve
                 fmt_map = {}
                 ids.append(book_id)
                 for fmt, stream_or_path in format_map.items():
-                    if self.add_format(book_id, fmt, stream_or_path, dbapi=dbapi, run_hooks=run_hooks):
+                    if self.add_format(book_id, fmt, stream_or_path, dbapi=dbapi, run_hooks=run_hooks, use_hardlink=use_hardlink):
                         fmt_map[fmt.lower()] = getattr(stream_or_path, 'name', stream_or_path) or '<stream>'
                 run_plugins_on_postadd(dbapi or self, book_id, fmt_map)
         return ids, duplicates
@@ -2243,6 +2358,7 @@ def remove_books(self, book_ids, permanent=False):
             else:
                 table.remove_books(book_ids, self.backend)
         self._search_api.discard_books(book_ids)
+        self._record_search_cache_clear(book_ids)
         self._clear_caches(book_ids=book_ids, template_cache=False, search_cache=False)
         for cc in self.cover_caches:
             cc.invalidate(book_ids)
@@ -2408,6 +2524,74 @@ def get_ids_for_custom_book_data(self, name):
         ''' Return the set of book ids for which name has data. '''
         return self.backend.get_ids_for_custom_book_data(name)
 
+    @read_api
+    def last_change_seq(self):
+        ''' Return the sequence number of the most recent entry in the change log. '''
+        return self.backend.last_change_seq()
+
+    @read_api
+    def changes_since(self, seq=0, limit=None):
+        '''
+        Return the changes made to books in this library after the change log
+        entry with sequence number seq, as a dict with the keys: ``latest_seq``,
+        ``reset`` and ``changes``. Each change is a dict with the keys:
+        ``seq``, ``book_id``, ``kind``, ``fields`` and ``timestamp``, where
+        kind is one of ``added``, ``removed``, ``metadata``, ``formats`` or
+        ``annotations``. If ``reset`` is True the log no longer goes back as
+        far as seq, and clients must do a full re-sync. At most limit changes
+        are returned, call again with the seq of the last change to get more.
+        '''
+        return self.backend.changes_since(seq, limit)
+
+    @read_api
+    def schema_signature(self):
+        ''' A value that changes when the schema of the database or its custom columns change '''
+        return self.backend.schema_signature()
+
+    @write_api
+    def refresh_from_change_log(self, seq):
+        '''
+        Re-read the data changed since the change log entry with sequence
+        number seq, typically by another process. Only the changed fields are
+        re-read from the database. Returns the sequence number of the latest
+        change or None if the changes could not be applied, in which case the
+        library must be re-opened. Does not handle changes to the schema or
+        custom columns, see :meth:`schema_signature`.
+        '''
+        ans = self.backend.changes_since(seq)
+        if ans['reset']:
+            return
+        if not ans['changes']:
+            return ans['latest_seq']
+        book_ids, field_names, reread_all = set(), set(), False
+        for change in ans['changes']:
+            book_ids.add(change['book_id'])
+            kind = change['kind']
+            if kind == 'metadata':
+                field_names.update(change['fields'])
+                field_names.add('last_modified')
+            elif kind == 'formats':
+                field_names.update(('formats', 'size', 'last_modified'))
+            elif kind in ('added', 'removed'):
+                reread_all = True
+        if reread_all:
+            self._reload_from_db()
+            return ans['latest_seq']
+        # Changing some fields also changes others
+        related = {'title': ('sort', 'path'), 'authors': ('author_sort', 'path')}
+        for name in tuple(field_names):
+            field_names.update(related.get(name, ()))
+            field_names.add(name + '_index')
+        self._clear_caches(book_ids=book_ids)
+        with self.backend.conn:
+            self.backend.prefs.load_from_db()
+            self._search_api.saved_searches.load_from_db()
+            for name in field_names:
+                field = self.fields.get(name)
+                if field is not None and hasattr(field, 'table'):
+                    field.table.read(self.backend)
+        return ans['latest_seq']
+
     @read_api
     def conversion_options(self, book_id, fmt='PIPE'):
         return self.backend.conversion_options(book_id, fmt)
@@ -3098,6 +3282,145 @@ def doit(fmt, mi, stream):
             if report_progress is not None:
                 report_progress(i+1, len(book_ids), mi)
 
+    @api
+    def embed_metadata_in_bulk(self, book_ids, only_fmts=None, report_error=None, report_progress=None, batch_size=100, max_workers=None, skip_unchanged=True):
+        '''
+        Same as :meth:`embed_metadata` but designed for updating large numbers
+        of books. The metadata for a batch of books is read under a single read
+        lock, the files are rewritten in parallel in worker processes and the
+        new file sizes are committed in a single transaction. Formats whose
+        metadata has not changed since it was last embedded by this method are
+        skipped, unless skip_unchanged is False.
+        '''
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.utils.ipc.pool import Failure, Pool
+        if only_fmts:
+            only_fmts = {f.lower() for f in only_fmts}
+        book_ids = tuple(book_ids)
+        with self.safe_read_lock:
+            stored_digests = self._get_custom_book_data(EMBEDDED_METADATA_DIGESTS, book_ids, {})
+        pool = Pool(max_workers=max_workers, name='EmbedMetadata')
+        num_done = 0
+        try:
+            with TemporaryDirectory('embed-md') as tdir:
+                for start in range(0, len(book_ids), batch_size):
+                    batch = book_ids[start:start+batch_size]
+                    jobs = self._snapshot_for_embed(batch, only_fmts, stored_digests if skip_unchanged else {}, tdir)
+                    for book_id, job in jobs.items():
+                        pool(book_id, 'calibre.library.save_to_disk', 'embed_serialized_metadata', job['data'])
+                    while True:
+                        # Jobs that are still queued when the pool fails to start a
+                        # worker are never marked as done, so an unbounded wait would
+                        # block forever, instead wait in steps, checking for failure
+                        try:
+                            pool.wait_for_tasks(timeout=1)
+                            break
+                        except RuntimeError:
+                            if pool.failed:
+                                raise Failure(pool.terminal_failure)
+                    results = {}
+                    while not pool.results.empty():
+                        wr = pool.results.get()
+                        if wr.is_terminal_failure:
+                            raise Failure(pool.terminal_failure)
+                        results[wr.id] = wr.result
+                    self._commit_embedded_metadata(jobs, results, stored_digests, report_error)
+                    for book_id in batch:
+                        num_done += 1
+                        if report_progress is not None:
+                            report_progress(num_done, len(book_ids), jobs[book_id]['mi'] if book_id in jobs else self.get_proxy_metadata(book_id))
+                    for job in jobs.values():
+                        for fmt, src, dest in job['data']['fmts']:
+                            with suppress(OSError):
+                                os.remove(dest)
+        finally:
+            pool.shutdown()
+
+    def _snapshot_for_embed(self, book_ids, only_fmts, stored_digests, tdir):
+        jobs = {}
+        ftable = self.fields['formats'].table
+        with self.safe_read_lock:
+            for book_id in book_ids:
+                fmts = ftable.book_col_map.get(book_id, ())
+                if not fmts:
+                    continue
+                try:
+                    path = self._field_for('path', book_id).replace('/', os.sep)
+                except Exception:
+                    continue
+                mi = self._get_metadata(book_id)
+                buf = BytesIO()
+                cdata = buf.getvalue() if self._copy_cover_to(book_id, buf) else None
+                mi.cover, mi.cover_data = None, (None, None)
+                opf = metadata_to_opf(mi)
+                digest = hashlib.sha256(opf + (cdata or b'')).hexdigest()
+                stored = stored_digests.get(book_id) or {}
+                fmt_data = []
+                for fmt in fmts:
+                    if only_fmts is not None and fmt.lower() not in only_fmts:
+                        continue
+                    try:
+                        name = ftable.fname_map[book_id][fmt]
+                        fpath = self.backend.format_abspath(book_id, fmt, name, path)
+                        st = os.stat(fpath)
+                    except Exception:
+                        continue
+                    state = [digest, st.st_size, st.st_mtime_ns]
+                    if stored.get(fmt) == state:
+                        continue
+                    fmt_data.append((fmt, name, fpath, state))
+                if not fmt_data:
+                    continue
+                data = {'last_modified': mi.last_modified.isoformat(), 'opf': os.path.join(tdir, f'{book_id}.opf'), 'fmts': []}
+                with open(data['opf'], 'wb') as f:
+                    f.write(opf)
+                if cdata:
+                    data['cover'] = os.path.join(tdir, f'{book_id}.jpg')
+                    with open(data['cover'], 'wb') as f:
+                        f.write(cdata)
+                for fmt, name, fpath, state in fmt_data:
+                    data['fmts'].append((fmt, fpath, os.path.join(tdir, f'{book_id}.{fmt.lower()}')))
+                jobs[book_id] = {'mi': mi, 'data': data, 'path': path, 'states': {x[0]: x[1:] for x in fmt_data}}
+        return jobs
+
+    def _commit_embedded_metadata(self, jobs, results, stored_digests, report_error):
+        ftable = self.fields['formats'].table
+        size_map, digest_map = {}, {}
+        with self.write_lock, self.backend.conn:  # Disable autocommit mode, for performance
+            for book_id, job in jobs.items():
+                result = results.get(book_id)
+                if result is None:
+                    continue
+                if result.err is not None:
+                    if report_error is None:
+                        raise Exception(result.err + '\n' + result.traceback)
+                    report_error(job['mi'], None, result.traceback)
+                    continue
+                for fmt, src, dest in job['data']['fmts']:
+                    new_size, errors = result.value[fmt]
+                    if errors and report_error is not None:
+                        report_error(job['mi'], fmt, '\n\n'.join(errors))
+                    if new_size is None:
+                        continue
+                    name, fpath, state = job['states'][fmt]
+                    try:
+                        st = os.stat(fpath)
+                    except OSError:
+                        continue
+                    if ftable.fname_map.get(book_id, {}).get(fmt) != name or [st.st_size, st.st_mtime_ns] != state[1:]:
+                        continue  # file was changed while its metadata was being updated
+                    with open(dest, 'rb') as src, self.backend.replacing_file(fpath) as f:
+                        shutil.copyfileobj(src, f)
+                    st = os.stat(fpath)
+                    self.format_metadata_cache[book_id].get(fmt, {})['size'] = new_size
+                    size_map[book_id] = ftable.update_fmt(book_id, fmt, name, new_size, self.backend)
+                    digests = digest_map.setdefault(book_id, dict(stored_digests.get(book_id) or {}))
+                    digests[fmt] = [state[0], st.st_size, st.st_mtime_ns]
+            self.fields['size'].table.update_sizes(size_map)
+            if digest_map:
+                self.backend.add_custom_data(EMBEDDED_METADATA_DIGESTS, digest_map, False)
+                stored_digests.update(digest_map)
+
     @read_api
     def get_last_read_positions(self, book_id, fmt, user):
         fmt = fmt.upper()
@@ -3276,6 +3599,7 @@ def delete_annotations(self, annot_ids):
         '''
         Delete annotations with the specified ids.
         '''
+        self.backend.record_changes('annotations', self.backend.book_ids_for_annotations(annot_ids))
         self.backend.delete_annotations(annot_ids)
 
     @write_api
@@ -3283,6 +3607,7 @@ def update_annotations(self, annot_id_map):
         '''
         Update annotations.
         '''
+        self.backend.record_changes('annotations', self.backend.book_ids_for_annotations(annot_id_map))
         self.backend.update_annotations(annot_id_map)
 
     @write_api
@@ -3304,6 +3629,7 @@ def set_annotations_for_book(self, book_id, fmt, annots_list, user_type='local',
         Set all annotations for the specified book_id, fmt, user_type and user.
         '''
         self.backend.set_annotations_for_book(book_id, fmt, annots_list, user_type, user)
+        self.backend.record_changes('annotations', (book_id,), (fmt.upper(),))
 
     @write_api
     def merge_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
@@ -3324,6 +3650,7 @@ def merge_annotations_for_book(self, book_id, fmt, annots_list, user_type='local
     @write_api
     def save_annotations_list(self, book_id: int, book_fmt: str, sync_annots_user: str, alist: list[dict]) -> None:
         self.backend.save_annotations_list(book_id, book_fmt, sync_annots_user, alist)
+        self.backend.record_changes('annotations', (book_id,), (book_fmt.upper(),))
 
     @write_api
     def reindex_annotations(self):
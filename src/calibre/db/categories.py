@@ -90,6 +90,29 @@ def find_categories(field_metadata):
             yield (category, cat['is_multiple'].get('cache_to_list', None), True)
 
 
+def categories_affected_by(field_metadata, fields):
+    '''
+    Return the set of categories from :func:`find_categories` whose items can
+    change when the specified fields of some books are changed, or None if
+    all of them can.
+    '''
+    fields = frozenset(fields)
+    if 'rating' in fields:
+        # The average ratings of the items in every category use it
+        return None
+    ans = set()
+    for category, is_multiple, is_composite in find_categories(field_metadata):
+        # Composite columns can depend on any field and the sort value of
+        # series depends on the languages of the books
+        if is_composite or category in fields or (
+            category == 'news' and 'tags' in fields) or (
+            category == 'authors' and 'author_sort' in fields) or (
+            field_metadata[category]['datatype'] == 'series' and 'languages' in fields
+        ):
+            ans.add(category)
+    return ans
+
+
 def create_tag_class(category, fm):
     cat = fm[category]
     dt = cat['datatype']
@@ -214,7 +237,7 @@ def sort_key_for_name(x, hierarchical_categories=()):
 # dict being in the default display order: standard fields, custom in alpha order,
 # user categories, then saved searches. This works because the backend adds
 # custom columns to field metadata in the right order.
-def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False, uncollapsed_categories=None):
+def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False, uncollapsed_categories=None, reuse=None):
     if sort not in CATEGORY_SORTS:
         raise ValueError('sort ' + sort + ' not a valid value')
 
@@ -237,6 +260,10 @@ def get_metadata(book_id):
     uncollapsed_categories = () if uncollapsed_categories is None else uncollapsed_categories
 
     for category, is_multiple, is_composite in find_categories(fm):
+        if reuse is not None and category in reuse:
+            # Unchanged since a previous call with the same arguments
+            categories[category] = reuse[category]
+            continue
         fl_sort = False if category in uncollapsed_categories else bool(first_letter_sort)
         tag_class = create_tag_class(category, fm)
         sort_on, reverse = sort, False
@@ -8,7 +8,7 @@
 
 from calibre import prints
 from calibre.db.legacy import LibraryDatabase
-from calibre.library.check_library import CHECKS, CheckLibrary
+from calibre.library.check_library import CHECKS, CheckLibrary, default_manifest_path
 
 readonly = False
 version = 0  # change this if you change signature of implementation()
@@ -60,6 +60,14 @@ def option_parser(get_parser, args):
         help=_('Comma-separated list of names to ignore.\n'
                'Default: all')
     )
+    parser.add_option(
+        '-i',
+        '--incremental',
+        default=False,
+        action='store_true',
+        help=_('Remember the state of the library folders between runs and only re-read folders that have changed'
+               ' since the previous check. Much faster for large libraries that are checked regularly.')
+    )
     parser.add_option(
         '--vacuum-fts-db',
         default=False,
@@ -122,7 +130,7 @@ def main(opts, args, dbctx):
     prints(_('Vacuuming database...'))
     db.new_api.vacuum(opts.vacuum_fts_db)
     checker = CheckLibrary(dbctx.library_path, db)
-    checker.scan_library(names, exts)
+    checker.scan_library(names, exts, manifest_path=default_manifest_path(db) if opts.incremental else None)
     for check in checks:
         _print_check_library_results(checker, check, as_csv=opts.csv)
 
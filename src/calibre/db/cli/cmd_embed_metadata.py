@@ -2,17 +2,30 @@
 # License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import sys
+
 from calibre import prints
 from calibre.db.cli import integers_from_string
 from calibre.srv.changes import formats_added
 
 readonly = False
-version = 0  # change this if you change signature of implementation()
+version = 1  # change this if you change signature of implementation()
 
 
 def implementation(db, notify_changes, book_id, only_fmts):
     if book_id is None:
         return db.all_book_ids()
+    if book_id == 'all':
+        book_ids = db.all_book_ids()
+        errors = []
+
+        def report_error(mi, fmt, tb):
+            errors.append((mi.title, fmt, tb))
+
+        db.embed_metadata_in_bulk(book_ids, only_fmts=only_fmts, report_error=report_error)
+        if notify_changes is not None:
+            notify_changes(formats_added({book_id: db.formats(book_id) for book_id in book_ids}))
+        return len(book_ids), errors
     with db.write_lock:
         if db.has_id(book_id):
             db.embed_metadata((book_id,), only_fmts=only_fmts)
@@ -48,7 +61,14 @@ def main(opts, args, dbctx):
         ids |= set(integers_from_string(arg))
     only_fmts = opts.only_formats or None
     if ids is None:
-        ids = dbctx.run('embed_metadata', None, None)
+        # Update all books in parallel, skipping files that already have
+        # up-to-date metadata
+        num, errors = dbctx.run('embed_metadata', 'all', only_fmts)
+        for title, fmt, tb in errors:
+            prints(_('Failed to update metadata in {0} ({1}):').format(title, fmt or _('all formats')), file=sys.stderr)
+            prints(tb, file=sys.stderr)
+        prints(_('Processed {} books').format(num))
+        return 0
 
     def progress(i, title):
         prints(_('Processed {0} ({1} of {2})').format(title, i, len(ids)))
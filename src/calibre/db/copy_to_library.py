@@ -2,19 +2,104 @@
 # License: GPL v3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import os
+import shutil
+import tempfile
+import traceback
+from contextlib import suppress
+
+from calibre.constants import iswindows
 from calibre.db.utils import find_identical_books
 from calibre.utils.config import tweaks
 from calibre.utils.date import now
 from polyglot.builtins import iteritems
 
 
-def automerge_book(automerge_action, book_id, mi, identical_book_list, newdb, format_map, extra_file_map):
+def files_in(book_dir):
+    ans = set()
+    for dirpath, dirnames, filenames in os.walk(book_dir):
+        ans.update(os.path.relpath(os.path.join(dirpath, x), book_dir) for x in filenames)
+    return ans
+
+
+class UndoBookFiles:
+
+    '''
+    Undo the changes made to the files in the library folder of newdb when
+    adding a book fails, since rolling back the database does not undo them.
+    Must be used with the write lock held on newdb.
+    '''
+
+    def __init__(self, newdb):
+        self.newdb = newdb
+        self.existing_files, self.backups = {}, {}
+
+    def book_dir(self, book_id):
+        path = self.newdb.field_for('path', book_id)
+        if path:
+            return os.path.join(self.newdb.backend.library_path, path.replace('/', os.sep))
+
+    def merging_into(self, book_id, replaced_fmts=()):
+        ''' Call before adding files to the existing book book_id. The files of
+        the formats in replaced_fmts are backed up. '''
+        book_dir = self.book_dir(book_id)
+        if book_dir and book_dir not in self.existing_files:
+            self.existing_files[book_dir] = files_in(book_dir)
+        for fmt in replaced_fmts:
+            path = self.newdb.format_abspath(book_id, fmt)
+            if path and path not in self.backups:
+                fd, backup = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.calibre-backup')
+                os.close(fd)
+                if iswindows:
+                    # Format files are overwritten in place on Windows
+                    shutil.copy2(path, backup)
+                else:
+                    os.remove(backup)
+                    try:
+                        os.link(path, backup)
+                    except OSError:
+                        shutil.copy2(path, backup)
+                self.backups[path] = backup
+
+    def undo(self, new_book_ids):
+        ''' Remove the folders of new_book_ids and the files added to existing
+        books and restore replaced format files. Must be called before the
+        in-memory data of newdb is reloaded from the rolled back database. '''
+        for path, backup in self.backups.items():
+            os.replace(backup, path)
+        for book_id in new_book_ids:
+            book_dir = self.book_dir(book_id)
+            if book_dir:
+                shutil.rmtree(book_dir, ignore_errors=True)
+                with suppress(OSError):
+                    os.rmdir(os.path.dirname(book_dir))  # The author folder, if now empty
+        for book_dir, existing in self.existing_files.items():
+            for relpath in files_in(book_dir) - existing:
+                with suppress(OSError):
+                    os.remove(os.path.join(book_dir, relpath))
+            for dirpath, dirnames, filenames in os.walk(book_dir, topdown=False):
+                if dirpath != book_dir and not filenames and not dirnames:
+                    with suppress(OSError):
+                        os.rmdir(dirpath)
+        self.existing_files, self.backups = {}, {}
+
+    def discard(self):
+        ''' Call when the book was added successfully '''
+        for backup in self.backups.values():
+            with suppress(OSError):
+                os.remove(backup)
+        self.existing_files, self.backups = {}, {}
+
+
+def automerge_book(automerge_action, book_id, mi, identical_book_list, newdb, format_map, extra_file_map, use_hardlinks=False, undo=None):
     seen_fmts = set()
     replace = automerge_action == 'overwrite'
     for identical_book in identical_book_list:
         ib_fmts = newdb.formats(identical_book)
         if ib_fmts:
             seen_fmts |= {fmt.upper() for fmt in ib_fmts}
+        if undo is not None:
+            undo.merging_into(identical_book, {fmt.upper() for fmt in ib_fmts or ()} & set(format_map) if replace else ())
         at_least_one_format_added = False
         for fmt, path in iteritems(format_map):
             if newdb.add_format(identical_book, fmt, path, replace=replace, run_hooks=False):
@@ -34,90 +119,217 @@ def automerge_book(automerge_action, book_id, mi, identical_book_list, newdb, fo
             # all formats
             new_book_id = newdb.add_books(
                 [(mi, format_map)], add_duplicates=True, apply_import_tags=tweaks['add_new_book_tags_when_importing_books'],
-                preserve_uuid=False, run_hooks=False)[0][0]
+                preserve_uuid=False, run_hooks=False, use_hardlink=use_hardlinks)[0][0]
             if extra_file_map:
                 newdb.add_extra_files(new_book_id, extra_file_map)
             return new_book_id
 
 
-def postprocess_copy(book_id, new_book_id, new_authors, db, newdb, identical_books_data, duplicate_action):
+def read_book_data(book_id, db, preserve_date=True, copy_notes=False, resource_cache=None):
+    '''
+    Read everything needed to copy the specified book to another library. Must
+    be called with the read lock held on db.
+    '''
+    mi = db.get_metadata(book_id, get_cover=True, cover_as_data=True)
+    if not preserve_date:
+        mi.timestamp = now()
+    format_map = {}
+    for fmt in db.formats(book_id, verify_formats=False):
+        path = db.format_abspath(book_id, fmt)
+        if path:
+            format_map[fmt.upper()] = path
+    author_id_map = db.get_item_ids('authors', mi.authors)
+    adata = db.author_data({aid for aid in author_id_map.values() if aid is not None})
+    notes = {}
+    if copy_notes:
+        resource_cache = {} if resource_cache is None else resource_cache
+        for field, items in db.items_with_notes_in_book(book_id).items():
+            for item_id, item_val in items.items():
+                nd = db.notes_data_for(field, item_id)
+                if nd:
+                    for rhash in nd['resource_hashes']:
+                        if rhash not in resource_cache:
+                            resource_cache[rhash] = db.get_notes_resource(rhash)
+                    notes.setdefault(field, {})[item_val] = nd
+    return {
+        'book_id': book_id, 'mi': mi, 'format_map': format_map,
+        'extra_file_map': {ef.relpath: ef.file_path for ef in db.list_extra_files(book_id)},
+        'author_sort_map': {author: adata[aid]['sort'] for author, aid in author_id_map.items() if aid in adata},
+        'conversion_options': db.conversion_options(book_id),
+        'annotations': db.all_annotations_for_book(book_id),
+        'notes': notes, 'resource_cache': resource_cache,
+    }
+
+
+def copy_notes_for_book(book_data, newdb):
+    # Only copy notes for items that do not already have notes in the destination library
+    resource_cache = book_data['resource_cache']
+    for field, items in book_data['notes'].items():
+        if not newdb.field_supports_notes(field):
+            continue
+        for item_val, nd in items.items():
+            item_id = newdb.get_item_id(field, item_val)
+            if item_id is None or newdb.notes_for(field, item_id):
+                continue
+            resource_hashes = set()
+            for rhash in nd['resource_hashes']:
+                if newdb.get_notes_resource(rhash) is None:
+                    rdata = resource_cache.get(rhash)
+                    if rdata is None:
+                        continue
+                    rhash = newdb.add_notes_resource(rdata['data'], rdata['name'], rdata['mtime'])
+                resource_hashes.add(rhash)
+            newdb.set_notes_for(field, item_id, nd['doc'], nd['searchable_text'], resource_hashes)
+
+
+def postprocess_copy(book_data, new_book_id, new_authors, newdb, identical_books_data, duplicate_action):
     if not new_book_id:
         return
     if new_authors:
-        author_id_map = db.get_item_ids('authors', new_authors)
         sort_map = {}
-        for author, aid in iteritems(author_id_map):
-            if aid is not None:
-                adata = db.author_data((aid,)).get(aid)
-                if adata is not None:
-                    aid = newdb.get_item_id('authors', author)
-                    if aid is not None:
-                        asv = adata.get('sort')
-                        if asv:
-                            sort_map[aid] = asv
+        for author, asv in iteritems(book_data['author_sort_map']):
+            if author in new_authors and asv:
+                aid = newdb.get_item_id('authors', author)
+                if aid is not None:
+                    sort_map[aid] = asv
         if sort_map:
             newdb.set_sort_for_authors(sort_map, update_books=False)
 
-    co = db.conversion_options(book_id)
+    co = book_data['conversion_options']
     if co is not None:
         newdb.set_conversion_options({new_book_id:co})
-    annots = db.all_annotations_for_book(book_id)
+    annots = book_data['annotations']
     if annots:
         newdb.restore_annotations(new_book_id, annots)
+    if book_data['notes']:
+        copy_notes_for_book(book_data, newdb)
     if identical_books_data is not None and duplicate_action != 'add':
         newdb.update_data_for_find_identical_books(new_book_id, identical_books_data)
 
 
+def add_book_data(
+        book_data, newdb, duplicate_action='add', automerge_action='overwrite', identical_books_data=None,
+        preserve_uuid=False, use_hardlinks=False, undo=None):
+    ''' Add a book read by :func:`read_book_data` to newdb. Must be called with
+    the write lock held on newdb. undo, if specified, is an
+    :class:`UndoBookFiles` used to record the changes to existing books. '''
+    book_id, mi = book_data['book_id'], book_data['mi']
+    format_map, extra_file_map = book_data['format_map'], book_data['extra_file_map']
+    identical_book_list = set()
+    new_authors = {k for k, v in iteritems(newdb.get_item_ids('authors', mi.authors)) if v is None}
+    new_book_id = None
+    return_data = {
+            'book_id': book_id, 'title': mi.title, 'authors': mi.authors, 'author': mi.format_field('authors')[1],
+            'action': 'add', 'new_book_id': None
+    }
+    if duplicate_action != 'add':
+        # Scanning for dupes can be slow on a large library so
+        # only do it if the option is set
+        if identical_books_data is None:
+            identical_books_data = identical_books_data = newdb.data_for_find_identical_books()
+        identical_book_list = find_identical_books(mi, identical_books_data)
+        if identical_book_list:  # books with same author and nearly same title exist in newdb
+            if duplicate_action == 'add_formats_to_existing':
+                new_book_id = automerge_book(
+                    automerge_action, book_id, mi, identical_book_list, newdb, format_map, extra_file_map, use_hardlinks=use_hardlinks, undo=undo)
+                return_data['action'] = 'automerge'
+                return_data['new_book_id'] = new_book_id
+                postprocess_copy(book_data, new_book_id, new_authors, newdb, identical_books_data, duplicate_action)
+            else:
+                return_data['action'] = 'duplicate'
+            return return_data
+
+    new_book_id = newdb.add_books(
+        [(mi, format_map)], add_duplicates=True, apply_import_tags=tweaks['add_new_book_tags_when_importing_books'],
+        preserve_uuid=preserve_uuid, run_hooks=False, use_hardlink=use_hardlinks)[0][0]
+    nbp = newdb.field_for('path', new_book_id)
+    if nbp:
+        for relpath, src_path in iteritems(extra_file_map):
+            newdb.backend.add_extra_file(relpath, src_path, nbp, use_hardlink=use_hardlinks)
+    postprocess_copy(book_data, new_book_id, new_authors, newdb, identical_books_data, duplicate_action)
+    return_data['new_book_id'] = new_book_id
+    return return_data
+
+
 def copy_one_book(
         book_id, src_db, dest_db, duplicate_action='add', automerge_action='overwrite',
         preserve_date=True, identical_books_data=None, preserve_uuid=False):
     db = src_db.new_api
     newdb = dest_db.new_api
     with db.safe_read_lock, newdb.write_lock:
-        mi = db.get_metadata(book_id, get_cover=True, cover_as_data=True)
-        if not preserve_date:
-            mi.timestamp = now()
-        format_map = {}
-        fmts = list(db.formats(book_id, verify_formats=False))
-        extra_file_map = {}
-        for ef in db.list_extra_files(book_id):
-            extra_file_map[ef.relpath] = ef.file_path
-        for fmt in fmts:
-            path = db.format_abspath(book_id, fmt)
-            if path:
-                format_map[fmt.upper()] = path
-        identical_book_list = set()
-        new_authors = {k for k, v in iteritems(newdb.get_item_ids('authors', mi.authors)) if v is None}
-        new_book_id = None
-        return_data = {
-                'book_id': book_id, 'title': mi.title, 'authors': mi.authors, 'author': mi.format_field('authors')[1],
-                'action': 'add', 'new_book_id': None
-        }
-        if duplicate_action != 'add':
-            # Scanning for dupes can be slow on a large library so
-            # only do it if the option is set
-            if identical_books_data is None:
-                identical_books_data = identical_books_data = newdb.data_for_find_identical_books()
-            identical_book_list = find_identical_books(mi, identical_books_data)
-            if identical_book_list:  # books with same author and nearly same title exist in newdb
-                if duplicate_action == 'add_formats_to_existing':
-                    new_book_id = automerge_book(automerge_action, book_id, mi, identical_book_list, newdb, format_map, extra_file_map)
-                    return_data['action'] = 'automerge'
-                    return_data['new_book_id'] = new_book_id
-                    postprocess_copy(book_id, new_book_id, new_authors, db, newdb, identical_books_data, duplicate_action)
-                else:
-                    return_data['action'] = 'duplicate'
-                return return_data
-
-        new_book_id = newdb.add_books(
-            [(mi, format_map)], add_duplicates=True, apply_import_tags=tweaks['add_new_book_tags_when_importing_books'],
-            preserve_uuid=preserve_uuid, run_hooks=False)[0][0]
-        bp = db.field_for('path', book_id)
-        if bp:
-            for (relpath, src_path, stat_result) in db.backend.iter_extra_files(book_id, bp, db.fields['formats'], yield_paths=True):
-                nbp = newdb.field_for('path', new_book_id)
-                if nbp:
-                    newdb.backend.add_extra_file(relpath, src_path, nbp)
-        postprocess_copy(book_id, new_book_id, new_authors, db, newdb, identical_books_data, duplicate_action)
-        return_data['new_book_id'] = new_book_id
-        return return_data
+        book_data = read_book_data(book_id, db, preserve_date=preserve_date)
+        return add_book_data(
+            book_data, newdb, duplicate_action=duplicate_action, automerge_action=automerge_action,
+            identical_books_data=identical_books_data, preserve_uuid=preserve_uuid)
+
+
+def copy_books(
+        book_ids, src_db, dest_db, duplicate_action='add', automerge_action='overwrite',
+        preserve_date=True, identical_books_data=None, preserve_uuid=False, use_hardlinks=False,
+        copy_notes=True, report_progress=None, batch_size=50):
+    '''
+    Copy many books from src_db to dest_db. The books are copied in batches of
+    batch_size books, the data for each batch is read up front and the batch is
+    added to dest_db in a single transaction. The locks on the libraries are
+    released between batches. If copying a book fails, the changes made to
+    dest_db for that book, including the files written to its library folder,
+    are rolled back. Notes for authors, tags, etc. are copied if the item has
+    no note in dest_db.
+
+    If use_hardlinks is True, book files are hardlinked rather than copied when
+    both libraries are on the same filesystem. Since the linked files share
+    their data, only use this when the books are going to be deleted from
+    src_db afterwards, that is, when moving books.
+
+    Returns a dict mapping book ids to the same data as returned by
+    :func:`copy_one_book` and a dict mapping book ids to a traceback for books
+    that could not be copied. report_progress, if specified, is called with
+    the number of books processed so far and the book id.
+    '''
+    db = src_db.new_api
+    newdb = dest_db.new_api
+    results, failures = {}, {}
+    resource_cache = {}
+    book_ids = tuple(book_ids)
+    num_done = 0
+    undo = UndoBookFiles(newdb)
+    for start in range(0, len(book_ids), batch_size):
+        with db.safe_read_lock, newdb.write_lock:
+            # Books with larger ids than this are added by this batch, as the
+            # write lock is held
+            max_book_id = max(newdb.all_book_ids(), default=0)
+            added_book_ids = set()
+            batch = []
+            for book_id in book_ids[start:start+batch_size]:
+                try:
+                    batch.append(read_book_data(book_id, db, preserve_date=preserve_date, copy_notes=copy_notes, resource_cache=resource_cache))
+                except Exception:
+                    failures[book_id] = traceback.format_exc()
+            if duplicate_action != 'add' and identical_books_data is None:
+                identical_books_data = newdb.data_for_find_identical_books()
+            with newdb.backend.conn:  # Disable autocommit mode, for performance
+                for book_data in batch:
+                    book_id = book_data['book_id']
+                    try:
+                        with newdb.backend.conn:  # A savepoint, so that the changes for a failed book are rolled back
+                            results[book_id] = add_book_data(
+                                book_data, newdb, duplicate_action=duplicate_action, automerge_action=automerge_action,
+                                identical_books_data=identical_books_data, preserve_uuid=preserve_uuid, use_hardlinks=use_hardlinks, undo=undo)
+                    except Exception:
+                        failures[book_id] = traceback.format_exc()
+                        new_book_ids = {x for x in newdb.all_book_ids() if x > max_book_id} - added_book_ids
+                        try:
+                            undo.undo(new_book_ids)
+                        except Exception:
+                            failures[book_id] += '\n' + traceback.format_exc()
+                        # The in-memory data may no longer match the rolled back database
+                        newdb.reload_from_db()
+                        if duplicate_action != 'add':
+                            identical_books_data = newdb.data_for_find_identical_books()
+                    else:
+                        undo.discard()
+                        added_book_ids.add(results[book_id]['new_book_id'])
+                    num_done += 1
+                    if report_progress is not None:
+                        report_progress(num_done, book_id)
+    return results, failures
@@ -50,6 +50,26 @@ class EventType(Enum):
     links_changed = auto()
 
 
+def change_log_entry(event_type, args):
+    '''
+    Return the (kind, book_ids, fields) recorded in the change log for the
+    specified event or None if the event does not change any books.
+    '''
+    if event_type is EventType.metadata_changed:
+        return 'metadata', args[1], (args[0],)
+    if event_type in (EventType.items_renamed, EventType.items_removed):
+        # items_removed is dispatched with the field object rather than its name
+        return 'metadata', args[1], (getattr(args[0], 'name', args[0]),)
+    if event_type in (EventType.format_added, EventType.book_edited):
+        return 'formats', (args[0],), (args[1],)
+    if event_type is EventType.formats_removed:
+        return 'formats', args[0], ()
+    if event_type is EventType.book_created:
+        return 'added', (args[0],), ()
+    if event_type is EventType.books_removed:
+        return 'removed', args[0], ()
+
+
 class EventDispatcher(Thread):
 
     def __init__(self):
@@ -58,6 +78,9 @@ def __init__(self):
         self.queue = Queue()
         self.activated = False
         self.library_id = ''
+        # Called synchronously, in the thread that generated the event, with
+        # (event_type, args) for every event
+        self.recorder = None
 
     def add_listener(self, callback):
         # note that we intentionally leak dead weakrefs. To not do so would
@@ -81,6 +104,8 @@ def __contains__(self, callback):
         return ref in self.refs
 
     def __call__(self, event_name, *args):
+        if self.recorder is not None:
+            self.recorder(event_name, args)
         if self.activated:
             self.queue.put((event_name, self.library_id, args))
 
@@ -11,6 +11,8 @@
 from contextlib import contextmanager
 from threading import Condition, Lock, current_thread
 
+from calibre.utils.monotonic import monotonic
+
 
 @contextmanager
 def try_lock(lock):
@@ -89,6 +91,10 @@ def __init__(self):
         self._exclusive_queue = []
         # This is for recycling waiter objects.
         self._free_waiters = []
+        # The number of times threads had to wait for the lock and the total
+        # time they waited, only the slow path is timed
+        self.shared_waits = self.exclusive_waits = 0
+        self.shared_wait_time = self.exclusive_wait_time = 0.0
 
     def acquire(self, blocking=True, shared=False):
         '''
@@ -109,6 +115,16 @@ def owns_lock(self):
         with self._lock:
             return self._exclusive_owner is me or me in self._shared_owners
 
+    def wait_stats(self):
+        ''' Return the number of times threads had to wait to acquire the lock
+        and the total time they waited in seconds, for shared and exclusive
+        acquisitions. '''
+        with self._lock:
+            return {
+                'shared': (self.shared_waits, self.shared_wait_time),
+                'exclusive': (self.exclusive_waits, self.exclusive_wait_time),
+            }
+
     def release(self):
         ''' Release the lock. '''
         # This decrements the appropriate lock counters, and if the lock
@@ -173,12 +189,15 @@ def _acquire_shared(self, blocking=True):
             if not blocking:
                 return False
             waiter = self._take_waiter()
+            start = monotonic()
             try:
                 self._shared_queue.append((me, waiter))
                 waiter.wait()
                 assert not self.is_exclusive
             finally:
                 self._return_waiter(waiter)
+                self.shared_waits += 1
+                self.shared_wait_time += monotonic() - start
         else:
             self.is_shared += 1
             self._shared_owners[me] = 1
@@ -200,11 +219,14 @@ def _acquire_exclusive(self, blocking=True):
             if not blocking:
                 return False
             waiter = self._take_waiter()
+            start = monotonic()
             try:
                 self._exclusive_queue.append((me, waiter))
                 waiter.wait()
             finally:
                 self._return_waiter(waiter)
+                self.exclusive_waits += 1
+                self.exclusive_wait_time += monotonic() - start
         else:
             self._exclusive_owner = me
             self.is_exclusive += 1
@@ -240,6 +262,9 @@ def release(self, *args):
     def owns_lock(self):
         return self._shlock.owns_lock()
 
+    def wait_stats(self):
+        return self._shlock.wait_stats()
+
 
 class DebugRWLockWrapper(RWLockWrapper):
 
@@ -34,6 +34,8 @@ class cmt(str):
 SEP = b'\0\x1c\0'
 DOC_NAME = 'doc.html'
 METADATA_EXT = '.metadata'
+# Number of search results for which text is fetched in a single query
+TEXT_CHUNK_SIZE = 64
 
 
 def hash_data(data: bytes) -> str:
@@ -44,6 +46,15 @@ def hash_key(key: str) -> str:
     return xxhash.xxh3_64_hexdigest(key.encode('utf-8'))
 
 
+def read_resource_data(path_or_stream_or_data) -> bytes:
+    if isinstance(path_or_stream_or_data, bytes):
+        return path_or_stream_or_data
+    if isinstance(path_or_stream_or_data, str):
+        with open(path_or_stream_or_data, 'rb') as f:
+            return f.read()
+    return path_or_stream_or_data.read()
+
+
 def remove_with_retry(x, is_dir=False):
     x = make_long_path_useable(x)
     f = (shutil.rmtree if is_dir else os.remove)
@@ -312,14 +323,37 @@ def key(path):
                 remove_with_retry(path, is_dir=True)
 
     def add_resource(self, conn, path_or_stream_or_data, name, update_name=True, mtime=None):
-        if isinstance(path_or_stream_or_data, bytes):
-            data = path_or_stream_or_data
-        elif isinstance(path_or_stream_or_data, str):
-            with open(path_or_stream_or_data, 'rb') as f:
-                data = f.read()
-        else:
-            data = path_or_stream_or_data.read()
+        data = read_resource_data(path_or_stream_or_data)
         resource_hash = hash_data(data)
+        self.store_resource(conn, resource_hash, data, name, update_name, mtime)
+        return resource_hash
+
+    def add_resources(self, conn, resources, update_name=False):
+        # Hash everything first so that identical resources are written only
+        # once and the existing resources can be found with a single query
+        ans, pending = [], {}
+        for r in resources:
+            data = read_resource_data(r[0])
+            resource_hash = hash_data(data)
+            ans.append(resource_hash)
+            if resource_hash not in pending:
+                pending[resource_hash] = data, r[1], (r[2] if len(r) > 2 else None)
+        existing = set()
+        hashes = tuple(pending)
+        for i in range(0, len(hashes), 512):
+            chunk = hashes[i:i+512]
+            existing |= {h for (h,) in conn.execute(
+                'SELECT hash FROM notes_db.resources WHERE hash IN ({})'.format(','.join(repeat('?', len(chunk)))), chunk)}
+        with conn:
+            for resource_hash, (data, name, mtime) in pending.items():
+                if resource_hash in existing and not update_name:
+                    with suppress(OSError):
+                        if os.stat(make_long_path_useable(self.path_for_resource(resource_hash))).st_size == len(data):
+                            continue
+                self.store_resource(conn, resource_hash, data, name, update_name, mtime)
+        return tuple(ans)
+
+    def store_resource(self, conn, resource_hash, data, name, update_name=True, mtime=None):
         path = self.path_for_resource(resource_hash)
         path = make_long_path_useable(path)
         exists = False
@@ -365,7 +399,6 @@ def add_resource(self, conn, path_or_stream_or_data, name, update_name=True, mti
                 except apsw.ConstraintError:
                     c += 1
                     name = f'{base_name}-{c}{ext}'
-        return resource_hash
 
     def get_resource_data(self, conn, resource_hash) -> dict | None:
         ans = None
@@ -379,7 +412,9 @@ def get_resource_data(self, conn, resource_hash) -> dict | None:
                 break
         return ans
 
-    def all_notes(self, conn, restrict_to_fields=(), limit=None, snippet_size=64, return_text=True, process_each_result=None) -> list[dict]:
+    def all_notes(
+        self, conn, restrict_to_fields=(), limit=None, snippet_size=64, return_text=True, process_each_result=None, offset=0
+    ) -> list[dict]:
         if snippet_size is None:
             snippet_size = 64
         char_size = snippet_size * 8
@@ -387,8 +422,8 @@ def all_notes(self, conn, restrict_to_fields=(), limit=None, snippet_size=64, re
         if restrict_to_fields:
             query += ' WHERE notes_db.notes.colname IN ({})'.format(','.join(repeat('?', len(restrict_to_fields))))
         query += ' ORDER BY mtime DESC'
-        if limit is not None:
-            query += f' LIMIT {limit}'
+        if limit is not None or offset:
+            query += f' LIMIT {-1 if limit is None else int(limit)} OFFSET {int(offset)}'
         for record in conn.execute(query, tuple(restrict_to_fields)):
             result = {
                 'id': record[0],
@@ -402,50 +437,60 @@ def all_notes(self, conn, restrict_to_fields=(), limit=None, snippet_size=64, re
             if ret is True:
                 break
 
+    def text_for_matches(self, conn, fts_table, fts_engine_query, note_ids, highlight_start, highlight_end, snippet_size):
+        ids = ','.join(repeat('?', len(note_ids)))
+        if highlight_start is None or highlight_end is None:
+            return dict(conn.execute(f'SELECT id, searchable_text FROM notes_db.notes WHERE id IN ({ids})', tuple(note_ids)))
+        if snippet_size is not None:
+            text = f'''snippet("{fts_table}", 0, ?, ?, '…', {max(1, min(snippet_size, 64))})'''
+        else:
+            text = f'''highlight("{fts_table}", 0, ?, ?)'''
+        return dict(conn.execute(
+            f'SELECT rowid, {text} FROM "{fts_table}" WHERE "{fts_table}" MATCH ? AND rowid IN ({ids})',
+            (highlight_start, highlight_end, fts_engine_query) + tuple(note_ids)))
+
     def search(self,
         conn, fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_fields=(),
-        return_text=True, process_each_result=None, limit=None
+        return_text=True, process_each_result=None, limit=None, offset=0
     ):
         if not fts_engine_query:
             yield from self.all_notes(
-                conn, restrict_to_fields, limit=limit, snippet_size=snippet_size, return_text=return_text, process_each_result=process_each_result)
+                conn, restrict_to_fields, limit=limit, snippet_size=snippet_size, return_text=return_text,
+                process_each_result=process_each_result, offset=offset)
             return
         fts_engine_query = unicode_normalize(fts_engine_query)
         fts_table = 'notes_fts' + ('_stemmed' if use_stemming else '')
-        hl_data = ()
-        if return_text:
-            text = 'notes.searchable_text'
-            if highlight_start is not None and highlight_end is not None:
-                if snippet_size is not None:
-                    text = f'''snippet("{fts_table}", 0, ?, ?, '…', {max(1, min(snippet_size, 64))})'''
-                else:
-                    text = f'''highlight("{fts_table}", 0, ?, ?)'''
-                hl_data = (highlight_start, highlight_end)
-            text = ', ' + text
-        else:
-            text = ''
-        query = 'SELECT {0}.id, {0}.colname, {0}.item {1} FROM {0} '.format('notes', text)
+        query = 'SELECT {0}.id, {0}.colname, {0}.item FROM {0} '.format('notes')
         query += f' JOIN {fts_table} ON notes_db.notes.id = {fts_table}.rowid'
         query += ' WHERE '
         if restrict_to_fields:
             query += ' notes_db.notes.colname IN ({}) AND '.format(','.join(repeat('?', len(restrict_to_fields))))
         query += f' "{fts_table}" MATCH ?'
         query += f' ORDER BY {fts_table}.rank '
-        if limit is not None:
-            query += f' LIMIT {limit}'
+        if limit is not None or offset:
+            query += f' LIMIT {-1 if limit is None else int(limit)} OFFSET {int(offset)}'
+        # Find the matches first and then generate the text, which for
+        # snippets and highlights is expensive, only for the results that are
+        # actually consumed, a chunk at a time.
         try:
-            for record in conn.execute(query, hl_data + restrict_to_fields + (fts_engine_query,)):
-                result = {
-                    'id': record[0],
-                    'field': record[1],
-                    'item_id': record[2],
-                    'text': record[3] if return_text else '',
-                }
-                if process_each_result is not None:
-                    result = process_each_result(result)
-                ret = yield result
-                if ret is True:
-                    break
+            matches = tuple(conn.execute(query, tuple(restrict_to_fields) + (fts_engine_query,)))
+            for i in range(0, len(matches), TEXT_CHUNK_SIZE):
+                chunk = matches[i:i+TEXT_CHUNK_SIZE]
+                texts = self.text_for_matches(
+                    conn, fts_table, fts_engine_query, tuple(r[0] for r in chunk), highlight_start, highlight_end, snippet_size
+                ) if return_text else {}
+                for record in chunk:
+                    result = {
+                        'id': record[0],
+                        'field': record[1],
+                        'item_id': record[2],
+                        'text': texts.get(record[0], ''),
+                    }
+                    if process_each_result is not None:
+                        result = process_each_result(result)
+                    ret = yield result
+                    if ret is True:
+                        return
         except apsw.SQLError as e:
             raise FTSQueryError(fts_engine_query, query, e) from e
 
@@ -544,10 +589,17 @@ def get_resource(rhash):
             return self.get_resource_data(conn, rhash)
         return export_note(nd['doc'], get_resource)
 
-    def import_note(self, conn, field_name, item_id, item_value, html, basedir, ctime=None, mtime=None):
+    def import_note(self, conn, field_name, item_id, item_value, html, basedir, ctime=None, mtime=None, resource_cache=None):
         from .exim import import_note
         def add_resource(path_or_stream_or_data, name):
-            return self.add_resource(conn, path_or_stream_or_data, name)
+            # resource_cache maps file paths to hashes so that images shared by
+            # many imported notes are only read and stored once
+            if resource_cache is None or not isinstance(path_or_stream_or_data, str):
+                return self.add_resource(conn, path_or_stream_or_data, name)
+            ans = resource_cache.get(path_or_stream_or_data)
+            if ans is None:
+                ans = resource_cache[path_or_stream_or_data] = self.add_resource(conn, path_or_stream_or_data, name)
+            return ans
         doc, searchable_text, resources = import_note(html, basedir, add_resource)
         return self.set_note(
             conn, field_name, item_id, item_value, marked_up_text=doc, used_resource_hashes=resources, searchable_text=searchable_text,
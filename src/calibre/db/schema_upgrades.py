@@ -818,3 +818,17 @@ def upgrade_version_25(self):
         alters.append("ALTER TABLE languages ADD COLUMN link TEXT NOT NULL DEFAULT '';")
         alters.append("ALTER TABLE ratings ADD COLUMN link TEXT NOT NULL DEFAULT '';")
         self.db.execute('\n'.join(alters))
+
+    def upgrade_version_26(self):
+        ''' Create the change_log table '''
+        self.db.execute('''
+DROP TABLE IF EXISTS change_log;
+CREATE TABLE change_log ( seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    book INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    fields TEXT NOT NULL DEFAULT '',
+    timestamp REAL NOT NULL
+);
+DROP INDEX IF EXISTS change_log_idx;
+CREATE INDEX change_log_idx ON change_log (timestamp);
+''')
@@ -12,6 +12,7 @@
 from io import BytesIO
 from tempfile import NamedTemporaryFile
 
+from calibre.constants import iswindows
 from calibre.db.constants import METADATA_FILE_NAME
 from calibre.db.tests.base import IMG, BaseTest
 from calibre.ptempfile import PersistentTemporaryFile
@@ -49,7 +50,18 @@ def test_add_format(self):  # {{{
 
         # Test that replace=True works
         lm = cache.field_for('last_modified', 1)
-        at(cache.add_format(1, 'FMT1', BytesIO(NF), replace=True))
+        path = cache.format_abspath(1, 'FMT1')
+        if not iswindows:
+            # Temporary files left behind by a crash are removed
+            open(path + '.calibre-tmp', 'wb').close()
+            os.chmod(path, 0o640)
+        with open(path, 'rb') as f:
+            at(cache.add_format(1, 'FMT1', BytesIO(NF), replace=True))
+            if not iswindows:
+                # The file is replaced rather than changed, so readers are not affected
+                ae(previous, f.read())
+                af([x for x in os.listdir(os.path.dirname(path)) if x.endswith('.calibre-tmp')])
+                ae(os.stat(path).st_mode & 0o777, 0o640)
         ae(NF, cache.format(1, 'FMT1'))
         ae(cache.format_metadata(1, 'FMT1')['size'], len(NF))
         at(cache.field_for('size', 1) >= len(NF))
@@ -464,6 +476,74 @@ def clear_extra_files(book_id):
 
     # }}}
 
+    def test_copy_books(self):  # {{{
+        from calibre.db.copy_to_library import copy_books
+        from calibre.utils.filenames import nlinks_file
+        src_db = self.init_cache()
+        dest_db = self.init_cache(self.cloned_library)
+        src_db.set_annotations_for_book(1, 'FMT1', [({'type': 'bookmark', 'title': 'bm', 'seq': 1, 'timestamp': '2020-01-01T00:00:00+00:00'}, 1.)])
+        aid = src_db.get_item_id('authors', src_db.field_for('authors', 1)[0])
+        h = src_db.add_notes_resource(b'resource', 'r.jpg')
+        src_db.set_notes_for('authors', aid, 'note with resource', resource_hashes=(h,))
+        bookdir = os.path.dirname(src_db.format_abspath(1, '__COVER_INTERNAL__'))
+        with open(os.path.join(bookdir, 'exf'), 'w') as f:
+            f.write('exf')
+        progress = []
+        results, failures = copy_books(
+            (1, 2), src_db, dest_db, use_hardlinks=True, report_progress=lambda i, book_id: progress.append((i, book_id)))
+        self.assertFalse(failures)
+        self.assertEqual(progress, [(1, 1), (2, 2)])
+        new_book_id = results[1]['new_book_id']
+        self.assertEqual(src_db.format(1, 'FMT1'), dest_db.format(new_book_id, 'FMT1'))
+        self.assertEqual(src_db.all_annotations_for_book(1), dest_db.all_annotations_for_book(new_book_id))
+        self.assertEqual(2, nlinks_file(dest_db.format_abspath(new_book_id, 'FMT1')))
+        self.assertEqual({'exf'}, {ef.relpath for ef in dest_db.list_extra_files(new_book_id)})
+        naid = dest_db.get_item_id('authors', src_db.field_for('authors', 1)[0])
+        self.assertEqual(dest_db.notes_for('authors', naid), 'note with resource')
+        self.assertEqual(dest_db.get_notes_resource(h)['data'], b'resource')
+
+        results, failures = copy_books((1,), src_db, dest_db)
+        self.assertFalse(failures)
+        self.assertEqual(1, nlinks_file(dest_db.format_abspath(results[1]['new_book_id'], 'FMT1')))
+
+        # The changes for a book that fails to copy are rolled back
+        from unittest.mock import patch
+
+        from calibre.db import copy_to_library
+        orig = copy_to_library.postprocess_copy
+
+        def postprocess_copy(book_data, *a):
+            if book_data['book_id'] == 2:
+                raise ValueError('failed')
+            return orig(book_data, *a)
+        def book_dirs():
+            lp = dest_db.backend.library_path
+            return {os.path.join(a, t) for a in os.listdir(lp) if os.path.isdir(os.path.join(lp, a)) for t in os.listdir(os.path.join(lp, a))}
+        before, before_dirs = dest_db.all_book_ids(), book_dirs()
+        with patch.object(copy_to_library, 'postprocess_copy', postprocess_copy):
+            results, failures = copy_books((1, 2), src_db, dest_db, batch_size=1)
+        self.assertEqual(set(results), {1}), self.assertEqual(set(failures), {2})
+        self.assertEqual(dest_db.all_book_ids(), before | {results[1]['new_book_id']})
+        self.assertEqual(len(dest_db.all_book_ids()), dest_db.backend.execute('SELECT COUNT(*) FROM books').fetchone()[0])
+        # The folder of the book that failed to copy is removed
+        self.assertEqual(book_dirs(), before_dirs | {dest_db.field_for('path', results[1]['new_book_id']).replace('/', os.sep)})
+        # Files merged into existing books are removed or restored
+        def files_of(book_id):
+            bdir = os.path.join(dest_db.backend.library_path, dest_db.field_for('path', book_id).replace('/', os.sep))
+            ans = {}
+            for dirpath, dirnames, filenames in os.walk(bdir):
+                for x in filenames:
+                    with open(os.path.join(dirpath, x), 'rb') as f:
+                        ans[os.path.relpath(os.path.join(dirpath, x), bdir)] = f.read()
+            return ans
+        before_files, before_dirs = files_of(2), book_dirs()
+        with patch.object(copy_to_library, 'postprocess_copy', postprocess_copy):
+            results, failures = copy_books((2,), src_db, dest_db, duplicate_action='add_formats_to_existing')
+        self.assertEqual(set(failures), {2})
+        self.assertEqual(files_of(2), before_files)
+        self.assertEqual(book_dirs(), before_dirs)
+    # }}}
+
     def test_merging_extra_files(self):  # {{{
         db = self.init_cache()
 
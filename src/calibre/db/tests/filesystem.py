@@ -160,6 +160,37 @@ def relpaths():
         self.assertEqual(cache.rename_extra_files(1, {'B': 'data/c'}), set())
         self.assertEqual(cache.rename_extra_files(1, {'B': 'data/c'}, replace=True), {'B'})
 
+    def test_check_library_incremental(self):
+        'Test that incremental library checks give the same results as full checks'
+        from calibre.library.check_library import CHECKS, CheckLibrary
+        cl = self.cloned_library
+        db = self.init_legacy(cl)
+        manifest = os.path.join(self.mkdtemp(), 'manifest.json')
+        old = time.time() - 100
+        for dirpath, dirnames, filenames in os.walk(cl):
+            os.utime(dirpath, (old, old))
+
+        def check(manifest_path=None):
+            c = CheckLibrary(cl, db)
+            c.scan_library([], [], manifest_path=manifest_path)
+            return c, {x[0]: sorted(getattr(c, x[0])) for x in CHECKS}
+
+        c, results = check(manifest)
+        self.assertEqual(c.manifest.hits, 0)
+        first_misses = c.manifest.misses
+        self.assertEqual(results, check()[1])
+        c, results = check(manifest)
+        self.assertEqual((c.manifest.hits, c.manifest.misses), (first_misses, 0))
+        self.assertEqual(results, check()[1])
+        bdir = os.path.dirname(db.new_api.format_abspath(1, 'FMT1'))
+        with open(os.path.join(bdir, 'unknown.xyz'), 'wb') as f:
+            f.write(b'xyz')
+        c, results = check(manifest)
+        self.assertEqual(c.manifest.misses, 1)
+        self.assertEqual(results, check()[1])
+        self.assertIn('unknown.xyz', {os.path.basename(x[1]) for x in results['extra_files']})
+        db.close()
+
     @unittest.skipUnless(iswindows, 'Windows only')
     def test_windows_atomic_move(self):
         'Test book file open in another process when changing metadata'
@@ -135,10 +135,14 @@ def get_lock(shared):
         self.assertTrue(lock.acquire(shared=True, blocking=False))
         lock.release()
         self.assertFalse(lock.acquire(shared=False, blocking=False))
+        self.assertEqual(lock.wait_stats()['exclusive'], (0, 0))
         lock.acquire(shared=False)
         shared.join(1)
         self.assertFalse(shared.is_alive())
         lock.release()
+        waits, wait_time = lock.wait_stats()['exclusive']
+        self.assertEqual(waits, 1)
+        self.assertGreater(wait_time, 0.5)
         self.assertTrue(lock.acquire(shared=False, blocking=False))
         lock.release()
 
@@ -152,6 +156,7 @@ def get_lock(shared):
         exclusive.join(1)
         self.assertFalse(exclusive.is_alive())
         lock.release()
+        self.assertEqual(lock.wait_stats()['shared'][0], 1)
         lock.acquire(shared=False)
         lock.release()
         lock.acquire(shared=True)
@@ -194,6 +194,50 @@ def ids_for_search(x, restrict_to_fields=()):
     an = cache.get_item_name('authors', authors[0])
     self.ae(ids_for_search(' AND '.join(an.split()), ('authors',)), {('authors', authors[0])})
 
+    # test pagination and snippets
+    all_results = cache.search_notes('common', highlight_start='[', highlight_end=']', snippet_size=4)
+    self.ae(len(all_results), 4)
+    for r in all_results:
+        self.assertIn('[common]', r['text'])
+    pages = sum((cache.search_notes('common', highlight_start='[', highlight_end=']', snippet_size=4, limit=3, offset=o) for o in (0, 3)), ())
+    self.ae(pages, all_results)
+    self.ae(cache.search_notes('', limit=2, offset=1), cache.search_notes('')[1:3])
+    self.ae({r['text'] for r in cache.search_notes('wunderbar')}, {cache.notes_data_for('authors', authors[0])['searchable_text']})
+
+
+def test_bulk_import(self: 'NotesTest'):
+    cache, notes = self.create_notes_db()
+    authors = sorted(cache.all_field_ids('authors'))
+    h1, h2, h3 = cache.add_notes_resources(((b'resource1', 'r1.jpg'), (b'resource2', 'r2.jpg'), (b'resource1', 'r3.jpg')))
+    self.ae(h1, h3)
+    self.ae(cache.get_notes_resource(h1)['name'], 'r1.jpg')
+    self.ae(cache.get_notes_resource(h2)['data'], b'resource2')
+    self.ae(cache.add_notes_resources(((b'resource2', 'other.jpg'),)), (h2,))
+    self.ae(cache.get_notes_resource(h2)['name'], 'r2.jpg')
+    progress = []
+    ans = cache.set_notes_in_bulk('authors', {
+        authors[0]: 'note one', authors[1]: ('note two', 'searchable two', (h1, h2))}, batch_size=1, report_progress=lambda *a: progress.append(a))
+    self.ae(progress, [(1, 2), (2, 2)])
+    self.ae(set(ans), {authors[0], authors[1]})
+    self.ae(cache.notes_for('authors', authors[0]), 'note one')
+    self.ae(cache.notes_resources_used_by('authors', authors[1]), frozenset({h1, h2}))
+
+    tdir = tempfile.mkdtemp()
+    with open(os.path.join(tdir, 'shared.png'), 'wb') as f:
+        f.write(b'shared image')
+    item_path_map = {}
+    for i, item_id in enumerate(sorted(cache.all_field_ids('tags'))):
+        item_path_map[item_id] = path = os.path.join(tdir, f'{i}.html')
+        with open(path, 'w') as f:
+            f.write(f'<p>imported note {i} <img src="shared.png"></p>')
+    ans = cache.import_notes('tags', item_path_map)
+    self.ae(set(ans), set(item_path_map))
+    used = {cache.notes_resources_used_by('tags', item_id) for item_id in item_path_map}
+    self.ae(len(used), 1)
+    self.ae(cache.get_notes_resource(next(iter(used.pop())))['data'], b'shared image')
+    self.ae(len(cache.search_notes('imported', restrict_to_fields=('tags',))), len(item_path_map))
+    shutil.rmtree(tdir)
+
 
 class NotesTest(BaseTest):
 
@@ -206,5 +250,6 @@ def create_notes_db(self):
 
     def test_notes(self):
         test_fts(self)
+        test_bulk_import(self)
         test_cache_api(self)
         test_notes_api(self)
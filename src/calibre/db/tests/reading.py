@@ -955,3 +955,25 @@ def evaluate(book, ctx):
         unload_user_template_functions('aaaaa')
         self.assertEqual(set(v.split(',')), {'Tag One', 'News', 'Tag Two', 'one argument'})
     # }}}
+
+    def test_concurrent_queries(self):  # {{{
+        'Test querying the change log in many threads at once, as the read lock allows'
+        from threading import Thread
+        cache = self.init_cache()
+        backend = cache.backend
+        backend.record_changes('x', range(2000))
+        expected = cache.changes_since(0)
+        errors = []
+
+        def run():
+            try:
+                for i in range(20):
+                    self.assertEqual(cache.changes_since(0), expected)
+                    self.assertEqual(cache.last_change_seq(), expected['latest_seq'])
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=run) for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertFalse(errors)
+    # }}}
@@ -1050,3 +1050,79 @@ def test_link_maps(self):
         self.assertEqual({}, cache.get_link_map('publisher'), 'links on publisher were not deleted')
         self.assertEqual({}, cache.get_all_link_maps_for_book(1), 'Not all links for book were deleted')
     # }}}
+
+    def test_embed_metadata_in_bulk(self):  # {{{
+        'Test updating metadata in book files in parallel'
+        from calibre.db.cache import EMBEDDED_METADATA_DIGESTS
+        cache = self.init_cache(self.cloned_library)
+        errors, progress = [], []
+        book_ids = cache.all_book_ids()
+
+        def embed():
+            cache.embed_metadata_in_bulk(
+                book_ids, report_error=lambda *a: errors.append(a), report_progress=lambda i, total, mi: progress.append(i), batch_size=2)
+
+        def states():
+            return {fmt: os.stat(cache.format_abspath(1, fmt)).st_mtime_ns for fmt in cache.formats(1)}
+
+        embed()
+        self.assertFalse(errors)
+        self.assertEqual(progress, list(range(1, len(book_ids) + 1)))
+        digests = cache.get_custom_book_data(EMBEDDED_METADATA_DIGESTS)
+        self.assertEqual(set(digests), {1, 2})
+        self.assertEqual(set(digests[1]), {'FMT1', 'FMT2'})
+        before = states()
+        # Nothing has changed so no files should be re-written
+        embed()
+        self.assertEqual(before, states())
+        self.assertEqual(digests, cache.get_custom_book_data(EMBEDDED_METADATA_DIGESTS))
+        cache.set_field('title', {1: 'changed title'})
+        embed()
+        self.assertNotEqual(digests[1], cache.get_custom_book_data(EMBEDDED_METADATA_DIGESTS)[1])
+        self.assertEqual(digests[2], cache.get_custom_book_data(EMBEDDED_METADATA_DIGESTS)[2])
+        # Books without covers have their metadata embedded as well
+        digests = cache.get_custom_book_data(EMBEDDED_METADATA_DIGESTS)
+        cache.set_cover({2: None})
+        cache.set_field('title', {2: 'changed title'})
+        embed()
+        self.assertFalse(errors)
+        self.assertNotEqual(digests[2], cache.get_custom_book_data(EMBEDDED_METADATA_DIGESTS)[2])
+    # }}}
+
+    def test_change_log(self):  # {{{
+        'Test the change log used for incremental syncing'
+        import time
+        cache = self.init_cache(self.cloned_library)
+        start = cache.last_change_seq()
+        self.assertEqual(cache.changes_since(start), {'latest_seq': start, 'reset': False, 'changes': []})
+
+        def kinds(seq):
+            return [(c['book_id'], c['kind'], c['fields']) for c in cache.changes_since(seq)['changes']]
+
+        cache.set_field('title', {1: 'changed title'})
+        cache.add_format(2, 'NEWFMT', BytesIO(b'xxx'), run_hooks=False)
+        cache.set_annotations_for_book(1, 'epub', [({'title': 'x', 'type': 'bookmark', 'timestamp': '2020-01-01T00:00:00+00:00'}, 1)])
+        cache.remove_books((3,))
+        changes = kinds(start)
+        self.assertIn((1, 'metadata', ['title']), changes)
+        self.assertIn((2, 'formats', ['NEWFMT']), changes)
+        self.assertIn((1, 'annotations', ['EPUB']), changes)
+        self.assertEqual(changes[-1], (3, 'removed', []))
+        ans = cache.changes_since(start, limit=1)
+        self.assertEqual(len(ans['changes']), 1)
+        self.assertEqual(kinds(ans['latest_seq']), changes[1:])
+        latest = cache.last_change_seq()
+        self.assertEqual(kinds(latest), [])
+        # Unknown sequence numbers or pruned changes require a full re-sync
+        self.assertTrue(cache.changes_since(latest + 10)['reset'])
+        cache.backend.prune_change_log(time.time() + 1)
+        self.assertTrue(cache.changes_since(start)['reset'])
+        self.assertFalse(cache.changes_since(latest)['reset'])
+        # Expired changes are pruned as new ones are recorded
+        from unittest.mock import patch
+        cache.set_field('title', {1: 'expired'})
+        cache.backend.execute('UPDATE change_log SET timestamp=0')
+        with patch('calibre.db.backend.CHANGE_LOG_PRUNE_INTERVAL', 2):
+            cache.set_field('title', {1: 'a', 2: 'b'})
+        self.assertEqual(cache.backend.get('SELECT COUNT(*) FROM change_log', all=False), 2)
+    # }}}
@@ -290,9 +290,12 @@ def serialize_cover_data(new_cdata, cpath):
     return save_cover_data_to(new_cdata, data_fmt=os.path.splitext(cpath)[1][1:])
 
 
-def set_metadata(stream, mi, apply_null=False, update_timestamp=False, force_identifiers=False, add_missing_cover=True, ftype='epub'):
-    stream.seek(0)
-    reader = get_zip_reader(stream, root=os.getcwd())
+def metadata_replacements(reader, mi, apply_null=False, update_timestamp=False, force_identifiers=False, add_missing_cover=True, ftype='epub'):
+    '''
+    Return the new contents of the OPF and a map of the names of any other
+    files in the EPUB opened by reader that must be replaced (or added) to
+    their new contents, to set the metadata to mi.
+    '''
     new_cdata = None
     try:
         new_cdata = mi.cover_data[1]
@@ -309,7 +312,6 @@ def set_metadata(stream, mi, apply_null=False, update_timestamp=False, force_ide
         reader.read_bytes(reader.opf_path), mi, cover_prefix=posixpath.dirname(reader.opf_path),
         cover_data=new_cdata, apply_null=apply_null, update_timestamp=update_timestamp,
         force_identifiers=force_identifiers, add_missing_cover=add_missing_cover, ftype=ftype)
-    cpath = None
     replacements = {}
     if new_cdata and raster_cover:
         try:
@@ -322,6 +324,15 @@ def set_metadata(stream, mi, apply_null=False, update_timestamp=False, force_ide
         except Exception:
             import traceback
             traceback.print_exc()
+    return opfbytes, replacements
+
+
+def set_metadata(stream, mi, apply_null=False, update_timestamp=False, force_identifiers=False, add_missing_cover=True, ftype='epub'):
+    stream.seek(0)
+    reader = get_zip_reader(stream, root=os.getcwd())
+    opfbytes, replacements = metadata_replacements(
+        reader, mi, apply_null=apply_null, update_timestamp=update_timestamp,
+        force_identifiers=force_identifiers, add_missing_cover=add_missing_cover, ftype=ftype)
 
     if isinstance(reader.archive, LocalZipFile):
         reader.archive.safe_replace(reader.container[OPF.MIMETYPE], opfbytes,
@@ -329,9 +340,3 @@ def set_metadata(stream, mi, apply_null=False, update_timestamp=False, force_ide
     else:
         safe_replace(stream, reader.container[OPF.MIMETYPE], opfbytes,
             extra_replacements=replacements, add_missing=True)
-    try:
-        if cpath is not None:
-            replacements[cpath].close()
-            os.remove(replacements[cpath].name)
-    except Exception:
-        pass
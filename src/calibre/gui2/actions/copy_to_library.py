@@ -33,9 +33,8 @@
     QWidget,
 )
 
-from calibre import as_unicode
 from calibre.constants import ismacos
-from calibre.db.copy_to_library import copy_one_book
+from calibre.db.copy_to_library import copy_books
 from calibre.gui2 import Dispatcher, choose_dir, error_dialog, gprefs, info_dialog, warning_dialog
 from calibre.gui2.actions import InterfaceAction
 from calibre.gui2.actions.choose_library import library_qicon
@@ -172,34 +171,33 @@ def doit(self):
             library_broker.prune_loaded_dbs()
 
     def _doit(self, newdb):
-        for i, x in enumerate(self.ids):
-            if self.was_canceled:
-                self.left_after_cancel = len(self.ids) - i
-                break
-            try:
-                self.do_one(i, x, newdb)
-            except Exception as err:
-                import traceback
-                err = as_unicode(err)
-                self.failed_books[x] = (err, as_unicode(traceback.format_exc()))
-
-    def do_one(self, num, book_id, newdb):
         duplicate_action = 'add'
         if self.check_for_duplicates:
             duplicate_action = 'add_formats_to_existing' if prefs['add_formats_to_existing'] else 'ignore'
-        rdata = copy_one_book(
-                book_id, self.db, newdb,
+        # Copy books in batches so that the copy can be canceled and the
+        # progress reported without paying the cost of a transaction per book
+        batch_size = 50
+        for start in range(0, len(self.ids), batch_size):
+            if self.was_canceled:
+                self.left_after_cancel = len(self.ids) - start
+                break
+            batch = self.ids[start:start+batch_size]
+            results, failures = copy_books(
+                batch, self.db, newdb,
                 preserve_date=gprefs['preserve_date_on_ctl'],
                 duplicate_action=duplicate_action, automerge_action=gprefs['automerge'],
                 identical_books_data=self.find_identical_books_data,
-                preserve_uuid=self.delete_after
-        )
-        self.progress(num, rdata['title'])
-        if rdata['action'] == 'automerge':
-            self.auto_merged_ids[book_id] = _('%(title)s by %(author)s') % dict(title=rdata['title'], author=rdata['author'])
-        elif rdata['action'] == 'duplicate':
-            self.duplicate_ids[book_id] = (rdata['title'], rdata['authors'])
-        self.processed.add(book_id)
+                preserve_uuid=self.delete_after, use_hardlinks=self.delete_after,
+                report_progress=lambda i, book_id: self.progress(start + i - 1, self.db.new_api.field_for('title', book_id))
+            )
+            for book_id, tb in failures.items():
+                self.failed_books[book_id] = (tb.strip().splitlines()[-1], tb)
+            for book_id, rdata in results.items():
+                if rdata['action'] == 'automerge':
+                    self.auto_merged_ids[book_id] = _('%(title)s by %(author)s') % dict(title=rdata['title'], author=rdata['author'])
+                elif rdata['action'] == 'duplicate':
+                    self.duplicate_ids[book_id] = (rdata['title'], rdata['authors'])
+                self.processed.add(book_id)
 # }}}
 
 
@@ -6,14 +6,19 @@
 __docformat__ = 'restructuredtext en'
 
 import fnmatch
+import json
 import os
 import re
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 from calibre import isbytestring
-from calibre.constants import filesystem_encoding
+from calibre.constants import cache_dir, filesystem_encoding
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, METADATA_FILE_NAME, NOTES_DIR_NAME, TRASH_DIR_NAME
 from calibre.ebooks import BOOK_EXTENSIONS
+from calibre.utils.filenames import atomic_rename
 from calibre.utils.localization import _
 from polyglot.builtins import iteritems
 
@@ -32,6 +37,12 @@
   array name
 '''
 
+MANIFEST_VERSION = 1
+# Directories modified more recently than this many seconds before a scan are
+# not trusted in the manifest, as filesystem mtime resolution can be as coarse
+# as two seconds.
+MTIME_GRACE_PERIOD = 2
+
 CHECKS = [('invalid_titles',    _('Invalid titles'), True, False),
           ('extra_titles',      _('Extra titles'), True, False),
           ('invalid_authors',   _('Invalid authors'), True, False),
@@ -45,6 +56,77 @@
       ]
 
 
+def default_manifest_path(db):
+    return os.path.join(cache_dir(), 'check-library', f'{db.library_id}.json')
+
+
+def list_directory(path):
+    '''
+    Return a mapping of name -> (is_dir, size, mtime_ns) for every entry in
+    the directory at path.
+    '''
+    ans = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+                st = entry.stat()
+            except OSError:
+                # Broken symlink or entry deleted while scanning
+                ans[entry.name] = (False, 0, 0)
+            else:
+                ans[entry.name] = (is_dir, st.st_size, st.st_mtime_ns)
+    return ans
+
+
+class DirectoryManifest:
+
+    '''
+    The (size, mtime) state of every directory seen during the previous check
+    of a library. A directory whose own mtime is unchanged has had no entries
+    added, removed or renamed, so its previous listing can be re-used instead
+    of scanning it again.
+    '''
+
+    def __init__(self, path, library_path):
+        self.path = path
+        self.library_path = library_path
+        self.old_state, self.new_state = {}, {}
+        self.hits = self.misses = 0
+        self.lock = Lock()
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return
+        if data.get('version') == MANIFEST_VERSION and data.get('library_path') == library_path:
+            self.old_state = data.get('dirs', {})
+
+    def listing(self, relpath, threshold):
+        path = os.path.join(self.library_path, relpath)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.old_state.get(relpath)
+        hit = cached is not None and cached[0] == mtime
+        entries = cached[1] if hit else list_directory(path)
+        # Called from many threads at once
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if mtime < threshold:
+                self.new_state[relpath] = [mtime, entries]
+        return entries
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = json.dumps({'version': MANIFEST_VERSION, 'library_path': self.library_path, 'dirs': self.new_state})
+        tpath = self.path + '.tmp'
+        with open(tpath, 'w') as f:
+            f.write(data)
+        atomic_rename(tpath, self.path)
+
+
 class CheckLibrary:
 
     def __init__(self, library_path, db):
@@ -96,33 +178,70 @@ def ignore_name(self, filename):
                 return True
         return False
 
-    def scan_library(self, name_ignores, extension_ignores):
+    def list_directories(self, relpaths):
+        '''
+        List the specified directories (relative to the library) in parallel.
+        Returns a mapping of relpath -> entries or the exception raised when
+        listing it.
+        '''
+        manifest, threshold = self.manifest, self.manifest_threshold
+        lib = self.src_library_path
+
+        def listing(relpath):
+            try:
+                if manifest is None:
+                    return list_directory(os.path.join(lib, relpath))
+                return manifest.listing(relpath, threshold)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return dict(zip(relpaths, pool.map(listing, relpaths)))
+
+    def scan_library(self, name_ignores, extension_ignores, manifest_path=None, max_workers=None):
+        '''
+        Scan the library folder for problems. If manifest_path is specified,
+        the state of the library folder is stored in it and only directories
+        that have changed since the previous scan are re-read from disk.
+        '''
         self.ignore_names = frozenset(name_ignores)
         self.ignore_ext = frozenset('.'+ e for e in extension_ignores)
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
 
         lib = self.src_library_path
-        for auth_dir in os.listdir(lib):
+        self.manifest = None if manifest_path is None else DirectoryManifest(manifest_path, lib)
+        self.manifest_threshold = time.time_ns() - MTIME_GRACE_PERIOD * 1_000_000_000
+        top_level = list_directory(lib)
+        auth_dirs = []
+        for auth_dir, (is_dir, size, mtime) in top_level.items():
             if self.ignore_name(auth_dir) or auth_dir in IGNORE_AT_TOP_LEVEL:
                 continue
-            auth_path = os.path.join(lib, auth_dir)
             # First check: author must be a directory
-            if not os.path.isdir(auth_path):
+            if not is_dir:
                 self.invalid_authors.append((auth_dir, auth_dir, 0))
                 continue
+            auth_dirs.append(auth_dir)
 
+        existing_book_dirs = set()
+        author_listings = self.list_directories(auth_dirs)
+        for auth_dir in auth_dirs:
             self.potential_authors[auth_dir] = {}
 
             # Look for titles in the author directories
             found_titles = False
             try:
-                for title_dir in os.listdir(auth_path):
+                titles = author_listings[auth_dir]
+                if isinstance(titles, Exception):
+                    raise titles
+                for title_dir, (is_dir, size, mtime) in titles.items():
+                    db_path = os.path.join(auth_dir, title_dir)
+                    if is_dir:
+                        existing_book_dirs.add(db_path if self.is_case_sensitive else db_path.lower())
                     if self.ignore_name(title_dir):
                         continue
-                    title_path = os.path.join(auth_path, title_dir)
-                    db_path = os.path.join(auth_dir, title_dir)
                     m = self.db_id_regexp.search(title_dir)
                     # Second check: title must have an ID and must be a directory
-                    if m is None or not os.path.isdir(title_path):
+                    if m is None or not is_dir:
                         self.invalid_titles.append((auth_dir, db_path, 0))
                         continue
 
@@ -151,18 +270,25 @@ def scan_library(self, name_ignores, extension_ignores):
             if not found_titles:
                 self.extra_authors.append((auth_dir, auth_dir, 0))
 
+        book_listings = self.list_directories([x[0] for x in self.book_dirs])
         for x in self.book_dirs:
             try:
-                self.process_book(lib, x)
+                listing = book_listings[x[0]]
+                if isinstance(listing, Exception):
+                    raise listing
+                self.process_book(lib, x, listing)
             except:
                 traceback.print_exc()
                 # Sort-of check: exception processing directory
-                self.failed_folders.append((title_path, traceback.format_exc(), []))
+                self.failed_folders.append((os.path.join(lib, x[0]), traceback.format_exc(), []))
 
         # Check for formats and covers in db for book dirs that are gone
         for id_ in self.all_ids:
             path = self.dbpath(id_)
-            if not os.path.exists(os.path.join(lib, path)):
+            q = path.replace('/', os.sep)
+            if not self.is_case_sensitive:
+                q = q.lower()
+            if q not in existing_book_dirs and not os.path.exists(os.path.join(lib, path)):
                 title_dir = os.path.basename(path)
                 book_formats = frozenset(x for x in
                             self.db.format_files(id_, index_is_id=True))
@@ -173,6 +299,12 @@ def scan_library(self, name_ignores, extension_ignores):
                     self.missing_covers.append((title_dir,
                             os.path.join(path, COVER_FILE_NAME), id_))
 
+        if self.manifest is not None:
+            try:
+                self.manifest.save()
+            except OSError:
+                traceback.print_exc()
+
     def is_ebook_file(self, filename):
         ext = os.path.splitext(filename)[1]
         if not ext:
@@ -184,9 +316,11 @@ def is_ebook_file(self, filename):
             return True
         return False
 
-    def process_book(self, lib, book_info):
+    def process_book(self, lib, book_info, listing=None):
         db_path, title_dir, book_id = book_info
-        filenames = frozenset(f for f in os.listdir(os.path.join(lib, db_path))
+        if listing is None:
+            listing = os.listdir(os.path.join(lib, db_path))
+        filenames = frozenset(f for f in listing
                                if not self.ignore_name(f) and (
                                    os.path.splitext(f)[1] not in self.ignore_ext or
                                    f == COVER_FILE_NAME))
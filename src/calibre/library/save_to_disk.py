@@ -462,3 +462,30 @@ def report_error(fmt, tb):
                 report_error(fmt, traceback.format_exc())
 
     return result
+
+
+def embed_serialized_metadata(book, common_data=None):
+    # This is called from a worker process. It must not open the database.
+    # Each format file is copied and the metadata is embedded into the copy,
+    # the database process is responsible for moving the copy into the library.
+    import shutil
+
+    from calibre.customize.ui import apply_null_metadata
+    from calibre.ebooks.metadata.meta import set_metadata
+    from calibre.ebooks.metadata.opf2 import pretty_print
+    mi, cdata = read_serialized_metadata(book)
+    if cdata:
+        mi.cover_data = ('jpeg', cdata)
+    result = {}
+    for fmt, src, dest in book['fmts']:
+        errors = []
+        try:
+            shutil.copyfile(src, dest)
+            with open(dest, 'r+b') as stream, apply_null_metadata, pretty_print:
+                set_metadata(stream, mi, stream_type=fmt, report_error=lambda mi, fmt, tb: errors.append(tb))
+                stream.seek(0, os.SEEK_END)
+                result[fmt] = stream.tell(), errors
+        except Exception:
+            errors.append(traceback.format_exc())
+            result[fmt] = None, errors
+    return result
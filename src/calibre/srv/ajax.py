@@ -4,17 +4,22 @@
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import asyncio
+from collections import defaultdict
 from functools import partial
 from itertools import cycle
+from threading import Lock
 
 from calibre import force_unicode
+from calibre.db.listeners import change_log_entry
 from calibre.db.view import sanitize_sort_field_name
 from calibre.ebooks.metadata import title_sort
 from calibre.ebooks.metadata.book.json_codec import JsonCodec
 from calibre.library.field_metadata import category_icon_map
+from calibre.srv.async_loop import in_worker_thread, run_blocking
 from calibre.srv.content import get as get_content
 from calibre.srv.content import icon as get_icon
-from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import custom_fields_to_display, decode_name, encode_name, get_db, http_date
 from calibre.utils.config import prefs, tweaks
@@ -42,6 +47,15 @@ def get_pagination(query, num=100, offset=0):
     return num, offset
 
 
+def get_after(query):
+    after = query.get('after')
+    if after:
+        try:
+            return int(after)
+        except Exception:
+            raise HTTPBadRequest(f'Invalid after: {after!r}')
+
+
 def category_icon(category, meta):  # {{{
     if category in category_icon_map:
         icon = category_icon_map[category]
@@ -57,8 +71,19 @@ def category_icon(category, meta):  # {{{
 
 # Book metadata {{{
 
+def category_tag_map(ctx, rd, db):
+    ''' A map of field name to a map of item name to the Tag object for it, for
+    looking up the category URLs of many books at once '''
+    ans = {}
+    for key, tags in iteritems(ctx.get_categories(rd, db)):
+        m = ans[key] = {}
+        for tag in tags:
+            m.setdefault(tag.original_name, tag)
+    return ans
+
+
 def book_to_json(ctx, rd, db, book_id,
-                 get_category_urls=True, device_compatible=False, device_for_template=None):
+                 get_category_urls=True, device_compatible=False, device_for_template=None, category_tags=None):
     mi = db.get_metadata(book_id, get_cover=False)
     codec = JsonCodec(db.field_metadata)
     if not device_compatible:
@@ -101,7 +126,8 @@ def book_to_json(ctx, rd, db, book_id,
 
         if get_category_urls:
             category_urls = data['category_urls'] = {}
-            all_cats = ctx.get_categories(rd, db)
+            if category_tags is None:
+                category_tags = category_tag_map(ctx, rd, db)
             for key in mi.all_field_keys():
                 fm = mi.metadata_for_field(key)
                 if (fm and fm['is_category'] and not fm['is_csp'] and
@@ -110,16 +136,16 @@ def book_to_json(ctx, rd, db, book_id,
                     if isinstance(categories, string_or_bytes):
                         categories = [categories]
                     category_urls[key] = dbtags = {}
+                    tags = category_tags.get(key, {})
                     for category in categories:
-                        for tag in all_cats.get(key, ()):
-                            if tag.original_name == category:
-                                dbtags[category] = ctx.url_for(
-                                    books_in,
-                                    encoded_category=encode_name(tag.category if tag.category else key),
-                                    encoded_item=encode_name(tag.original_name if tag.id is None else str(tag.id)),
-                                    library_id=db.server_library_id
-                                )
-                                break
+                        tag = tags.get(category)
+                        if tag is not None:
+                            dbtags[category] = ctx.url_for(
+                                books_in,
+                                encoded_category=encode_name(tag.category if tag.category else key),
+                                encoded_item=encode_name(tag.original_name if tag.id is None else str(tag.id)),
+                                library_id=db.server_library_id
+                            )
     else:
         series = data.get('series', None) or ''
         if series:
@@ -218,13 +244,16 @@ def books(ctx, rd, library_id):
         device_for_template = rd.query.get('device_for_template', None)
         ans = {}
         allowed_book_ids = ctx.allowed_book_ids(rd, db)
+        category_tags = category_tag_map(ctx, rd, db) if category_urls and not device_compatible else None
+        # The books are encoded from their Metadata, as in /ajax/book, not with
+        # books_as_json(), whose output has a different format
         for book_id in ids:
             if book_id not in allowed_book_ids:
                 ans[book_id] = None
                 continue
             data, lm = book_to_json(
                 ctx, rd, db, book_id, get_category_urls=category_urls,
-                device_compatible=device_compatible, device_for_template=device_for_template)
+                device_compatible=device_compatible, device_for_template=device_for_template, category_tags=category_tags)
             last_modified = lm if last_modified is None else max(lm, last_modified)
             ans[book_id] = data
     if last_modified is not None:
@@ -529,7 +558,13 @@ def books_in(ctx, rd, encoded_category, encoded_item, library_id):
 
 # Search {{{
 
-def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl=''):
+def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl='', after=None):
+    '''
+    If after is the id of a book in the results, the returned books are the
+    ones following it and offset is ignored. This is cheaper than using
+    offset for deep pages and is not affected by books being added before the
+    current page.
+    '''
     multisort = [(sanitize_sort_field_name(db.field_metadata, s), ensure_val(o, 'asc', 'desc') == 'asc')
                  for s, o in zip(sort.split(','), cycle(sort_order.split(',')))]
     skeys = db.field_metadata.sortable_field_keys()
@@ -537,10 +572,11 @@ def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl=''):
         if sfield not in skeys:
             raise HTTPNotFound(f'{sort} is not a valid sort field')
 
-    ids, parse_error = ctx.search(rd, db, query, vl=vl, report_restriction_errors=True)
-    ids = db.multisort(fields=multisort, ids_to_sort=ids)
+    ids, parse_error, position = ctx.sorted_search(rd, db, query, multisort, vl=vl, after=after)
+    if position is not None:
+        offset = position
     total_num = len(ids)
-    ids = ids[offset:offset+num]
+    ids = list(ids[offset:offset+num])
     num_books = db.number_of_books_in_virtual_library(vl) if query else total_num
     ans = {
         'total_num': total_num, 'sort_order':sort_order,
@@ -565,17 +601,126 @@ def search(ctx, rd, library_id):
     is a list of matched book ids. For all the other fields in the object, see
     :func:`search_result`.
 
-    Optional: ?num=100&offset=0&sort=title&sort_order=asc&query=&vl=
+    Optional: ?num=100&offset=0&sort=title&sort_order=asc&query=&vl=&after=
+
+    Use after=<id of the last book of the previous page> instead of offset to
+    get the next page.
     '''
     db = get_db(ctx, rd, library_id)
     query = rd.query.get('query')
     num, offset = get_pagination(rd.query)
+    after = get_after(rd.query)
     with db.safe_read_lock:
-        return search_result(ctx, rd, db, query, num, offset, rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or '')
+        return search_result(
+            ctx, rd, db, query, num, offset, rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or '', after=after)
 
 # }}}
 
 
+class ChangeWaiters:
+
+    '''
+    Wake the coroutines waiting for changes to a library, from the event
+    threads of the libraries, instead of having them poll the change log.
+    '''
+
+    def __init__(self, library_broker):
+        self.lock = Lock()
+        self.waiters = defaultdict(set)
+        library_broker.add_db_event_callback(self.on_db_event)
+
+    def on_db_event(self, library_id, event_type, event_data):
+        if change_log_entry(event_type, event_data) is None:
+            return
+        with self.lock:
+            waiters = self.waiters.pop(library_id, ())
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.wake, future)
+
+    def wake(self, future):
+        if not future.done():
+            future.set_result(None)
+
+    def add(self, library_id):
+        ''' Return a future that is done when the library is next changed '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            self.waiters[library_id].add((loop, future))
+        return future
+
+    def remove(self, library_id, future):
+        with self.lock:
+            self.waiters[library_id].discard((future.get_loop(), future))
+
+
+change_waiters_lock = Lock()
+
+
+def change_waiters(ctx):
+    with change_waiters_lock:
+        ans = getattr(ctx, 'change_waiters', None)
+        if ans is None:
+            ans = ctx.change_waiters = ChangeWaiters(ctx.library_broker)
+        return ans
+
+
+def changes_for_user(ctx, rd, db, since, limit):
+    with db.safe_read_lock:
+        ans = db.changes_since(since, limit=limit)
+        if ctx.restriction_for(rd, db):
+            allowed_book_ids = ctx.allowed_book_ids(rd, db)
+            for change in ans['changes']:
+                if change['book_id'] not in allowed_book_ids:
+                    change['kind'], change['fields'] = 'removed', []
+    return ans
+
+
+@endpoint('/ajax/changes/{since=0}/{library_id=None}', postprocess=json)
+async def changes(ctx, rd, since, library_id):
+    '''
+    Return the changes made to books in the library since the change with
+    sequence number since. See :meth:`calibre.db.cache.Cache.changes_since` for
+    the format of the returned data. Books that the user is not allowed to
+    access are reported as removed.
+
+    Optional: ?num=500&wait=0
+
+    If wait is not zero and there are no changes, wait for up to wait seconds
+    for changes to be made before returning. wait is ignored unless the server
+    uses the asyncio event loop, as the request would otherwise occupy a
+    worker thread while waiting.
+    '''
+    try:
+        since = int(since)
+    except Exception:
+        raise HTTPNotFound('Invalid change sequence number')
+    num = get_pagination(rd.query, num=500)[0]
+    try:
+        wait = float(rd.query.get('wait', 0))
+    except Exception:
+        raise HTTPNotFound('Invalid wait')
+    # Return before the connection is closed for inactivity
+    wait = 0 if in_worker_thread() else min(max(0, wait), ctx.opts.timeout / 2)
+    db = await run_blocking(get_db, ctx, rd, library_id)
+    if wait:
+        waiters = change_waiters(ctx)
+        # Start waiting before reading the change log, so that changes made
+        # in between are not missed
+        changed = waiters.add(db.server_library_id)
+        try:
+            ans = await run_blocking(changes_for_user, ctx, rd, db, since, max(1, num))
+            if not ans['changes'] and not ans['reset']:
+                await asyncio.wait((changed,), timeout=wait)
+                ans = await run_blocking(changes_for_user, ctx, rd, db, since, max(1, num))
+        finally:
+            waiters.remove(db.server_library_id, changed)
+    else:
+        ans = await run_blocking(changes_for_user, ctx, rd, db, since, max(1, num))
+    ans['library_id'] = db.server_library_id
+    return ans
+
+
 @endpoint('/ajax/library-info', postprocess=json)
 def library_info(ctx, rd):
     ' Return info about available libraries '
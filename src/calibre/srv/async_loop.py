@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A server loop that runs on an asyncio event loop, used when the event_loop
+option is set to asyncio. Connections are handled exactly as in
+:class:`calibre.srv.loop.ServerLoop`, but endpoints can be declared with
+``async def``. Such endpoints are started in a worker thread, as usual, which
+is released as soon as the endpoint returns its coroutine. The coroutine then
+runs on the event loop, so that endpoints that spend most of their time
+waiting do not occupy worker threads. Coroutines must call blocking code,
+such as database queries, with :func:`run_blocking`.
+'''
+
+import asyncio
+import selectors
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import local
+
+from calibre.srv.loop import ServerLoop
+from calibre.utils.monotonic import monotonic
+
+thread_data = local()
+
+
+def in_worker_thread():
+    '''
+    Return True if the running coroutine occupies a worker thread, that is,
+    it is run by :func:`run_in_worker_thread` rather than by the event loop
+    of the server.
+    '''
+    return asyncio.get_running_loop() is getattr(thread_data, 'event_loop', None)
+
+
+async def run_blocking(func, *args, **kwargs):
+    '''
+    Call func in a thread from the bounded pool of threads of the running
+    event loop and return its result. When the coroutine is run in a worker
+    thread, by :func:`run_in_worker_thread`, func is called directly, as that
+    thread is occupied till the coroutine completes anyway.
+    '''
+    if in_worker_thread():
+        return func(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+def run_in_worker_thread(coro):
+    '''
+    Run coro to completion in the calling worker thread, for server loops that
+    cannot run coroutines. Every worker thread re-uses a single event loop,
+    rather than creating an event loop and a pool of threads for every request.
+    '''
+    loop = getattr(thread_data, 'event_loop', None)
+    if loop is None:
+        loop = thread_data.event_loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+
+class AsyncioSelector:
+
+    ' Implement the parts of the selectors API used by ServerLoop on top of an asyncio event loop '
+
+    def __init__(self, loop, callback):
+        self.loop, self.callback = loop, callback
+        self.registered = {}
+
+    def register(self, fd, events):
+        if fd in self.registered:
+            raise KeyError(f'{fd} is already registered')
+        self.registered[fd] = 0
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        current = self.registered[fd]
+        for event, add, remove in (
+            (selectors.EVENT_READ, self.loop.add_reader, self.loop.remove_reader),
+            (selectors.EVENT_WRITE, self.loop.add_writer, self.loop.remove_writer),
+        ):
+            if events & event and not current & event:
+                add(fd, self.callback, fd, event)
+            elif current & event and not events & event:
+                remove(fd)
+        self.registered[fd] = events
+
+    def unregister(self, fd):
+        self.modify(fd, 0)
+        del self.registered[fd]
+
+    def close(self):
+        for fd in tuple(self.registered):
+            self.unregister(fd)
+
+
+class AsyncServerLoop(ServerLoop):
+
+    def __init__(self, *args, **kwargs):
+        ServerLoop.__init__(self, *args, **kwargs)
+        self.event_loop = self.executor = None
+        # fd -> the tasks running coroutines for the connection, HTTP/2
+        # connections can have several
+        self.tasks = {}
+        self.processing_buffered = False
+
+    def create_selector(self):
+        # Use a selector based loop on all platforms, as the proactor loop on
+        # Windows cannot watch sockets for readiness
+        self.event_loop = asyncio.SelectorEventLoop(selectors.DefaultSelector())
+        self.executor = ThreadPoolExecutor(max_workers=self.opts.worker_count, thread_name_prefix='ServerAsyncWorker')
+        self.event_loop.set_default_executor(self.executor)
+        self.tasks = {}
+        self.processing_buffered = False
+        return AsyncioSelector(self.event_loop, self.on_ready)
+
+    def run(self):
+        self.event_loop.call_soon(self.check_timeouts_periodically)
+        try:
+            self.event_loop.run_forever()
+        except SystemExit:
+            self.shutdown()
+            raise
+        except KeyboardInterrupt:
+            pass
+
+    def setup_connection(self, s, conn):
+        ServerLoop.setup_connection(self, s, conn)
+        conn.run_coroutine = partial(self.run_coroutine, s, conn)
+
+    def on_ready(self, fd, event):
+        if event == selectors.EVENT_READ:
+            self.process((fd,), ())
+        else:
+            self.process((), (fd,))
+
+    def process(self, readable, writable, actions=None):
+        try:
+            if self.ready:
+                self.handle_actions(self.get_actions(readable, writable) if actions is None else actions)
+            self.update_registrations()
+            if self.buffered and not self.processing_buffered:
+                self.processing_buffered = True
+                self.event_loop.call_soon(self.process_buffered)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            self.log.exception('Error in AsyncServerLoop.process')
+        if not self.ready:
+            self.event_loop.stop()
+
+    def process_buffered(self):
+        # Connections with data in their read buffers are readable without
+        # the socket being readable
+        self.processing_buffered = False
+        self.process(tuple(self.buffered), ())
+
+    def check_timeouts_periodically(self):
+        now = monotonic()
+        try:
+            self.check_timeouts(now)
+            self.update_registrations()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            self.log.exception('Error in AsyncServerLoop.check_timeouts')
+        if self.socket.fileno() < 0:
+            self.ready = False
+            self.log.error('Listening socket was unexpectedly terminated')
+            self.event_loop.stop()
+            return
+        delay = self.timers.time_to_next_expiry(now)
+        delay = self.opts.timeout if delay is None else min(delay, self.opts.timeout)
+        self.event_loop.call_later(max(delay, self.timers.resolution), self.check_timeouts_periodically)
+
+    def run_coroutine(self, s, conn, coro):
+        task = self.event_loop.create_task(coro)
+        self.tasks.setdefault(s, set()).add(task)
+        task.add_done_callback(partial(self.coroutine_done, s, conn))
+
+    def coroutine_done(self, s, conn, task):
+        tasks = self.tasks.get(s)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self.tasks[s]
+        if task.cancelled() or self.connection_map.get(s) is not conn:
+            return
+        e = task.exception()
+        event = (True, task.result()) if e is None else (False, (type(e), e, e.__traceback__))
+        self.process((), (), ((s, conn, event),))
+
+    def close(self, s, conn):
+        for task in self.tasks.pop(s, ()):
+            task.cancel()
+        ServerLoop.close(self, s, conn)
+
+    def shutdown(self):
+        ServerLoop.shutdown(self)
+        loop, self.event_loop = self.event_loop, None
+        if loop is not None and not loop.is_closed():
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending, timeout=self.opts.shutdown_timeout))
+            loop.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
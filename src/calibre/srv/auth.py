@@ -4,6 +4,7 @@
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import hmac
 import os
 import random
 import struct
@@ -17,7 +18,7 @@
 from calibre.srv.utils import encode_path, parse_http_dict
 from calibre.utils.monotonic import monotonic
 from polyglot import http_client
-from polyglot.binary import as_hex_unicode, from_base64_unicode, from_hex_bytes
+from polyglot.binary import as_hex_unicode, from_base64_unicode, from_hex_bytes, from_hex_unicode
 
 MAX_AGE_SECONDS = 3600
 nonce_counter, nonce_counter_lock = 0, Lock()
@@ -212,6 +213,39 @@ def validate_request(self, pw, data, log=None):
 # }}}
 
 
+def session_signature(secret, expires, username, pw):
+    return hmac.new(secret, f'{expires}:{username}:{pw}'.encode('utf-8'), sha256).hexdigest()
+
+
+def create_session_token(secret, username, pw, max_age_seconds):
+    '''
+    Create a token of the form expires:username:signature where the signature
+    is an HMAC of the other two parts and the password of the user, so that
+    the token stops working when the password is changed or the user is
+    removed.
+    '''
+    expires = int(monotonic() + max_age_seconds)
+    username = as_hex_unicode(username)
+    return f'{expires}:{username}:{session_signature(secret, expires, username, pw)}'
+
+
+def validate_session_token(secret, token, user_credentials):
+    '''
+    Return the username for a token created by :func:`create_session_token`
+    or None if the token is invalid or has expired.
+    '''
+    try:
+        expires, username, signature = token.split(':')
+        if int(expires) < monotonic():
+            return
+        un = from_hex_unicode(username)
+    except Exception:
+        return
+    pw = user_credentials.get(un)
+    if pw and hmac.compare_digest(session_signature(secret, expires, username, pw), signature):
+        return un
+
+
 class AuthController:
     '''
     Implement Basic/Digest authentication for the Content server. Android browsers
@@ -237,17 +271,30 @@ class AuthController:
     hijacking, since we have to ignore repeated nc values, because Firefox does
     not implement the digest auth spec properly (it sends out of order nc
     values).
+
+    If session_max_age_seconds is not zero, a signed session cookie is set
+    after a successful Basic/Digest authentication. Requests that send the
+    cookie, or its value as a Bearer token in the Authorization header, are
+    authenticated by checking its signature, which is much cheaper than
+    validating the HTTP auth credentials. Clients such as OPDS readers and the
+    web reader make a great many requests, so this matters. The same session
+    hijacking caveat as above applies to the session cookie.
     '''
     ANDROID_COOKIE = 'android_workaround'
+    SESSION_COOKIE = 'calibre_session'
 
     def __init__(self,
                  user_credentials=None, prefer_basic_auth=False, realm='calibre',
-                 max_age_seconds=MAX_AGE_SECONDS, log=None, ban_time_in_minutes=0, ban_after=5):
+                 max_age_seconds=MAX_AGE_SECONDS, log=None, ban_time_in_minutes=0, ban_after=5,
+                 session_max_age_seconds=0, session_cookie_path='/'):
         self.user_credentials, self.prefer_basic_auth = user_credentials, prefer_basic_auth
         self.ban_list = BanList(ban_time_in_minutes=ban_time_in_minutes, max_failures_before_ban=ban_after)
         self.log = log
         self.secret = as_hex_unicode(os.urandom(random.randint(20, 30)))
+        self.session_secret = os.urandom(32)
         self.max_age_seconds = max_age_seconds
+        self.session_max_age_seconds = max(0, session_max_age_seconds)
+        self.session_cookie_path = session_cookie_path
         self.key_order = '{%d}:{%d}:{%d}' % random.choice(tuple(permutations((0,1,2))))  # noqa: UP031
         self.realm = realm
         if '"' in realm:
@@ -257,6 +304,8 @@ def check(self, un, pw):
         return pw and self.user_credentials.get(un) == pw
 
     def __call__(self, data, endpoint):
+        if self.session_max_age_seconds and self.validate_session(data):
+            return
         path = encode_path(*data.path)
         http_auth_needed = not (endpoint.android_workaround and self.validate_android_cookie(path, data.cookies.get(self.ANDROID_COOKIE)))
         if http_auth_needed:
@@ -264,6 +313,29 @@ def __call__(self, data, endpoint):
             if endpoint.android_workaround:
                 data.outcookie[self.ANDROID_COOKIE] = synthesize_nonce(self.key_order, path, self.secret)
                 data.outcookie[self.ANDROID_COOKIE]['path'] = path
+            if self.session_max_age_seconds and data.username:
+                self.start_session(data)
+
+    def validate_session(self, data):
+        auth = data.inheaders.get('Authorization', '')
+        scheme, rest = auth.partition(' ')[::2]
+        token = rest.strip() if scheme.lower() == 'bearer' else data.cookies.get(self.SESSION_COOKIE)
+        if token:
+            un = validate_session_token(self.session_secret, token, self.user_credentials)
+            if un is not None:
+                data.username = un
+                return True
+        return False
+
+    def start_session(self, data):
+        pw = self.user_credentials.get(data.username)
+        if pw:
+            m = data.outcookie
+            m[self.SESSION_COOKIE] = create_session_token(self.session_secret, data.username, pw, self.session_max_age_seconds)
+            m[self.SESSION_COOKIE]['path'] = self.session_cookie_path
+            m[self.SESSION_COOKIE]['max-age'] = str(self.session_max_age_seconds)
+            m[self.SESSION_COOKIE]['httponly'] = True
+            m[self.SESSION_COOKIE]['samesite'] = 'Lax'
 
     def validate_android_cookie(self, path, cookie):
         return cookie and validate_nonce(self.key_order, cookie, path, self.secret) and not is_nonce_stale(cookie, self.max_age_seconds)
@@ -303,6 +375,8 @@ def do_http_auth(self, data, endpoint):
                     return
                 log_msg = f'Failed login attempt from: {data.remote_addr}'
                 self.ban_list.failed(ban_key)
+            elif self.session_max_age_seconds and scheme == 'bearer':
+                pass  # An expired or invalid session token, ask the client to login again
             else:
                 raise HTTPSimpleResponse(http_client.BAD_REQUEST, 'Unsupported authentication method')
 
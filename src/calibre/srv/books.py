@@ -7,9 +7,10 @@
 import os
 import tempfile
 import time
+from collections import OrderedDict
 from functools import partial
 from hashlib import sha1
-from threading import Lock, RLock
+from threading import Event, Lock, RLock
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
@@ -20,6 +21,7 @@
 from calibre.srv.render_book import RENDER_VERSION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
+from calibre.utils.config import prefs
 from calibre.utils.filenames import rmtree
 from calibre.utils.localization import _
 from calibre.utils.resources import get_path as P
@@ -61,6 +63,15 @@ def book_hash(library_uuid, book_id, fmt, size, mtime):
     return as_unicode(sha1(raw).hexdigest())
 
 
+def format_hash(db, book_id, fmt):
+    ' Return the hash identifying the rendered form of the specified format along with its size and mtime, must be called with the read lock held '
+    fm = db.format_metadata(book_id, fmt, allow_cache=False)
+    if not fm:
+        return None, None, None
+    size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+    return book_hash(db.library_id, book_id, fmt, size, mtime), size, mtime
+
+
 staging_cleaned = False
 
 
@@ -73,7 +84,7 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, prerender=False):
     global staging_cleaned
     tdir = os.path.join(books_cache_dir(), 's')
     if not staging_cleaned:
@@ -84,31 +95,137 @@ def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
     with os.fdopen(fd, 'wb') as f:
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
+    kwargs = {}
+    pool = ctx.jobs_manager.get_render_pool()
+    if pool is not None:
+        kwargs = {'render_pool': (pool.address, pool.authkey), 'max_workers': pool.max_workers_per_job}
     job_id = ctx.start_job(f'Render book {book_id} ({fmt})', 'calibre.srv.render_book', 'render', args=(
-        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
-    queued_jobs[bhash] = job_id
+        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}), kwargs=kwargs,
+        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir, ctx.opts.book_render_cache_size * 1024 * 1024, prerender))
+    if job_id is not None:
+        queued_jobs[bhash] = job_id
     return job_id
 
 
-last_final_clean_time = 0
+MANIFEST_NAME = 'calibre-book-manifest.json'
 
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
-        try:
-            tm = os.path.getmtime(os.path.join(fdir, x, 'calibre-book-manifest.json'))
-        except OSError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+def dir_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                ans += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return ans
+
+
+class RenderCache:
+
+    '''
+    Keeps track of the rendered books in the final cache directory, in order of
+    last access, so that the books that have not been read for the longest
+    time can be removed when the cache grows larger than its maximum size.
+    Also counts how often books are found already rendered when opened. Must
+    be used with cache_lock held. The processes of a multi-process server
+    share the cache directory, so it is scanned again whenever a book is
+    added with a maximum size, to see the books rendered and removed by the
+    other processes. The order of last access is the modification time of the
+    manifests, which is updated whenever a book is opened.
+    '''
+
+    def __init__(self, base=None):
+        self.base = base
+        self.entries = None  # bhash -> size, least recently used first
+        self.total_size = 0
+        self.hits = self.misses = self.prerendered = self.evicted = 0
+        self.awaiting_render = set()
+
+    @property
+    def fdir(self):
+        return self.base or os.path.join(books_cache_dir(), 'f')
+
+    def ensure_scanned(self):
+        if self.entries is None:
+            fdir, found = self.fdir, []
+            for x in os.listdir(fdir):
+                path = os.path.join(fdir, x)
+                try:
+                    atime = os.path.getmtime(os.path.join(path, MANIFEST_NAME))
+                except OSError:
+                    # Left over from an interrupted render
+                    safe_remove(path, False)
+                    continue
+                found.append((atime, x, dir_size(path)))
+            found.sort()
+            self.entries = OrderedDict((x, size) for atime, x, size in found)
+            self.total_size = sum(itervalues(self.entries))
+        return self.entries
+
+    def __contains__(self, bhash):
+        return bhash in self.ensure_scanned()
+
+    def accessed(self, bhash):
+        entries = self.ensure_scanned()
+        if bhash in entries:
+            entries.move_to_end(bhash)
+            try:
+                os.utime(os.path.join(self.fdir, bhash, MANIFEST_NAME), None)
+            except OSError:
+                pass
+
+    def hit(self, bhash):
+        self.accessed(bhash)
+        if bhash in self.awaiting_render:
+            # The book was rendered because it was opened, already counted as a miss
+            self.awaiting_render.discard(bhash)
+        else:
+            self.hits += 1
+
+    def miss(self, bhash):
+        self.misses += 1
+        self.awaiting_render.add(bhash)
+
+    def render_failed(self, bhash):
+        self.awaiting_render.discard(bhash)
+
+    def discard(self, bhash):
+        self.total_size -= self.ensure_scanned().pop(bhash, 0)
+
+    def add(self, bhash, max_size=0):
+        entries = self.ensure_scanned()
+        self.total_size -= entries.pop(bhash, 0)
+        entries[bhash] = size = dir_size(os.path.join(self.fdir, bhash))
+        self.total_size += size
+        self.evict(max_size)
+
+    def evict(self, max_size):
+        if max_size <= 0:
+            return
+        newest = next(reversed(self.ensure_scanned()), None)
+        self.entries = None
+        self.ensure_scanned()
+        if newest in self.entries:
+            self.entries.move_to_end(newest)
+        # The most recently added book is never evicted, even if it is larger than max_size
+        while self.total_size > max_size and len(self.entries) > 1:
+            bhash, size = self.entries.popitem(last=False)
+            self.total_size -= size
+            self.evicted += 1
+            safe_remove(os.path.join(self.fdir, bhash), False)
+
+    def stats(self):
+        entries = self.ensure_scanned()
+        opened = self.hits + self.misses
+        return {
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': (self.hits / opened) if opened else 0,
+            'prerendered': self.prerendered, 'evicted': self.evicted,
+            'num_of_books': len(entries), 'size': self.total_size,
+        }
+
+
+render_cache = RenderCache()
 
 
 def rename_with_retry(a, b, sleep_time=1):
@@ -124,21 +241,129 @@ def rename_with_retry(a, b, sleep_time=1):
 
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
+        bhash, pathtoebook, tdir, max_cache_size, prerender = job.data
         queued_jobs.pop(bhash, None)
         safe_remove(pathtoebook)
         if job.failed:
-            failed_jobs[bhash] = (job.was_aborted, job.traceback)
+            if not prerender:
+                failed_jobs[bhash] = (job.was_aborted, job.traceback)
+            render_cache.render_failed(bhash)
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
                 safe_remove(dest, False)
                 rename_with_retry(tdir, dest)
+                render_cache.add(bhash, max_cache_size)
+                if prerender:
+                    render_cache.prerendered += 1
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
+                render_cache.render_failed(bhash)
+
+
+# Pre-rendering {{{
+
+FORMAT_PRIORITIES = ('EPUB', 'AZW3', 'DOCX', 'LIT', 'MOBI', 'ODT', 'RTF', 'MD', 'MARKDOWN', 'TXT', 'PDF')
+
+
+def format_for_reading(db, book_id):
+    ' The format the browser viewer opens by default, see get_preferred_format() in book_details.pyj '
+    formats = db.formats(book_id)
+    fmt = prefs['output_format'].upper()
+    fmt = 'EPUB' if fmt == 'PDF' else fmt
+    if fmt in formats:
+        return fmt
+    for q in sorted(formats, key=lambda x: FORMAT_PRIORITIES.index(x) if x in FORMAT_PRIORITIES else len(FORMAT_PRIORITIES)):
+        if plugin_for_input_format(q) is not None:
+            return q
+
+
+class Prerenderer:
+
+    '''
+    A server plugin that renders the most recently read and the most recently
+    added books for viewing ahead of time, one book at a time, whenever the
+    server has not run any jobs for idle_time seconds.
+    '''
+
+    check_interval = 30
+    idle_time = 120
+
+    def __init__(self, ctx, num_books):
+        self.ctx, self.num_books = ctx, num_books
+        self.attempted = set()
+        self.newest = None
+        self.shutdown = Event()
+        self.stop = self.shutdown.set
+
+    def start(self, loop):
+        while not self.shutdown.wait(self.check_interval):
+            jm = self.ctx.jobs_manager
+            if jm is None or jm.idle_time() < self.idle_time:
+                continue
+            try:
+                self.render_next()
+            except Exception:
+                loop.log.exception('Failed to prepare a book for viewing in advance')
+
+    def newest_books(self, library_id, db, count):
+        # Sorting the whole library is only done again when it has changed
+        with db.safe_read_lock:
+            key = library_id, id(db), db.last_change_seq(), count
+            if self.newest is None or self.newest[0] != key:
+                self.newest = key, tuple(db.multisort([('timestamp', False)])[:count])
+        return self.newest[1]
+
+    def candidates(self):
+        seen = set()
+        for library_id, book_id, fmt in last_read_cache().get_most_recently_read(self.num_books):
+            if (library_id, book_id) not in seen:
+                seen.add((library_id, book_id))
+                yield library_id, book_id, fmt
+        num_added = self.num_books - len(seen)
+        if num_added > 0:
+            library_id = self.ctx.library_broker.default_library
+            db = self.ctx.library_broker.get(library_id)
+            if db is not None:
+                db = db.new_api
+                for book_id in self.newest_books(library_id, db, num_added):
+                    if (library_id, book_id) not in seen:
+                        fmt = format_for_reading(db, book_id)
+                        if fmt:
+                            yield library_id, book_id, fmt
+
+    def render_next(self):
+        ' Start rendering the first candidate that is not already rendered. Returns the job id or None if there is nothing to render. '
+        for library_id, book_id, fmt in self.candidates():
+            if plugin_for_input_format(fmt) is None:
+                continue
+            db = self.ctx.library_broker.get(library_id)
+            if db is None:
+                continue
+            db = db.new_api
+            with db.safe_read_lock:
+                bhash, size, mtime = format_hash(db, book_id, fmt)
+                # Books are not re-rendered after a failure or after being
+                # evicted, so that a small cache does not cause endless renders
+                if bhash is None or bhash in self.attempted:
+                    continue
+                with cache_lock:
+                    if bhash in render_cache or bhash in queued_jobs:
+                        continue
+                    self.attempted.add(bhash)
+                    return queue_job(self.ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, prerender=True)
+# }}}
+
+
+@endpoint('/book-render-cache-stats', postprocess=json)
+def book_render_cache_stats(ctx, rd):
+    ' The number of books found already rendered when opened (hits) and not found (misses) and the size of the cache '
+    with cache_lock:
+        ans = render_cache.stats()
+    ans['max_size'] = ctx.opts.book_render_cache_size * 1024 * 1024
+    return ans
 
 
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
@@ -150,19 +375,17 @@ def book_manifest(ctx, rd, book_id, fmt):
     if not ctx.has_id(rd, db, book_id):
         raise BookNotFound(book_id, db)
     with db.safe_read_lock:
-        fm = db.format_metadata(book_id, fmt, allow_cache=False)
-        if not fm:
+        bhash, size, mtime = format_hash(db, book_id, fmt)
+        if bhash is None:
             raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {library_id}')
-        size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
-        bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
         with cache_lock:
-            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
+            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, MANIFEST_NAME))
             if force_reload:
                 safe_remove(mpath, True)
             try:
-                os.utime(mpath, None)
                 with open(mpath, 'rb') as f:
                     ans = jsonlib.load(f)
+                render_cache.hit(bhash)
                 ans['metadata'] = book_as_json(db, book_id)
                 user = rd.username or None
                 ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
@@ -171,11 +394,14 @@ def book_manifest(ctx, rd, book_id, fmt):
             except OSError as e:
                 if e.errno != errno.ENOENT:
                     raise
+                # Removed by force_reload or by another server process
+                render_cache.discard(bhash)
             x = failed_jobs.pop(bhash, None)
             if x is not None:
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
             job_id = queued_jobs.get(bhash)
             if job_id is None:
+                render_cache.miss(bhash)
                 job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
@@ -191,6 +417,8 @@ def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     mpath = abspath(os.path.join(base, bhash, name))
     if not mpath.startswith(base):
         raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
+    with cache_lock:
+        render_cache.accessed(bhash)
     try:
         return rd.filesystem_file_with_custom_etag(open(mpath, 'rb'), bhash, name)
     except OSError as e:
@@ -247,6 +475,26 @@ def set_last_read_position(ctx, rd, library_id, book_id, fmt):
     return b''
 
 
+MAX_ANNOTATION_CHANGES = 10000
+
+
+def parse_which(which):
+    for item in which.split('_'):
+        book_id, fmt = item.partition('-')[::2]
+        try:
+            book_id = int(book_id)
+        except Exception:
+            continue
+        yield book_id, fmt
+
+
+def annotations_data(db, book_id, fmt, user):
+    return {
+        'last_read_positions': db.get_last_read_positions(book_id, fmt, user),
+        'annotations_map': db.annotations_map_for_book(book_id, fmt, user_type='web', user=user) if user else {}
+    }
+
+
 @endpoint('/book-get-annotations/{library_id}/{+which}', postprocess=json)
 def get_annotations(ctx, rd, library_id, which):
     '''
@@ -257,22 +505,48 @@ def get_annotations(ctx, rd, library_id, which):
     user = rd.username or '*'
     ans = {}
     allowed_book_ids = ctx.allowed_book_ids(rd, db)
-    for item in which.split('_'):
-        book_id, fmt = item.partition('-')[::2]
-        try:
-            book_id = int(book_id)
-        except Exception:
-            continue
-        if book_id not in allowed_book_ids:
-            continue
-        key = f'{book_id}:{fmt}'
-        ans[key] = {
-            'last_read_positions': db.get_last_read_positions(book_id, fmt, user),
-            'annotations_map': db.annotations_map_for_book(book_id, fmt, user_type='web', user=user) if user else {}
-        }
+    for book_id, fmt in parse_which(which):
+        if book_id in allowed_book_ids:
+            ans[f'{book_id}:{fmt}'] = annotations_data(db, book_id, fmt, user)
     return ans
 
 
+@endpoint('/book-get-annotations-changes/{library_id}/{since}/{+which}', postprocess=json, types={'since': int})
+def get_annotations_changes(ctx, rd, library_id, since, which):
+    '''
+    Same as /book-get-annotations except that the annotations are returned
+    only for the specified books whose annotations have changed since the
+    change with sequence number since. Last read positions are always
+    returned, as they are small. Returns an object with the keys: change_seq,
+    to be used as since for the next call, reset, which is True if the
+    changes no longer go back as far as since, in which case the annotations
+    of all the specified books are returned, and books, with the same data
+    as returned by /book-get-annotations.
+    '''
+    db = get_db(ctx, rd, library_id)
+    user = rd.username or '*'
+    books = {}
+    allowed_book_ids = ctx.allowed_book_ids(rd, db)
+    with db.safe_read_lock:
+        latest = db._last_change_seq()
+        changes = db._changes_since(since, MAX_ANNOTATION_CHANGES)
+        reset = changes['reset'] or len(changes['changes']) >= MAX_ANNOTATION_CHANGES
+        changed = set()
+        for change in changes['changes']:
+            if change['kind'] == 'annotations':
+                # Some changes do not record the format, in which case
+                # the annotations for all formats of the book have changed
+                fmts = change['fields'] or ('',)
+                changed.update((change['book_id'], fmt) for fmt in fmts)
+        for book_id, fmt in parse_which(which):
+            if book_id in allowed_book_ids:
+                if reset or (book_id, fmt.upper()) in changed or (book_id, '') in changed:
+                    books[f'{book_id}:{fmt}'] = annotations_data(db, book_id, fmt, user)
+                else:
+                    books[f'{book_id}:{fmt}'] = {'last_read_positions': db.get_last_read_positions(book_id, fmt, user)}
+    return {'change_seq': latest, 'reset': reset, 'books': books}
+
+
 @endpoint('/book-update-annotations/{library_id}/{book_id}/{+fmt}', types={'book_id': int}, methods=('POST',))
 def update_annotations(ctx, rd, library_id, book_id, fmt):
     db = get_db(ctx, rd, library_id)
@@ -244,18 +244,17 @@ def cdb_copy_to_library(ctx, rd, target_library_id, library_id):
     if duplicate_action != 'add':
         identical_books_data = db_dest.data_for_find_identical_books()
     to_remove = set()
-    from calibre.db.copy_to_library import copy_one_book
+    from calibre.db.copy_to_library import copy_books
+    results, failures = copy_books(
+        book_ids, db_src, db_dest, duplicate_action=duplicate_action, automerge_action=automerge_action,
+        preserve_uuid=move_books, preserve_date=preserve_date, identical_books_data=identical_books_data, use_hardlinks=move_books)
     for book_id in book_ids:
-        try:
-            rdata = copy_one_book(
-                    book_id, db_src, db_dest, duplicate_action=duplicate_action, automerge_action=automerge_action,
-                    preserve_uuid=move_books, preserve_date=preserve_date, identical_books_data=identical_books_data)
+        if book_id in results:
             if move_books:
                 to_remove.add(book_id)
-            response[book_id] = {'ok': True, 'payload': rdata}
-        except Exception:
-            import traceback
-            response[book_id] = {'ok': False, 'payload': traceback.format_exc()}
+            response[book_id] = {'ok': True, 'payload': results[book_id]}
+        else:
+            response[book_id] = {'ok': False, 'payload': failures.get(book_id, '')}
 
     if to_remove:
         db_src.remove_books(to_remove, permanent=True)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Push notifications of changes to libraries to WebSocket clients, so that they
+do not have to poll /ajax/changes. Clients connect to /ws/changes, which needs
+the same authentication as the other endpoints, and receive a JSON message
+for every batch of changes to the libraries they can access, of the form::
+
+    {"type": "changes", "library_id": ..., "change_seq": ..., "fields": [...],
+     "added": [...], "metadata": [...], "formats": [...], "annotations": [...],
+     "removed": [...]}
+
+where the lists are of book ids, see :func:`calibre.db.listeners.change_log_entry`.
+Books that the user is not allowed to access are reported as removed. Use
+/interface-data/book-changes with change_seq to get the changed books. When
+there are no changes for a while, a {"type": "keepalive"} message is sent so
+that the connection is not closed for inactivity.
+'''
+
+import json
+from collections import defaultdict
+from threading import Event, Lock
+from urllib.parse import urlparse
+
+from calibre.db.listeners import change_log_entry
+from calibre.srv.errors import HTTPForbidden, HTTPNotFound
+from calibre.utils.monotonic import monotonic
+from calibre.utils.speedups import ReadOnlyFileBuffer
+
+CHANGE_KINDS = ('added', 'metadata', 'formats', 'annotations', 'removed')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def origin_matches_host(origin, inheaders):
+    try:
+        purl = urlparse(origin)
+        origin_port = purl.port or DEFAULT_PORTS.get(purl.scheme)
+    except ValueError:
+        return False
+    if not purl.hostname:
+        return False
+    for host in (inheaders.get('Host'), inheaders.get('X-Forwarded-Host')):
+        if host:
+            try:
+                hurl = urlparse(f'{purl.scheme}://{host.split(",")[0].strip()}')
+                port = hurl.port or DEFAULT_PORTS.get(purl.scheme)
+            except ValueError:
+                continue
+            if hurl.hostname == purl.hostname and port == origin_port:
+                return True
+    return False
+
+
+class UserData:
+
+    def __init__(self, username):
+        self.username = username
+
+
+class ChangeNotifier:
+
+    '''
+    A server plugin that is also the WebSocket handler for /ws/changes. The
+    changes are collected from the event listeners of the libraries, see
+    :meth:`calibre.srv.library_broker.LibraryBroker.add_db_event_callback`.
+    Events in quick succession, such as when many books are edited at once,
+    are sent as a single message, after coalesce_interval seconds. In
+    processes that do not make changes to libraries themselves, use
+    :meth:`poll_for_changes` to read the changes from the change logs of the
+    libraries instead.
+    '''
+
+    coalesce_interval = 0.5
+    poll_interval = 1
+
+    def __init__(self, handler):
+        self.ctx, self.router = handler.router.ctx, handler.router
+        self.auth_controller = handler.auth_controller
+        self.path = (self.router.strip_path or ()) + ('ws', 'changes')
+        self.lock = Lock()
+        self.connections = {}
+        self.pending = {}
+        self.change_seqs = None
+        self.changed, self.shutdown = Event(), Event()
+        self.ctx.library_broker.add_db_event_callback(self.on_db_event)
+
+    def poll_for_changes(self):
+        self.change_seqs = {}
+
+    # Server plugin {{{
+    def start(self, loop):
+        keepalive_interval = max(1, loop.opts.timeout / 2)
+        last_sent = monotonic()
+        while True:
+            self.changed.wait(keepalive_interval if self.change_seqs is None else self.poll_interval)
+            if self.shutdown.is_set():
+                break
+            if self.change_seqs is not None:
+                try:
+                    self.read_change_logs()
+                except Exception:
+                    loop.log.exception('Failed to read library change logs')
+            if self.pending:
+                self.shutdown.wait(self.coalesce_interval)
+                self.changed.clear()
+                try:
+                    self.send_pending()
+                except Exception:
+                    loop.log.exception('Failed to send library change notifications')
+                last_sent = monotonic()
+            elif monotonic() - last_sent >= keepalive_interval:
+                self.broadcast('{"type": "keepalive"}')
+                last_sent = monotonic()
+
+    def stop(self):
+        self.shutdown.set()
+        self.changed.set()
+    # }}}
+
+    # Collecting changes {{{
+    def on_db_event(self, library_id, event_type, event_data):
+        entry = change_log_entry(event_type, event_data)
+        if entry is not None and self.connections:
+            self.add_changes(library_id, *entry)
+            self.changed.set()
+
+    def add_changes(self, library_id, kind, book_ids, fields=()):
+        with self.lock:
+            changes = self.pending.get(library_id)
+            if changes is None:
+                changes = self.pending[library_id] = defaultdict(set)
+            book_ids = set(book_ids)
+            if kind == 'removed':
+                for k in CHANGE_KINDS:
+                    changes[k] -= book_ids
+            changes[kind] |= book_ids
+            changes['fields'].update(fields)
+
+    def read_change_logs(self):
+        broker = self.ctx.library_broker
+        with broker:
+            dbs = {library_id: db for library_id, db in broker.loaded_dbs.items() if db is not None}
+        for library_id, db in dbs.items():
+            db = db.new_api
+            seq = self.change_seqs.get(library_id)
+            if seq is None:
+                self.change_seqs[library_id] = db.last_change_seq()
+                continue
+            changes = db.changes_since(seq)
+            self.change_seqs[library_id] = changes['latest_seq']
+            if self.connections:
+                for change in changes['changes']:
+                    self.add_changes(library_id, change['kind'], (change['book_id'],), change['fields'])
+    # }}}
+
+    # Sending changes {{{
+    def send_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            connections = tuple(self.connections.values())
+        for library_id, changes in pending.items():
+            db = self.ctx.library_broker.get(library_id)
+            if db is None:
+                continue
+            db = db.new_api
+            change_seq = db.last_change_seq()
+            messages = {}
+            for connection_ref, username in connections:
+                if username not in messages:
+                    messages[username] = self.message_for_user(username, library_id, db, changes, change_seq)
+                if messages[username] is not None:
+                    self.send(connection_ref, messages[username])
+
+    def message_for_user(self, username, library_id, db, changes, change_seq):
+        data = UserData(username)
+        try:
+            if library_id not in self.ctx.library_info(data)[0]:
+                return
+        except HTTPForbidden:
+            return
+        ans = {'type': 'changes', 'library_id': library_id, 'change_seq': change_seq, 'fields': sorted(changes['fields'])}
+        kinds = {k: changes[k] for k in CHANGE_KINDS}
+        if self.ctx.restriction_for(data, db):
+            allowed_book_ids = self.ctx.allowed_book_ids(data, db)
+            removed = set(kinds.pop('removed'))
+            for k, book_ids in tuple(kinds.items()):
+                kinds[k] = book_ids & allowed_book_ids
+                removed |= book_ids - allowed_book_ids
+            kinds['removed'] = removed
+        if not any(kinds.values()):
+            return
+        for k, book_ids in kinds.items():
+            ans[k] = sorted(book_ids)
+        return json.dumps(ans)
+
+    def send(self, connection_ref, message):
+        conn = connection_ref()
+        if conn is not None and conn.ready:
+            conn.send_websocket_message(message)
+
+    def broadcast(self, message):
+        with self.lock:
+            connections = tuple(self.connections.values())
+        for connection_ref, username in connections:
+            self.send(connection_ref, message)
+    # }}}
+
+    # WebSocket handler {{{
+    def check_websocket_upgrade(self, connection_id, conn, inheaders):
+        # Called in a worker thread of the server
+        if conn.path != self.path:
+            raise HTTPNotFound()
+        origin = inheaders.get('Origin')
+        if origin is not None and not origin_matches_host(origin, inheaders):
+            # Browsers send the Origin of the page that opened the connection,
+            # which must not be allowed to read the changes using the
+            # credentials of the user
+            raise HTTPForbidden(f'WebSocket connections from {origin} are not allowed')
+        username = None
+        if self.auth_controller is not None:
+            data = conn.create_request_data(inheaders, ReadOnlyFileBuffer(b''))
+            self.router.read_cookies(data)
+            if not (self.auth_controller.session_max_age_seconds and self.auth_controller.validate_session(data)):
+                self.auth_controller.do_http_auth(data, None)
+            username = data.username
+        # Raises HTTPForbidden if the user cannot access any libraries
+        self.ctx.library_info(UserData(username))
+        conn.websocket_username = username
+
+    def handle_websocket_upgrade(self, connection_id, connection_ref, inheaders):
+        with self.lock:
+            self.connections[connection_id] = connection_ref, connection_ref().websocket_username
+
+    def handle_websocket_data(self, connection_id, data, message_starting, message_finished):
+        pass  # Clients have nothing to say
+
+    def handle_websocket_pong(self, connection_id, data):
+        pass
+
+    def handle_websocket_close(self, connection_id):
+        with self.lock:
+            self.connections.pop(connection_id, None)
+    # }}}
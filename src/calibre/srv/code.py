@@ -16,10 +16,11 @@
 from calibre.customize.ui import available_input_formats
 from calibre.db.view import sanitize_sort_field_name
 from calibre.ebooks.metadata.book.render import resolve_default_author_link
-from calibre.srv.ajax import search_result
+from calibre.srv.ajax import changes_for_user, search_result
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound, HTTPRedirect, HTTPTempRedirect
 from calibre.srv.last_read import last_read_cache
-from calibre.srv.metadata import book_as_json, categories_as_json, categories_settings, get_gpref, icon_map, web_search_link
+from calibre.srv.metadata import book_as_json, books_as_json, categories_as_json, categories_settings, categories_subtree, get_gpref, icon_map, web_search_link
+from calibre.srv.metrics import metrics_as_text
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
@@ -79,6 +80,19 @@ def console_print(ctx, rd):
     return ''
 
 
+@endpoint('/metrics', cache_control='no-cache')
+def server_metrics(ctx, rd):
+    '''
+    Metrics about the requests, worker threads, jobs, caches and database
+    locks of this server process, in the Prometheus text exposition format.
+    Only available to authenticated users and trusted IP addresses.
+    '''
+    if not rd.username and not rd.is_trusted_ip:
+        raise HTTPForbidden('Metrics are only available to authenticated users')
+    rd.outheaders['Content-Type'] = 'text/plain; version=0.0.4; charset=UTF-8'
+    return metrics_as_text(ctx)
+
+
 def get_basic_query_data(ctx, rd):
     db, library_id, library_map, default_library = get_library_data(ctx, rd)
     skeys = db.field_metadata.sortable_field_keys()
@@ -233,20 +247,18 @@ def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
         ans['book_details_vertical_categories'] = db._pref('book_details_vertical_categories', ())
         ans['fields_that_support_notes'] = tuple(db._field_supports_notes())
         ans['categories_using_hierarchy'] = db._pref('categories_using_hierarchy', ())
-        mdata = ans['metadata'] = {}
         try:
             extra_books = {
                 int(x) for x in rd.query.get('extra_books', '').split(',')
             }
         except Exception:
             extra_books = ()
-        for coll in (ans['search_result']['book_ids'], extra_books):
-            for book_id in coll:
-                if book_id not in mdata:
-                    data = book_as_json(db, book_id)
-                    if data is not None:
-                        mdata[book_id] = data
-    return ans
+        ans['change_seq'] = db._last_change_seq()
+        book_ids = list(ans['search_result']['book_ids'])
+        seen = set(book_ids)
+        book_ids.extend(x for x in extra_books if x not in seen)
+        mdata = books_as_json(db, book_ids)
+    return ans, mdata
 
 
 @endpoint('/interface-data/books-init', postprocess=json)
@@ -263,8 +275,9 @@ def books(ctx, rd):
     except Exception:
         raise HTTPNotFound('Invalid number of books: {!r}'.format(rd.query.get('num')))
     library_id, db, sorts, orders, vl = get_basic_query_data(ctx, rd)
-    ans = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
+    ans, mdata = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
     ans['library_id'] = library_id
+    ans['metadata'] = mdata
     return ans
 
 
@@ -294,7 +307,9 @@ def interface_data(ctx, rd):
         num = int(rd.query.get('num', rd.opts.num_per_page))
     except Exception:
         raise HTTPNotFound('Invalid number of books: {!r}'.format(rd.query.get('num')))
-    ans.update(get_library_init_data(ctx, rd, db, num, sorts, orders, vl))
+    data, mdata = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
+    ans.update(data)
+    ans['metadata'] = mdata
     return ans
 
 
@@ -321,6 +336,9 @@ def more_books(ctx, rd):
     be specified as JSON in the request body.
 
     Optional: ?num=50&library_id=<default library>
+
+    The query can have the optional key after, the id of the last book of the
+    previous page, used instead of offset to get the next page.
     '''
     db, library_id = get_library_data(ctx, rd)[:2]
 
@@ -333,21 +351,24 @@ def more_books(ctx, rd):
         query, offset, sorts, orders, vl = search_query['query'], search_query[
             'offset'
         ], search_query['sort'], search_query['sort_order'], search_query['vl']
+        after = search_query.get('after')
     except KeyError as err:
         raise HTTPBadRequest(f'Search query missing key: {as_unicode(err)}')
     except Exception as err:
         raise HTTPBadRequest(f'Invalid query: {as_unicode(err)}')
+    if after is not None:
+        try:
+            after = int(after)
+        except Exception:
+            raise HTTPBadRequest(f'Invalid after: {after!r}')
     ans = {}
     with db.safe_read_lock:
         ans['search_result'] = search_result(
-            ctx, rd, db, query, num, offset, sorts, orders, vl
+            ctx, rd, db, query, num, offset, sorts, orders, vl, after=after
         )
-        mdata = ans['metadata'] = {}
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
+        mdata = books_as_json(db, ans['search_result']['book_ids'])
 
+    ans['metadata'] = mdata
     return ans
 
 
@@ -384,8 +405,8 @@ def get_books(ctx, rd):
     searchq = rd.query.get('search', '')
     db = get_library_data(ctx, rd)[0]
     ans = {}
-    mdata = ans['metadata'] = {}
     with db.safe_read_lock:
+        ans['change_seq'] = db._last_change_seq()
         try:
             ans['search_result'] = search_result(
                 ctx, rd, db, searchq, num, 0, ','.join(sorts), ','.join(orders), vl
@@ -394,10 +415,50 @@ def get_books(ctx, rd):
             # This must not be translated as it is used by the front end to
             # detect invalid search expressions
             raise HTTPBadRequest(f'Invalid search expression: {as_unicode(err)}')
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
+        mdata = books_as_json(db, ans['search_result']['book_ids'])
+    ans['metadata'] = mdata
+    return ans
+
+
+@endpoint('/interface-data/book-changes/{since}', postprocess=json, types={'since': int})
+def book_changes(ctx, rd, since):
+    '''
+    Get the books added, changed or removed since the change with sequence
+    number since, which is the change_seq returned by /interface-data/init,
+    /interface-data/books-init and /interface-data/get-books. Used by clients
+    to update the books they have instead of downloading them all again. The
+    metadata of added and changed books is returned in the same format as
+    /interface-data/get-books. Annotations are not reported, use
+    /book-get-annotations-changes for them.
+
+    If reset is True the changes no longer go back as far as since and the
+    client must get all the books again. Otherwise, if more is True, call
+    again with change_seq to get the remaining changes.
+
+    Optional: ?library_id=<default library>&num=500
+    '''
+    db, library_id = get_library_data(ctx, rd)[:2]
+    try:
+        num = max(1, int(rd.query.get('num', 500)))
+    except Exception:
+        raise HTTPNotFound('Invalid number of changes: {!r}'.format(rd.query.get('num')))
+    with db.safe_read_lock:
+        changes = changes_for_user(ctx, rd, db, since, num)
+        changed, removed = set(), set()
+        for change in changes['changes']:
+            if change['kind'] == 'removed':
+                changed.discard(change['book_id'])
+                removed.add(change['book_id'])
+            elif change['kind'] != 'annotations':
+                removed.discard(change['book_id'])
+                changed.add(change['book_id'])
+        mdata = books_as_json(db, sorted(changed))
+    removed |= changed - set(mdata)
+    ans = {
+        'library_id': library_id, 'change_seq': changes['latest_seq'], 'reset': changes['reset'],
+        'more': len(changes['changes']) >= num, 'removed_book_ids': sorted(removed),
+    }
+    ans['metadata'] = mdata
     return ans
 
 
@@ -450,15 +511,34 @@ def tag_browser(ctx, rd):
     Get the Tag Browser serialized as JSON
     Optional: ?library_id=<default library>&sort_tags_by=name&partition_method=first letter
               &collapse_at=25&dont_collapse=&hide_empty_categories=&vl=''
+              &node=<key of a node, once for every level from the root>&depth=0
+
+    If node or depth are specified only the part of the tree below node, to a
+    depth of depth levels (all levels if zero) is returned, nodes whose
+    children are left out have the number of children in num_children. Node
+    keys, unlike node ids, do not change when the library changes, see
+    :func:`calibre.srv.metadata.categories_node_key`.
     '''
     db, library_id = get_library_data(ctx, rd)[:2]
     opts = categories_settings(rd.query, db, gst_container=tuple)
     vl = rd.query.get('vl') or ''
-    etag = json_dumps([db.last_modified().isoformat(), rd.username, library_id, vl, list(opts)])
+    path = tuple(rd.query.get('node', all=True))
+    try:
+        depth = max(0, int(rd.query.get('depth', 0)))
+    except Exception:
+        raise HTTPNotFound('Invalid depth: {!r}'.format(rd.query.get('depth')))
+    etag = json_dumps([db.last_modified().isoformat(), rd.username, library_id, vl, list(opts), path, depth])
     etag = hashlib.sha1(etag).hexdigest()
+    subtree = None
+    if path or depth:
+        def subtree(data):
+            ans = categories_subtree(data, path, depth)
+            if ans is None:
+                raise HTTPNotFound('No node {} in the Tag Browser'.format(' > '.join(path)))
+            return ans
 
     def generate():
-        return json(ctx, rd, tag_browser, categories_as_json(ctx, rd, db, opts, vl))
+        return json(ctx, rd, tag_browser, categories_as_json(ctx, rd, db, opts, vl, subtree=subtree))
 
     return rd.etagged_dynamic_response(etag, generate)
 
@@ -8,6 +8,7 @@
 import errno
 import os
 import re
+from collections import OrderedDict
 from contextlib import suppress
 from functools import partial
 from io import BytesIO
@@ -16,15 +17,18 @@
 
 from calibre import fit_image, guess_type, sanitize_file_name
 from calibre.constants import config_dir, iswindows
+from calibre.customize.ui import configured_metadata_writer
 from calibre.db.constants import DATA_DIR_NAME, DATA_FILE_PATTERN, RESOURCE_URL_SCHEME
 from calibre.db.errors import NoSuchFormat
 from calibre.ebooks.covers import cprefs, generate_cover, override_prefs, scale_cover, set_use_roman
 from calibre.ebooks.metadata import authors_to_string
+from calibre.ebooks.metadata.epub import get_zip_reader
 from calibre.ebooks.metadata.meta import set_metadata
-from calibre.ebooks.metadata.opf2 import metadata_to_opf
+from calibre.ebooks.metadata.opf2 import OPF, metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.metadata import encode_stat_result
+from calibre.srv.metrics import metrics
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_use_roman, http_date
 from calibre.utils.config_base import tweaks
@@ -36,6 +40,7 @@
 from calibre.utils.resources import get_path as P
 from calibre.utils.shared_file import share_open
 from calibre.utils.speedups import ReadOnlyFileBuffer
+from calibre.utils.spliced_zip import SplicedZipFile
 from polyglot.binary import as_hex_unicode, from_base64_bytes
 from polyglot.urllib import quote
 
@@ -65,11 +70,13 @@ def open_for_write(fname):
 
 
 def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func, extra_etag_data=''):
-    ''' We cannot copy files directly from the library folder to the output
-    socket, as this can potentially lock the library for an extended period. So
-    instead we copy out the data from the library folder into a temp folder. We
-    make sure to only do this copy once, using the previous copy, if there have
-    been no changes to the data for the file since the last copy. '''
+    ''' Files that have to be generated or changed, such as covers and formats
+    whose metadata is updated, and on Windows all files, as open files there
+    prevent the library from changing them, are not sent directly from the
+    library folder. Instead we copy out the data from the library folder into a
+    temp folder. We make sure to only do this copy once, using the previous
+    copy, if there have been no changes to the data for the file since the last
+    copy. '''
     global rename_counter
 
     # Avoid too many items in a single directory for performance
@@ -117,6 +124,7 @@ def safe_mtime():
                 ans = open_for_write(fname)
                 copy_func(ans)
                 ans.seek(0)
+        metrics.file_cache_access('files' if prefix == 'fmt' else 'covers', used_cache == 'yes')
         if ctx.testing:
             rd.outheaders['Used-Cache'] = used_cache
             rd.outheaders['Tempfile'] = as_hex_unicode(fname)
@@ -187,6 +195,73 @@ def book_filename(rd, book_id, mi, fmt, as_encoded_unicode=False):
     return fname
 
 
+# The most recently served EPUB files with updated metadata, so that the OPF
+# and cover are not generated again for every download and Range request
+spliced_epubs = OrderedDict()
+spliced_epubs_lock = Lock()
+MAX_SPLICED_EPUBS = 16
+
+
+def spliced_epub(db, book_id, fmt, mi, cache_key):
+    '''
+    Return the EPUB with its metadata updated by replacing only the OPF and
+    cover in the ZIP file as it is read, without copying the file, or None if
+    that is not possible. cache_key must change whenever the metadata or
+    cover of the book change.
+    '''
+    plugin = configured_metadata_writer(fmt)
+    if not hasattr(plugin, 'metadata_replacements'):
+        return
+    path = db.format_abspath(book_id, fmt)
+    if not path:
+        return
+    try:
+        stream = share_open(path, 'rb')
+    except OSError:
+        return
+    try:
+        st = os.fstat(stream.fileno())
+        key = cache_key + (book_id, db.cover_last_modified(book_id), path, st.st_ino, st.st_size, st.st_mtime_ns)
+        with spliced_epubs_lock:
+            cached = spliced_epubs.get(key)
+            if cached is not None:
+                spliced_epubs.move_to_end(key)
+        if cached is not None:
+            return cached.reopen(stream)
+        reader = get_zip_reader(stream, root=os.getcwd())
+        if not mi.cover_data or not mi.cover_data[-1]:
+            cdata = db.cover(book_id)
+            if cdata:
+                mi.cover_data = ('jpeg', cdata)
+        with plugin:
+            opfbytes, replacements = plugin.metadata_replacements(reader, mi, fmt)
+        replacements[reader.container[OPF.MIMETYPE]] = opfbytes
+        ans = SplicedZipFile(stream, replacements, name=path, mtime=st.st_mtime)
+        with spliced_epubs_lock:
+            spliced_epubs[key] = ans.reopen(None)
+            while len(spliced_epubs) > MAX_SPLICED_EPUBS:
+                spliced_epubs.popitem(last=False)
+        return ans
+    except Exception:
+        # Fall back to updating a copy of the file
+        stream.close()
+
+
+def open_format(db, book_id, fmt):
+    ''' Open the file for the specified format directly in the library
+    folder, so that it can be sent with sendfile(). The library is only locked
+    while opening the file, as files that are replaced or deleted after being
+    opened remain readable, except on Windows. The library does not change
+    format files in place, see
+    :meth:`calibre.db.backend.DB.replacing_file`. Returns None if the file
+    could not be opened. '''
+    with db.safe_read_lock:
+        path = db.format_abspath(book_id, fmt)
+        if path:
+            with suppress(OSError):
+                return share_open(path, 'rb')
+
+
 def book_fmt(ctx, rd, library_id, db, book_id, fmt):
     mdata = db.format_metadata(book_id, fmt)
     if not mdata:
@@ -225,6 +300,17 @@ def copy_func(dest):
     rd.outheaders['Content-Disposition'] = (
         f'''{cd}; filename="{book_filename(rd, book_id, mi, fmt)}"; filename*=utf-8''{book_filename(rd, book_id, mi, fmt, as_encoded_unicode=True)}''')
 
+    if update_metadata and fmt == 'epub' and not iswindows:
+        ans = spliced_epub(db, book_id, fmt, mi, (library_id, mtime, extra_etag_data))
+        if ans is not None:
+            rd.outheaders['Content-Type'] = guess_type('a.epub')[0]
+            return rd.filesystem_file_with_custom_etag(ans, 'fmt', library_id, book_id, mtime, extra_etag_data)
+
+    if not update_metadata and not iswindows:
+        ans = open_format(db, book_id, fmt)
+        if ans is not None:
+            return rd.filesystem_file_with_custom_etag(ans, 'fmt', library_id, book_id, mtime, extra_etag_data)
+
     return create_file_copy(ctx, rd, 'fmt', library_id, book_id, fmt, mtime, copy_func, extra_etag_data=extra_etag_data)
 # }}}
 
@@ -11,9 +11,10 @@
 from calibre import as_unicode
 from calibre.constants import cache_dir, config_dir, is_running_from_develop
 from calibre.srv.bonjour import BonJour
+from calibre.srv.books import Prerenderer
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
-from calibre.srv.loop import ServerLoop
+from calibre.srv.loop import server_loop_class
 from calibre.srv.opts import server_config
 from calibre.srv.utils import RotatingLog
 
@@ -68,6 +69,8 @@ def __init__(self, library_broker, notify_changes):
         plugins = self.plugins = []
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
+        if opts.prerender_books > 0:
+            plugins.append(Prerenderer(self.handler.ctx, opts.prerender_books))
         self.opts = opts
         self.log, self.access_log = log, access_log
         self.handler.set_log(self.log)
@@ -85,7 +88,7 @@ def user_manager(self):
     def start(self):
         if self.current_thread is None:
             try:
-                self.loop = ServerLoop(
+                self.loop = server_loop_class(self.opts)(
                     create_http_handler(self.handler.dispatch),
                     opts=self.opts,
                     log=self.log,
@@ -103,6 +106,7 @@ def start(self):
                         pass
                 return
             self.handler.set_jobs_manager(self.loop.jobs_manager)
+            self.handler.set_thread_pool(self.loop.pool)
             self.current_thread = t = Thread(
                 name='EmbeddedServer', target=self.serve_forever
             )
@@ -7,6 +7,7 @@
 from importlib import import_module
 from threading import Lock
 
+from calibre.db.categories import categories_affected_by
 from calibre.srv.auth import AuthController
 from calibre.srv.errors import HTTPForbidden
 from calibre.srv.library_broker import LibraryBroker, path_for_db
@@ -17,13 +18,52 @@
 from polyglot.builtins import itervalues
 
 
+class TagBrowserCacheEntry:
+
+    __slots__ = ('book_ids', 'categories', 'change_seq', 'data', 'json', 'lock', 'timestamp')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.book_ids = self.categories = self.change_seq = self.data = self.json = self.timestamp = None
+
+
+class RestrictionCacheEntry:
+
+    __slots__ = ('book_ids', 'lock', 'state')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.book_ids = self.state = None
+
+
+class SortCacheEntry:
+
+    __slots__ = ('ids', 'lock', 'positions')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.ids = self.positions = None
+
+    @property
+    def size(self):
+        # A map of positions costs several times as much as the ids
+        return 0 if self.ids is None else len(self.ids) * (1 if self.positions is None else 5)
+
+
 class Context:
 
     log = None
     url_for = None
     jobs_manager = None
+    thread_pool = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
+    SORT_CACHE_SIZE = 100
+    # The maximum total number of book ids in the cached sorted search results
+    # of a library, see SortCacheEntry.size
+    MAX_SORT_CACHE_IDS = 2000000
+    RESTRICTION_CACHE_SIZE = 25
+    MAX_TAG_BROWSER_CHANGES = 1000
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
@@ -87,7 +127,7 @@ def has_id(self, request_data, db, book_id):
         restriction = self.restriction_for(request_data, db)
         if restriction:
             try:
-                return book_id in db.search('', restriction=restriction)
+                return book_id in self.restricted_book_ids(db, restriction)
             except ParseException:
                 return False
         return db.has_id(book_id)
@@ -96,12 +136,12 @@ def newest_book_ids(self, request_data, db, count=5):
         restriction = self.restriction_for(request_data, db)
         allowed_book_ids = None
         if restriction:
-            allowed_book_ids = db.search('', restriction=restriction)
+            allowed_book_ids = self.restricted_book_ids(db, restriction)
         return db.newly_added_book_ids(count=count, book_ids=allowed_book_ids)
 
     def get_allowed_book_ids_from_restriction(self, request_data, db):
         restriction = self.restriction_for(request_data, db)
-        return frozenset(db.search('', restriction=restriction)) if restriction else None
+        return self.restricted_book_ids(db, restriction) if restriction else None
 
     def allowed_book_ids(self, request_data, db):
         try:
@@ -112,6 +152,49 @@ def allowed_book_ids(self, request_data, db):
             ans = db.all_book_ids()
         return ans
 
+    def restricted_book_ids(self, db, restriction):
+        '''
+        Return the ids of the books matching the library restriction of a
+        user. The ids are cached per library and restriction. When books are
+        changed, only the books whose search results may have changed, see
+        :meth:`calibre.db.cache.Cache.books_with_changed_search_results`, are
+        searched again.
+        '''
+        with self.lock:
+            cache = self.library_broker.restriction_caches[db.server_library_id]
+            entry = cache.pop(restriction, None)
+            if entry is None:
+                entry = RestrictionCacheEntry()
+            cache[restriction] = entry
+            if len(cache) > self.RESTRICTION_CACHE_SIZE:
+                cache.popitem(last=False)
+        # Callers may already hold the db read lock, so it is acquired before
+        # the lock of the entry, never after it
+        with db.safe_read_lock, entry.lock:
+            # The db can be replaced by a new db for the same library, in the GUI
+            state = id(db), db.clear_all_search_caches_count, db.clear_search_cache_count
+            if entry.book_ids is not None and entry.state != state and not self.update_restricted_book_ids(db, restriction, entry, state):
+                entry.book_ids = None
+            if entry.book_ids is None:
+                entry.state = state
+                entry.book_ids = frozenset(db.search('', restriction=restriction))
+            return entry.book_ids
+
+    def update_restricted_book_ids(self, db, restriction, entry, state):
+        # Must be called with the lock of the entry and the db read lock held.
+        # Returns False if the ids have to be searched for again.
+        if entry.state[:2] != state[:2]:
+            return False
+        changed = db.books_with_changed_search_results(entry.state[2])
+        if changed is None:
+            return False
+        ids = set(entry.book_ids) - changed
+        changed &= db.all_book_ids()
+        if changed:
+            ids |= db.search('', restriction=restriction, book_ids=changed)
+        entry.state, entry.book_ids = state, frozenset(ids)
+        return True
+
     def check_for_write_access(self, request_data):
         if not request_data.username:
             if request_data.is_trusted_ip:
@@ -122,7 +205,11 @@ def check_for_write_access(self, request_data):
 
     def get_effective_book_ids(self, db, request_data, vl, report_parse_errors=False):
         try:
-            return db.books_in_virtual_library(vl, self.restriction_for(request_data, db))
+            restriction = self.restriction_for(request_data, db)
+            if not restriction:
+                return db.books_in_virtual_library(vl)
+            ans = self.restricted_book_ids(db, restriction)
+            return ans & db.books_in_virtual_library(vl) if vl else ans
         except ParseException:
             if report_parse_errors:
                 raise
@@ -133,7 +220,7 @@ def get_categories(self, request_data, db, sort='name', first_letter_sort=True,
         restrict_to_ids = self.get_effective_book_ids(db, request_data, vl,
                                           report_parse_errors=report_parse_errors)
         key = restrict_to_ids, sort, first_letter_sort
-        with self.lock:
+        with db.safe_read_lock, self.lock:
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
             if old is None or old[0] <= db.last_modified():
@@ -145,23 +232,55 @@ def get_categories(self, request_data, db, sort='name', first_letter_sort=True,
                 cache[key] = old
             return old[1]
 
-    def get_tag_browser(self, request_data, db, opts, render, vl=''):
+    def get_tag_browser(self, request_data, db, opts, render, vl='', subtree=None):
+        '''
+        Return the Tag Browser created by render() as JSON, or only the part
+        of it returned by subtree(), if specified. The Tag Browser is cached
+        per virtual library, restriction and opts. When the library changes
+        only the categories affected by the changes are read again. Different
+        Tag Browsers are created in parallel.
+        '''
         restrict_to_ids = self.get_effective_book_ids(db, request_data, vl)
-        key = restrict_to_ids, opts
+        key = vl, self.restriction_for(request_data, db), opts
         with self.lock:
-            cache = self.library_broker.category_caches[db.server_library_id]
-            old = cache.pop(key, None)
-            if old is None or old[0] <= db.last_modified():
-                categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
-                data = json.dumps(render(db, categories), ensure_ascii=False)
-                if isinstance(data, str):
-                    data = data.encode('utf-8')
-                cache[key] = old = (utcnow(), data)
-                if len(cache) > self.CATEGORY_CACHE_SIZE:
-                    cache.popitem(last=False)
-            else:
-                cache[key] = old
-            return old[1]
+            cache = self.library_broker.tag_browser_caches[db.server_library_id]
+            entry = cache.pop(key, None)
+            if entry is None:
+                entry = TagBrowserCacheEntry()
+            cache[key] = entry
+            if len(cache) > self.CATEGORY_CACHE_SIZE:
+                cache.popitem(last=False)
+        with entry.lock:
+            if entry.data is None or entry.book_ids != restrict_to_ids or entry.timestamp <= db.last_modified():
+                self.update_tag_browser(entry, db, opts, render, restrict_to_ids)
+            if subtree is not None:
+                return json.dumps(subtree(entry.data), ensure_ascii=False).encode('utf-8')
+            if entry.json is None:
+                entry.json = json.dumps(entry.data, ensure_ascii=False).encode('utf-8')
+            return entry.json
+
+    def update_tag_browser(self, entry, db, opts, render, restrict_to_ids):
+        timestamp, change_seq = utcnow(), db.last_change_seq()
+        reuse = None
+        if entry.data is not None and entry.book_ids == restrict_to_ids:
+            changes = db.changes_since(entry.change_seq, limit=self.MAX_TAG_BROWSER_CHANGES)
+            if not changes['reset'] and len(changes['changes']) < self.MAX_TAG_BROWSER_CHANGES:
+                fields = set()
+                for change in changes['changes']:
+                    if change['kind'] == 'metadata':
+                        fields.update(change['fields'])
+                    elif change['kind'] == 'formats':
+                        fields.add('formats')
+                    elif change['kind'] != 'annotations':
+                        break
+                else:
+                    affected = categories_affected_by(db.field_metadata, fields)
+                    if affected is not None:
+                        reuse = {k: v for k, v in entry.categories.items() if k not in affected}
+        entry.categories = db.get_categories(
+            book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter', reuse=reuse)
+        entry.data, entry.json = render(db, entry.categories), None
+        entry.book_ids, entry.timestamp, entry.change_seq = restrict_to_ids, timestamp, change_seq
 
     def search(self, request_data, db, query, vl='', report_restriction_errors=False):
         try:
@@ -172,9 +291,16 @@ def search(self, request_data, db, query, vl='', report_restriction_errors=False
             except ParseException as e:
                 return frozenset(), e
             return frozenset(), None
-        query = query or ''
+        matches = self.cached_search(db, query or '', restrict_to_ids)
+        if report_restriction_errors:
+            return matches, None
+        return matches
+
+    def cached_search(self, db, query, restrict_to_ids):
         key = query, restrict_to_ids
-        with self.lock:
+        # The db read lock is always acquired before self.lock, as callers may
+        # already hold it
+        with db.safe_read_lock, self.lock:
             cache = self.library_broker.search_caches[db.server_library_id]
             old = cache.pop(key, None)
             if old is None or old[0] < db.clear_search_cache_count:
@@ -184,10 +310,59 @@ def search(self, request_data, db, query, vl='', report_restriction_errors=False
                     cache.popitem(last=False)
             else:
                 cache[key] = old
-            if report_restriction_errors:
-                return old[1], None
             return old[1]
 
+    def sorted_search(self, request_data, db, query, multisort, vl='', after=None):
+        '''
+        Return the ids of the books matching query, sorted by multisort, as a
+        tuple, the error, if any, in the restriction of the user and, if after
+        is the id of one of the books, the position following it, else None.
+        The sorted ids are cached, so that paginating through them only costs
+        a slice. The positions of the books are only mapped when after is
+        used. Different sorts are done in parallel.
+        '''
+        try:
+            restrict_to_ids = self.get_effective_book_ids(db, request_data, vl, report_parse_errors=True)
+        except ParseException:
+            try:
+                self.get_allowed_book_ids_from_restriction(request_data, db)
+            except ParseException as e:
+                return (), e, None
+            return (), None, None
+        query = query or ''
+        matches = self.cached_search(db, query, restrict_to_ids)
+        key = query, restrict_to_ids, tuple(multisort), db.clear_search_cache_count
+        with self.lock:
+            cache = self.library_broker.sort_caches[db.server_library_id]
+            entry = cache.pop(key, None)
+            if entry is None:
+                entry = SortCacheEntry()
+            cache[key] = entry
+            if len(cache) > self.SORT_CACHE_SIZE:
+                cache.popitem(last=False)
+        # Callers may already hold the db read lock, so it is acquired before
+        # the lock of the entry, never after it
+        with db.safe_read_lock, entry.lock:
+            if entry.ids is not None and after is None:
+                return entry.ids, None, None
+            size = entry.size
+            if entry.ids is None:
+                entry.ids = tuple(db.multisort(fields=multisort, ids_to_sort=matches))
+            ids, position = entry.ids, None
+            if after is not None:
+                if entry.positions is None:
+                    entry.positions = {book_id: i for i, book_id in enumerate(ids)}
+                position = entry.positions.get(after)
+                if position is not None:
+                    position += 1
+            grown = entry.size > size
+        if grown:
+            with self.lock:
+                total = sum(e.size for e in cache.values())
+                while total > self.MAX_SORT_CACHE_IDS and len(cache) > 1:
+                    total -= cache.popitem(last=False)[1].size
+        return ids, None, position
+
 
 SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'fts')
 
@@ -201,7 +376,8 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
             has_ssl = opts.ssl_certfile is not None and opts.ssl_keyfile is not None
             prefer_basic_auth = {'auto':has_ssl, 'basic':True}.get(opts.auth_mode, False)
             self.auth_controller = AuthController(
-                user_credentials=ctx.user_manager, prefer_basic_auth=prefer_basic_auth, ban_time_in_minutes=opts.ban_for, ban_after=opts.ban_after)
+                user_credentials=ctx.user_manager, prefer_basic_auth=prefer_basic_auth, ban_time_in_minutes=opts.ban_for, ban_after=opts.ban_after,
+                session_max_age_seconds=opts.auth_session_timeout * 60, session_cookie_path=opts.url_prefix or '/')
         self.router = Router(ctx=ctx, url_prefix=opts.url_prefix, auth_controller=self.auth_controller)
         for module in SRV_MODULES:
             module = import_module('calibre.srv.' + module)
@@ -218,6 +394,9 @@ def set_log(self, log):
     def set_jobs_manager(self, jobs_manager):
         self.router.ctx.jobs_manager = jobs_manager
 
+    def set_thread_pool(self, thread_pool):
+        self.router.ctx.thread_pool = thread_pool
+
     def close(self):
         self.router.ctx.library_broker.close()
 
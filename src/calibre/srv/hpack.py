@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+HPACK, the header compression format used by HTTP/2, see RFC 7541. The
+decoder supports everything a client can send. The encoder, used for the few
+headers in server responses, only uses the static table and does not use
+Huffman coding.
+'''
+
+# The static table, from Appendix A of RFC 7541
+STATIC_TABLE = (
+    (b':authority', b''),
+    (b':method', b'GET'),
+    (b':method', b'POST'),
+    (b':path', b'/'),
+    (b':path', b'/index.html'),
+    (b':scheme', b'http'),
+    (b':scheme', b'https'),
+    (b':status', b'200'),
+    (b':status', b'204'),
+    (b':status', b'206'),
+    (b':status', b'304'),
+    (b':status', b'400'),
+    (b':status', b'404'),
+    (b':status', b'500'),
+    (b'accept-charset', b''),
+    (b'accept-encoding', b'gzip, deflate'),
+    (b'accept-language', b''),
+    (b'accept-ranges', b''),
+    (b'accept', b''),
+    (b'access-control-allow-origin', b''),
+    (b'age', b''),
+    (b'allow', b''),
+    (b'authorization', b''),
+    (b'cache-control', b''),
+    (b'content-disposition', b''),
+    (b'content-encoding', b''),
+    (b'content-language', b''),
+    (b'content-length', b''),
+    (b'content-location', b''),
+    (b'content-range', b''),
+    (b'content-type', b''),
+    (b'cookie', b''),
+    (b'date', b''),
+    (b'etag', b''),
+    (b'expect', b''),
+    (b'expires', b''),
+    (b'from', b''),
+    (b'host', b''),
+    (b'if-match', b''),
+    (b'if-modified-since', b''),
+    (b'if-none-match', b''),
+    (b'if-range', b''),
+    (b'if-unmodified-since', b''),
+    (b'last-modified', b''),
+    (b'link', b''),
+    (b'location', b''),
+    (b'max-forwards', b''),
+    (b'proxy-authenticate', b''),
+    (b'proxy-authorization', b''),
+    (b'range', b''),
+    (b'referer', b''),
+    (b'refresh', b''),
+    (b'retry-after', b''),
+    (b'server', b''),
+    (b'set-cookie', b''),
+    (b'strict-transport-security', b''),
+    (b'transfer-encoding', b''),
+    (b'user-agent', b''),
+    (b'vary', b''),
+    (b'via', b''),
+    (b'www-authenticate', b''),
+)
+
+# The Huffman code (code, length in bits) for every byte value, followed by
+# the code for EOS, from Appendix B of RFC 7541
+HUFFMAN_CODES = (
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28), (0xfffffe4, 28), (0xfffffe5, 28), (0xfffffe6, 28),
+    (0xfffffe7, 28), (0xfffffe8, 28), (0xffffea, 24), (0x3ffffffc, 30), (0xfffffe9, 28), (0xfffffea, 28), (0x3ffffffd,
+    30), (0xfffffeb, 28), (0xfffffec, 28), (0xfffffed, 28), (0xfffffee, 28), (0xfffffef, 28), (0xffffff0, 28), (0xffffff1,
+    28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28), (0xffffff4, 28), (0xffffff5, 28), (0xffffff6, 28),
+    (0xffffff7, 28), (0xffffff8, 28), (0xffffff9, 28), (0xffffffa, 28), (0xffffffb, 28), (0x14, 6), (0x3f8, 10), (0x3f9,
+    10), (0xffa, 12), (0x1ff9, 13), (0x15, 6), (0xf8, 8), (0x7fa, 11), (0x3fa, 10), (0x3fb, 10), (0xf9, 8), (0x7fb, 11),
+    (0xfa, 8), (0x16, 6), (0x17, 6), (0x18, 6), (0x0, 5), (0x1, 5), (0x2, 5), (0x19, 6), (0x1a, 6), (0x1b, 6), (0x1c, 6),
+    (0x1d, 6), (0x1e, 6), (0x1f, 6), (0x5c, 7), (0xfb, 8), (0x7ffc, 15), (0x20, 6), (0xffb, 12), (0x3fc, 10), (0x1ffa,
+    13), (0x21, 6), (0x5d, 7), (0x5e, 7), (0x5f, 7), (0x60, 7), (0x61, 7), (0x62, 7), (0x63, 7), (0x64, 7), (0x65, 7),
+    (0x66, 7), (0x67, 7), (0x68, 7), (0x69, 7), (0x6a, 7), (0x6b, 7), (0x6c, 7), (0x6d, 7), (0x6e, 7), (0x6f, 7), (0x70,
+    7), (0x71, 7), (0x72, 7), (0xfc, 8), (0x73, 7), (0xfd, 8), (0x1ffb, 13), (0x7fff0, 19), (0x1ffc, 13), (0x3ffc, 14),
+    (0x22, 6), (0x7ffd, 15), (0x3, 5), (0x23, 6), (0x4, 5), (0x24, 6), (0x5, 5), (0x25, 6), (0x26, 6), (0x27, 6), (0x6,
+    5), (0x74, 7), (0x75, 7), (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5), (0x2b, 6), (0x76, 7), (0x2c, 6), (0x8, 5), (0x9,
+    5), (0x2d, 6), (0x77, 7), (0x78, 7), (0x79, 7), (0x7a, 7), (0x7b, 7), (0x7ffe, 15), (0x7fc, 11), (0x3ffd, 14),
+    (0x1ffd, 13), (0xffffffc, 28), (0xfffe6, 20), (0x3fffd2, 22), (0xfffe7, 20), (0xfffe8, 20), (0x3fffd3, 22), (0x3fffd4,
+    22), (0x3fffd5, 22), (0x7fffd9, 23), (0x3fffd6, 22), (0x7fffda, 23), (0x7fffdb, 23), (0x7fffdc, 23), (0x7fffdd, 23),
+    (0x7fffde, 23), (0xffffeb, 24), (0x7fffdf, 23), (0xffffec, 24), (0xffffed, 24), (0x3fffd7, 22), (0x7fffe0, 23),
+    (0xffffee, 24), (0x7fffe1, 23), (0x7fffe2, 23), (0x7fffe3, 23), (0x7fffe4, 23), (0x1fffdc, 21), (0x3fffd8, 22),
+    (0x7fffe5, 23), (0x3fffd9, 22), (0x7fffe6, 23), (0x7fffe7, 23), (0xffffef, 24), (0x3fffda, 22), (0x1fffdd, 21),
+    (0xfffe9, 20), (0x3fffdb, 22), (0x3fffdc, 22), (0x7fffe8, 23), (0x7fffe9, 23), (0x1fffde, 21), (0x7fffea, 23),
+    (0x3fffdd, 22), (0x3fffde, 22), (0xfffff0, 24), (0x1fffdf, 21), (0x3fffdf, 22), (0x7fffeb, 23), (0x7fffec, 23),
+    (0x1fffe0, 21), (0x1fffe1, 21), (0x3fffe0, 22), (0x1fffe2, 21), (0x7fffed, 23), (0x3fffe1, 22), (0x7fffee, 23),
+    (0x7fffef, 23), (0xfffea, 20), (0x3fffe2, 22), (0x3fffe3, 22), (0x3fffe4, 22), (0x7ffff0, 23), (0x3fffe5, 22),
+    (0x3fffe6, 22), (0x7ffff1, 23), (0x3ffffe0, 26), (0x3ffffe1, 26), (0xfffeb, 20), (0x7fff1, 19), (0x3fffe7, 22),
+    (0x7ffff2, 23), (0x3fffe8, 22), (0x1ffffec, 25), (0x3ffffe2, 26), (0x3ffffe3, 26), (0x3ffffe4, 26), (0x7ffffde, 27),
+    (0x7ffffdf, 27), (0x3ffffe5, 26), (0xfffff1, 24), (0x1ffffed, 25), (0x7fff2, 19), (0x1fffe3, 21), (0x3ffffe6, 26),
+    (0x7ffffe0, 27), (0x7ffffe1, 27), (0x3ffffe7, 26), (0x7ffffe2, 27), (0xfffff2, 24), (0x1fffe4, 21), (0x1fffe5, 21),
+    (0x3ffffe8, 26), (0x3ffffe9, 26), (0xffffffd, 28), (0x7ffffe3, 27), (0x7ffffe4, 27), (0x7ffffe5, 27), (0xfffec, 20),
+    (0xfffff3, 24), (0xfffed, 20), (0x1fffe6, 21), (0x3fffe9, 22), (0x1fffe7, 21), (0x1fffe8, 21), (0x7ffff3, 23),
+    (0x3fffea, 22), (0x3fffeb, 22), (0x1ffffee, 25), (0x1ffffef, 25), (0xfffff4, 24), (0xfffff5, 24), (0x3ffffea, 26),
+    (0x7ffff4, 23), (0x3ffffeb, 26), (0x7ffffe6, 27), (0x3ffffec, 26), (0x3ffffed, 26), (0x7ffffe7, 27), (0x7ffffe8, 27),
+    (0x7ffffe9, 27), (0x7ffffea, 27), (0x7ffffeb, 27), (0xffffffe, 28), (0x7ffffec, 27), (0x7ffffed, 27), (0x7ffffee, 27),
+    (0x7ffffef, 27), (0x7fffff0, 27), (0x3ffffee, 26), (0x3fffffff, 30),
+)
+
+STATIC_TABLE_SIZE = len(STATIC_TABLE)
+STATIC_INDEX = {}
+STATIC_NAME_INDEX = {}
+for i, (name, value) in enumerate(STATIC_TABLE, start=1):
+    STATIC_INDEX.setdefault((name, value), i)
+    STATIC_NAME_INDEX.setdefault(name, i)
+del i, name, value
+EOS = len(HUFFMAN_CODES) - 1
+# Maps a code with a leading 1 bit marking its length to its symbol
+HUFFMAN_DECODE_MAP = {(1 << length) | code: sym for sym, (code, length) in enumerate(HUFFMAN_CODES)}
+DEFAULT_TABLE_SIZE = 4096
+ENTRY_OVERHEAD = 32
+
+
+class HPACKError(ValueError):
+    pass
+
+
+class HeaderListTooLarge(HPACKError):
+    pass
+
+
+def decode_integer(data, pos, prefix_bits):
+    ' Decode the integer at pos in data, returning it and the position after it '
+    mask = (1 << prefix_bits) - 1
+    try:
+        ans = data[pos] & mask
+        pos += 1
+        if ans < mask:
+            return ans, pos
+        shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            ans += (b & 0x7f) << shift
+            shift += 7
+            if not b & 0x80:
+                return ans, pos
+            if shift > 28:
+                raise HPACKError('Integer too large')
+    except IndexError:
+        raise HPACKError('Truncated integer')
+
+
+def encode_integer(value, prefix_bits, flags=0):
+    mask = (1 << prefix_bits) - 1
+    if value < mask:
+        return bytes((flags | value,))
+    ans = bytearray((flags | mask,))
+    value -= mask
+    while value >= 0x80:
+        ans.append((value & 0x7f) | 0x80)
+        value >>= 7
+    ans.append(value)
+    return bytes(ans)
+
+
+def huffman_decode(data):
+    ans = bytearray()
+    code, length = 1, 0
+    lookup = HUFFMAN_DECODE_MAP.get
+    for byte in data:
+        for shift in range(7, -1, -1):
+            code = (code << 1) | ((byte >> shift) & 1)
+            length += 1
+            sym = lookup(code)
+            if sym is not None:
+                if sym == EOS:
+                    raise HPACKError('EOS in Huffman encoded string')
+                ans.append(sym)
+                code, length = 1, 0
+            elif length > 30:
+                raise HPACKError('Invalid Huffman code')
+    # The padding must be the most significant bits of EOS, that is all ones,
+    # and shorter than a byte
+    if length > 7 or code != (1 << (length + 1)) - 1:
+        raise HPACKError('Invalid padding in Huffman encoded string')
+    return bytes(ans)
+
+
+def decode_string(data, pos):
+    try:
+        huffman = data[pos] & 0x80
+    except IndexError:
+        raise HPACKError('Truncated string')
+    length, pos = decode_integer(data, pos, 7)
+    end = pos + length
+    if end > len(data):
+        raise HPACKError('Truncated string')
+    raw = bytes(data[pos:end])
+    return (huffman_decode(raw) if huffman else raw), end
+
+
+def encode_string(raw):
+    return encode_integer(len(raw), 7) + raw
+
+
+class Decoder:
+
+    '''
+    Decode header blocks into lists of (name, value) bytestrings. A decoder
+    must be used for all the header blocks of a connection, in the order they
+    were received, as they share the dynamic table.
+    '''
+
+    def __init__(self, max_table_size=DEFAULT_TABLE_SIZE):
+        # The maximum size we allow the peer to use, as sent in SETTINGS
+        self.max_allowed_table_size = self.max_table_size = max_table_size
+        self.dynamic_table = []  # newest entry first
+        self.table_size = 0
+
+    def evict(self):
+        while self.table_size > self.max_table_size:
+            name, value = self.dynamic_table.pop()
+            self.table_size -= len(name) + len(value) + ENTRY_OVERHEAD
+
+    def add(self, name, value):
+        self.dynamic_table.insert(0, (name, value))
+        self.table_size += len(name) + len(value) + ENTRY_OVERHEAD
+        self.evict()
+
+    def entry(self, idx):
+        if idx < 1:
+            raise HPACKError('Invalid header table index: 0')
+        if idx <= STATIC_TABLE_SIZE:
+            return STATIC_TABLE[idx - 1]
+        try:
+            return self.dynamic_table[idx - STATIC_TABLE_SIZE - 1]
+        except IndexError:
+            raise HPACKError(f'Invalid header table index: {idx}')
+
+    def literal(self, data, pos, prefix_bits):
+        idx, pos = decode_integer(data, pos, prefix_bits)
+        if idx:
+            name = self.entry(idx)[0]
+        else:
+            name, pos = decode_string(data, pos)
+        value, pos = decode_string(data, pos)
+        return name, value, pos
+
+    def decode(self, data, max_size=None):
+        '''
+        Decode the header block in data. If max_size is specified and the
+        decoded header list, measured as in SETTINGS_MAX_HEADER_LIST_SIZE, is
+        larger, HeaderListTooLarge is raised, after the whole block has been
+        processed, so that the dynamic table remains usable.
+        '''
+        ans = []
+        pos, end = 0, len(data)
+        headers_seen = False
+        size = 0
+        while pos < end:
+            b = data[pos]
+            if b & 0x80:
+                idx, pos = decode_integer(data, pos, 7)
+                header = self.entry(idx)
+            elif b & 0x40:
+                name, value, pos = self.literal(data, pos, 6)
+                self.add(name, value)
+                header = name, value
+            elif b & 0x20:
+                if headers_seen:
+                    raise HPACKError('Dynamic table size update after header fields')
+                size, pos = decode_integer(data, pos, 5)
+                if size > self.max_allowed_table_size:
+                    raise HPACKError(f'Dynamic table size update to {size} is too large')
+                self.max_table_size = size
+                self.evict()
+                continue
+            else:
+                # Literal without indexing or never indexed
+                name, value, pos = self.literal(data, pos, 4)
+                header = name, value
+            headers_seen = True
+            if ans is not None:
+                size += len(header[0]) + len(header[1]) + ENTRY_OVERHEAD
+                if max_size is not None and size > max_size:
+                    ans = None
+                else:
+                    ans.append(header)
+        if ans is None:
+            raise HeaderListTooLarge(f'Header list larger than {max_size} bytes')
+        return ans
+
+
+class Encoder:
+
+    ' Encode lists of (name, value) bytestrings into header blocks '
+
+    def encode(self, headers):
+        ans = []
+        for name, value in headers:
+            idx = STATIC_INDEX.get((name, value))
+            if idx is not None:
+                ans.append(encode_integer(idx, 7, 0x80))
+                continue
+            # Literal without indexing, indexed name
+            idx = STATIC_NAME_INDEX.get(name)
+            if idx is None:
+                ans.append(b'\0' + encode_string(name))
+            else:
+                ans.append(encode_integer(idx, 4))
+            ans.append(encode_string(value))
+        return b''.join(ans)
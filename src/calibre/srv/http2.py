@@ -0,0 +1,675 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+HTTP/2 support, see RFC 9113. Clients negotiate HTTP/2 with ALPN during the
+SSL handshake or, without SSL, by starting the connection with the HTTP/2
+connection preface ("prior knowledge"). All the requests a client makes at the
+same time, for example for the covers in the cover grid, are then sent as
+streams over a single connection and processed in parallel by the worker
+threads. Responses are created exactly as for HTTP/1.1, by :class:`H2Stream`,
+and sent as HEADERS and DATA frames, interleaved between streams and subject
+to flow control. Server push is not supported.
+'''
+
+import socket
+import sys
+import traceback
+from collections import deque
+from functools import partial
+from io import DEFAULT_BUFFER_SIZE, BytesIO
+from struct import Struct, pack, unpack_from
+
+from calibre.ptempfile import SpooledTemporaryFile
+from calibre.srv.errors import HTTPSimpleResponse
+from calibre.srv.hpack import Decoder, Encoder, HeaderListTooLarge, HPACKError
+from calibre.srv.http_request import HTTP2_PREFACE_REQUEST_LINE, HTTP_METHODS, HTTPHeaderParser, parse_uri
+from calibre.srv.http_response import GeneratedOutput, HTTPConnection, Range
+from calibre.srv.loop import RDWR, READ, WRITE
+from calibre.srv.utils import HTTP11
+from calibre.srv.web_socket import WebSocketConnection
+from polyglot import http_client
+from polyglot.builtins import error_message, reraise
+from polyglot.queue import Full
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+# 24 bit length as 16 + 8 bits, type, flags, stream id
+FRAME_HEADER = Struct('!HBBBL')
+
+DATA, HEADERS, PRIORITY, RST_STREAM, SETTINGS, PUSH_PROMISE, PING, GOAWAY, WINDOW_UPDATE, CONTINUATION = range(10)
+END_STREAM = ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+
+(NO_ERROR, PROTOCOL_ERROR, INTERNAL_ERROR, FLOW_CONTROL_ERROR, SETTINGS_TIMEOUT, STREAM_CLOSED, FRAME_SIZE_ERROR,
+ REFUSED_STREAM, CANCEL, COMPRESSION_ERROR, CONNECT_ERROR, ENHANCE_YOUR_CALM, INADEQUATE_SECURITY, HTTP_1_1_REQUIRED) = range(14)
+
+(SETTINGS_HEADER_TABLE_SIZE, SETTINGS_ENABLE_PUSH, SETTINGS_MAX_CONCURRENT_STREAMS, SETTINGS_INITIAL_WINDOW_SIZE,
+ SETTINGS_MAX_FRAME_SIZE, SETTINGS_MAX_HEADER_LIST_SIZE) = range(1, 7)
+
+DEFAULT_WINDOW_SIZE = 65535
+MAX_WINDOW_SIZE = 2**31 - 1
+DEFAULT_MAX_FRAME_SIZE = 16384
+MAX_CONCURRENT_STREAMS = 100
+# The flow control window we allow the client, for the connection and for
+# every stream
+RECEIVE_WINDOW_SIZE = 1024 * 1024
+# Stop generating DATA frames when this many bytes are waiting to be sent
+SEND_BUFFER_SIZE = 256 * 1024
+SEND_CHUNK_SIZE = 64 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+# Headers that are not allowed in HTTP/2 messages
+CONNECTION_SPECIFIC_HEADERS = frozenset((b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding', b'upgrade'))
+PSEUDO_HEADERS = frozenset((b':method', b':path', b':scheme', b':authority'))
+
+
+class H2Error(Exception):
+
+    def __init__(self, code, msg):
+        Exception.__init__(self, msg)
+        self.code = code
+
+
+def strip_padding(flags, payload):
+    if flags & PADDED:
+        if not payload or payload[0] >= len(payload):
+            raise H2Error(PROTOCOL_ERROR, 'Invalid padding')
+        payload = payload[1:len(payload) - payload[0]]
+    return payload
+
+
+def run_stream_job(stream_id, func):
+    # Jobs for the streams of a connection share the file descriptor of the
+    # connection, so their results carry the stream id
+    try:
+        return stream_id, True, func()
+    except Exception:
+        return stream_id, False, sys.exc_info()
+
+
+async def stream_coroutine(stream_id, coro):
+    try:
+        return stream_id, True, await coro
+    except Exception:
+        return stream_id, False, sys.exc_info()
+
+
+def read_chunks(f, size=None):
+    while size is None or size > 0:
+        data = f.read(SEND_CHUNK_SIZE if size is None else min(SEND_CHUNK_SIZE, size))
+        if not data:
+            break
+        if size is not None:
+            size -= len(data)
+        yield data
+
+
+def output_chunks(output):
+    ' Iterate over the body of a response, as HTTPConnection.write_response_body() would send it '
+    if isinstance(output, GeneratedOutput):
+        for chunk in output.output:
+            if chunk:
+                yield chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+        return
+    f, ranges = output.src_file, output.ranges
+    if ranges is None:
+        yield from read_chunks(f)
+    elif isinstance(ranges, Range):
+        f.seek(ranges.start)
+        yield from read_chunks(f, ranges.size)
+    else:
+        first = True
+        for r, range_part in ranges:
+            if r is None:
+                yield b'\r\n' + range_part
+            else:
+                yield (b'' if first else b'\r\n') + range_part + b'\r\n'
+                first = False
+                f.seek(r.start)
+                yield from read_chunks(f, r.size)
+
+
+def parse_response_head(raw):
+    ' Convert an HTTP/1.1 response head into HTTP/2 header fields and the remaining data '
+    head, body = bytes(raw).partition(b'\r\n\r\n')[::2]
+    lines = head.split(b'\r\n')
+    headers = [(b':status', lines[0].split(b' ', 2)[1])]
+    for line in lines[1:]:
+        name, value = line.partition(b':')[::2]
+        name = name.strip().lower()
+        if name not in CONNECTION_SPECIFIC_HEADERS:
+            headers.append((name, value.strip()))
+    return headers, body
+
+
+class H2Stream(HTTPConnection):
+
+    '''
+    A single request on an HTTP/2 connection. Responses are generated by the
+    code in :class:`HTTPConnection` and handed over to the connection for
+    sending in :meth:`response_ready`.
+    '''
+
+    def __init__(self, conn, stream_id, send_window):
+        self.conn, self.stream_id = conn, stream_id
+        for attr in (
+            'opts', 'log', 'access_log', 'remote_addr', 'remote_port', 'is_trusted_ip', 'tdir', 'request_handler',
+            'static_cache', 'translator_cache', 'compressed_cache', 'max_header_line_size', 'max_request_body_size',
+        ):
+            setattr(self, attr, getattr(conn, attr))
+        self.handle_event = None
+        self.method = self.request_line = self.path = self.query = self.scheme = None
+        self.forwarded_for = self.request_original_uri = None
+        self.response_protocol = self.request_protocol = HTTP11
+        self.close_after_response = self.response_started = False
+        self.inheaders = self.request_body = None
+        self.request_body_size = 0
+        # Set when the client has finished sending the request
+        self.remote_closed = False
+        self.job_pending = False
+        # Flow control window for sending
+        self.send_window = send_window
+        # Bytes received since the last WINDOW_UPDATE for the stream
+        self.unacknowledged = 0
+        # The response body, as an iterator over chunks and the current chunk
+        self.body, self.pending = None, b''
+        # Set when sending is blocked by the flow control window of the stream
+        self.blocked = False
+
+    @property
+    def state_description(self):
+        return 'HTTP/2 stream: {} Client: {}:{} Request: {}'.format(
+            self.stream_id, self.remote_addr, self.remote_port, (self.request_line or b'').decode('utf-8', 'replace'))
+
+    @property
+    def run_coroutine(self):
+        if self.conn.run_coroutine is not None:
+            return self.run_stream_coroutine
+
+    def run_stream_coroutine(self, coro):
+        self.job_pending = True
+        self.conn.run_coroutine(stream_coroutine(self.stream_id, coro))
+
+    def headers_received(self, headers):
+        if headers is None:
+            # The decoded headers are larger than h2_max_header_list_size
+            return self.simple_response(http_client.REQUEST_HEADER_FIELDS_TOO_LARGE)
+        pseudo = {}
+        parser = HTTPHeaderParser()
+        try:
+            for name, value in headers:
+                if b'\r' in value or b'\n' in value or b'\0' in value:
+                    raise ValueError(f'Invalid value for header: {name!r}')
+                if name.startswith(b':'):
+                    if name not in PSEUDO_HEADERS or name in pseudo or parser.hdict or parser.lines:
+                        raise ValueError(f'Invalid pseudo-header: {name!r}')
+                    pseudo[name] = value
+                else:
+                    if name != name.lower() or name in CONNECTION_SPECIFIC_HEADERS or (name == b'te' and value != b'trailers'):
+                        raise ValueError(f'Invalid header: {name!r}')
+                    parser(name + b': ' + value + b'\r\n')
+            parser(b'\r\n')
+            method, path = pseudo[b':method'], pseudo[b':path']
+            self.scheme = pseudo[b':scheme'].decode('ascii')
+            self.method = method.decode('ascii')
+        except (KeyError, ValueError) as e:
+            self.log.warn(f'Malformed HTTP/2 request from: {self.remote_addr}: {e}')
+            return self.conn.h2_reset_stream(self.stream_id, PROTOCOL_ERROR)
+        self.request_line = method + b' ' + path + b' HTTP/2'
+        self.inheaders = inheaders = parser.hdict
+        if 'Host' not in inheaders and b':authority' in pseudo:
+            inheaders['Host'] = pseudo[b':authority'].decode('utf-8', 'replace')
+        if self.method not in HTTP_METHODS:
+            return self.simple_response(http_client.BAD_REQUEST, 'Unknown HTTP method')
+        self.request_original_uri = path
+        try:
+            self.path, self.query = parse_uri(path)[1:]
+        except HTTPSimpleResponse as e:
+            return self.simple_response(e.http_code, error_message(e))
+        try:
+            request_content_length = int(inheaders.get('Content-Length', 0))
+        except ValueError:
+            return self.simple_response(http_client.BAD_REQUEST, 'Invalid Content-Length')
+        if request_content_length > self.max_request_body_size:
+            return self.simple_response(http_client.REQUEST_ENTITY_TOO_LARGE,
+                f'The entity sent with the request exceeds the maximum allowed bytes ({self.max_request_body_size}).')
+        self.forwarded_for = inheaders.get('X-Forwarded-For')
+
+    @property
+    def accepts_data(self):
+        return self.inheaders is not None and not self.response_started and not self.job_pending
+
+    def data_received(self, data):
+        if not self.accepts_data or not data:
+            return
+        self.request_body_size += len(data)
+        if self.request_body_size > self.max_request_body_size:
+            return self.simple_response(http_client.REQUEST_ENTITY_TOO_LARGE,
+                f'The entity sent with the request exceeds the maximum allowed bytes ({self.max_request_body_size}).')
+        if self.request_body is None:
+            self.request_body = SpooledTemporaryFile(prefix='rq-body-', max_size=DEFAULT_BUFFER_SIZE, dir=self.tdir)
+        self.request_body.write(data)
+
+    def request_received(self):
+        if self.accepts_data:
+            self.prepare_response(self.inheaders, BytesIO() if self.request_body is None else self.request_body)
+
+    def queue_job(self, func, *args):
+        if args:
+            func = partial(func, *args)
+        try:
+            self.conn.pool.put_nowait(self.conn.socket.fileno(), partial(run_stream_job, self.stream_id, func))
+        except Full:
+            self.log.warn(f'Server busy handling request: {self.state_description}')
+            return self.report_busy()
+        self.job_pending = True
+
+    def response_ready(self, header_file, output=None):
+        self.response_started = True
+        self.conn.h2_send_response(self, header_file, output)
+
+
+class HTTP2Connection(WebSocketConnection):
+
+    ' A connection that switches to HTTP/2 when the client asks for it '
+
+    in_h2_mode = False
+
+    def connection_ready(self):
+        if not self.in_h2_mode and self.ssl_context is not None and self.opts.use_http2 and self.socket.selected_alpn_protocol() == 'h2':
+            return self.start_h2(PREFACE)
+        WebSocketConnection.connection_ready(self)
+
+    def start_http2_with_prior_knowledge(self):
+        if self.ssl_context is not None or not self.opts.use_http2:
+            return False
+        self.start_h2(PREFACE[len(HTTP2_PREFACE_REQUEST_LINE):])
+        return True
+
+    def start_h2(self, expected_preface):
+        self.in_h2_mode = True
+        # The server loop must close the connection rather than send an
+        # HTTP/1.1 response if an error occurs
+        self.response_started = True
+        self.request_line = b'HTTP/2'
+        self.h2_expected_preface = expected_preface
+        self.h2_in, self.h2_out = bytearray(), bytearray()
+        self.h2_decoder, self.h2_encoder = Decoder(), Encoder()
+        self.h2_streams = {}
+        # Streams with response data to send, in round robin order
+        self.h2_send_order = deque()
+        self.h2_last_stream_id = 0
+        # (stream_id, flags, header block) while CONTINUATION frames are expected
+        self.h2_continuation = None
+        self.h2_settings_received = self.h2_goaway_sent = self.h2_goaway_received = False
+        self.h2_send_window = DEFAULT_WINDOW_SIZE
+        self.h2_unacknowledged = 0
+        self.h2_initial_window_size = DEFAULT_WINDOW_SIZE
+        self.h2_max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        self.h2_max_header_list_size = self.max_header_line_size * 8
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        self.h2_send_frame(SETTINGS, 0, 0, b''.join(pack('!HL', k, v) for k, v in (
+            (SETTINGS_ENABLE_PUSH, 0), (SETTINGS_MAX_CONCURRENT_STREAMS, MAX_CONCURRENT_STREAMS),
+            (SETTINGS_INITIAL_WINDOW_SIZE, RECEIVE_WINDOW_SIZE), (SETTINGS_MAX_HEADER_LIST_SIZE, self.h2_max_header_list_size))))
+        self.h2_send_frame(WINDOW_UPDATE, 0, 0, pack('!L', RECEIVE_WINDOW_SIZE - DEFAULT_WINDOW_SIZE))
+        self.handle_event = self.h2_event
+        self.h2_update_state()
+
+    @property
+    def state_description(self):
+        if self.in_h2_mode:
+            return f'HTTP/2 Client: {self.remote_addr}:{self.remote_port} Streams: {len(self.h2_streams)}'
+        return WebSocketConnection.state_description.fget(self)
+
+    def handle_timeout(self):
+        if self.in_h2_mode:
+            # Keep the connection open while requests are being processed
+            return any(s.job_pending for s in self.h2_streams.values())
+        return WebSocketConnection.handle_timeout(self)
+
+    def close(self):
+        if self.in_h2_mode:
+            self.h2_streams.clear(), self.h2_send_order.clear()
+        WebSocketConnection.close(self)
+
+    def h2_event(self, event):
+        if event is READ:
+            self.h2_read()
+        elif event is WRITE:
+            self.h2_write()
+        else:
+            ok, result = event
+            if not ok:
+                reraise(*result)
+            self.h2_job_done(*result)
+        self.h2_update_state()
+
+    def h2_update_state(self):
+        if not self.ready:
+            return
+        if not self.h2_goaway_sent:
+            self.h2_fill_send_buffer()
+        if self.h2_out:
+            self.wait_for = WRITE if self.h2_goaway_sent else RDWR
+        elif self.h2_goaway_sent or (self.h2_goaway_received and not self.h2_streams):
+            self.ready = False
+        else:
+            self.wait_for = READ
+
+    # Sending {{{
+    def h2_send_frame(self, ftype, flags, stream_id, payload=b''):
+        n = len(payload)
+        self.h2_out += FRAME_HEADER.pack(n >> 8, n & 0xff, ftype, flags, stream_id)
+        self.h2_out += payload
+
+    def h2_write(self):
+        if self.h2_out:
+            sent = self.send(self.h2_out[:SEND_CHUNK_SIZE])
+            if sent:
+                del self.h2_out[:sent]
+
+    def h2_reset_stream(self, stream_id, code):
+        self.h2_send_frame(RST_STREAM, 0, stream_id, pack('!L', code))
+        self.h2_streams.pop(stream_id, None)
+
+    def h2_connection_error(self, code, msg):
+        self.log.warn(f'HTTP/2 connection error for client: {self.remote_addr}: {msg}')
+        self.h2_send_frame(GOAWAY, 0, 0, pack('!LL', self.h2_last_stream_id, code) + msg.encode('utf-8'))
+        self.h2_goaway_sent = True
+        self.h2_send_order.clear()
+
+    def h2_send_response(self, stream, header_file, output):
+        headers, body = parse_response_head(header_file.read())
+        end_stream = stream.method == 'HEAD' or (output is None and not body)
+        block = self.h2_encoder.encode(headers)
+        size = self.h2_max_frame_size
+        self.h2_send_frame(HEADERS, (END_STREAM if end_stream else 0) | (0 if len(block) > size else END_HEADERS), stream.stream_id, block[:size])
+        for i in range(size, len(block), size):
+            self.h2_send_frame(CONTINUATION, 0 if i + size < len(block) else END_HEADERS, stream.stream_id, block[i:i+size])
+        if end_stream:
+            self.h2_stream_sent(stream)
+        else:
+            stream.body = iter((body,)) if output is None else output_chunks(output)
+            self.h2_send_order.append(stream)
+
+    def h2_stream_sent(self, stream):
+        if self.h2_streams.get(stream.stream_id) is stream:
+            if stream.remote_closed:
+                del self.h2_streams[stream.stream_id]
+            else:
+                # The response was sent before the request was complete, tell
+                # the client to stop sending it
+                self.h2_reset_stream(stream.stream_id, NO_ERROR)
+
+    def h2_next_chunk(self, stream):
+        try:
+            stream.pending = memoryview(next(stream.body))
+        except StopIteration:
+            stream.body = None
+        except Exception:
+            self.log.exception(f'Error while generating response for: {stream.state_description}')
+            stream.body = None
+            self.h2_reset_stream(stream.stream_id, INTERNAL_ERROR)
+
+    def h2_fill_send_buffer(self):
+        order = self.h2_send_order
+        while order and len(self.h2_out) < SEND_BUFFER_SIZE and self.h2_send_window > 0:
+            stream = order.popleft()
+            if self.h2_streams.get(stream.stream_id) is not stream:
+                continue  # reset
+            if not stream.pending and stream.body is not None:
+                self.h2_next_chunk(stream)
+                if self.h2_streams.get(stream.stream_id) is not stream:
+                    continue
+            if not stream.pending and stream.body is None:
+                self.h2_send_frame(DATA, END_STREAM, stream.stream_id)
+                self.h2_stream_sent(stream)
+                continue
+            n = min(len(stream.pending), stream.send_window, self.h2_send_window, self.h2_max_frame_size)
+            if n <= 0:
+                stream.blocked = True
+                continue
+            chunk, stream.pending = stream.pending[:n], stream.pending[n:]
+            if not stream.pending:
+                self.h2_next_chunk(stream)
+                if self.h2_streams.get(stream.stream_id) is not stream:
+                    continue
+            stream.send_window -= n
+            self.h2_send_window -= n
+            if stream.body is None and not stream.pending:
+                self.h2_send_frame(DATA, END_STREAM, stream.stream_id, chunk)
+                self.h2_stream_sent(stream)
+            else:
+                self.h2_send_frame(DATA, 0, stream.stream_id, chunk)
+                order.append(stream)
+
+    def h2_unblock(self, stream):
+        if stream.blocked and stream.send_window > 0:
+            stream.blocked = False
+            self.h2_send_order.append(stream)
+    # }}}
+
+    # Receiving {{{
+    def h2_read(self):
+        data = self.recv(READ_CHUNK_SIZE)
+        if not data:
+            return
+        self.h2_in += data
+        try:
+            self.h2_process_input()
+        except H2Error as e:
+            self.h2_connection_error(e.code, str(e))
+
+    def h2_process_input(self):
+        buf, pos = self.h2_in, 0
+        if self.h2_expected_preface:
+            n = min(len(buf), len(self.h2_expected_preface))
+            if buf[:n] != self.h2_expected_preface[:n]:
+                raise H2Error(PROTOCOL_ERROR, 'Invalid connection preface')
+            self.h2_expected_preface = self.h2_expected_preface[n:]
+            pos = n
+        while len(buf) - pos >= FRAME_HEADER.size and not self.h2_goaway_sent:
+            hi, lo, ftype, flags, stream_id = FRAME_HEADER.unpack_from(buf, pos)
+            length = (hi << 8) | lo
+            if length > DEFAULT_MAX_FRAME_SIZE:
+                raise H2Error(FRAME_SIZE_ERROR, f'Frame of size {length} is too large')
+            end = pos + FRAME_HEADER.size + length
+            if end > len(buf):
+                break
+            payload = bytes(buf[pos + FRAME_HEADER.size:end])
+            pos = end
+            self.h2_frame_received(ftype, flags, stream_id & 0x7fffffff, payload)
+        del buf[:pos]
+
+    def h2_frame_received(self, ftype, flags, stream_id, payload):
+        if not self.h2_settings_received and ftype != SETTINGS:
+            raise H2Error(PROTOCOL_ERROR, 'The first frame must be a SETTINGS frame')
+        if self.h2_continuation is not None:
+            if ftype != CONTINUATION or stream_id != self.h2_continuation[0]:
+                raise H2Error(PROTOCOL_ERROR, 'Expected a CONTINUATION frame')
+        elif ftype == CONTINUATION:
+            raise H2Error(PROTOCOL_ERROR, 'Unexpected CONTINUATION frame')
+        handler = self.h2_frame_handlers.get(ftype)
+        if handler is not None:  # Unknown frame types must be ignored
+            handler(self, flags, stream_id, payload)
+
+    def h2_data(self, flags, stream_id, payload):
+        if stream_id == 0:
+            raise H2Error(PROTOCOL_ERROR, 'DATA frame for stream 0')
+        self.h2_unacknowledged += len(payload)
+        if self.h2_unacknowledged >= RECEIVE_WINDOW_SIZE // 2:
+            self.h2_send_frame(WINDOW_UPDATE, 0, 0, pack('!L', self.h2_unacknowledged))
+            self.h2_unacknowledged = 0
+        stream = self.h2_streams.get(stream_id)
+        if stream is None or stream.remote_closed:
+            if stream_id > self.h2_last_stream_id:
+                raise H2Error(PROTOCOL_ERROR, 'DATA frame for idle stream')
+            if stream is not None:
+                self.h2_reset_stream(stream_id, STREAM_CLOSED)
+            # else: the stream was reset, ignore frames that were in flight
+            return
+        if flags & END_STREAM:
+            stream.remote_closed = True
+        else:
+            stream.unacknowledged += len(payload)
+            if stream.unacknowledged >= RECEIVE_WINDOW_SIZE // 2:
+                self.h2_send_frame(WINDOW_UPDATE, 0, stream_id, pack('!L', stream.unacknowledged))
+                stream.unacknowledged = 0
+        stream.data_received(strip_padding(flags, payload))
+        if stream.remote_closed:
+            stream.request_received()
+
+    def h2_headers(self, flags, stream_id, payload):
+        if stream_id == 0:
+            raise H2Error(PROTOCOL_ERROR, 'HEADERS frame for stream 0')
+        payload = strip_padding(flags, payload)
+        if flags & PRIORITY_FLAG:
+            payload = payload[5:]
+        if flags & END_HEADERS:
+            self.h2_header_block_received(stream_id, flags, payload)
+        else:
+            self.h2_continuation = stream_id, flags, bytearray(payload)
+
+    def h2_continuation_frame(self, flags, stream_id, payload):
+        block = self.h2_continuation[2]
+        block += payload
+        if len(block) > self.h2_max_header_list_size:
+            raise H2Error(ENHANCE_YOUR_CALM, 'Header block too large')
+        if flags & END_HEADERS:
+            stream_id, flags = self.h2_continuation[:2]
+            self.h2_continuation = None
+            self.h2_header_block_received(stream_id, flags, bytes(block))
+
+    def h2_header_block_received(self, stream_id, flags, block):
+        try:
+            headers = self.h2_decoder.decode(block, max_size=self.h2_max_header_list_size)
+        except HeaderListTooLarge:
+            headers = None
+        except HPACKError as e:
+            raise H2Error(COMPRESSION_ERROR, str(e))
+        stream = self.h2_streams.get(stream_id)
+        if stream is not None:
+            # Trailers, which are ignored
+            if stream.remote_closed or not flags & END_STREAM:
+                return self.h2_reset_stream(stream_id, PROTOCOL_ERROR if not stream.remote_closed else STREAM_CLOSED)
+            stream.remote_closed = True
+            return stream.request_received()
+        if stream_id % 2 == 0 or stream_id <= self.h2_last_stream_id:
+            raise H2Error(PROTOCOL_ERROR if stream_id % 2 == 0 else STREAM_CLOSED, f'HEADERS frame for invalid stream: {stream_id}')
+        self.h2_last_stream_id = stream_id
+        if len(self.h2_streams) >= MAX_CONCURRENT_STREAMS or self.h2_goaway_received:
+            return self.h2_reset_stream(stream_id, REFUSED_STREAM)
+        self.h2_streams[stream_id] = stream = H2Stream(self, stream_id, self.h2_initial_window_size)
+        stream.remote_closed = bool(flags & END_STREAM)
+        stream.headers_received(headers)
+        if stream.remote_closed:
+            stream.request_received()
+
+    def h2_priority(self, flags, stream_id, payload):
+        if stream_id == 0:
+            raise H2Error(PROTOCOL_ERROR, 'PRIORITY frame for stream 0')
+        if len(payload) != 5:
+            self.h2_reset_stream(stream_id, FRAME_SIZE_ERROR)
+
+    def h2_rst_stream(self, flags, stream_id, payload):
+        if stream_id == 0 or stream_id > self.h2_last_stream_id:
+            raise H2Error(PROTOCOL_ERROR, f'RST_STREAM frame for invalid stream: {stream_id}')
+        if len(payload) != 4:
+            raise H2Error(FRAME_SIZE_ERROR, 'Invalid RST_STREAM frame')
+        self.h2_streams.pop(stream_id, None)
+
+    def h2_settings(self, flags, stream_id, payload):
+        if stream_id != 0:
+            raise H2Error(PROTOCOL_ERROR, 'SETTINGS frame for non-zero stream')
+        if flags & ACK:
+            if payload:
+                raise H2Error(FRAME_SIZE_ERROR, 'SETTINGS acknowledgement with payload')
+            return
+        if len(payload) % 6:
+            raise H2Error(FRAME_SIZE_ERROR, 'Invalid SETTINGS frame')
+        for i in range(0, len(payload), 6):
+            key, val = unpack_from('!HL', payload, i)
+            if key == SETTINGS_INITIAL_WINDOW_SIZE:
+                if val > MAX_WINDOW_SIZE:
+                    raise H2Error(FLOW_CONTROL_ERROR, 'Initial window size too large')
+                delta, self.h2_initial_window_size = val - self.h2_initial_window_size, val
+                for stream in self.h2_streams.values():
+                    stream.send_window += delta
+                    if stream.send_window > MAX_WINDOW_SIZE:
+                        raise H2Error(FLOW_CONTROL_ERROR, 'Stream window too large')
+                    self.h2_unblock(stream)
+            elif key == SETTINGS_MAX_FRAME_SIZE:
+                if not DEFAULT_MAX_FRAME_SIZE <= val <= 2**24 - 1:
+                    raise H2Error(PROTOCOL_ERROR, f'Invalid max frame size: {val}')
+                self.h2_max_frame_size = val
+            elif key == SETTINGS_ENABLE_PUSH:
+                if val > 1:
+                    raise H2Error(PROTOCOL_ERROR, 'Invalid value for SETTINGS_ENABLE_PUSH')
+            # The other settings do not matter to us, in particular, the
+            # encoder does not use the dynamic table, so its size is irrelevant
+        self.h2_settings_received = True
+        self.h2_send_frame(SETTINGS, ACK, 0)
+
+    def h2_push_promise(self, flags, stream_id, payload):
+        raise H2Error(PROTOCOL_ERROR, 'Clients must not send PUSH_PROMISE')
+
+    def h2_ping(self, flags, stream_id, payload):
+        if stream_id != 0:
+            raise H2Error(PROTOCOL_ERROR, 'PING frame for non-zero stream')
+        if len(payload) != 8:
+            raise H2Error(FRAME_SIZE_ERROR, 'Invalid PING frame')
+        if not flags & ACK:
+            self.h2_send_frame(PING, ACK, 0, payload)
+
+    def h2_goaway(self, flags, stream_id, payload):
+        if stream_id != 0:
+            raise H2Error(PROTOCOL_ERROR, 'GOAWAY frame for non-zero stream')
+        self.h2_goaway_received = True
+
+    def h2_window_update(self, flags, stream_id, payload):
+        if len(payload) != 4:
+            raise H2Error(FRAME_SIZE_ERROR, 'Invalid WINDOW_UPDATE frame')
+        increment = unpack_from('!L', payload)[0] & 0x7fffffff
+        if stream_id == 0:
+            if increment == 0:
+                raise H2Error(PROTOCOL_ERROR, 'WINDOW_UPDATE with zero increment')
+            self.h2_send_window += increment
+            if self.h2_send_window > MAX_WINDOW_SIZE:
+                raise H2Error(FLOW_CONTROL_ERROR, 'Connection window too large')
+            return
+        stream = self.h2_streams.get(stream_id)
+        if stream is None:
+            if stream_id > self.h2_last_stream_id:
+                raise H2Error(PROTOCOL_ERROR, 'WINDOW_UPDATE for idle stream')
+            return
+        if increment == 0:
+            return self.h2_reset_stream(stream_id, PROTOCOL_ERROR)
+        stream.send_window += increment
+        if stream.send_window > MAX_WINDOW_SIZE:
+            return self.h2_reset_stream(stream_id, FLOW_CONTROL_ERROR)
+        self.h2_unblock(stream)
+
+    h2_frame_handlers = {
+        DATA: h2_data, HEADERS: h2_headers, PRIORITY: h2_priority, RST_STREAM: h2_rst_stream, SETTINGS: h2_settings,
+        PUSH_PROMISE: h2_push_promise, PING: h2_ping, GOAWAY: h2_goaway, WINDOW_UPDATE: h2_window_update,
+        CONTINUATION: h2_continuation_frame,
+    }
+    # }}}
+
+    def h2_job_done(self, stream_id, ok, result):
+        stream = self.h2_streams.get(stream_id)
+        if stream is None:
+            return  # The stream was reset by the client
+        stream.job_pending = False
+        try:
+            stream.job_done(ok, result)
+        except Exception as e:
+            self.log.exception(f'Unhandled exception in state: {stream.state_description}')
+            if stream.response_started:
+                self.h2_reset_stream(stream_id, INTERNAL_ERROR)
+            else:
+                stream.report_unhandled_exception(e, traceback.format_exc())
@@ -4,6 +4,7 @@
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import json
 import re
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 
@@ -19,6 +20,11 @@
 protocol_map = {(1, 0):HTTP1, (1, 1):HTTP11}
 quoted_slash = re.compile(br'%2[fF]')
 HTTP_METHODS = {'HEAD', 'GET', 'PUT', 'POST', 'TRACE', 'DELETE', 'OPTIONS'}
+# Used by the processes of a multi-process server to tell the main process
+# about the client that made a forwarded request, see srv/prefork.py
+FORWARDED_CLIENT_HEADER = 'X-Calibre-Forwarded-Client'
+# The first line of the connection preface sent by HTTP/2 clients, see srv/http2.py
+HTTP2_PREFACE_REQUEST_LINE = b'PRI * HTTP/2.0\r\n'
 
 
 # Parse URI {{{
@@ -204,6 +210,9 @@ class HTTPRequest(Connection):
     request_handler = None
     static_cache = None
     translator_cache = None
+    # Only True for connections that can come solely from the other processes
+    # of a multi-process server
+    accepts_forwarded_client = False
 
     def __init__(self, *args, **kwargs):
         Connection.__init__(self, *args, **kwargs)
@@ -261,6 +270,8 @@ def parse_request_line(self, buf, event, first=False):  # {{{
             if first:
                 return self.set_state(READ, self.parse_request_line, Accumulator())
             return self.simple_response(http_client.BAD_REQUEST, 'Multiple leading empty lines not allowed')
+        if line == HTTP2_PREFACE_REQUEST_LINE and self.start_http2_with_prior_knowledge():
+            return
 
         try:
             method, uri, req_protocol = line.strip().split(b' ', 2)
@@ -307,6 +318,13 @@ def parse_header_line(self, parser, buf, event):
             self.finalize_headers(parser.hdict)
 
     def finalize_headers(self, inheaders):
+        if self.accepts_forwarded_client:
+            fc = inheaders.get(FORWARDED_CLIENT_HEADER)
+            if fc:
+                try:
+                    self.remote_addr, self.remote_port, self.is_trusted_ip = json.loads(fc)
+                except Exception:
+                    return self.simple_response(http_client.BAD_REQUEST, f'Invalid {FORWARDED_CLIENT_HEADER} header')
         request_content_length = int(inheaders.get('Content-Length', 0))
         if request_content_length > self.max_request_body_size:
             return self.simple_response(http_client.REQUEST_ENTITY_TOO_LARGE,
@@ -408,6 +426,10 @@ def handle_timeout(self):
         self.simple_response(http_client.REQUEST_TIMEOUT)
         return True
 
+    def start_http2_with_prior_knowledge(self):
+        ' Called when a client starts a connection with the HTTP/2 preface, return True to switch to HTTP/2 '
+        return False
+
     def write(self, buf, end=None):
         raise NotImplementedError()
 
@@ -6,18 +6,20 @@
 
 import errno
 import hashlib
+import inspect
 import os
 import struct
 import time
 import uuid
-from collections import namedtuple
-from functools import wraps
+from collections import OrderedDict, namedtuple
+from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from itertools import chain, repeat
 from operator import itemgetter
 
 from calibre import force_unicode, guess_type
 from calibre.constants import __version__
+from calibre.srv.async_loop import run_in_worker_thread
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
 from calibre.srv.loop import WRITE
@@ -32,9 +34,18 @@
 if isinstance(MULTIPART_SEPARATOR, bytes):
     MULTIPART_SEPARATOR = MULTIPART_SEPARATOR.decode('ascii')
 COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'application/oebps-package+xml'}
+# Extensions of the files created by precompress() for the encodings they use,
+# in order of preference
+PRECOMPRESSED_EXTENSIONS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSED_CACHE_SIZE = 32 * 1024 * 1024  # bytes
 import zlib
 from itertools import zip_longest
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 def file_metadata(fileobj):
     try:
@@ -170,16 +181,21 @@ def gzip_prefix():
 
 
 def compress_readable_output(src_file, compress_level=6):
+    return compress_chunks(iter(partial(src_file.read, DEFAULT_BUFFER_SIZE), b''), compress_level)
+
+
+def compress_chunks(chunks, compress_level=6):
     crc = zlib.crc32(b'')
     size = 0
     zobj = zlib.compressobj(compress_level,
                             zlib.DEFLATED, -zlib.MAX_WBITS,
                             zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY)
     prefix_written = False
-    while True:
-        data = src_file.read(DEFAULT_BUFFER_SIZE)
+    for data in chunks:
         if not data:
-            break
+            continue
+        if isinstance(data, str):
+            data = data.encode('utf-8')
         size += len(data)
         crc = zlib.crc32(data, crc)
         data = zobj.compress(data)
@@ -187,7 +203,78 @@ def compress_readable_output(src_file, compress_level=6):
             prefix_written = True
             data = gzip_prefix() + data
         yield data
-    yield zobj.flush() + struct.pack(b'<L', crc & 0xffffffff) + struct.pack(b'<L', size)
+    yield (b'' if prefix_written else gzip_prefix()) + zobj.flush() + struct.pack(b'<L', crc & 0xffffffff) + struct.pack(b'<L', size)
+
+
+def compress_and_cache(src_file, cache, key):
+    chunks = []
+    for chunk in compress_readable_output(src_file):
+        chunks.append(chunk)
+        yield chunk
+    cache.set(key, b''.join(chunks))
+
+
+class CompressedCache:
+
+    ' An LRU cache of compressed response bodies, limited by their total size '
+
+    def __init__(self, max_size=COMPRESSED_CACHE_SIZE):
+        self.max_size, self.size = max_size, 0
+        self.max_item_size = max_size // 4
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        ans = self.items.get(key)
+        if ans is not None:
+            self.items.move_to_end(key)
+        return ans
+
+    def set(self, key, data):
+        if len(data) > self.max_item_size:
+            return
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.items[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            self.size -= len(self.items.popitem(last=False)[1])
+
+
+def precompress(data):
+    '''
+    Compress data for serving without compressing it on every request. Yields
+    (extension, compressed data) pairs, the files named by adding extension to
+    the name of the file containing data are used by the server if they are
+    newer than it. Only used for resource files.
+    '''
+    if brotli is not None:
+        yield '.br', brotli.compress(data, quality=11)
+    yield '.gz', b''.join(compress_readable_output(BytesIO(data), compress_level=9))
+
+
+def is_precompressible_resource(path):
+    return isinstance(path, str) and os.path.abspath(path).startswith(P('content-server', allow_user_override=False) + os.sep)
+
+
+def precompressed_variants(path, mtime):
+    ' Return a map of encoding to path for the up-to-date files created by precompress() for the file at path '
+    ans = {}
+    for encoding, ext in PRECOMPRESSED_EXTENSIONS:
+        if encoding == 'br' and brotli is None:
+            # Clients are not sent brotli compressed data unless we could
+            # also have created it
+            continue
+        try:
+            st = os.stat(path + ext)
+        except OSError:
+            continue
+        if st.st_mtime >= mtime:
+            ans[encoding] = path + ext
+    return ans
 # }}}
 
 
@@ -323,6 +410,7 @@ def filesystem_file_output(output, outheaders, stat_result):
     etag = f'"{etag}"'
     self = ReadableOutput(output, etag=etag, content_length=stat_result.st_size)
     self.name = output.name
+    self.mtime = stat_result.st_mtime
     self.use_sendfile = True
     return self
 
@@ -356,6 +444,7 @@ def __init__(self, output, etag=None):
         self.content_length = None
         self.etag = etag
         self.accept_ranges = False
+        self.use_sendfile = False
 
 
 class StaticOutput:
@@ -371,6 +460,7 @@ def __init__(self, data):
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    compressed_cache = None
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -441,19 +531,28 @@ def prepare_response(self, inheaders, request_body_file):
             msg = force_unicode(self.request_line, 'utf-8') + '\n' + inheaders.pretty()
             return self.simple_response(http_client.OK, msg, close_after_response=False)
         request_body_file.seek(0)
-        outheaders = MultiDict()
-        data = RequestData(
+        data = self.create_request_data(inheaders, request_body_file)
+        self.queue_job(self.run_request_handler, data)
+
+    def create_request_data(self, inheaders, request_body_file):
+        return RequestData(
             self.method, self.path, self.query, inheaders, request_body_file,
-            outheaders, self.response_protocol, self.static_cache, self.opts,
+            MultiDict(), self.response_protocol, self.static_cache, self.opts,
             self.remote_addr, self.remote_port, self.is_trusted_ip,
             self.translator_cache, self.tdir, self.forwarded_for, self.request_original_uri
         )
-        self.queue_job(self.run_request_handler, data)
 
     def run_request_handler(self, data):
         result = self.request_handler(data)
+        if inspect.iscoroutine(result) and self.run_coroutine is None:
+            # The server loop cannot run coroutines, so run it in this worker
+            # thread
+            result = run_in_worker_thread(result)
         return data, result
 
+    async def await_request_handler(self, data, coro):
+        return data, await coro
+
     def send_range_not_satisfiable(self, content_length):
         buf = [
             f'{self.response_protocol} {http_client.REQUESTED_RANGE_NOT_SATISFIABLE} {http_client.responses[http_client.REQUESTED_RANGE_NOT_SATISFIABLE]}',
@@ -476,6 +575,16 @@ def send_not_modified(self, etag=None):
         self.log_access(status_code=http_client.NOT_MODIFIED, response_size=response_data.sz)
         self.response_ready(response_data)
 
+    def send_http_simple_response(self, e):
+        eh = {}
+        if e.location:
+            eh['Location'] = e.location
+        if e.authenticate:
+            eh['WWW-Authenticate'] = e.authenticate
+        if e.log:
+            self.log.warn(e.log)
+        self.simple_response(e.http_code, msg=error_message(e) or '', close_after_response=e.close_connection, extra_headers=eh)
+
     def report_busy(self):
         self.simple_response(http_client.SERVICE_UNAVAILABLE)
 
@@ -483,17 +592,15 @@ def job_done(self, ok, result):
         if not ok:
             etype, e, tb = result
             if isinstance(e, HTTPSimpleResponse):
-                eh = {}
-                if e.location:
-                    eh['Location'] = e.location
-                if e.authenticate:
-                    eh['WWW-Authenticate'] = e.authenticate
-                if e.log:
-                    self.log.warn(e.log)
-                return self.simple_response(e.http_code, msg=error_message(e) or '', close_after_response=e.close_connection, extra_headers=eh)
+                return self.send_http_simple_response(e)
             reraise(etype, e, tb)
 
         data, output = result
+        if inspect.iscoroutine(output):
+            # Free the worker thread, the result is passed to job_done() once
+            # the server loop has run the coroutine
+            self.run_coroutine(self.await_request_handler(data, output))
+            return
         output = self.finalize_output(output, data, self.method is HTTP1)
         if output is None:
             return
@@ -665,19 +772,31 @@ def finalize_output(self, output, request, is_http1):
                     outheaders['Content-Type'] = 'application/octet-stream'
         elif isinstance(output, string_or_bytes):
             output = dynamic_output(output, outheaders)
+        elif isinstance(output, ETaggedFile):
+            # A file like object that is not a file in the filesystem
+            output = ReadableOutput(output.output, etag=f'"{output.etag}"')
         elif hasattr(output, 'read'):
             output = ReadableOutput(output)
         elif isinstance(output, StaticOutput):
             output = ReadableOutput(ReadOnlyFileBuffer(output.data), etag=output.etag, content_length=output.content_length)
         elif isinstance(output, ETaggedDynamicOutput):
-            output = dynamic_output(output(), outheaders, etag=output.etag)
+            try:
+                output = dynamic_output(output(), outheaders, etag=output.etag)
+            except HTTPSimpleResponse as e:
+                return self.send_http_simple_response(e)
         else:
             output = GeneratedOutput(output)
         ct = outheaders.get('Content-Type', '').partition(';')[0]
         compressible = (not ct or ct.startswith(('text/', 'image/svg')) or ct.partition(';')[0] in COMPRESSIBLE_TYPES)
         compressible = (compressible and request.status_code == http_client.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+                        (opts.compress_min_size > -1 and (output.content_length is None or output.content_length >= opts.compress_min_size)) and not is_http1)
+        vary = compressible
+        precompressed = {}
+        if compressible:
+            if output.use_sendfile and is_precompressible_resource(output.name):
+                precompressed = precompressed_variants(output.name, output.mtime)
+            encoding = acceptable_encoding(request.inheaders.get('Accept-Encoding', ''), frozenset(precompressed) | {'gzip'})
+            compressible = encoding is not None
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == http_client.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -704,15 +823,18 @@ def finalize_output(self, output, request, is_http1):
             outheaders.set('ETag', output.etag, replace_all=True)
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
+        if vary:
+            outheaders.set('Vary', 'Accept-Encoding', replace_all=True)
         if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', f'{output.content_length}')
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
-        if output.content_length is not None and not compressible and not ranges:
+            output = self.compressed_output(output, encoding, precompressed.get(encoding), resource=(
+                tuple(request.path), tuple(sorted(request.query.items()))))
+        if output.content_length is not None and not ranges:
             outheaders.set('Content-Length', f'{output.content_length}', replace_all=True)
 
-        if compressible or output.content_length is None:
+        if output.content_length is None:
             outheaders.set('Transfer-Encoding', 'chunked', replace_all=True)
 
         if ranges:
@@ -730,11 +852,45 @@ def finalize_output(self, output, request, is_http1):
             request.status_code = http_client.PARTIAL_CONTENT
         return output
 
+    def compressed_output(self, output, encoding, precompressed_path=None, resource=None):
+        if precompressed_path is not None:
+            try:
+                f = open(precompressed_path, 'rb')
+            except OSError:
+                pass
+            else:
+                output.src_file.close()
+                ans = ReadableOutput(f, etag=output.etag, content_length=os.fstat(f.fileno()).st_size)
+                ans.accept_ranges, ans.use_sendfile, ans.ranges = False, True, None
+                return ans
+        if isinstance(output, GeneratedOutput):
+            # Generated output is compressed as it is produced, it is never
+            # cached as it is usually not the same for different requests
+            return GeneratedOutput(compress_chunks(output.output), etag=output.etag)
+        cache = self.compressed_cache
+        if cache is None or output.content_length > cache.max_item_size:
+            return GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+        # The ETag alone does not identify a resource, for example, all the
+        # MathJax files share the ETag of the MathJax manifest, so the key
+        # includes the request path and query as well
+        key = output.etag
+        if not key:
+            key = hashlib.sha1(output.src_file.read()).digest()
+            output.src_file.seek(0)
+        key = resource, key, encoding
+        data = cache.get(key)
+        if data is None:
+            return GeneratedOutput(compress_and_cache(output.src_file, cache, key), etag=output.etag)
+        ans = ReadableOutput(ReadOnlyFileBuffer(data), etag=output.etag, content_length=len(data))
+        ans.accept_ranges, ans.ranges = False, None
+        return ans
+
 
 def create_http_handler(handler=None, websocket_handler=None):
-    from calibre.srv.web_socket import WebSocketConnection
+    from calibre.srv.http2 import HTTP2Connection
     static_cache = {}
     translator_cache = {}
+    compressed_cache = CompressedCache()
     if handler is None:
         def dummy_http_handler(data):
             return 'Hello'
@@ -742,10 +898,11 @@ def dummy_http_handler(data):
 
     @wraps(handler)
     def wrapper(*args, **kwargs):
-        ans = WebSocketConnection(*args, **kwargs)
+        ans = HTTP2Connection(*args, **kwargs)
         ans.request_handler = handler
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
+        ans.compressed_cache = compressed_cache
         ans.translator_cache = translator_cache
         return ans
     return wrapper
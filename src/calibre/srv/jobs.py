@@ -3,33 +3,237 @@
 
 
 import os
+import sys
 import time
+import traceback
 from collections import deque, namedtuple
+from contextlib import contextmanager
 from functools import partial
+from importlib import import_module
 from itertools import count
-from threading import Event, RLock, Thread
+from multiprocessing import Pipe
+from threading import Event, Lock, RLock, Thread
 
 from calibre import detect_ncpus, force_unicode
-from calibre.utils.ipc.simple_worker import WorkerError, fork_job
+from calibre.constants import iswindows
+from calibre.ptempfile import PersistentTemporaryFile
+from calibre.utils.ipc import eintr_retry_call
+from calibre.utils.ipc.launch import Worker
+from calibre.utils.ipc.simple_worker import WorkerError
 from calibre.utils.monotonic import monotonic
-from polyglot.builtins import iteritems, itervalues
+from polyglot.builtins import environ_item, iteritems, itervalues
 from polyglot.queue import Empty, Queue
 
+if iswindows:
+    from multiprocessing.connection import PipeConnection as Connection
+else:
+    from multiprocessing.connection import Connection
+
 StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data')
 DoneEvent = namedtuple('DoneEvent', 'job_id')
 
+# The modules used by the jobs of the server, imported by the worker
+# processes when they start, so that jobs do not have to wait for them
+PRELOAD_MODULES = ('calibre.customize.ui', 'calibre.srv.render_book', 'calibre.srv.convert')
+
+
+# Worker processes {{{
+
+class PooledWorker:
+
+    ' A worker process that runs jobs one after the other, see :func:`worker_main` '
+
+    def __init__(self):
+        a, b = Pipe()
+        with a:
+            env = {
+                'CALIBRE_WORKER_FD': str(a.fileno()),
+                'CALIBRE_SIMPLE_WORKER': environ_item('calibre.srv.jobs:worker_main'),
+            }
+            self.process = Worker(env)
+            self.process(pass_fds=(a.fileno(),))
+        self.conn = b
+        self.num_of_jobs = 0
+
+    @property
+    def is_alive(self):
+        return self.process.is_alive
+
+    def __call__(self, module, func, args, kwargs, log_path, abort=None, timeout=300):
+        self.num_of_jobs += 1
+        eintr_retry_call(self.conn.send, (module, func, args, kwargs, log_path))
+        st = monotonic()
+        while not self.conn.poll(0.1):
+            if abort is not None and abort.is_set():
+                return
+            if not self.is_alive:
+                break
+            if monotonic() - st > timeout:
+                raise WorkerError('Worker appears to have hung')
+        try:
+            return eintr_retry_call(self.conn.recv)
+        except (EOFError, OSError):
+            raise WorkerError('Worker process crashed while running the job', traceback.format_exc())
+
+    def shutdown(self):
+        try:
+            eintr_retry_call(self.conn.send, None)
+        except Exception:
+            pass
+        self.kill()
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        t = Thread(name='KillPooledWorker', target=self.kill_process)
+        t.daemon = True
+        t.start()
+
+    def kill_process(self):
+        self.process.kill()
+        try:
+            os.remove(self.process.log_path)
+        except OSError:
+            pass
+
+
+class WorkerPool:
+
+    '''
+    Reusable worker processes for jobs, so that jobs do not pay the cost of
+    starting a process and importing modules. A worker is used for at most
+    max_jobs_per_worker jobs and is discarded if a job fails to complete, for
+    example because it is aborted.
+    '''
+
+    def __init__(self, max_jobs_per_worker=50):
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.lock = Lock()
+        self.idle_workers = []
+        self.shutting_down = False
+
+    def prewarm(self, num=1):
+        ' Start worker processes so that there are at least num idle workers '
+        with self.lock:
+            while len(self.idle_workers) < num and not self.shutting_down:
+                self.idle_workers.append(PooledWorker())
+
+    def get_worker(self):
+        with self.lock:
+            while self.idle_workers:
+                w = self.idle_workers.pop()
+                if w.is_alive:
+                    return w
+                w.kill()
+        return PooledWorker()
+
+    def release_worker(self, w, reusable):
+        with self.lock:
+            if reusable and not self.shutting_down and w.is_alive and w.num_of_jobs < self.max_jobs_per_worker:
+                self.idle_workers.append(w)
+                return
+        if reusable:
+            w.shutdown()
+        else:
+            w.kill()
+
+    def run_job(self, module, func, args=(), kwargs=None, abort=None, timeout=300):
+        '''
+        Run func from module in a worker, with the same interface as
+        :func:`calibre.utils.ipc.simple_worker.fork_job`. The output of the
+        job is written to its own log file.
+        '''
+        with PersistentTemporaryFile('_job.log') as f:
+            log_path = f.name
+        w = self.get_worker()
+        reusable = False
+        try:
+            res = w(module, func, args, kwargs or {}, log_path, abort=abort, timeout=timeout)
+        except WorkerError as e:
+            e.log_path = log_path
+            raise
+        else:
+            if res is None:  # aborted
+                return {'result': None, 'stdout_stderr': log_path}
+            reusable = True
+            if res.get('tb'):
+                raise WorkerError('Worker failed', res['tb'], log_path)
+            return {'result': res['result'], 'stdout_stderr': log_path}
+        finally:
+            self.release_worker(w, reusable)
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+            workers, self.idle_workers = self.idle_workers, []
+        for w in workers:
+            w.shutdown()
+
+
+@contextmanager
+def output_redirected_to(path):
+    for f in (sys.stdout, sys.stderr):
+        try:
+            f.flush()
+        except Exception:
+            pass
+    saved = os.dup(1), os.dup(2)
+    with open(path, 'wb') as f:
+        os.dup2(f.fileno(), 1), os.dup2(f.fileno(), 2)
+        try:
+            yield
+        finally:
+            for f in (sys.stdout, sys.stderr):
+                try:
+                    f.flush()
+                except Exception:
+                    pass
+            for fd, orig in zip((1, 2), saved):
+                os.dup2(orig, fd)
+                os.close(orig)
+
+
+def worker_main():
+    # The entry point for the worker processes of WorkerPool
+    for mod in PRELOAD_MODULES:
+        try:
+            import_module(mod)
+        except Exception:
+            traceback.print_exc()
+    cwd = os.getcwd()
+    with Connection(int(os.environ['CALIBRE_WORKER_FD'])) as conn:
+        while True:
+            try:
+                job = eintr_retry_call(conn.recv)
+            except EOFError:
+                break
+            if job is None:
+                break
+            module, func, args, kwargs, log_path = job
+            with output_redirected_to(log_path):
+                try:
+                    res = {'result': getattr(import_module(module), func)(*args, **kwargs)}
+                except BaseException:
+                    res = {'tb': traceback.format_exc()}
+                finally:
+                    os.chdir(cwd)
+            eintr_retry_call(conn.send, res)
+# }}}
+
 
 class Job(Thread):
 
     daemon = True
 
-    def __init__(self, start_event, events_queue):
+    def __init__(self, start_event, events_queue, worker_pool):
         Thread.__init__(self, name=f'JobsMonitor{start_event.job_id}')
         self.abort_event = Event()
         self.events_queue = events_queue
         self.job_name = start_event.name
         self.job_id = start_event.job_id
-        self.func = partial(fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
+        self.func = partial(worker_pool.run_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
         self.data, self.callback = start_event.data, start_event.callback
         self.result = self.traceback = None
         self.done = False
@@ -101,6 +305,9 @@ def __init__(self, opts, log):
         self.max_block = None
         self.shutting_down = False
         self.event_loop = None
+        self.last_activity = monotonic()
+        self.render_pool = None
+        self.worker_pool = WorkerPool()
 
     def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
         with self.lock:
@@ -111,6 +318,7 @@ def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=
                 t.daemon = True
                 t.start()
             job_id = next(self.job_id)
+            self.last_activity = monotonic()
             self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data))
             self.waiting_job_ids.add(job_id)
             return job_id
@@ -127,6 +335,37 @@ def job_status(self, job_id):
                     return 'waiting', None, None, None
         return None, None, None, None
 
+    def idle_time(self):
+        ' The number of seconds since the last job was started or finished, zero while there are jobs running '
+        with self.lock:
+            if self.jobs or self.waiting_job_ids:
+                return 0
+            return monotonic() - self.last_activity
+
+    def stats(self):
+        ' The number of jobs running, waiting to run and finished, and of the busy workers of the render pool '
+        with self.lock:
+            return {
+                'running': len(self.jobs), 'waiting': len(self.waiting_job_ids), 'finished': len(self.finished_jobs),
+                'render_pool_busy_workers': 0 if self.render_pool is None else len(self.render_pool.tasks),
+            }
+
+    def get_render_pool(self):
+        ' The pool of worker processes shared by all jobs that render books, see :mod:`calibre.srv.render_pool` '
+        with self.lock:
+            if self.shutting_down:
+                return None
+            if self.render_pool is None:
+                from calibre.srv.render_pool import RenderPool
+                self.render_pool = RenderPool(self.max_jobs)
+            return self.render_pool
+
+    def prewarm(self, num=1):
+        ' Start num worker processes in the background, so that the next jobs start immediately '
+        t = Thread(name='PrewarmJobWorkers', target=self.worker_pool.prewarm, args=(min(num, self.max_jobs),))
+        t.daemon = True
+        t.start()
+
     def abort_job(self, job_id):
         job = self.jobs.get(job_id)
         if job is not None:
@@ -148,6 +387,9 @@ def shutdown(self, timeout=5.0):
             for job in itervalues(self.jobs):
                 job.abort_event.set()
             self.events.put(False)
+            if self.render_pool is not None:
+                self.render_pool.shutdown()
+        self.worker_pool.shutdown()
 
     def wait_for_shutdown(self, wait_till):
         for job in itervalues(self.jobs):
@@ -186,7 +428,7 @@ def start_waiting_jobs(self):
         with self.lock:
             while self.waiting_jobs and len(self.jobs) < self.max_jobs:
                 ev = self.waiting_jobs.popleft()
-                self.jobs[ev.job_id] = Job(ev, self.events)
+                self.jobs[ev.job_id] = Job(ev, self.events, self.worker_pool)
                 self.waiting_job_ids.discard(ev.job_id)
         self.update_max_block()
 
@@ -221,6 +463,7 @@ def abort_hanging_jobs(self):
     def job_finished(self, job_id):
         with self.lock:
             self.finished_jobs[job_id] = job = self.jobs.pop(job_id)
+            self.last_activity = monotonic()
             if job.callback is not None:
                 try:
                     job.callback(job)
@@ -246,6 +489,11 @@ def prune_finished_jobs(self):
     # }}}
 
 
+def print_test(x):
+    print(x)
+    return os.getpid()
+
+
 def sleep_test(x):
     time.sleep(x)
     return x
@@ -74,6 +74,12 @@ def get_recently_read(self, user):
                 })
             return ans
 
+    def get_most_recently_read(self, limit):
+        ' The (library_id, book_id, fmt) of the limit most recently read books, by any user '
+        with lock:
+            return tuple(self.execute(
+                'SELECT library_id,book,format FROM last_read_positions GROUP BY library_id,book,format ORDER BY MAX(epoch) DESC LIMIT ?', (limit,)))
+
 
 path_cache = {}
 
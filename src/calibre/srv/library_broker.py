@@ -4,6 +4,7 @@
 
 import os
 from collections import OrderedDict, defaultdict
+from threading import Event
 from threading import RLock as Lock
 
 from calibre import filesystem_encoding
@@ -54,6 +55,14 @@ def init_library(library_path, is_default_library):
     return db
 
 
+def approximate_footprint(db):
+    ' An estimate of the memory used by a loaded library, which is roughly proportional to the size of its database '
+    try:
+        return os.path.getsize(db.new_api.dbpath)
+    except OSError:
+        return 0
+
+
 def make_library_id_unique(library_id, existing):
     bname = library_id
     c = 0
@@ -94,6 +103,20 @@ def db_matches(db, library_id, library_path):
 
 class LibraryBroker:
 
+    # If not None, the changes made to loaded libraries by other processes are
+    # applied, checking for changes at most once every this many seconds.
+    # Used by the processes of a multi-process server, see srv/prefork.py
+    external_changes_check_interval = None
+
+    # Libraries that have been used in the last this many seconds are never
+    # unloaded by unload_idle_libraries(), as requests are likely to still be
+    # using them, which would keep them in memory anyway
+    min_unload_idle_time = 60
+
+    # Unloaded libraries may still be in use by requests in flight, so they
+    # are closed only once they have been unloaded for this many seconds
+    unloaded_close_delay = 300
+
     def __init__(self, libraries):
         self.lock = Lock()
         self.lmap = OrderedDict()
@@ -118,26 +141,145 @@ def __init__(self, libraries):
             self.library_name_map[library_id] = basename(corrected_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
-        self.category_caches, self.search_caches, self.tag_browser_caches = (
-            defaultdict(OrderedDict), defaultdict(OrderedDict),
-            defaultdict(OrderedDict))
+        self.unloaded_dbs = []
+        self.change_seqs = {}
+        self.access_times, self.footprints = {}, {}
+        self.category_caches, self.search_caches, self.sort_caches, self.tag_browser_caches, self.restriction_caches = (
+            defaultdict(OrderedDict), defaultdict(OrderedDict), defaultdict(OrderedDict),
+            defaultdict(OrderedDict), defaultdict(OrderedDict))
+        self.opds_caches = {}
+        self.db_event_callbacks, self.db_listeners = [], {}
 
     def get(self, library_id=None):
+        try:
+            with self:
+                return self._get(library_id)
+        finally:
+            if self.unloaded_dbs:
+                self.close_unloaded_libraries()
+
+    def _get(self, library_id):
+        # Must be called with lock held
+        library_id = library_id or self.default_library
+        if library_id in self.loaded_dbs:
+            ans = self.loaded_dbs[library_id]
+            if ans is None or self.external_changes_check_interval is None or self.apply_external_changes(library_id, ans):
+                self.access_times[library_id] = monotonic()
+                return ans
+            self._unload(library_id)
+        path = self.lmap.get(library_id)
+        if path is None:
+            return
+        self.access_times[library_id] = monotonic()
+        try:
+            self.loaded_dbs[library_id] = ans = self.init_library(
+                path, library_id == self.default_library)
+            ans.new_api.server_library_id = library_id
+        except Exception:
+            self.loaded_dbs[library_id] = None
+            raise
+        self.footprints[library_id] = approximate_footprint(ans)
+        self._listen_for_db_events(library_id, ans)
+        if self.external_changes_check_interval is not None:
+            self.change_seqs[library_id] = monotonic(), ans.new_api.last_change_seq(), ans.new_api.schema_signature()
+        return ans
+
+    def _unload(self, library_id):
+        # Must be called with lock held
+        for cache in (
+            self.category_caches, self.search_caches, self.sort_caches, self.tag_browser_caches, self.restriction_caches, self.opds_caches, self.change_seqs,
+            self.footprints,
+        ):
+            cache.pop(library_id, None)
+        listener = self.db_listeners.pop(library_id, None)
+        db = self.loaded_dbs.pop(library_id, None)
+        if db is not None:
+            if listener is not None:
+                db.new_api.remove_listener(listener)
+            self.unloaded_dbs.append((monotonic(), db))
+        return db
+
+    def close_unloaded_libraries(self, delay=None):
+        '''
+        Close the libraries that were unloaded more than delay seconds ago,
+        defaulting to :attr:`unloaded_close_delay`. Closing a library stops its
+        event thread and closes its database connection.
+        '''
+        delay = self.unloaded_close_delay if delay is None else delay
+        now = monotonic()
         with self:
-            library_id = library_id or self.default_library
-            if library_id in self.loaded_dbs:
-                return self.loaded_dbs[library_id]
-            path = self.lmap.get(library_id)
-            if path is None:
-                return
-            try:
-                self.loaded_dbs[library_id] = ans = self.init_library(
-                    path, library_id == self.default_library)
-                ans.new_api.server_library_id = library_id
-            except Exception:
-                self.loaded_dbs[library_id] = None
-                raise
-            return ans
+            closeable = [db for unloaded_at, db in self.unloaded_dbs if now - unloaded_at >= delay]
+            self.unloaded_dbs = [x for x in self.unloaded_dbs if now - x[0] < delay]
+        for db in closeable:
+            db.close()
+
+    def unload_idle_libraries(self, idle_time=0, memory_budget=0):
+        '''
+        Unload the libraries that have not been used for idle_time seconds
+        and then, least recently used first, libraries till the approximate
+        memory used by the loaded libraries is less than memory_budget bytes.
+        Zero means no limit. Unloaded libraries are loaded again when they are
+        next used. Returns the ids of the unloaded libraries. Requests in
+        flight may still be using an unloaded library, so it is closed later,
+        see :meth:`close_unloaded_libraries`.
+        '''
+        now = monotonic()
+        with self:
+            loaded = sorted((library_id for library_id, db in self.loaded_dbs.items() if db is not None), key=lambda x: self.access_times.get(x, 0))
+            total = sum(self.footprints.get(library_id, 0) for library_id in loaded)
+            unload = []
+            for library_id in loaded:
+                age = now - self.access_times.get(library_id, 0)
+                if age < self.min_unload_idle_time:
+                    break
+                if (idle_time and age > idle_time) or (memory_budget and total > memory_budget):
+                    total -= self.footprints.get(library_id, 0)
+                    unload.append(library_id)
+            for library_id in unload:
+                self._unload(library_id)
+        return unload
+
+    def add_db_event_callback(self, callback):
+        '''
+        Call callback with (library_id, event_type, event_data) for the events
+        of all libraries, see :class:`calibre.db.listeners.EventType`. It is
+        called in the event thread of the library.
+        '''
+        with self:
+            self.db_event_callbacks.append(callback)
+            for library_id, db in self.loaded_dbs.items():
+                if db is not None:
+                    self._listen_for_db_events(library_id, db)
+
+    def _listen_for_db_events(self, library_id, db):
+        # Must be called with lock held
+        if self.db_event_callbacks and library_id not in self.db_listeners:
+            def listener(event_type, library_uuid, event_data):
+                for callback in self.db_event_callbacks:
+                    callback(library_id, event_type, event_data)
+            # The db keeps only a weak reference to its listeners
+            self.db_listeners[library_id] = listener
+            db.new_api.add_listener(listener)
+
+    def apply_external_changes(self, library_id, db):
+        # Must be called with lock held. Returns False if the library has to
+        # be re-opened, because its schema or custom columns have changed or
+        # its change log no longer goes back far enough.
+        last_checked, seq, signature = self.change_seqs.get(library_id, (0, None, None))
+        now = monotonic()
+        if seq is None or now - last_checked < self.external_changes_check_interval:
+            return True
+        db = db.new_api
+        if db.schema_signature() != signature:
+            return False
+        if db.last_change_seq() != seq:
+            seq = db.refresh_from_change_log(seq)
+            if seq is None:
+                return False
+            for cache in (self.category_caches, self.search_caches, self.sort_caches, self.tag_browser_caches, self.restriction_caches, self.opds_caches):
+                cache.pop(library_id, None)
+        self.change_seqs[library_id] = now, seq, signature
+        return True
 
     def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
@@ -147,7 +289,9 @@ def close(self):
         with self:
             for db in itervalues(self.loaded_dbs):
                 getattr(db, 'close', lambda: None)()
-            self.lmap, self.loaded_dbs = OrderedDict(), {}
+            for unloaded_at, db in self.unloaded_dbs:
+                db.close()
+            self.lmap, self.loaded_dbs, self.unloaded_dbs = OrderedDict(), {}, []
 
     @property
     def default_library(self):
@@ -186,6 +330,33 @@ def __exit__(self, *a):
         self.lock.release()
 
 
+class LibraryUnloader:
+
+    '''
+    A server plugin that unloads libraries that have been idle for idle_time
+    seconds or that do not fit in memory_budget bytes, see
+    :meth:`LibraryBroker.unload_idle_libraries`.
+    '''
+
+    check_interval = 60
+
+    def __init__(self, library_broker, idle_time=0, memory_budget=0):
+        self.library_broker, self.idle_time, self.memory_budget = library_broker, idle_time, memory_budget
+        self.shutdown = Event()
+        self.stop = self.shutdown.set
+
+    def start(self, loop):
+        while not self.shutdown.wait(self.check_interval):
+            try:
+                unloaded = self.library_broker.unload_idle_libraries(self.idle_time, self.memory_budget)
+                self.library_broker.close_unloaded_libraries()
+            except Exception:
+                loop.log.exception('Failed to unload idle libraries')
+            else:
+                if unloaded:
+                    loop.log('Unloaded idle libraries:', ', '.join(unloaded))
+
+
 EXPIRED_AGE = 300  # seconds
 
 
@@ -6,7 +6,7 @@
 
 import ipaddress
 import os
-import select
+import selectors
 import socket
 import ssl
 import traceback
@@ -15,7 +15,7 @@
 from io import BytesIO
 
 from calibre import as_unicode
-from calibre.constants import iswindows
+from calibre.constants import isbsd, islinux, iswindows
 from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.errors import JobQueueFull
 from calibre.srv.jobs import JobsManager
@@ -41,6 +41,7 @@
 from polyglot.queue import Empty, Full
 
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
+SELECTOR_EVENTS = {READ: selectors.EVENT_READ, WRITE: selectors.EVENT_WRITE, RDWR: selectors.EVENT_READ | selectors.EVENT_WRITE, WAIT: 0}
 WAKEUP, JOB_DONE = b'\0', b'\x01'
 IPPROTO_IPV6 = getattr(socket, 'IPPROTO_IPV6', 41)
 
@@ -133,6 +134,67 @@ def readline(self):
     # }}}
 
 
+class TimerWheel:  # {{{
+
+    '''
+    A hashed timing wheel used to track connection inactivity timeouts. Adding
+    and removing keys is O(1) and :meth:`expired` only looks at the slots that
+    have elapsed since it was last called, rather than at every key. Keys
+    expire at most one slot after their deadline, never before it, except for
+    deadlines further in the future than span, which expire after span.
+    Callers must re-check such keys and add them again if needed.
+    '''
+
+    def __init__(self, span, num_slots=64, now=None):
+        self.num_slots = num_slots
+        self.resolution = max(span / (num_slots - 2), 0.001)
+        self.slots = tuple(set() for i in range(num_slots))
+        self.key_map = {}
+        self.last_tick = int((monotonic() if now is None else now) / self.resolution)
+
+    def __len__(self):
+        return len(self.key_map)
+
+    def __contains__(self, key):
+        return key in self.key_map
+
+    def add(self, key, deadline):
+        self.remove(key)
+        tick = int(deadline / self.resolution) + 1
+        tick = max(self.last_tick + 1, min(tick, self.last_tick + self.num_slots - 1))
+        idx = tick % self.num_slots
+        self.slots[idx].add(key)
+        self.key_map[key] = idx
+
+    def remove(self, key):
+        idx = self.key_map.pop(key, None)
+        if idx is not None:
+            self.slots[idx].discard(key)
+
+    def expired(self, now):
+        ' Remove and return all keys whose deadline is before now '
+        current = int(now / self.resolution)
+        ans = []
+        if current > self.last_tick:
+            for tick in range(self.last_tick + 1, min(current, self.last_tick + self.num_slots) + 1):
+                slot = self.slots[tick % self.num_slots]
+                if slot:
+                    for key in slot:
+                        del self.key_map[key]
+                    ans.extend(slot)
+                    slot.clear()
+            self.last_tick = current
+        return ans
+
+    def time_to_next_expiry(self, now):
+        ' The number of seconds until the next key expires or None if there are no keys '
+        if self.key_map:
+            for tick in range(self.last_tick + 1, self.last_tick + self.num_slots):
+                if self.slots[tick % self.num_slots]:
+                    return max(0, tick * self.resolution - now)
+# }}}
+
+
 class BadIPSpec(ValueError):
     pass
 
@@ -172,6 +234,14 @@ def is_local_address(addr: ipaddress.IPv4Address | ipaddress.IPv6Address | None)
 
 class Connection:  # {{{
 
+    # Set by the server loop, called whenever wait_for changes, possibly from
+    # a thread other than the server thread
+    state_changed = None
+    # Set by server loops that can run coroutines, see srv/async_loop.py.
+    # Called with a coroutine, whose result is passed to handle_event() as
+    # the result of a job.
+    run_coroutine = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -203,6 +273,16 @@ def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log,
         self.last_activity = monotonic()
         self.ready = True
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        self._wait_for = val
+        if self.state_changed is not None:
+            self.state_changed()
+
     def optimize_for_sending_packet(self):
         start_cork(self.socket)
         self.orig_send_bufsize = self.send_bufsize = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
@@ -342,7 +422,7 @@ def drain_ssl_buffer(self):
 
     def close(self):
         self.ready = False
-        self.handle_event = None  # prevent reference cycles
+        self.handle_event = self.state_changed = self.run_coroutine = None  # prevent reference cycles
         try:
             self.socket.shutdown(socket.SHUT_WR)
         except OSError:
@@ -393,6 +473,7 @@ def parsed_trusted_ips(raw):
 class ServerLoop:
 
     LISTENING_MSG = 'calibre server listening on'
+    MAX_ACCEPTS_PER_TICK = 64
 
     def __init__(
         self,
@@ -420,12 +501,22 @@ def __init__(
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.selector = self.timers = None
+        # fd -> the selector events the fd is registered for
+        self.registered = {}
+        # fds of connections with data in their read buffers, these are
+        # readable without waiting on the selector
+        self.buffered = set()
+        # fds of connections whose registrations need to be updated
+        self.dirty = set()
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
             self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             self.ssl_context.load_cert_chain(certfile=self.opts.ssl_certfile, keyfile=self.opts.ssl_keyfile)
             self.ssl_context.set_servername_callback(self.on_ssl_servername)
+            if self.opts.use_http2:
+                self.ssl_context.set_alpn_protocols(['h2', 'http/1.1'])
 
         self.pre_activated_socket = None
         self.socket_was_preactivated = False
@@ -527,8 +618,13 @@ def serve(self):
         from calibre.utils.network import format_addr_for_url
 
         self.connection_map = {}
+        self.registered, self.buffered, self.dirty = {}, set(), set()
+        self.timers = TimerWheel(self.opts.timeout)
+        self.selector = self.create_selector()
+        self.selector.register(self.socket.fileno(), selectors.EVENT_READ)
+        self.selector.register(self.control_out.fileno(), selectors.EVENT_READ)
         if not self.socket_was_preactivated:
-            self.socket.listen(min(socket.SOMAXCONN, 128))
+            self.socket.listen(socket.SOMAXCONN)
         self.bound_address = ba = self.socket.getsockname()
         ba_str = ''
         if isinstance(ba, tuple):
@@ -541,19 +637,24 @@ def serve(self):
                 self.log(self.LISTENING_MSG, ba_str)
             self.plugin_pool.start()
             self.ready = True
-
-            while self.ready:
-                try:
-                    self.tick()
-                except SystemExit:
-                    self.shutdown()
-                    raise
-                except KeyboardInterrupt:
-                    break
-                except:
-                    self.log.exception('Error in ServerLoop.tick')
+            self.run()
             self.shutdown()
 
+    def create_selector(self):
+        return selectors.DefaultSelector()
+
+    def run(self):
+        while self.ready:
+            try:
+                self.tick()
+            except SystemExit:
+                self.shutdown()
+                raise
+            except KeyboardInterrupt:
+                break
+            except:
+                self.log.exception('Error in ServerLoop.tick')
+
     def serve_forever(self):
         ''' Listen for incoming connections. '''
         self.initialize_socket()
@@ -561,7 +662,14 @@ def serve_forever(self):
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.socket.family == getattr(socket, 'AF_UNIX', None):
+            self.socket.setblocking(0)
+            return
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.opts.server_processes > 1 and (islinux or isbsd) and hasattr(socket, 'SO_REUSEPORT'):
+            # Allow the processes of a multi-process server to each listen
+            # on the same port, see srv/prefork.py
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
         # activate dual-stack.
@@ -584,69 +692,70 @@ def bind(self, family, atype, proto=0):
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
-        has_ssl = self.ssl_context is not None
-        for s, conn in iteritems(self.connection_map):
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
-            if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
-                if conn.read_buffer.has_data:
-                    readable.append(s)
-                else:
-                    if has_ssl:
-                        conn.drain_ssl_buffer()
-                        if conn.ready:
-                            (readable if conn.read_buffer.has_data else read_needed).append(s)
-                        else:
-                            close_needed.append((s, conn))
-                    else:
-                        read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
-            self.close(s, conn)
+        self.check_timeouts(now)
+        self.update_registrations()
 
-        for x, conn in close_needed:
-            self.close(s, conn)
-
-        if readable:
-            writable = []
+        if self.socket.fileno() < 0:
+            self.ready = False
+            self.log.error('Listening socket was unexpectedly terminated')
+            return
+        if self.buffered:
+            timeout = 0
         else:
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
-                self.ready = False
-                self.log.error('Listening socket was unexpectedly terminated')
-                return
-            except OSError as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
-                if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
-                    return
-                for s, conn in tuple(iteritems(self.connection_map)):
-                    try:
-                        select.select([s], [], [], 0)
-                    except OSError as e:
-                        if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
-                            self.close(s, conn)  # Bad socket, discard
+            timeout = self.timers.time_to_next_expiry(now)
+            timeout = self.opts.timeout if timeout is None else min(timeout, self.opts.timeout)
+        readable, writable = list(self.buffered), []
+        try:
+            events = self.selector.select(timeout)
+        except OSError as e:
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                 return
+            for s, conn in tuple(iteritems(self.connection_map)):
+                try:
+                    os.fstat(s)
+                except OSError:
+                    self.close(s, conn)  # Bad socket, discard
+            return
+        for key, mask in events:
+            s = key.fd
+            if mask & selectors.EVENT_READ and s not in self.buffered:
+                readable.append(s)
+            if mask & selectors.EVENT_WRITE:
+                writable.append(s)
 
         if not self.ready:
             return
 
+        self.handle_actions(self.get_actions(readable, writable))
+
+    def check_timeouts(self, now):
+        for s in self.timers.expired(now):
+            conn = self.connection_map.get(s)
+            if conn is None:
+                continue
+            if now - conn.last_activity > self.opts.timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                else:
+                    self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
+                    self.close(s, conn)
+                    continue
+            self.timers.add(s, conn.last_activity + self.opts.timeout)
+
+    def update_registrations(self):
+        while self.dirty:
+            s = self.dirty.pop()
+            conn = self.connection_map.get(s)
+            if conn is not None and not self.update_registration(s, conn):
+                self.close(s, conn)
+
+    def handle_actions(self, actions):
+        ' Pass the events in actions, an iterable of (fd, connection, event) to the connections '
         ignore = set()
-        for s, conn, event in self.get_actions(readable, writable):
+        for s, conn, event in actions:
             if s in ignore:
                 continue
+            self.dirty.add(s)
             try:
                 conn.handle_event(event)
                 if not conn.ready:
@@ -681,6 +790,33 @@ def tick(self):
                         self.log.error(f'Error in SSL handshake, terminating connection: {as_unicode(e)}')
                         self.close(s, conn)
 
+    def update_registration(self, s, conn):
+        ' Register the connection for the events it is waiting for. Returns False if the connection should be closed. '
+        events = SELECTOR_EVENTS[conn.wait_for]
+        if events & selectors.EVENT_READ:
+            if not conn.read_buffer.has_data and self.ssl_context is not None and conn.ready and conn.socket.pending():
+                # Decrypted data buffered in the SSL layer does not make the
+                # socket readable, so move it into the read buffer
+                conn.drain_ssl_buffer()
+                if not conn.ready:
+                    return False
+            if conn.read_buffer.has_data:
+                self.buffered.add(s)
+            else:
+                self.buffered.discard(s)
+        else:
+            self.buffered.discard(s)
+        current = self.registered.get(s, 0)
+        if events != current:
+            if not current:
+                self.selector.register(s, events)
+            elif not events:
+                self.selector.unregister(s)
+            else:
+                self.selector.modify(s, events)
+            self.registered[s] = events
+        return True
+
     def write_to_control(self, what):
         if iswindows:
             self.control_in.sendall(what)
@@ -706,6 +842,12 @@ def dispatch_job_results(self):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        self.buffered.discard(s)
+        self.dirty.discard(s)
+        self.timers.remove(s)
+        if self.registered.pop(s, 0):
+            with suppress(Exception):
+                self.selector.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -713,12 +855,17 @@ def get_actions(self, readable, writable):
         control = self.control_out.fileno()
         for s in readable:
             if s == listener:
-                sock, addr = self.accept()
-                if sock is not None:
+                # Accept several connections at a time so that bursts of new
+                # connections do not overflow the listen backlog
+                for i in range(self.MAX_ACCEPTS_PER_TICK):
+                    sock, addr = self.accept()
+                    if sock is None:
+                        break
                     s = sock.fileno()
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        self.setup_connection(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -741,7 +888,9 @@ def get_actions(self, readable, writable):
                     self.log.error('Control connection failed to read after signalling ready')
                     raise Exception('Control connection failed to read, something bad happened')
             else:
-                yield s, self.connection_map[s], READ
+                conn = self.connection_map.get(s)
+                if conn is not None:
+                    yield s, conn, READ
         for s in writable:
             try:
                 conn = self.connection_map[s]
@@ -749,6 +898,11 @@ def get_actions(self, readable, writable):
                 continue  # Happens if connection was closed during read phase
             yield s, conn, WRITE
 
+    def setup_connection(self, s, conn):
+        conn.state_changed = partial(self.dirty.add, s)
+        self.dirty.add(s)
+        self.timers.add(s, conn.last_activity + self.opts.timeout)
+
     def accept(self):
         try:
             sock, addr = self.socket.accept()
@@ -769,6 +923,10 @@ def shutdown(self):
                 self.socket = None
         for s, conn in tuple(iteritems(self.connection_map)):
             self.close(s, conn)
+        if self.selector is not None:
+            with suppress(Exception):
+                self.selector.close()
+            self.selector = None
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -777,6 +935,14 @@ def shutdown(self):
         self.jobs_manager.wait_for_shutdown(wait_till)
 
 
+def server_loop_class(opts):
+    ' The class of server loop to use for the event_loop option in opts '
+    if opts.event_loop == 'asyncio':
+        from calibre.srv.async_loop import AsyncServerLoop
+        return AsyncServerLoop
+    return ServerLoop
+
+
 class EchoLine(Connection):  # {{{
 
     bye_after_echo = False
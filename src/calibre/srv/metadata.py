@@ -45,9 +45,13 @@ def encode_datetime(dateval):
 
 
 def add_field(field, db, book_id, ans, field_metadata):
+    if field_metadata.get('datatype') is not None:
+        add_field_value(field, db._field_for(field, book_id), ans, field_metadata)
+
+
+def add_field_value(field, val, ans, field_metadata):
     datatype = field_metadata.get('datatype')
     if datatype is not None:
-        val = db._field_for(field, book_id)
         if val is not None and val not in empty_val:
             if datatype == 'datetime':
                 val = encode_datetime(val)
@@ -71,39 +75,73 @@ def encode_stat_result(s: os.stat_result) -> dict[str, int]:
     }
 
 
+def formats_as_json(db, book_id):
+    fmts = db._formats(book_id, verify_formats=False)
+    ans = []
+    fm = {}
+    for fmt in fmts:
+        m = db.format_metadata(book_id, fmt)
+        if m and m.get('size', 0) > 0:
+            ans.append(fmt)
+            fm[fmt] = m['size']
+    return {'formats': ans, 'format_sizes': fm}
+
+
+def add_book_extras(db, book_id, ans):
+    ids = ans.get('identifiers')
+    if ids:
+        ans['urls_from_identifiers'] = urls_from_identifiers(ids)
+    langs = ans.get('languages')
+    if langs:
+        ans['lang_names'] = {l:calibre_langcode_to_name(l) for l in langs}
+    link_maps = db.get_all_link_maps_for_book(book_id)
+    if link_maps:
+        ans['link_maps'] = link_maps
+    x = db.items_with_notes_in_book(book_id)
+    if x:
+        ans['items_with_notes'] = {field: {v: k for k, v in items.items()} for field, items in x.items()}
+    data_files = db.list_extra_files(book_id, use_cache=True, pattern=DATA_FILE_PATTERN)
+    if data_files:
+        ans['data_files'] = {e.relpath: encode_stat_result(e.stat_result) for e in data_files}
+
+
 def book_as_json(db, book_id):
     db = db.new_api
     with db.safe_read_lock:
-        fmts = db._formats(book_id, verify_formats=False)
-        ans = []
-        fm = {}
-        for fmt in fmts:
-            m = db.format_metadata(book_id, fmt)
-            if m and m.get('size', 0) > 0:
-                ans.append(fmt)
-                fm[fmt] = m['size']
-        ans = {'formats': ans, 'format_sizes': fm}
+        ans = formats_as_json(db, book_id)
         if not ans['formats'] and not db.has_id(book_id):
             return None
         fm = db.field_metadata
         for field in fm.all_field_keys():
             if field not in IGNORED_FIELDS:
                 add_field(field, db, book_id, ans, fm[field])
-        ids = ans.get('identifiers')
-        if ids:
-            ans['urls_from_identifiers'] = urls_from_identifiers(ids)
-        langs = ans.get('languages')
-        if langs:
-            ans['lang_names'] = {l:calibre_langcode_to_name(l) for l in langs}
-        link_maps = db.get_all_link_maps_for_book(book_id)
-        if link_maps:
-            ans['link_maps'] = link_maps
-        x = db.items_with_notes_in_book(book_id)
-        if x:
-            ans['items_with_notes'] = {field: {v: k for k, v in items.items()} for field, items in x.items()}
-        data_files = db.list_extra_files(book_id, use_cache=True, pattern=DATA_FILE_PATTERN)
-        if data_files:
-            ans['data_files'] = {e.relpath: encode_stat_result(e.stat_result) for e in data_files}
+        add_book_extras(db, book_id, ans)
+    return ans
+
+
+def books_as_json(db, book_ids):
+    '''
+    Same as :func:`book_as_json` for many books at once. The values of each
+    field are read for all the books in a single call. Returns a dict mapping
+    book ids to data, in the order of book_ids, books that do not exist are
+    omitted.
+    '''
+    db = db.new_api
+    ans = {}
+    with db.safe_read_lock:
+        for book_id in book_ids:
+            data = formats_as_json(db, book_id)
+            if data['formats'] or db.has_id(book_id):
+                ans[book_id] = data
+        fm = db.field_metadata
+        for field in fm.all_field_keys():
+            field_metadata = fm[field]
+            if field in IGNORED_FIELDS or field_metadata.get('datatype') is None or field not in db.fields:
+                continue
+            for book_id, val in db._all_field_for(field, ans).items():
+                add_field_value(field, val, ans[book_id], field_metadata)
+        for book_id, data in ans.items():
+            add_book_extras(db, book_id, data)
     return ans
 
 
@@ -631,8 +669,56 @@ def render_categories(opts, db, category_data):
     return {'root':root, 'item_map': items}
 
 
-def categories_as_json(ctx, rd, db, opts, vl):
-    return ctx.get_tag_browser(rd, db, opts, partial(render_categories, opts), vl=vl)
+def categories_node_key(item):
+    '''
+    The key of a node of the Tag Browser, from its entry in item_map. Unlike
+    the node ids, which depend on the position of the node in the tree, keys
+    do not change when the library changes. The key of a top level category is
+    its category, for example, tags. The key of any other node is its category
+    and its original_name or, if it has none, its name, separated by a colon,
+    for example, tags:Fiction, so that items from different categories in a
+    user category do not collide. The keys of other category nodes, such as
+    the ones that collapse a category by first letter, are prefixed with a *,
+    for example, *authors:A.
+    '''
+    if item.get('is_category'):
+        if not item.get('parent'):
+            return item['category']
+        return '*{}:{}'.format(item['category'], item['name'])
+    return '{}:{}'.format(item['category'], item.get('original_name', item['name']))
+
+
+def categories_subtree(data, path=(), depth=0):
+    '''
+    Return the part of the Tag Browser data from :func:`render_categories`
+    below the node reached by following the node keys in path from the root,
+    see :func:`categories_node_key`, to a depth of depth levels, or all levels
+    if depth is zero. Nodes whose children are left out have the number of
+    children in num_children and only the items for the included nodes are in
+    item_map. Returns None if there is no node at path.
+    '''
+    node = data['root']
+    items = data['item_map']
+    for key in path:
+        for child in node['children']:
+            if categories_node_key(items[child['id']]) == key:
+                node = child
+                break
+        else:
+            return
+    ans = {}
+
+    def copy_node(node, level):
+        if node['id'] is not None:
+            ans[node['id']] = items[node['id']]
+        if depth and level >= depth and node['children']:
+            return {'id': node['id'], 'children': [], 'num_children': len(node['children'])}
+        return {'id': node['id'], 'children': [copy_node(child, level + 1) for child in node['children']]}
+    return {'root': copy_node(node, 0), 'item_map': ans}
+
+
+def categories_as_json(ctx, rd, db, opts, vl, subtree=None):
+    return ctx.get_tag_browser(rd, db, opts, partial(render_categories, opts), vl=vl, subtree=subtree)
 
 
 # Test tag browser {{{
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Instrumentation of the server, served in the Prometheus text exposition
+format by the /metrics endpoint. The metrics are for the process that serves
+the request, when the server uses several processes each has its own.
+'''
+
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+# The upper bounds of the buckets of the request latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, val):
+        self.counts[bisect_left(self.buckets, val)] += 1
+        self.sum += val
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for le, c in zip(self.buckets + ('+Inf',), self.counts):
+            total += c
+            yield le, total
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.request_durations = defaultdict(Histogram)
+        self.request_errors = defaultdict(int)
+        self.file_cache = defaultdict(int)
+
+    def observe_request(self, route, duration, failed=False):
+        with self.lock:
+            self.request_durations[route].observe(duration)
+            if failed:
+                self.request_errors[route] += 1
+
+    def file_cache_access(self, cache, hit):
+        with self.lock:
+            self.file_cache[(cache, 'hit' if hit else 'miss')] += 1
+
+
+metrics = Metrics()
+
+
+def escape_label(val):
+    return str(val).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + '}'
+
+
+class Exposition:
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, mtype, help_text, samples):
+        ' samples is a list of (labels, value) pairs, or (suffix, labels, value) triples for histograms '
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {mtype}')
+        for sample in samples:
+            suffix, labels, val = sample if len(sample) == 3 else ('',) + tuple(sample)
+            self.lines.append(f'{name}{suffix}{format_labels(labels)} {val}')
+
+    def __str__(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def metrics_as_text(ctx):
+    out = Exposition()
+    with metrics.lock:
+        durations = {route: (tuple(h.cumulative_counts()), h.sum, h.count) for route, h in metrics.request_durations.items()}
+        errors = dict(metrics.request_errors)
+        file_cache = dict(metrics.file_cache)
+
+    samples = []
+    for route, (buckets, total, count) in sorted(durations.items()):
+        for le, c in buckets:
+            samples.append(('_bucket', {'endpoint': route, 'le': le}, c))
+        samples.append(('_sum', {'endpoint': route}, total))
+        samples.append(('_count', {'endpoint': route}, count))
+    out.add('calibre_request_duration_seconds', 'histogram', 'Time taken by the endpoints to handle requests', samples)
+    out.add('calibre_request_errors_total', 'counter', 'The number of requests that failed with an error',
+            [({'endpoint': route}, c) for route, c in sorted(errors.items())])
+
+    pool = ctx.thread_pool
+    if pool is not None:
+        out.add('calibre_worker_threads', 'gauge', 'The number of threads that handle requests', [({}, len(pool.workers))])
+        out.add('calibre_busy_worker_threads', 'gauge', 'The number of threads handling requests', [({}, pool.busy)])
+        out.add('calibre_request_queue_length', 'gauge', 'The number of requests waiting for a thread', [({}, pool.queue_length)])
+
+    jm = ctx.jobs_manager
+    if jm is not None:
+        stats = jm.stats()
+        out.add('calibre_jobs', 'gauge', 'The number of jobs, such as book rendering, by state',
+                [({'state': k}, stats[k]) for k in ('running', 'waiting', 'finished')])
+        out.add('calibre_render_pool_busy_workers', 'gauge', 'The number of busy workers in the pool that renders books',
+                [({}, stats['render_pool_busy_workers'])])
+
+    from calibre.srv.books import cache_lock, render_cache
+    with cache_lock:
+        stats = render_cache.stats()
+    out.add('calibre_render_cache_requests_total', 'counter', 'The number of books opened in the viewer, by whether they were already rendered',
+            [({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])])
+    out.add('calibre_render_cache_books', 'gauge', 'The number of rendered books in the cache', [({}, stats['num_of_books'])])
+    out.add('calibre_render_cache_size_bytes', 'gauge', 'The size of the rendered books in the cache', [({}, stats['size'])])
+    out.add('calibre_render_cache_evicted_total', 'counter', 'The number of rendered books removed to limit the size of the cache',
+            [({}, stats['evicted'])])
+    out.add('calibre_render_cache_prerendered_total', 'counter', 'The number of books rendered before being opened', [({}, stats['prerendered'])])
+
+    out.add('calibre_file_cache_requests_total', 'counter', 'Requests for covers and book files, by whether a cached copy was used',
+            [({'cache': cache, 'result': result}, c) for (cache, result), c in sorted(file_cache.items())])
+
+    broker = ctx.library_broker
+    with broker:
+        dbs = {library_id: db for library_id, db in broker.loaded_dbs.items() if db is not None}
+    samples, times = [], []
+    for library_id, db in sorted(dbs.items()):
+        for mode, (count, wait_time) in db.new_api.read_lock.wait_stats().items():
+            samples.append(({'library_id': library_id, 'mode': mode}, count))
+            times.append(({'library_id': library_id, 'mode': mode}, wait_time))
+    out.add('calibre_db_lock_waits_total', 'counter', 'The number of times a thread had to wait for the database lock', samples)
+    out.add('calibre_db_lock_wait_seconds_total', 'counter', 'The time threads spent waiting for the database lock', times)
+    return str(out)
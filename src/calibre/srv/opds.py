@@ -7,7 +7,9 @@
 
 import hashlib
 from collections import OrderedDict, namedtuple
+from copy import deepcopy
 from functools import partial
+from threading import Lock
 
 from html5_parser import parse
 from lxml import etree
@@ -21,6 +23,7 @@
 from calibre.library.comments import comments_to_html
 from calibre.srv.errors import HTTPInternalServerError, HTTPNotFound
 from calibre.srv.http_request import parse_uri
+from calibre.srv.http_response import parse_if_none_match
 from calibre.srv.routes import endpoint
 from calibre.srv.utils import Offsets, get_library_data, http_date
 from calibre.utils.config import prefs
@@ -33,10 +36,16 @@
 from polyglot.builtins import as_bytes, iteritems
 from polyglot.urllib import unquote_plus, urlencode
 
+ATOM_CONTENT_TYPE = 'application/atom+xml; charset=UTF-8'
 
-def atom(ctx, rd, endpoint, output):
-    rd.outheaders.set('Content-Type', 'application/atom+xml; charset=UTF-8', replace_all=True)
+
+def set_atom_headers(rd):
+    rd.outheaders.set('Content-Type', ATOM_CONTENT_TYPE, replace_all=True)
     rd.outheaders.set('Calibre-Instance-Id', force_unicode(prefs['installation_uuid'], 'utf-8'), replace_all=True)
+
+
+def atom(ctx, rd, endpoint, output):
+    set_atom_headers(rd)
     if isinstance(output, bytes):
         ans = output  # Assume output is already UTF-8 XML
     elif isinstance(output, str):
@@ -330,7 +339,7 @@ class AcquisitionFeed(NavFeed):
     def __init__(self, id_, updated, request_context, items, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
         for book_id in items:
-            self.root.append(ACQUISITION_ENTRY(book_id, updated, request_context))
+            self.root.append(request_context.acquisition_entry(book_id, updated))
 
 
 class CategoryFeed(NavFeed):
@@ -353,11 +362,78 @@ def __init__(self, items, which, id_, updated, request_context, offsets, page_ur
             self.root.append(CATALOG_GROUP_ENTRY(item, which, request_context, updated))
 
 
+class OPDSCache:
+
+    '''
+    The feeds and book entries of a library. Feeds are stored with the version
+    of the library they were created from and are used only for that
+    version. Book entries are dropped when the change log of the library
+    reports changes to their books.
+    '''
+
+    MAX_FEEDS = 256
+    MAX_ENTRIES = 4096
+
+    def __init__(self):
+        self.lock = Lock()
+        self.feeds = OrderedDict()
+        self.entries = OrderedDict()
+        self.change_seq = None
+
+    def sync(self, db):
+        seq = db.last_change_seq()
+        with self.lock:
+            since = self.change_seq
+        if seq == since:
+            return
+        changes = None if since is None else db.changes_since(since, limit=self.MAX_ENTRIES)
+        with self.lock:
+            if changes is None or changes['reset'] or len(changes['changes']) >= self.MAX_ENTRIES:
+                self.entries.clear()
+            else:
+                changed = {c['book_id'] for c in changes['changes']}
+                for key in tuple(self.entries):
+                    if key[0] in changed:
+                        del self.entries[key]
+            self.change_seq = seq
+
+    def get(self, cache, max_size, key, create, version=None):
+        with self.lock:
+            ans = cache.get(key)
+            if ans is not None and ans[0] == version:
+                cache.move_to_end(key)
+                return ans[1]
+        ans = create()
+        with self.lock:
+            cache[key] = version, ans
+            cache.move_to_end(key)
+            if len(cache) > max_size:
+                cache.popitem(last=False)
+        return ans
+
+    def entry(self, key, create):
+        # lxml elements can have only one parent, so return a copy
+        return deepcopy(self.get(self.entries, self.MAX_ENTRIES, key, create))
+
+    def feed(self, key, version, create):
+        return self.get(self.feeds, self.MAX_FEEDS, key, create, version)
+
+
+def opds_cache(ctx, db):
+    caches = ctx.library_broker.opds_caches
+    with ctx.lock:
+        ans = caches.get(db.server_library_id)
+        if ans is None:
+            ans = caches[db.server_library_id] = OPDSCache()
+    return ans
+
+
 class RequestContext:
 
     def __init__(self, ctx, rd):
         self.db, self.library_id, self.library_map, self.default_library = get_library_data(ctx, rd)
         self.ctx, self.rd = ctx, rd
+        self.cache = opds_cache(ctx, self.db)
 
     def url_for(self, path, **kwargs):
         lid = kwargs.pop('library_id', self.library_id)
@@ -387,6 +463,33 @@ def get_categories(self, report_parse_errors=False):
     def search(self, query):
         return self.ctx.search(self.rd, self.db, query)
 
+    def acquisition_entry(self, book_id, updated):
+        # The entries use the language of the request
+        return self.cache.entry((book_id, self.rd.lang_code), partial(ACQUISITION_ENTRY, book_id, updated, self))
+
+    def cached_feed(self, key, generate):
+        '''
+        Return the feed created by generate() as a response with an ETag. The
+        feed is cached per user restriction, language and key, till the
+        library is changed.
+        '''
+        rd, db = self.rd, self.db
+        with db.safe_read_lock:
+            self.cache.sync(db)
+            version = self.cache.change_seq, db.last_modified()
+        key = (self.ctx.restriction_for(rd, db), tuple(sorted(iteritems(self.library_map))), rd.lang_code) + key
+        etag = hashlib.sha1(repr((version, key)).encode('utf-8')).hexdigest()
+        rd.outheaders['Last-Modified'] = http_date(timestampfromdt(version[1]))
+        set_atom_headers(rd)
+        if f'"{etag}"' in parse_if_none_match(rd.inheaders.get('If-None-Match', '')):
+            data = b''  # A Not Modified response is sent
+        else:
+            data = self.cache.feed(key, version, lambda: atom(self.ctx, rd, None, generate()))
+
+        def output():
+            return data
+        return rd.etagged_dynamic_response(etag, output, content_type=ATOM_CONTENT_TYPE)
+
 
 def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
         sort_by='title', ascending=True, feed_title=None):
@@ -466,10 +569,14 @@ def get_navcatalog(request_context, which, page_url, up_url, offset=0):
     return ans.root
 
 
-@endpoint('/opds', postprocess=atom)
+@endpoint('/opds')
 def opds(ctx, rd):
     rc = RequestContext(ctx, rd)
-    db = rc.db
+    return rc.cached_feed(('opds',), partial(top_level_feed, rc))
+
+
+def top_level_feed(rc):
+    db, rd = rc.db, rc.rd
     try:
         categories = rc.get_categories(report_parse_errors=True)
     except ParseException as p:
@@ -504,14 +611,17 @@ def getter(x):
     return TopLevel(last_modified, cats, rc).root
 
 
-@endpoint('/opds/navcatalog/{which}', postprocess=atom)
+@endpoint('/opds/navcatalog/{which}')
 def opds_navcatalog(ctx, rd, which):
     try:
         offset = int(rd.query.get('offset', 0))
     except Exception:
         raise HTTPNotFound('Not found')
     rc = RequestContext(ctx, rd)
+    return rc.cached_feed(('navcatalog', which, offset), partial(navcatalog_feed, rc, which, offset))
+
 
+def navcatalog_feed(rc, which, offset):
     page_url = rc.url_for('/opds/navcatalog', which=which)
     up_url = rc.url_for('/opds')
     which = from_hex_unicode(which)
@@ -524,7 +634,7 @@ def opds_navcatalog(ctx, rd, which):
     raise HTTPNotFound('Not found')
 
 
-@endpoint('/opds/category/{category}/{which}', postprocess=atom)
+@endpoint('/opds/category/{category}/{which}')
 def opds_category(ctx, rd, category, which):
     try:
         offset = int(rd.query.get('offset', 0))
@@ -534,6 +644,10 @@ def opds_category(ctx, rd, category, which):
     if not which or not category:
         raise HTTPNotFound('Not found')
     rc = RequestContext(ctx, rd)
+    return rc.cached_feed(('category', category, which, offset), partial(category_feed, rc, category, which, offset))
+
+
+def category_feed(rc, category, which, offset):
     page_url = rc.url_for('/opds/category', which=which, category=category)
     up_url = rc.url_for('/opds/navcatalog', which=category)
 
@@ -575,7 +689,7 @@ def opds_category(ctx, rd, category, which):
     return get_acquisition_feed(rc, ids, offset, page_url, up_url, 'calibre-category:'+category+':'+str(which), sort_by=sort_by)
 
 
-@endpoint('/opds/categorygroup/{category}/{which}', postprocess=atom)
+@endpoint('/opds/categorygroup/{category}/{which}')
 def opds_categorygroup(ctx, rd, category, which):
     try:
         offset = int(rd.query.get('offset', 0))
@@ -586,6 +700,10 @@ def opds_categorygroup(ctx, rd, category, which):
         raise HTTPNotFound('Not found')
 
     rc = RequestContext(ctx, rd)
+    return rc.cached_feed(('categorygroup', category, which, offset), partial(categorygroup_feed, rc, category, which, offset))
+
+
+def categorygroup_feed(rc, category, which, offset):
     categories = rc.get_categories()
     page_url = rc.url_for('/opds/categorygroup', category=category, which=which)
 
@@ -619,7 +737,7 @@ def belongs(x, which):
     return CategoryFeed(items, category, id_, updated, rc, offsets, page_url, up_url, title=feed_title).root
 
 
-@endpoint('/opds/search/{query=""}', postprocess=atom)
+@endpoint('/opds/search/{query=""}')
 def opds_search(ctx, rd, query):
     try:
         offset = int(rd.query.get('offset', 0))
@@ -632,6 +750,10 @@ def opds_search(ctx, rd, query):
         query = path[-1]
         if isinstance(query, bytes):
             query = query.decode('utf-8')
+    return rc.cached_feed(('search', query, offset), partial(search_feed, rc, query, offset))
+
+
+def search_feed(rc, query, offset):
     try:
         ids = rc.search(query)
     except Exception:
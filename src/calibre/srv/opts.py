@@ -70,6 +70,20 @@ def __new__(cls, *args):
     'worker_count', 10,
     None,
 
+    _('Number of server processes'),
+    'server_processes', 1,
+    _('Run the server in this many processes, to make use of multiple CPU cores.'
+      ' The processes share the listening socket. All changes to libraries are made'
+      ' by the main process, the other processes forward requests that make changes'
+      ' to it and reload libraries after they are changed. Only supported on Linux'
+      ' and BSD, on other platforms a single process is used.'),
+
+    _('The event loop used to handle connections'),
+    'event_loop', Choices('selectors', 'asyncio'),
+    _('The event loop used by the server to handle network connections. With "asyncio",'
+      ' requests that spend most of their time waiting, such as waiting for changes to a'
+      ' library, do not occupy one of the worker threads while they wait.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -82,6 +96,29 @@ def __new__(cls, *args):
     _('Maximum amount of time worker processes are allowed to run (in minutes). Set'
       ' to zero for no limit.'),
 
+    _('Max. size of the cache of books prepared for viewing (in MB)'),
+    'book_render_cache_size', 1024,
+    _('Books are prepared for reading in the browser the first time they are opened and the'
+      ' result is cached on disk. When the cache grows larger than this size, the books that'
+      ' have not been read for the longest time are removed from it. Set to zero for no limit.'),
+
+    _('Number of books to prepare for viewing in advance'),
+    'prerender_books', 0,
+    _('Prepare this many of the most recently read and most recently added books for reading'
+      ' in the browser ahead of time, so that they open quickly. Books are prepared one at a time'
+      ' and only when the server has not been running any other jobs for a while.'),
+
+    _('Unload libraries not used for (in minutes)'),
+    'library_idle_time', 0,
+    _('Libraries that have not been used for this many minutes are unloaded to free memory and are'
+      ' loaded again the next time they are used. Set to zero to keep libraries loaded.'),
+
+    _('Memory for loaded libraries (in MB)'),
+    'library_memory_budget', 0,
+    _('When the libraries loaded by the server use more than approximately this much memory, the'
+      ' libraries that have not been used for the longest time are unloaded, to be loaded again'
+      ' the next time they are used. Useful when serving many libraries. Set to zero for no limit.'),
+
     _('The port on which to listen for connections'),
     'port', 8080,
     None,
@@ -127,6 +164,13 @@ def __new__(cls, *args):
     ' increasing performance. However, it can cause corrupted file transfers on some'
     ' broken filesystems. If you experience corrupted file transfers, turn it off.'),
 
+    _('Use HTTP/2 for clients that support it'),
+    'use_http2', False,
+    _('Use the HTTP/2 protocol for SSL connections from clients that support it. With HTTP/2 all'
+      ' the requests made by a browser at the same time, for example for the covers in the cover grid,'
+      ' are sent in parallel over a single connection. Clients that know the server supports HTTP/2'
+      ' can also use it without SSL.'),
+
     _('Max. log file size (in MB)'),
     'max_log_size', 20,
     _('The maximum size of log files, generated by the server. When the log becomes larger'
@@ -183,6 +227,11 @@ def __new__(cls, *args):
     _('Number of login failures for ban'), 'ban_after', 5,
     _('The number of login failures after which an IP address is banned'),
 
+    _('Remember logged in users for'), 'auth_session_timeout', 60,
+    _('The number of minutes for which a user that has logged in is remembered, using'
+      ' a signed cookie, so that their password does not have to be checked for every'
+      ' request. If set to zero, the password is checked for every request.'),
+
     _('Ignored user-defined metadata fields'),
     'ignored_fields', None,
     _('Comma separated list of user-defined metadata fields that will not be displayed'
@@ -79,6 +79,10 @@ def stop(self, wait_till):
     def busy(self):
         return sum(int(w.working) for w in self.workers)
 
+    @property
+    def queue_length(self):
+        return self.request_queue.qsize()
+
     @property
     def idle(self):
         return sum(int(not w.working) for w in self.workers)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run the content server in several processes, to use multiple CPU cores. Every
+process listens on the same port with SO_REUSEPORT, so the kernel spreads
+incoming connections between them. Only the main process makes changes to
+libraries. The other processes forward requests that could change a library to
+it over a Unix socket and reload libraries that have been changed, which they
+detect using the change log stored in the library.
+'''
+
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import traceback
+from contextlib import suppress
+from threading import Thread
+
+from calibre.constants import isbsd, islinux
+from calibre.db.cache import Cache
+from calibre.srv.errors import HTTPSimpleResponse
+from calibre.srv.http_request import FORWARDED_CLIENT_HEADER
+from calibre.srv.http_response import create_http_handler
+from calibre.srv.loop import ServerLoop
+from calibre.srv.opts import Options, options
+from calibre.srv.pool import PluginPool
+from polyglot import http_client
+
+is_supported = (islinux or isbsd) and hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX')
+HOP_BY_HOP_HEADERS = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade'))
+UNFORWARDED_REQUEST_HEADERS = HOP_BY_HOP_HEADERS | {'accept-encoding', 'content-length', 'expect', FORWARDED_CLIENT_HEADER.lower()}
+UNFORWARDED_RESPONSE_HEADERS = HOP_BY_HOP_HEADERS | {'content-length', 'date'}
+EXTERNAL_CHANGES_CHECK_INTERVAL = 1  # seconds
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+
+    def __init__(self, path, timeout):
+        http_client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def quote_uri(uri):
+    # Clients can send URIs with non-ASCII bytes, which http.client refuses
+    return re.sub(rb'[^\x21-\x7e]', lambda m: b'%%%02X' % m.group()[0], uri).decode('ascii')
+
+
+class WriteForwarder:
+
+    ' Forward requests to the main process, for use as :attr:`Router.forward_writes` '
+
+    def __init__(self, address, timeout):
+        self.address, self.timeout = address, timeout
+
+    def __call__(self, data):
+        body = data.request_body_file
+        body.seek(0, os.SEEK_END)
+        size = body.tell()
+        body.seek(0)
+        conn = UnixHTTPConnection(self.address, self.timeout)
+        try:
+            try:
+                conn.putrequest(data.method, quote_uri(data.request_original_uri), skip_host=True, skip_accept_encoding=True)
+                for key, val in data.inheaders.items():
+                    if key.lower() not in UNFORWARDED_REQUEST_HEADERS:
+                        conn.putheader(key, val)
+                conn.putheader(FORWARDED_CLIENT_HEADER, json.dumps([data.remote_addr, data.remote_port, data.is_trusted_ip]))
+                conn.putheader('Content-Length', str(size))
+                conn.endheaders()
+                while True:
+                    chunk = body.read(64 * 1024)
+                    if not chunk:
+                        break
+                    conn.send(chunk)
+                res = conn.getresponse()
+                ans = res.read()
+            except OSError as e:
+                raise HTTPSimpleResponse(http_client.SERVICE_UNAVAILABLE, f'Failed to forward request to the main server process with error: {e}')
+        finally:
+            conn.close()
+        data.status_code = res.status
+        for key, val in res.getheaders():
+            if key.lower() not in UNFORWARDED_RESPONSE_HEADERS:
+                data.outheaders[key] = val
+        return ans
+
+
+def create_forwarded_request_handler(handler):
+    ' Create a connection handler for requests forwarded from the other processes '
+    create = create_http_handler(handler)
+
+    def forwarded_request_handler(*args, **kwargs):
+        ans = create(*args, **kwargs)
+        ans.accepts_forwarded_client = True
+        return ans
+    return forwarded_request_handler
+
+
+def forwarding_loop(handler, sock, opts, log):
+    ' A server loop that serves requests forwarded by the other processes on the Unix socket sock '
+    kw = {name: getattr(opts, name) for name in options}
+    kw.update(ssl_certfile=None, ssl_keyfile=None, allow_socket_preallocation=False, server_processes=1)
+    ans = ServerLoop(create_forwarded_request_handler(handler), opts=Options(**kw), log=log)
+    ans.LISTENING_MSG = None
+    ans.pre_activated_socket = sock
+    return ans
+
+
+def run_reader(server, address, writer_socket, writer_address, prepare_process):
+    loop = server.loop
+    writer_socket.close()
+    # The listening socket and control connection are inherited from the main process
+    inherited_socket = loop.socket
+    loop.close_control_connection()
+    loop.create_control_connection()
+    # Changes are made by the main process, so they are read from the change
+    # logs of the libraries to notify the WebSocket clients of this process
+    server.change_notifier.poll_for_changes()
+    loop.plugin_pool = PluginPool(loop, (server.change_notifier,))
+    loop.LISTENING_MSG = None
+    loop.bind_address = address
+    try:
+        loop.do_bind()
+    except OSError:
+        # The inherited socket was not created by us, for example, it was
+        # pre-activated by systemd, so share it with the main process instead
+        loop.socket = inherited_socket
+        loop.socket_was_preactivated = True
+    else:
+        inherited_socket.close()
+    server.handler.router.forward_writes = WriteForwarder(writer_address, loop.opts.timeout)
+    server.handler.ctx.library_broker.external_changes_check_interval = EXTERNAL_CHANGES_CHECK_INTERVAL
+    Cache.index_fts_in_background = False
+    prepare_process()
+    loop.serve()
+
+
+def stop_processes(pids, timeout):
+    for pid in pids:
+        with suppress(OSError):
+            os.kill(pid, signal.SIGTERM)
+    wait_till = time.monotonic() + timeout
+    pids = set(pids)
+    while pids:
+        for pid in tuple(pids):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    pids.discard(pid)
+            except ChildProcessError:
+                pids.discard(pid)
+        if pids:
+            if time.monotonic() > wait_till:
+                for pid in pids:
+                    with suppress(OSError):
+                        os.kill(pid, signal.SIGKILL)
+                    with suppress(ChildProcessError):
+                        os.waitpid(pid, 0)
+                break
+            time.sleep(0.01)
+
+
+def serve_in_processes(server, prepare_process=lambda: None):
+    '''
+    Serve using server.loop in opts.server_processes processes. server must be
+    a :class:`calibre.srv.standalone.Server`. prepare_process is called in
+    every process just before it starts serving. Must be called before any
+    threads are started, as it uses fork().
+    '''
+    loop = server.loop
+    loop.initialize_socket()
+    address = loop.socket.getsockname()[:2]
+    tdir = tempfile.mkdtemp(prefix='calibre-srv-')
+    writer_address = os.path.join(tdir, 'writer')
+    writer_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    writer_socket.bind(writer_address)
+    writer_socket.listen(socket.SOMAXCONN)
+    pids = []
+    try:
+        for i in range(loop.opts.server_processes - 1):
+            pid = os.fork()
+            if pid == 0:
+                exit_code = 0
+                try:
+                    run_reader(server, address, writer_socket, writer_address, prepare_process)
+                except KeyboardInterrupt:
+                    pass
+                except BaseException:
+                    traceback.print_exc()
+                    exit_code = 1
+                finally:
+                    os._exit(exit_code)
+            pids.append(pid)
+        forwarded = forwarding_loop(server.handler.dispatch, writer_socket, loop.opts, loop.log)
+        t = Thread(name='ForwardedRequests', target=forwarded.serve_forever, daemon=True)
+        t.start()
+        try:
+            prepare_process()
+            loop.serve()
+        finally:
+            forwarded.stop()
+            t.join(loop.opts.shutdown_timeout)
+            forwarded.close_control_connection()
+    finally:
+        stop_processes(pids, loop.opts.shutdown_timeout)
+        shutil.rmtree(tdir, ignore_errors=True)
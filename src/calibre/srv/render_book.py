@@ -26,6 +26,7 @@
 from calibre.utils.date import EPOCH
 from calibre.utils.forked_map import forked_map, forked_map_is_supported
 from calibre.utils.logging import default_log
+from calibre.utils.monotonic import monotonic
 from calibre.utils.serialize import json_dumps, json_loads, msgpack_loads
 from calibre.utils.short_uuid import uuid4
 from calibre_extensions.fast_css_transform import transform_properties
@@ -577,11 +578,40 @@ def calculate_number_of_workers(names, in_process_container, max_workers):
     return num_workers
 
 
+worker_containers = {}
+MAX_WORKER_CONTAINERS_SIZE = 64 * 1024 * 1024
+
+
+def process_book_file_in_worker(tdir, opfpath, virtualize_resources, link_uid, name, active_books=None):
+    # Run in the long lived worker processes of the server's render pool,
+    # which process the files of many books, so the containers of the books
+    # being rendered are kept. active_books are the (tdir, opfpath) of the
+    # books the pool is currently rendering, the containers of all other
+    # books are dropped, as are the least recently used ones once the
+    # containers hold more than MAX_WORKER_CONTAINERS_SIZE bytes of files.
+    key = tdir, opfpath
+    if active_books is not None:
+        for k in tuple(worker_containers):
+            if k != key and k not in active_books:
+                del worker_containers[k]
+    entry = worker_containers.pop(key, None)
+    if entry is None:
+        container = SimpleContainer(tdir, opfpath, default_log)
+        entry = container, sum(os.path.getsize(x) for x in container.name_path_map.values())
+    worker_containers[key] = entry
+    total = sum(size for c, size in worker_containers.values())
+    while total > MAX_WORKER_CONTAINERS_SIZE and len(worker_containers) > 1:
+        total -= worker_containers.pop(next(iter(worker_containers)))[1]
+    return process_book_file(virtualize_resources, link_uid, entry[0], name)
+
+
 def process_exploded_book(
     book_fmt, opfpath, input_fmt, tdir, log=None, book_hash=None, save_bookmark_data=False,
-    book_metadata=None, virtualize_resources=True, max_workers=1
+    book_metadata=None, virtualize_resources=True, max_workers=1, render_pool=None, timings=None
 ):
     log = log or default_log
+    timings = {} if timings is None else timings
+    phase_start = monotonic()
     container = SimpleContainer(tdir, opfpath, log)
     input_plugin = plugin_for_input_format(input_fmt)
     is_comic = bool(getattr(input_plugin, 'is_image_collection', False))
@@ -648,15 +678,26 @@ def needs_work(mt):
     num_workers = calculate_number_of_workers(names_that_need_work, container, max_workers)
     results = []
     f = partial(process_book_file, virtualize_resources, book_render_data['link_uid'], container)
+    now = monotonic()
+    timings['prepare'], phase_start = now - phase_start, now
     if num_workers < 2:
         results.extend(map(f, names_that_need_work))
     else:
-        if forked_map_is_supported:
+        if render_pool is not None:
+            # The pool workers load the book from disk
+            container.commit()
+            from calibre.srv.render_pool import process_files_in_pool
+            results.extend(process_files_in_pool(
+                render_pool, [(n, os.path.getsize(container.name_path_map[n])) for n in names_that_need_work],
+                container.root, container.name_path_map[container.opf_name], virtualize_resources, book_render_data['link_uid']))
+        elif forked_map_is_supported:
             results.extend(forked_map(f, names_that_need_work, num_workers=num_workers))
         else:
             with ThreadPoolExecutor(max_workers=num_workers) as executor:
                 results.extend(executor.map(f, names_that_need_work))
 
+    now = monotonic()
+    timings['process_files'], phase_start = now - phase_start, now
     ltm = book_render_data['link_to_map']
     html_data = {}
     virtualized_names = set()
@@ -724,6 +765,8 @@ def manifest_data(name):
         for k, v in tuple(amap.items()):
             amap[k] = tuple(v)  # needed for JSON serialization
 
+    timings['finalize'] = monotonic() - phase_start
+    book_render_data['render_stats'] = {'num_workers': num_workers, 'num_files_processed': len(names_that_need_work), 'timings': timings}
     data = as_bytes(json.dumps(book_render_data, ensure_ascii=False))
     with open(os.path.join(container.root, 'calibre-book-manifest.json'), 'wb') as f:
         f.write(data)
@@ -804,8 +847,12 @@ def get_stored_annotations(container, bookmark_data):
                 yield {'type': 'last-read', 'pos': epubcfi, 'pos_type': 'epubcfi', 'timestamp': EPOCH}
 
 
-def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=0):
+def render(
+    pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=0, render_pool=None
+):
     pathtoebook = os.path.abspath(pathtoebook)
+    timings = {}
+    phase_start = monotonic()
     mi = None
     if serialize_metadata:
         from calibre.customize.ui import quick_metadata
@@ -813,10 +860,12 @@ def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, ex
         with open(pathtoebook, 'rb') as f, quick_metadata:
             mi = get_metadata(f, os.path.splitext(pathtoebook)[1][1:].lower())
     book_fmt, opfpath, input_fmt = extract_book(pathtoebook, output_dir, log=default_log)
+    timings['extract'] = monotonic() - phase_start
     container, bookmark_data = process_exploded_book(
         book_fmt, opfpath, input_fmt, output_dir, max_workers=max_workers,
         book_hash=book_hash, save_bookmark_data=extract_annotations,
-        book_metadata=mi, virtualize_resources=virtualize_resources
+        book_metadata=mi, virtualize_resources=virtualize_resources,
+        render_pool=render_pool, timings=timings
     )
     if serialize_metadata:
         from calibre.ebooks.metadata.book.serialize import metadata_as_dict
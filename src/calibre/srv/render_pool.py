@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A pool of long lived worker processes, shared by all the render jobs of the
+server, in which the files of the books being rendered are processed. Render
+jobs run in their own worker processes and connect to the pool to have the
+files of their book processed in parallel. The largest files are processed
+first and no job is allowed to use more than max_workers_per_job workers at
+a time, so that several books can be rendered at once.
+'''
+
+import os
+from heapq import heappop, heappush
+from itertools import count
+from multiprocessing.connection import Client, Listener
+from threading import Lock, Thread
+
+from calibre.utils.ipc.pool import Failure, Pool
+from polyglot.queue import Empty, Queue
+
+
+class RenderJob:
+
+    def __init__(self, job_id, tdir, opfpath, virtualize_resources, link_uid, files):
+        self.job_id = job_id
+        self.args = tdir, opfpath, virtualize_resources, link_uid
+        self.pending = []
+        for name, size in files:
+            heappush(self.pending, (-size, name))
+        self.running = 0
+        self.results = Queue()
+
+
+class RenderPool(Thread):
+
+    daemon = True
+
+    def __init__(self, max_workers, max_workers_per_job=None):
+        Thread.__init__(self, name='RenderPoolListener')
+        self.max_workers = max(1, max_workers)
+        self.max_workers_per_job = max_workers_per_job or max(1, (self.max_workers + 1) // 2)
+        self.authkey = os.urandom(32)
+        self.listener = Listener(authkey=self.authkey)
+        self.address = self.listener.address
+        self.lock = Lock()
+        self.jobs = []
+        self.tasks = {}
+        self.task_ids, self.job_ids = count(), count()
+        self.pool = None
+        self.shutting_down = False
+        self.start()
+
+    def run(self):
+        while not self.shutting_down:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self.shutting_down:
+                    break
+                continue
+            t = Thread(name='RenderPoolJob', target=self.serve_job, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def serve_job(self, conn):
+        with conn:
+            try:
+                tdir, opfpath, virtualize_resources, link_uid, files = conn.recv()
+            except Exception:
+                return
+            job = RenderJob(next(self.job_ids), tdir, opfpath, virtualize_resources, link_uid, files)
+            with self.lock:
+                self.jobs.append(job)
+                self.dispatch()
+            try:
+                for i in range(len(files)):
+                    name, ok, result = job.results.get()
+                    conn.send((name, ok, result))
+                    if not ok:
+                        break
+            except Exception:
+                pass  # The render job was aborted
+            finally:
+                with self.lock:
+                    if job in self.jobs:
+                        self.jobs.remove(job)
+
+    def next_task(self):
+        # The largest pending file of the jobs that are below their limit
+        ans = None
+        for job in self.jobs:
+            if job.pending and job.running < self.max_workers_per_job and (ans is None or job.pending[0] < ans.pending[0]):
+                ans = job
+        if ans is not None:
+            return ans, heappop(ans.pending)[1]
+        return None, None
+
+    def dispatch(self):
+        # Must be called with self.lock held
+        while len(self.tasks) < self.max_workers and not self.shutting_down:
+            job, name = self.next_task()
+            if job is None:
+                break
+            task_id = next(self.task_ids)
+            if self.pool is None or self.pool.failed:
+                self.start_pool()
+            # The workers drop the books that are no longer being rendered
+            active_books = frozenset(j.args[:2] for j in self.jobs)
+            try:
+                self.pool(task_id, 'calibre.srv.render_book', 'process_book_file_in_worker', *job.args, name, active_books=active_books)
+            except Failure as e:
+                job.results.put((name, False, f'Failed to process {name} with error: {e.failure_message}'))
+                self.pool = None
+                continue
+            job.running += 1
+            self.tasks[task_id] = job, name
+
+    def start_pool(self):
+        # A crashed worker process stops the pool, so a new pool is used for
+        # subsequent tasks
+        self.pool = pool = Pool(max_workers=self.max_workers, name='RenderPool')
+        t = Thread(name='RenderPoolResults', target=self.read_results, args=(pool,))
+        t.daemon = True
+        t.start()
+
+    def read_results(self, pool):
+        while not self.shutting_down:
+            try:
+                wr = pool.results.get(timeout=1)
+            except Empty:
+                if (pool.failed or pool is not self.pool) and not pool.busy_workers:
+                    break
+                continue
+            with self.lock:
+                job, name = self.tasks.pop(wr.id, (None, None))
+                if job is not None:
+                    job.running -= 1
+                    if wr.is_terminal_failure:
+                        job.results.put((name, False, f'Worker process crashed while processing {name}:\n{wr.result.traceback}'))
+                    elif wr.result.err:
+                        job.results.put((name, False, f'Failed to process {name} with error: {wr.result.err}\n{wr.result.traceback}'))
+                    else:
+                        job.results.put((name, True, wr.result.value))
+                self.dispatch()
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+            pool, self.pool = self.pool, None
+            for job in self.jobs:
+                job.results.put((None, False, 'The render pool was shut down'))
+        try:
+            self.listener.close()
+        except Exception:
+            pass
+        if pool is not None:
+            pool.shutdown()
+
+
+def process_files_in_pool(pool_address, files, tdir, opfpath, virtualize_resources, link_uid):
+    ' Process the specified (name, size) files in the render pool at pool_address, yielding the results '
+    address, authkey = pool_address
+    with Client(address, authkey=authkey) as conn:
+        conn.send((tdir, opfpath, virtualize_resources, link_uid, tuple(files)))
+        for i in range(len(files)):
+            name, ok, result = conn.recv()
+            if not ok:
+                raise Exception(result)
+            yield result
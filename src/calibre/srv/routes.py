@@ -14,7 +14,9 @@
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPNotFound, HTTPSimpleResponse, RouteError
+from calibre.srv.metrics import metrics
 from calibre.srv.utils import http_date
+from calibre.utils.monotonic import monotonic
 from calibre.utils.serialize import MSGPACK_MIME, json_dumps, msgpack_dumps
 from polyglot import http_client
 from polyglot.builtins import iteritems, itervalues
@@ -92,6 +94,7 @@ def annotate(f):
         f.ok_code = ok_code
         f.is_endpoint = True
         f.needs_db_write = needs_db_write
+        f.is_coroutine = inspect.iscoroutinefunction(f)
         argspec = inspect.getfullargspec(f)
         if len(argspec.args) < 2:
             raise TypeError(f'The endpoint {f.route!r} must take at least two arguments')
@@ -107,6 +110,11 @@ def annotate(f):
     return annotate
 
 
+def record_request(endpoint_, start, error=None):
+    # Errors such as HTTPNotFound are responses, not failures
+    metrics.observe_request(endpoint_.route, monotonic() - start, failed=error is not None and not isinstance(error, HTTPSimpleResponse))
+
+
 class Route:
 
     var_pat = None
@@ -234,6 +242,9 @@ def __init__(self, endpoints=None, ctx=None, url_prefix=None, auth_controller=No
             self.strip_path = tuple(self.url_prefix[1:].split('/'))
         self.ctx = ctx
         self.auth_controller = auth_controller
+        # If not None, requests that could change libraries are passed to this
+        # function instead of being handled, see srv/prefork.py
+        self.forward_writes = None
         self.init_session = getattr(ctx, 'init_session', lambda ep, data:None)
         self.finalize_session = getattr(ctx, 'finalize_session', lambda ep, data, output:None)
         self.endpoints = set()
@@ -301,8 +312,22 @@ def read_cookies(self, data):
 
     def dispatch(self, data):
         endpoint_, args = self.find_route(data.path)
+        start = monotonic()
+        try:
+            ans = self.dispatch_to_endpoint(endpoint_, data, args, start)
+        except Exception as e:
+            record_request(endpoint_, start, e)
+            raise
+        if not inspect.iscoroutine(ans):
+            # Coroutines are recorded when they finish
+            record_request(endpoint_, start)
+        return ans
+
+    def dispatch_to_endpoint(self, endpoint_, data, args, start):
         if data.method not in endpoint_.methods:
             raise HTTPSimpleResponse(http_client.METHOD_NOT_ALLOWED)
+        if self.forward_writes is not None and (endpoint_.needs_db_write or data.method not in ('GET', 'HEAD')):
+            return self.forward_writes(data)
 
         self.read_cookies(data)
 
@@ -316,6 +341,20 @@ def dispatch(self, data):
         if endpoint_.needs_db_write:
             self.ctx.check_for_write_access(data)
         ans = endpoint_(self.ctx, data, *args)
+        if endpoint_.is_coroutine:
+            return self.finish_async_dispatch(endpoint_, data, ans, start)
+        return self.finish_dispatch(endpoint_, data, ans)
+
+    async def finish_async_dispatch(self, endpoint_, data, coro, start):
+        try:
+            ans = self.finish_dispatch(endpoint_, data, await coro)
+        except Exception as e:
+            record_request(endpoint_, start, e)
+            raise
+        record_request(endpoint_, start)
+        return ans
+
+    def finish_dispatch(self, endpoint_, data, ans):
         self.finalize_session(endpoint_, data, ans)
         outheaders = data.outheaders
 
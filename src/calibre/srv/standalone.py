@@ -11,10 +11,12 @@
 from calibre.constants import is_running_from_develop, ismacos, iswindows
 from calibre.db.legacy import LibraryDatabase
 from calibre.srv.bonjour import BonJour
+from calibre.srv.books import Prerenderer
+from calibre.srv.change_notifier import ChangeNotifier
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
-from calibre.srv.library_broker import load_gui_libraries
-from calibre.srv.loop import BadIPSpec, ServerLoop
+from calibre.srv.library_broker import LibraryUnloader, load_gui_libraries
+from calibre.srv.loop import BadIPSpec, server_loop_class
 from calibre.srv.manage_users_cli import manage_users_cli
 from calibre.srv.opts import opts_to_parser
 from calibre.srv.users import connect
@@ -70,17 +72,24 @@ def __init__(self, libraries, opts):
         if opts.search_the_net_urls:
             with open(os.path.expanduser(opts.search_the_net_urls), 'rb') as f:
                 self.handler.router.ctx.search_the_net_urls = json.load(f)
-        plugins = []
+        self.change_notifier = ChangeNotifier(self.handler)
+        plugins = [self.change_notifier]
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
-        self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+        if opts.prerender_books > 0:
+            plugins.append(Prerenderer(self.handler.ctx, opts.prerender_books))
+        if opts.library_idle_time > 0 or opts.library_memory_budget > 0:
+            plugins.append(LibraryUnloader(
+                self.handler.ctx.library_broker, idle_time=opts.library_idle_time * 60, memory_budget=opts.library_memory_budget * 1024 * 1024))
+        self.loop = server_loop_class(opts)(
+            create_http_handler(self.handler.dispatch, websocket_handler=self.change_notifier),
             opts=opts,
             log=log,
             access_log=access_log,
             plugins=plugins)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
+        self.handler.set_thread_pool(self.loop.pool)
         self.serve_forever = self.loop.serve_forever
         self.stop = self.loop.stop
         if is_running_from_develop:
@@ -236,8 +245,23 @@ def main(args=sys.argv):
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
-    # Needed for dynamic cover generation, which uses Qt for drawing
-    from calibre.gui2 import ensure_app, load_builtin_fonts
-    ensure_app(), load_builtin_fonts()
+
+    def prepare_process():
+        # Needed for dynamic cover generation, which uses Qt for drawing
+        from calibre.gui2 import ensure_app, load_builtin_fonts
+        ensure_app(), load_builtin_fonts()
+        # Worker processes are started only after any forking for daemonizing
+        # or for multiple server processes is done, so that they belong to the
+        # process that uses them
+        server.loop.jobs_manager.prewarm()
+
+    if opts.server_processes > 1:
+        from calibre.srv.prefork import is_supported, serve_in_processes
+        if is_supported:
+            with HandleInterrupt(server.stop):
+                serve_in_processes(server, prepare_process)
+            return
+        server.loop.log.warn('Running in multiple processes is not supported on this platform, using a single process')
+    prepare_process()
     with HandleInterrupt(server.stop):
         server.serve_forever()
@@ -6,15 +6,18 @@
 
 import json
 import os
+import time
 import zlib
+from datetime import datetime, timezone
 from functools import partial
 from io import BytesIO
+from unittest.mock import patch
 
 from calibre.ebooks.metadata.meta import get_metadata
 from calibre.srv.tests.base import LibraryBaseTest
 from calibre.utils.localization import _
 from polyglot.binary import as_base64_bytes
-from polyglot.http_client import FORBIDDEN, NOT_FOUND, OK
+from polyglot.http_client import BAD_REQUEST, FORBIDDEN, NOT_FOUND, NOT_MODIFIED, OK
 from polyglot.urllib import quote, urlencode
 
 
@@ -55,6 +58,201 @@ def test_ajax_book(self):  # {{{
 
     # }}}
 
+    def test_ajax_changes(self):  # {{{
+        'Test /ajax/changes'
+        from threading import Timer
+        with self.create_server(event_loop='asyncio') as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+            request = partial(make_request, conn, prefix='/ajax/changes')
+            latest = db.last_change_seq()
+            r, data = request(f'/{latest}')
+            self.ae(data['changes'], [])
+            self.ae(data['library_id'], db.server_library_id)
+            t = Timer(0.2, db.set_field, args=('title', {1: 'changed'}))
+            t.start()
+            r, data = request(f'/{latest}?wait=30')
+            t.join()
+            self.ae([(c['book_id'], c['kind'], c['fields']) for c in data['changes']], [(1, 'metadata', ['title'])])
+            r, data = request(f'/{latest}?wait=x')
+            self.ae(r.status, NOT_FOUND)
+        # wait is ignored when the request would occupy a worker thread
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+            latest = db.last_change_seq()
+            start = time.monotonic()
+            r, data = make_request(conn, f'/ajax/changes/{latest}?wait=30')
+            self.ae(data['changes'], [])
+            self.assertLess(time.monotonic() - start, 10)
+    # }}}
+
+    def test_delta_sync(self):  # {{{
+        'Test /interface-data/book-changes and /book-get-annotations-changes'
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+            lid = db.server_library_id
+            r, data = make_request(conn, '/interface-data/get-books', prefix='')
+            since = data['change_seq']
+            self.ae(since, db.last_change_seq())
+            request = partial(make_request, conn, prefix='/interface-data/book-changes')
+            r, data = request(f'/{since}')
+            self.ae((data['metadata'], data['removed_book_ids'], data['reset'], data['change_seq']), ({}, [], False, since))
+            db.set_field('title', {1: 'changed'})
+            db.remove_books((2,))
+            r, data = request(f'/{since}')
+            self.ae(set(data['metadata']), {'1'})
+            self.ae(data['metadata']['1']['title'], 'changed')
+            self.ae(data['removed_book_ids'], [2])
+            self.assertFalse(data['more'])
+            r, data2 = request(f'/{since}?num=1')
+            self.assertTrue(data2['more'])
+            self.ae(request(f'/{data2["change_seq"]}')[1]['removed_book_ids'], [2])
+            self.ae(request(f'/{data["change_seq"]}')[1]['metadata'], {})
+            self.ae(request(f'/{db.last_change_seq() + 10}')[1]['reset'], True)
+            self.ae(request('/x')[0].status, NOT_FOUND)
+
+            request = partial(make_request, conn, prefix=f'/book-get-annotations-changes/{lid}')
+            since = db.last_change_seq()
+            db.set_last_read_position(1, 'EPUB', user='*', device='d', cfi='/1', pos_frac=0.5)
+            r, data = request(f'/{since}/1-EPUB_3-EPUB')
+            self.assertFalse(data['reset'])
+            self.ae(set(data['books']), {'1:EPUB', '3:EPUB'})
+            self.assertNotIn('annotations_map', data['books']['1:EPUB'])
+            self.ae(len(data['books']['1:EPUB']['last_read_positions']), 1)
+            annot = {'type': 'bookmark', 'title': 'b', 'pos': 'epubcfi(/2)', 'pos_type': 'epubcfi', 'timestamp': '2020-01-01T00:00:00+00:00'}
+            db.merge_annotations_for_book(1, 'EPUB', [annot], user_type='web', user='*')
+            r, data = request(f'/{since}/1-epub_3-EPUB')
+            self.ae(data['books']['1:epub']['annotations_map']['bookmark'][0]['title'], 'b')
+            self.assertNotIn('annotations_map', data['books']['3:EPUB'])
+            r, data = request(f'/{data["change_seq"]}/1-EPUB')
+            self.assertNotIn('annotations_map', data['books']['1:EPUB'])
+    # }}}
+
+    def test_tag_browser(self):  # {{{
+        'Test caching and partial fetching of the Tag Browser'
+        from calibre.srv.metadata import categories_settings, render_categories
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+            request = partial(make_request, conn, prefix='/interface-data/tag-browser')
+
+            def expected():
+                opts = categories_settings({}, db, gst_container=tuple)
+                categories = db.get_categories(sort=opts.sort_by, first_letter_sort=True)
+                return json.loads(json.dumps(render_categories(opts, db, categories)))
+
+            def cache_entry():
+                cache = server.handler.router.ctx.library_broker.tag_browser_caches[db.server_library_id]
+                self.ae(len(cache), 1)
+                return next(iter(cache.values()))
+
+            self.ae(request('')[1], expected())
+            categories = cache_entry().categories
+            db.set_field('tags', {1: ['Tag One', 'newtag']})
+            data = request('')[1]
+            self.ae(data, expected())
+            self.assertIn('newtag', {item['name'] for item in data['item_map'].values()})
+            # Only the categories affected by the change are read again
+            self.assertIs(cache_entry().categories['authors'], categories['authors'])
+            self.assertIsNot(cache_entry().categories['tags'], categories['tags'])
+            db.set_field('rating', {1: 4})
+            data = request('')[1]
+            self.ae(data, expected())
+            self.assertIsNot(cache_entry().categories['authors'], categories['authors'])
+
+            r, top = request('?depth=1')
+            self.ae([c['id'] for c in top['root']['children']], [c['id'] for c in data['root']['children']])
+            self.ae(set(top['item_map']), {c['id'] for c in data['root']['children']})
+            for node in top['root']['children']:
+                self.ae(node['children'], [])
+                self.ae(node.get('num_children', 0), len(next(c for c in data['root']['children'] if c['id'] == node['id'])['children']))
+            tags = next(c for c in data['root']['children'] if data['item_map'][c['id']]['category'] == 'tags')
+            r, sub = request('?node=tags')
+            self.ae(sub['root'], tags)
+            self.ae(sub['item_map'][tags['id']]['category'], 'tags')
+            # Node keys, unlike node ids, do not change when the library changes
+            db.set_field('authors', {2: ['Aaa Added']})
+            r, sub = request('?node=tags&node=tags:newtag&depth=1')
+            self.ae(sub['item_map'][sub['root']['id']]['name'], 'newtag')
+            # A matching ETag does not need the tree
+            with patch('calibre.srv.code.categories_as_json', side_effect=AssertionError):
+                r, sub = request('?node=tags&node=tags:newtag&depth=1', headers={'If-None-Match': r.getheader('ETag')})
+            self.ae(r.status, NOT_MODIFIED)
+            self.ae(request('?node=xxx')[0].status, NOT_FOUND)
+            self.ae(request('?node=tags&node=xxx')[0].status, NOT_FOUND)
+            self.ae(request('?node=tags&node=authors:newtag')[0].status, NOT_FOUND)
+            self.ae(request('?depth=x')[0].status, NOT_FOUND)
+    # }}}
+
+    def test_change_notifications(self):  # {{{
+        'Test pushing library changes to WebSocket clients'
+        from threading import Thread
+
+        from calibre.srv.change_notifier import ChangeNotifier
+        from calibre.srv.http_response import create_http_handler
+        from calibre.srv.tests.web_sockets import WSClient
+        with self.create_server(auth=True, auth_mode='basic') as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            um = server.handler.ctx.user_manager
+            um.add_user('all', 'test')
+            um.add_user('12', 'test', restriction={
+                'library_restrictions':{os.path.basename(db.backend.library_path): 'id:1 or id:2'}})
+            notifier = ChangeNotifier(server.handler)
+            notifier.coalesce_interval = 0.01
+            server.loop.handler = create_http_handler(server.handler.dispatch, websocket_handler=notifier)
+            t = Thread(target=notifier.start, args=(server.loop,), daemon=True)
+            t.start()
+
+            def connect(username='all', path='/ws/changes'):
+                headers = {'Authorization': 'Basic ' + as_base64_bytes(f'{username}:test').decode('ascii')} if username else {}
+                return WSClient(server.address[1], path=path, headers=headers)
+
+            def message(client):
+                frame = client.read_frame()
+                return json.loads(frame.payload)
+
+            for args in ((None,), ('all', '/ws/other')):
+                self.assertRaises(ValueError, connect, *args)
+            # Pages on other sites cannot connect with the credentials of the user
+            host = f'localhost:{server.address[1]}'
+            for origin, host_header in (('http://evil.example', host), ('null', host), (f'http://{host}', None)):
+                headers = {'Origin': origin, 'Host': host_header} if host_header else {'Origin': origin}
+                headers['Authorization'] = 'Basic ' + as_base64_bytes('all:test').decode('ascii')
+                self.assertRaises(ValueError, WSClient, server.address[1], path='/ws/changes', headers=headers)
+            with WSClient(server.address[1], path='/ws/changes', headers={
+                'Origin': f'http://{host}', 'Host': host, 'Authorization': 'Basic ' + as_base64_bytes('all:test').decode('ascii')}):
+                pass
+            while notifier.connections:
+                time.sleep(0.01)
+            with connect() as c1, connect('12') as c2:
+                while len(notifier.connections) < 2:
+                    time.sleep(0.01)
+                db.set_field('title', {1: 'changed', 3: 'changed'})
+                db.set_field('tags', {1: ['x']})
+                m = message(c1)
+                self.ae((m['type'], m['library_id'], m['metadata'], m['removed']), ('changes', db.server_library_id, [1, 3], []))
+                self.ae(m['fields'], ['tags', 'title'])
+                self.ae(m['change_seq'], db.last_change_seq())
+                m = message(c2)
+                self.ae((m['metadata'], m['removed']), ([1], [3]))
+                db.remove_books((3,))
+                self.ae(message(c1)['removed'], [3])
+                self.ae(message(c2)['removed'], [3])
+            notifier.stop()
+            t.join()
+
+            # Reading changes from the change log, as in processes that do not make changes
+            notifier = ChangeNotifier(server.handler)
+            notifier.poll_for_changes()
+            notifier.read_change_logs()
+            notifier.connections[0] = (lambda: None), 'all'
+            db.set_field('title', {2: 'changed'})
+            notifier.read_change_logs()
+            self.ae(dict(notifier.pending[db.server_library_id]), {'metadata': {2}, 'fields': {'title'}})
+    # }}}
+
     def test_ajax_categories(self):  # {{{
         'Test /ajax/categories and /ajax/search'
         with self.create_server() as server:
@@ -85,6 +283,78 @@ def test_ajax_categories(self):  # {{{
             self.ae(set(data['book_ids']), {2})
     # }}}
 
+    def test_book_lists(self):  # {{{
+        'Test the paginated lists of books'
+        from calibre.srv.metadata import book_as_json, books_as_json
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            ids = sorted(db.all_book_ids())
+            data = books_as_json(db, ids + [1000])
+            self.ae(list(data), ids)
+            for book_id in ids:
+                self.ae(json.dumps(data[book_id]), json.dumps(book_as_json(db, book_id)))
+            conn = server.connect()
+            r, data = make_request(conn, '/interface-data/books-init?num=2&sort=title.asc', prefix='')
+            self.ae(r.status, OK)
+            self.assertTrue(r.getheader('Content-Length'))
+            page = data['search_result']['book_ids']
+            self.ae(len(page), 2)
+            self.ae(set(data['metadata']), set(map(str, page)))
+            for book_id in page:
+                self.ae(data['metadata'][str(book_id)]['title'], db.field_for('title', book_id))
+            r, zdata = make_request(conn, '/interface-data/books-init?num=2&sort=title.asc', prefix='', headers={'Accept-Encoding': 'gzip'})
+            self.ae(r.getheader('Content-Encoding'), 'gzip')
+            self.ae(json.loads(zlib.decompress(zdata, 16+zlib.MAX_WBITS)), data)
+            all_sorted = make_request(conn, '/search?num=100&sort=title')[1]['book_ids']
+            self.ae(all_sorted[:2], page)
+            r, data = make_request(conn, f'/search?num=1&sort=title&after={page[0]}')
+            self.ae(data['book_ids'], all_sorted[1:2])
+            self.ae(data['offset'], 1)
+            # An unknown book falls back to offset
+            self.ae(make_request(conn, '/search?num=1&offset=2&sort=title&after=1000')[1]['book_ids'], all_sorted[2:3])
+            self.ae(make_request(conn, '/search?after=x')[0].status, BAD_REQUEST)
+            body = json.dumps({'query': '', 'offset': 0, 'sort': 'title', 'sort_order': 'asc', 'vl': '', 'after': 'x'})
+            self.ae(make_request(conn, '/interface-data/more-books?num=10', prefix='', method='POST', data=body)[0].status, BAD_REQUEST)
+            body = json.dumps({'query': '', 'offset': 0, 'sort': 'title', 'sort_order': 'asc', 'vl': '', 'after': page[1]})
+            data = make_request(conn, '/interface-data/more-books?num=10', prefix='', method='POST', data=body)[1]
+            self.ae(data['search_result']['book_ids'], all_sorted[2:])
+            self.ae(set(data['metadata']), set(map(str, all_sorted[2:])))
+            # Sorted results are updated when the library changes
+            db.set_field('title', {all_sorted[-1]: '0 first'})
+            self.ae(make_request(conn, '/search?num=1&sort=title')[1]['book_ids'], all_sorted[-1:])
+    # }}}
+
+    def test_metrics(self):  # {{{
+        'Test the /metrics endpoint'
+        from calibre.srv.metrics import metrics
+        with self.create_server() as server:
+            conn = server.connect()
+            self.ae(make_request(conn, '/metrics', prefix='')[0].status, FORBIDDEN)
+        with self.create_server(local_write=True) as server:
+            server.handler.set_thread_pool(server.loop.pool)
+            library_id = server.handler.router.ctx.library_broker.default_library
+            search, book = '/ajax/search/{library_id=None}', '/ajax/book/{book_id}/{library_id=None}'
+            before = {route: metrics.request_durations[route].count for route in (search, book)}
+            conn = server.connect()
+            make_request(conn, '/search?num=1')
+            make_request(conn, '/book/1')
+            make_request(conn, '/book/1000')
+            r, data = make_request(conn, '/metrics', prefix='')
+            self.ae(r.status, OK)
+            self.assertTrue(r.getheader('Content-Type').startswith('text/plain; version=0.0.4'))
+            samples = {}
+            for line in data.decode('utf-8').splitlines():
+                if not line.startswith('#'):
+                    k, v = line.rpartition(' ')[::2]
+                    samples[k] = float(v)
+            self.ae(samples[f'calibre_request_duration_seconds_count{{endpoint="{search}"}}'], before[search] + 1)
+            self.ae(samples[f'calibre_request_duration_seconds_bucket{{endpoint="{book}",le="+Inf"}}'], before[book] + 2)
+            self.assertNotIn(f'calibre_request_errors_total{{endpoint="{book}"}}', samples)
+            self.ae(samples['calibre_worker_threads'], server.loop.opts.worker_count)
+            self.ae(samples['calibre_request_queue_length'], 0)
+            self.ae(samples[f'calibre_db_lock_waits_total{{library_id="{library_id}",mode="exclusive"}}'], 0)
+    # }}}
+
     def test_srv_restrictions(self):  # {{{
         ' Test that virtual lib. + search restriction works on all end points'
         with self.create_server(auth=True, auth_mode='basic') as server:
@@ -159,6 +429,50 @@ def sr(path, **k):
             # Not going test legacy and opds as they are too painful
     # }}}
 
+    def test_restriction_cache(self):  # {{{
+        ' Test that the books allowed by a restriction are cached and updated incrementally'
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            db = ctx.library_broker.get(None)
+            searches = []
+            orig_search = db.search
+
+            def search(*a, **kw):
+                searches.append(kw.get('book_ids'))
+                return orig_search(*a, **kw)
+            db.search = search
+            restriction = 'tags:"=present"'
+            db.set_field('tags', {1: ['present']})
+            ae = self.assertEqual
+            ae(ctx.restricted_book_ids(db, restriction), {1})
+            ae(ctx.restricted_book_ids(db, restriction), {1})
+            ae(searches, [None])
+            db.set_field('tags', {1: [], 2: ['present']})
+            ae(ctx.restricted_book_ids(db, restriction), {2})
+            ae(searches[1:], [{1, 2}])
+            db.set_field('title', {3: 'changed'})
+            ae(ctx.restricted_book_ids(db, restriction), {2})
+            ae(searches[2:], [{3}])
+            db.remove_books((2,))
+            ae(ctx.restricted_book_ids(db, restriction), set())
+            ae(len(searches), 3)
+            # Changes that are not limited to some books cause a new search
+            db.set_pref('virtual_libraries', {'x': 'id:1'})
+            ae(ctx.restricted_book_ids(db, restriction), set())
+            ae(searches[3:], [None])
+            # Changes that are not in the change log, such as marking books
+            # through a view, are seen
+            from calibre.db.view import View
+            View(db).set_marked_ids({1, 3})
+            ae(ctx.restricted_book_ids(db, restriction), set())
+            ae(searches[4:], [{1, 3}])
+            restriction = 'last_modified:>2099-01-01'
+            ae(ctx.restricted_book_ids(db, restriction), set())
+            db.update_last_modified({3}, now=datetime(2100, 1, 1, tzinfo=timezone.utc))
+            ae(ctx.restricted_book_ids(db, restriction), {3})
+            ae(searches[5:], [None, {3}])
+    # }}}
+
     def test_srv_add_book(self):  # {{{
         with self.create_server(auth=True, auth_mode='basic') as server:
             server.handler.ctx.user_manager.add_user('12', 'test')
@@ -45,11 +45,11 @@ def android2(ctx, data):
     return 'android2'
 
 
-def router(prefer_basic_auth=False, ban_for=0, ban_after=5):
+def router(prefer_basic_auth=False, ban_for=0, ban_after=5, session_max_age_seconds=0):
     from calibre.srv.auth import AuthController
     return Router(itervalues(globals()), auth_controller=AuthController(
         {'testuser':'testpw', '!@#$%^&*()-=_+':'!@#$%^&*()-=_+'},
-        ban_time_in_minutes=ban_for, ban_after=ban_after,
+        ban_time_in_minutes=ban_for, ban_after=ban_after, session_max_age_seconds=session_max_age_seconds,
         prefer_basic_auth=prefer_basic_auth, realm=REALM, max_age_seconds=1))
 
 
@@ -162,6 +162,30 @@ def library_info(username=None):
 
     # }}}
 
+    def test_user_manager_cache(self):  # {{{
+        from calibre.srv.users import UserManager
+        with TemporaryDirectory() as base:
+            path = os.path.join(base, 'users.sqlite')
+            um, other = UserManager(path), UserManager(path)
+            um.check_for_changes_interval = 0
+            um.add_user('a', 'pw1', readonly=True)
+            self.ae(um.get('a'), 'pw1')
+            self.assertTrue(um.is_readonly('a'))
+            um.change_password('a', 'pw2')
+            self.ae(um.get('a'), 'pw2')
+            um.update_user_restrictions('a', {'blocked_library_names': ['L2']})
+            self.ae(um.restrictions('a')['blocked_library_names'], frozenset({'l2'}))
+            # Changes made by other connections are noticed
+            other.set_readonly('a', False)
+            other.add_user('b', 'pw3')
+            self.assertFalse(um.is_readonly('a'))
+            self.ae(um.get('b'), 'pw3')
+            other.remove_user('b')
+            self.assertIsNone(um.get('b'))
+            self.assertIsNone(um.restrictions('b'))
+            um.conn.close(), other.conn.close()
+    # }}}
+
     def test_digest_auth(self):  # {{{
         'Test HTTP Digest auth'
         from calibre.srv.http_request import normalize_header_name
@@ -305,3 +329,40 @@ def test_android_auth_workaround(self):  # {{{
                 self.ae(e.code, http_client.UNAUTHORIZED)
 
     # }}}
+
+    def test_session_auth(self):  # {{{
+        'Test authentication with session cookies and tokens'
+        from calibre.srv.auth import AuthController
+        r = router(prefer_basic_auth=True, session_max_age_seconds=1)
+        credentials = r.auth_controller.user_credentials
+        with TestServer(r.dispatch) as server:
+            r.auth_controller.log = server.log
+            conn = server.connect()
+
+            def request(headers={}, path='/closed'):
+                conn.request('GET', path, headers=headers)
+                r = conn.getresponse()
+                r.read()
+                return r
+
+            r = request({'Authorization': b'Basic ' + as_base64_bytes(b'testuser:testpw')})
+            self.ae(r.status, http_client.OK)
+            cookie = r.getheader('Set-Cookie')
+            self.assertIn(AuthController.SESSION_COOKIE, cookie)
+            self.assertIn('HttpOnly', cookie)
+            token = cookie.partition('=')[2].partition(';')[0].strip('"')
+            for headers in ({'Cookie': f'{AuthController.SESSION_COOKIE}={token}'}, {'Authorization': f'Bearer {token}'}):
+                r = request(headers)
+                self.ae(r.status, http_client.OK)
+                self.assertIsNone(r.getheader('Set-Cookie'))
+            bad = token[:-1] + ('0' if token[-1] != '0' else '1')
+            self.ae(request({'Authorization': f'Bearer {bad}'}).status, http_client.UNAUTHORIZED)
+            self.ae(request({'Authorization': 'Bearer x:y:z'}).status, http_client.UNAUTHORIZED)
+            # Changing the password invalidates the session
+            credentials['testuser'] = 'changed'
+            self.ae(request({'Authorization': f'Bearer {token}'}).status, http_client.UNAUTHORIZED)
+            credentials['testuser'] = 'testpw'
+            self.ae(request({'Authorization': f'Bearer {token}'}).status, http_client.OK)
+            time.sleep(2.01)
+            self.ae(request({'Authorization': f'Bearer {token}'}).status, http_client.UNAUTHORIZED)
+    # }}}
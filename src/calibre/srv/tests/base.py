@@ -107,12 +107,13 @@ class TestServer(Thread):
     def __init__(self, handler, plugins=(), **kwargs):
         Thread.__init__(self, name='ServerMain')
         from calibre.srv.http_response import create_http_handler
-        from calibre.srv.loop import ServerLoop
+        from calibre.srv.loop import server_loop_class
         from calibre.srv.opts import Options
         self.setup_defaults(kwargs)
-        self.loop = ServerLoop(
+        opts = Options(**kwargs)
+        self.loop = server_loop_class(opts)(
             create_http_handler(handler),
-            opts=Options(**kwargs),
+            opts=opts,
             plugins=plugins,
             log=ServerLog(level=ServerLog.DEBUG),
         )
@@ -166,13 +167,13 @@ def __init__(self, library_path, libraries=(), plugins=(), **kwargs):
         Thread.__init__(self, name='ServerMain')
         from calibre.srv.handler import Handler
         from calibre.srv.http_response import create_http_handler
-        from calibre.srv.loop import ServerLoop
+        from calibre.srv.loop import server_loop_class
         from calibre.srv.opts import Options
         self.setup_defaults(kwargs)
         opts = Options(**kwargs)
         self.libraries = libraries or (library_path,)
         self.handler = Handler(self.libraries, opts, testing=True)
-        self.loop = ServerLoop(
+        self.loop = server_loop_class(opts)(
             create_http_handler(self.handler.dispatch),
             opts=opts,
             plugins=plugins,
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A load test for the server event loop. Many simultaneous clients repeatedly
+connect, make a request and wait for the server to close the connection.
+Reports the number of connections handled per second and the latency
+percentiles. Run it with::
+
+    CALIBRE_SRV_BENCHMARK=1 calibre-debug -t calibre.srv.tests.benchmark
+
+or directly with ``calibre-debug calibre/srv/tests/benchmark.py``. To measure
+how the server scales with the number of server processes, run it with the
+path to a calibre library::
+
+    calibre-debug calibre/srv/tests/benchmark.py /path/to/library
+
+To measure the throughput and latency of the endpoints of the Content server,
+serving a generated library, with clients that use keep-alive connections to
+make a mix of requests, run::
+
+    calibre-debug calibre/srv/tests/benchmark.py -- --requests --books 1000 --output results.json
+
+The results are written as JSON to the output file, for comparison across
+releases. Use --mix to specify the requests to make, see :data:`DEFAULT_MIX`.
+'''
+
+import errno
+import json
+import os
+import random
+import selectors
+import signal
+import socket
+import sys
+import time
+from collections import defaultdict
+from io import BytesIO
+from threading import Thread
+from unittest import skipUnless
+
+from calibre.srv.tests.base import BaseTest, LibraryBaseTest, LibraryServer, TestServer
+from calibre.utils.monotonic import monotonic
+from polyglot import http_client
+from polyglot.binary import as_hex_unicode
+from polyglot.urllib import quote
+
+REQUEST = 'GET {} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+def run_benchmark(address, concurrency=1000, duration=10, wait_for_pending=30, path='/benchmark'):
+    '''
+    Keep concurrency connections open to the server at address for duration
+    seconds, opening a new connection as soon as one completes. Returns a dict
+    with the number of completed connections, the number of failures, the
+    connections per second and latency percentiles in seconds.
+    '''
+    sel = selectors.DefaultSelector()
+    request = REQUEST.format(path).encode('ascii')
+    latencies, failures = [], 0
+    started = monotonic()
+    stop_starting_at = started + duration
+    give_up_at = stop_starting_at + wait_for_pending
+
+    def start_connection():
+        s = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        err = s.connect_ex(address[:2])
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            s.close()
+            return False
+        sel.register(s, selectors.EVENT_WRITE, [monotonic(), memoryview(request), []])
+        return True
+
+    def finish(s, ok):
+        nonlocal failures
+        state = sel.get_key(s).data
+        sel.unregister(s)
+        s.close()
+        if ok:
+            latencies.append(monotonic() - state[0])
+        else:
+            failures += 1
+        if monotonic() < stop_starting_at and not start_connection():
+            failures += 1
+
+    for i in range(concurrency):
+        if not start_connection():
+            failures += 1
+    while sel.get_map():
+        now = monotonic()
+        if now > give_up_at:
+            for key in tuple(sel.get_map().values()):
+                finish(key.fileobj, False)
+            break
+        for key, mask in sel.select(min(1, give_up_at - now)):
+            s, state = key.fileobj, key.data
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    state[1] = state[1][s.send(state[1]):]
+                    if not state[1]:
+                        sel.modify(s, selectors.EVENT_READ, state)
+                else:
+                    data = s.recv(65536)
+                    if data:
+                        state[2].append(data)
+                    else:
+                        finish(s, b''.join(state[2]).startswith(b'HTTP/1.1 200 '))
+            except BlockingIOError:
+                pass
+            except OSError:
+                finish(s, False)
+    elapsed = monotonic() - started
+    sel.close()
+    latencies.sort()
+    return {
+        'concurrency': concurrency, 'connections': len(latencies), 'failures': failures,
+        'connections_per_second': len(latencies) / elapsed if elapsed else 0,
+        'p50': percentile(latencies, 50), 'p99': percentile(latencies, 99), 'max': latencies[-1] if latencies else 0,
+    }
+
+
+def format_results(r):
+    return (
+        '{concurrency} concurrent: {connections} connections, {failures} failures, {connections_per_second:.0f} connections/sec,'
+        ' latency p50: {p50_ms:.1f} ms p99: {p99_ms:.1f} ms max: {max_ms:.1f} ms'.format(
+            p50_ms=r['p50'] * 1000, p99_ms=r['p99'] * 1000, max_ms=r['max'] * 1000, **r))
+
+
+def ensure_fd_limit(needed):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed if hard == resource.RLIM_INFINITY else min(needed, hard), hard))
+
+
+def benchmark(concurrency_levels=(1000, 5000), duration=10, report=print):
+    # Both the server and the client need a file descriptor per connection
+    ensure_fd_limit(2 * max(concurrency_levels) + 256)
+    results = []
+    with TestServer(lambda data: 'ok', listen_on='127.0.0.1', timeout=60) as server:
+        for concurrency in concurrency_levels:
+            r = run_benchmark(server.address, concurrency=concurrency, duration=duration)
+            report(format_results(r))
+            results.append(r)
+    return results
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    try:
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def start_server_process(library_path, port, num_processes, tdir):
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            from calibre.srv.standalone import main
+            os.environ['CALIBRE_NO_SI_DANGER_DANGER'] = '1'
+            main([
+                'calibre-server', '--listen-on=127.0.0.1', f'--port={port}', f'--server-processes={num_processes}',
+                '--disable-use-bonjour', '--max-log-size=0', '--log=' + os.path.join(tdir, 'log'),
+                '--userdb=' + os.path.join(tdir, 'users.sqlite'), '--shutdown-timeout=1', library_path])
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return pid
+        time.sleep(0.05)
+    stop_server_process(pid)
+    raise SystemExit('Server process failed to start')
+
+
+def stop_server_process(pid):
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+
+
+def benchmark_processes(library_path, process_counts=(1, 2, 4), concurrency=100, duration=10, path='/interface-data/books-init', report=print):
+    '''
+    Measure the throughput of a calibre-server serving the library at
+    library_path with different numbers of server processes. Each server
+    process loads the library on its first request, so run a warm up round
+    before measuring.
+    '''
+    from calibre.ptempfile import TemporaryDirectory
+    ensure_fd_limit(2 * concurrency + 256)
+    results = []
+    for num_processes in process_counts:
+        with TemporaryDirectory() as tdir:
+            port = free_port()
+            pid = start_server_process(library_path, port, num_processes, tdir)
+            try:
+                run_benchmark(('127.0.0.1', port), concurrency=concurrency, duration=max(1, duration // 4), path=path)
+                r = run_benchmark(('127.0.0.1', port), concurrency=concurrency, duration=duration, path=path)
+            finally:
+                stop_server_process(pid)
+        r['server_processes'] = num_processes
+        report(f'{num_processes} server processes: ' + format_results(r))
+        results.append(r)
+    return results
+
+
+# Request mix {{{
+
+# The requests to make, as (name, path, weight) where requests are picked with
+# a probability proportional to their weight. In paths, {book_id}, {author},
+# {tag} and {fmt} are replaced by values from the library.
+DEFAULT_MIX = (
+    ('books-init', '/interface-data/books-init', 2),
+    ('get-books', '/interface-data/get-books?sort=timestamp.desc&search=tags:%22={tag}%22', 3),
+    ('book-metadata', '/interface-data/book-metadata/{book_id}', 4),
+    ('tag-browser', '/interface-data/tag-browser', 1),
+    ('cover', '/get/cover/{book_id}', 4),
+    ('thumb', '/get/thumb/{book_id}?sz=300x400', 6),
+    ('opds', '/opds', 1),
+    ('opds-newest', '/opds/navcatalog/' + as_hex_unicode('Onewest'), 1),
+    ('opds-search', '/opds/search/{author}', 1),
+    ('book-file', '/get/{fmt}/{book_id}', 2),
+)
+
+
+def create_library(library_path, num_books=1000, format_size=256 * 1024, seed=0):
+    '''
+    Create a library at library_path with num_books books that have random
+    metadata, a cover and a PDF of format_size bytes. Returns the values for
+    the paths of the request mix.
+    '''
+    from calibre.db.cache import Cache
+    from calibre.db.legacy import create_backend
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.utils.resources import get_image_path as I
+    rng = random.Random(seed)
+    authors = [f'Author {i}' for i in range(max(1, num_books // 5))]
+    tags = [f'Tag {i}' for i in range(max(1, num_books // 20))]
+    series = [f'Series {i}' for i in range(max(1, num_books // 10))]
+    cover, fmt_data = I('lt.png', data=True), rng.randbytes(format_size)
+    db = Cache(create_backend(library_path))
+    db.init()
+    book_ids = []
+    try:
+        for start in range(0, num_books, 100):
+            books = []
+            for i in range(start, min(num_books, start + 100)):
+                mi = Metadata(f'Book {i}', rng.sample(authors, rng.randint(1, min(3, len(authors)))))
+                mi.tags = rng.sample(tags, rng.randint(0, min(5, len(tags))))
+                if rng.random() < 0.5:
+                    mi.series, mi.series_index = rng.choice(series), rng.randint(1, 10)
+                mi.rating = rng.randint(0, 5) * 2
+                mi.cover_data = 'png', cover
+                books.append((mi, {'PDF': BytesIO(fmt_data)}))
+            book_ids.extend(db.add_books(books, apply_import_tags=False, run_hooks=False)[0])
+    finally:
+        db.close()
+    return {'book_id': book_ids, 'author': authors, 'tag': tags, 'fmt': ['pdf']}
+
+
+def load_mix(path):
+    with open(path, 'rb') as f:
+        return tuple((name, url, float(weight)) for name, url, weight in json.load(f))
+
+
+def run_request_mix(address, values, mix=DEFAULT_MIX, clients=20, duration=10, seed=0):
+    '''
+    Make requests from mix to the server at address for duration seconds, with
+    clients simultaneous clients, each using a single keep-alive connection.
+    Returns the status and latency in seconds of every request by name.
+    '''
+    names, paths, weights = zip(*mix)
+    stop_at = monotonic() + duration
+    results = [defaultdict(list) for i in range(clients)]
+
+    def client(num):
+        rng = random.Random(seed + num)
+        ans = results[num]
+        conn = None
+        while monotonic() < stop_at:
+            idx = rng.choices(range(len(names)), weights)[0]
+            path = paths[idx].format(**{k: quote(str(rng.choice(v)), safe='') for k, v in values.items()})
+            if conn is None:
+                conn = http_client.HTTPConnection(*address[:2], timeout=60)
+            start = monotonic()
+            try:
+                conn.request('GET', path)
+                r = conn.getresponse()
+                r.read()
+                status = r.status
+            except (OSError, http_client.HTTPException):
+                status = 0
+                conn.close()
+                conn = None
+            ans[names[idx]].append((status, monotonic() - start))
+        if conn is not None:
+            conn.close()
+
+    threads = [Thread(target=client, args=(i,), daemon=True) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    ans = defaultdict(list)
+    for r in results:
+        for name, requests in r.items():
+            ans[name].extend(requests)
+    return ans
+
+
+def summarize(requests_by_name, elapsed):
+    def stats(requests):
+        latencies = sorted(latency for status, latency in requests)
+        return {
+            'requests': len(requests), 'failures': sum(1 for status, latency in requests if status != http_client.OK),
+            'requests_per_second': len(requests) / elapsed if elapsed else 0,
+            'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else 0,
+        }
+    ans = stats([x for requests in requests_by_name.values() for x in requests])
+    ans['endpoints'] = {name: stats(requests) for name, requests in sorted(requests_by_name.items())}
+    return ans
+
+
+def format_mix_results(r):
+    def line(name, s):
+        return (
+            '{name:14} {requests:7} requests {failures:5} failures {requests_per_second:8.1f} req/sec'
+            ' p50: {p50:7.1f} p95: {p95:7.1f} p99: {p99:7.1f} ms'.format(
+                name=name, **dict(s, p50=s['p50'] * 1000, p95=s['p95'] * 1000, p99=s['p99'] * 1000)))
+    return '\n'.join([line(name, s) for name, s in r['endpoints'].items()] + [line('total', r)])
+
+
+def benchmark_request_mix(
+    num_books=1000, clients=20, duration=10, warmup=2, mix=DEFAULT_MIX, library_path=None, report=print, **server_opts
+):
+    '''
+    Start a server in this process, serving the library at library_path or a
+    generated library of num_books books, and make requests from mix to it
+    with clients simultaneous clients for duration seconds, after warmup
+    seconds of requests that are not measured, so that caches are filled.
+    Returns the results by request name, with the requests per second and the
+    latency percentiles in seconds.
+    '''
+    from calibre import __version__
+    from calibre.ptempfile import TemporaryDirectory
+    ensure_fd_limit(2 * clients + 256)
+    with TemporaryDirectory('srv-benchmark') as tdir:
+        if library_path is None:
+            library_path = os.path.join(tdir, 'library')
+            os.mkdir(library_path)
+            values = create_library(library_path, num_books)
+        else:
+            values = library_values(library_path)
+        server_opts.setdefault('listen_on', '127.0.0.1')
+        server_opts.setdefault('timeout', 60)
+        with LibraryServer(library_path, **server_opts) as server:
+            if warmup > 0:
+                run_request_mix(server.address, values, mix, clients, warmup)
+            started = monotonic()
+            requests = run_request_mix(server.address, values, mix, clients, duration)
+            ans = summarize(requests, monotonic() - started)
+    ans.update({
+        'calibre_version': __version__, 'python_version': sys.version.split()[0], 'platform': sys.platform,
+        'num_books': len(values['book_id']), 'clients': clients, 'duration': duration,
+    })
+    report(format_mix_results(ans))
+    return ans
+
+
+def library_values(library_path):
+    from calibre.db.cache import Cache
+    from calibre.db.legacy import create_backend
+    db = Cache(create_backend(library_path))
+    db.init()
+    try:
+        book_ids = tuple(db.all_book_ids())
+        fmts = sorted({fmt.lower() for book_id in book_ids for fmt in db.formats(book_id)})
+        return {
+            'book_id': book_ids, 'author': sorted(db.all_field_names('authors')) or [''], 'tag': sorted(db.all_field_names('tags')) or [''],
+            'fmt': fmts or ['epub']}
+    finally:
+        db.close()
+# }}}
+
+
+class BenchmarkTest(BaseTest):
+
+    @skipUnless(os.environ.get('CALIBRE_SRV_BENCHMARK'), 'Set CALIBRE_SRV_BENCHMARK to run the server benchmark')
+    def test_load(self):
+        'Benchmark connections per second and latency at 1000 and 5000 concurrent connections'
+        for r in benchmark():
+            self.ae(r['failures'], 0, format_results(r))
+
+    @skipUnless(os.environ.get('CALIBRE_SRV_BENCHMARK'), 'Set CALIBRE_SRV_BENCHMARK to run the server benchmark')
+    def test_request_mix(self):
+        'Benchmark the requests per second and latency of the endpoints'
+        r = benchmark_request_mix()
+        self.ae(r['failures'], 0, format_mix_results(r))
+
+
+class RequestMixTest(LibraryBaseTest):
+
+    def test_request_mix_benchmark(self):
+        'Test the request mix benchmark'
+        tdir = self.mkdtemp()
+        values = create_library(tdir, num_books=10, format_size=1024)
+        self.ae(len(values['book_id']), 10)
+        r = benchmark_request_mix(clients=2, duration=0.5, warmup=0, library_path=tdir, report=lambda x: None)
+        self.ae(r['num_books'], 10)
+        self.ae(r['failures'], 0, format_mix_results(r))
+        self.assertGreater(r['requests'], 0)
+        self.assertLessEqual(set(r['endpoints']), {x[0] for x in DEFAULT_MIX})
+        self.assertTrue(json.dumps(r))
+
+
+def main(args=sys.argv):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('library', nargs='?', help='Path to a calibre library')
+    parser.add_argument('--requests', action='store_true', help='Benchmark the endpoints of the Content server with a mix of requests')
+    parser.add_argument('--books', type=int, default=1000, help='Number of books in the generated library, if no library is specified')
+    parser.add_argument('--clients', type=int, default=20, help='Number of simultaneous clients')
+    parser.add_argument('--duration', type=float, default=10, help='Duration of the benchmark in seconds')
+    parser.add_argument('--mix', help='Path to a JSON file with a list of [name, path, weight] of the requests to make')
+    parser.add_argument('--output', help='Path to write the results to as JSON')
+    opts = parser.parse_args(args[1:])
+    if opts.requests:
+        results = benchmark_request_mix(
+            num_books=opts.books, clients=opts.clients, duration=opts.duration, library_path=opts.library,
+            mix=load_mix(opts.mix) if opts.mix else DEFAULT_MIX)
+    elif opts.library:
+        results = benchmark_processes(opts.library)
+    else:
+        results = benchmark()
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
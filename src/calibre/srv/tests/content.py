@@ -9,7 +9,9 @@
 import time
 import zlib
 from io import BytesIO
+from unittest.mock import patch
 
+from calibre.constants import iswindows
 from calibre.ebooks.metadata.epub import get_metadata
 from calibre.ebooks.metadata.opf2 import OPF
 from calibre.srv.tests.base import LibraryBaseTest
@@ -17,6 +19,7 @@
 from calibre.utils.resources import get_image_path as I
 from calibre.utils.resources import get_path as P
 from calibre.utils.shared_file import share_open
+from calibre.utils.zipfile import ZipFile
 from polyglot import http_client
 from polyglot.binary import from_hex_unicode
 
@@ -96,33 +99,85 @@ def bad(*args):
             bad('fmt1', 1, 'zzzz')
             bad('fmt1', 'xx')
 
-            # Test simple fetching of format without metadata update
+            # Test simple fetching of format without metadata update, it is
+            # sent directly from the library, except on Windows
             r, data = get('fmt1', 1, db.server_library_id)
             self.ae(data, db.format(1, 'fmt1'))
             self.assertIsNotNone(r.getheader('Content-Disposition'))
-            self.ae(r.getheader('Used-Cache'), 'no')
+            self.ae(r.getheader('Used-Cache'), 'no' if iswindows else None)
             r, data = get('fmt1', 1)
             self.ae(data, db.format(1, 'fmt1'))
-            self.ae(r.getheader('Used-Cache'), 'yes')
+            self.ae(r.getheader('Used-Cache'), 'yes' if iswindows else None)
+            conn.request('GET', '/get/fmt1/1', headers={'Range': 'bytes=2-5'})
+            r = conn.getresponse()
+            self.ae((r.status, r.read()), (http_client.PARTIAL_CONTENT, data[2:6]))
+            db.add_format(1, 'fmt1', BytesIO(b'replaced'))
+            r, data = get('fmt1', 1)
+            self.ae(data, b'replaced')
 
-            # Test fetching of format with metadata update
+            # Test fetching of format with metadata update, EPUB files are
+            # updated as they are served, without making a copy
             raw = P('quick_start/eng.epub', data=True)
             r, data = get('epub', 1)
             self.ae(r.status, http_client.OK)
             etag = r.getheader('ETag')
             self.assertIsNotNone(etag)
-            self.ae(r.getheader('Used-Cache'), 'no')
+            self.ae(r.getheader('Used-Cache'), 'no' if iswindows else None)
+            self.ae(r.getheader('Content-Type'), 'application/epub+zip')
+            self.ae(int(r.getheader('Content-Length')), len(data))
             self.assertTrue(data.startswith(b'PK'))
-            self.assertGreaterEqual(len(data), len(raw))
+            self.assertIsNone(ZipFile(BytesIO(data)).testzip())
             db.set_field('title', {1:'changed'})
             r, data = get('epub', 1)
             self.assertNotEqual(r.getheader('ETag'), etag)
             etag = r.getheader('ETag')
-            self.ae(r.getheader('Used-Cache'), 'no')
-            mi = get_metadata(BytesIO(data), extract_cover=False)
+            mi = get_metadata(BytesIO(data))
             self.ae(mi.title, 'changed')
+            self.ae(mi.cover_data[1], db.cover(1))
+            conn.request('GET', '/get/epub/1', headers={'Range': 'bytes=100-199'})
+            r = conn.getresponse()
+            self.ae((r.status, r.read()), (http_client.PARTIAL_CONTENT, data[100:200]))
+            if not iswindows:
+                # The updated OPF and cover are re-used till the book changes
+                with patch('calibre.srv.content.get_zip_reader', side_effect=ValueError):
+                    r, cdata = get('epub', 1)
+                    self.ae((r.getheader('Used-Cache'), cdata), (None, data))
+                db.set_cover({1: I('lt.png', data=True)})
+                r, data = get('epub', 1)
+                self.ae(get_metadata(BytesIO(data)).cover_data[1], db.cover(1))
+                # Short reads from the ZIP file are handled
+                from calibre.utils.spliced_zip import SplicedZipFile
+
+                class ShortReads(BytesIO):
+                    short = False
+
+                    def read(self, n=-1):
+                        if self.short:
+                            n = min(n, 7) if n > -1 else 7
+                        return BytesIO.read(self, n)
+                with open(db.format_abspath(1, 'epub'), 'rb') as f:
+                    raw = f.read()
+                replacements = {'META-INF/container.xml': b'replaced', 'new': b'new'}
+                full = SplicedZipFile(BytesIO(raw), replacements).read()
+                zf = SplicedZipFile(ShortReads(raw), replacements)
+                zf.stream.short = True
+                self.ae(zf.read(), full)
+                zf.seek(3)
+                self.ae(zf.read(1000), full[3:1003])
+                self.ae(ZipFile(BytesIO(full)).read('new'), b'new')
+                # Added entries get the timestamp of the ZIP file, not the current time
+                mtime = time.mktime((2020, 1, 2, 3, 4, 6, 0, 0, -1))
+                zf = ZipFile(BytesIO(SplicedZipFile(BytesIO(raw), replacements, mtime=mtime).read()))
+                self.ae(zf.getinfo('new').date_time, (2020, 1, 2, 3, 4, 6))
+                self.ae(SplicedZipFile(BytesIO(raw), replacements).read(), full)
+            # Files that cannot be updated in place are copied
+            with db.write_lock, open(db.format_abspath(1, 'epub'), 'r+b') as f:
+                epub = f.read()
+                f.seek(0)
+                f.write(b'a prefix' + epub)
             r, data = get('epub', 1)
-            self.ae(r.getheader('Used-Cache'), 'yes')
+            self.ae(r.getheader('Used-Cache'), 'no')
+            self.ae(get_metadata(BytesIO(data), extract_cover=False).title, 'changed')
 
             # Test plugboards
             import calibre.library.save_to_disk as c
@@ -268,6 +323,105 @@ def t(html, body_children, nsmap=('http://www.w3.org/1999/xhtml',)):
         t(f'<p>{text}<p>{text}', [{'n':'p','x':text}, {'n':'p','x':text}])
     # }}}
 
+    def test_render_pool(self):  # {{{
+        from calibre.ebooks.oeb.iterator.book import extract_book
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.render_book import SimpleContainer, process_book_file
+        from calibre.srv.render_pool import RenderPool, process_files_in_pool
+        pool = RenderPool(2, max_workers_per_job=2)
+        try:
+            with TemporaryDirectory() as tdir:
+                results = {}
+                for which in ('local', 'pool'):
+                    book_dir = os.path.join(tdir, which)
+                    os.mkdir(book_dir)
+                    opfpath = extract_book(P('quick_start/eng.epub'), book_dir)[1]
+                    c = SimpleContainer(book_dir, opfpath)
+                    names = [n for n, mt in c.mime_map.items() if mt in ('application/xhtml+xml', 'text/css')]
+                    if which == 'local':
+                        results[which] = [process_book_file(True, 'uid', c, n) for n in names]
+                    else:
+                        files = [(n, os.path.getsize(c.name_path_map[n])) for n in names]
+                        results[which] = list(process_files_in_pool((pool.address, pool.authkey), files, c.root, opfpath, True, 'uid'))
+                    for n in names:
+                        with open(c.name_path_map[n], 'rb') as f:
+                            results[which + n] = f.read()
+                self.assertTrue(names)
+                for n in names:
+                    self.ae(results['local' + n], results['pool' + n])
+                # Results from the pool are in order of completion, not of names
+                for which in ('local', 'pool'):
+                    results[which] = {k: v for r in results[which] for k, v in r[1].items()}, set().union(*(r[2] for r in results[which]))
+                self.ae(results['local'], results['pool'])
+                self.assertRaises(Exception, tuple, process_files_in_pool((pool.address, pool.authkey), [('missing', 1)], c.root, opfpath, True, 'uid'))
+
+                # Workers drop the containers of books that are no longer being rendered
+                from calibre.srv import render_book
+                render_book.worker_containers.clear()
+                keys = []
+                for which in ('w1', 'w2'):
+                    book_dir = os.path.join(tdir, which)
+                    os.mkdir(book_dir)
+                    keys.append((book_dir, extract_book(P('quick_start/eng.epub'), book_dir)[1]))
+                render_book.process_book_file_in_worker(*keys[0], True, 'uid', names[0], active_books=frozenset(keys[:1]))
+                render_book.process_book_file_in_worker(*keys[1], True, 'uid', names[0], active_books=frozenset(keys))
+                self.ae(set(render_book.worker_containers), set(keys))
+                render_book.process_book_file_in_worker(*keys[1], True, 'uid', names[1], active_books=frozenset(keys[1:]))
+                self.ae(set(render_book.worker_containers), set(keys[1:]))
+                with patch('calibre.srv.render_book.MAX_WORKER_CONTAINERS_SIZE', 1):
+                    render_book.process_book_file_in_worker(*keys[0], True, 'uid', names[1], active_books=frozenset(keys))
+                self.ae(set(render_book.worker_containers), set(keys[:1]))
+                render_book.worker_containers.clear()
+        finally:
+            pool.shutdown()
+    # }}}
+
+    def test_library_unloading(self):  # {{{
+        'Test unloading of idle libraries'
+        import shutil
+
+        from calibre.srv.library_broker import LibraryBroker
+        other = os.path.join(self.mkdtemp(), 'other')
+        shutil.copytree(self.library_path, other)
+        broker = LibraryBroker([self.library_path, other])
+        broker.min_unload_idle_time = 0
+        try:
+            lid, olid = broker.lmap
+            broker.add_db_event_callback(lambda *a: None)
+            db, odb = broker.get(lid), broker.get(olid)
+            title = db.field_for('title', 1)
+            broker.search_caches[lid]['x'] = 1
+            self.assertGreater(broker.footprints[lid], 0)
+            self.ae(broker.unload_idle_libraries(idle_time=100), [])
+            # Least recently used first
+            broker.get(lid)
+            self.ae(broker.unload_idle_libraries(memory_budget=broker.footprints[lid]), [olid])
+            self.assertNotIn(olid, broker.loaded_dbs)
+            # Unloaded libraries remain usable by requests in flight
+            self.assertFalse(odb.is_closed)
+            self.assertTrue(odb.field_for('title', 1))
+            self.assertNotIn(olid, broker.db_listeners)
+            # and are closed later
+            broker.close_unloaded_libraries()
+            self.assertFalse(odb.is_closed)
+            broker.close_unloaded_libraries(delay=0)
+            self.assertTrue(odb.is_closed)
+            self.assertFalse(odb.event_dispatcher.is_alive())
+            broker.access_times[lid] -= 1000
+            self.ae(broker.unload_idle_libraries(idle_time=100), [lid])
+            self.assertNotIn('x', broker.search_caches[lid])
+            # Unloaded libraries are loaded again when used
+            ndb = broker.get(lid)
+            self.assertIsNot(ndb, db)
+            self.ae(ndb.field_for('title', 1), title)
+            # Recently used libraries are not unloaded
+            broker.min_unload_idle_time = 60
+            self.ae(broker.unload_idle_libraries(memory_budget=1), [])
+        finally:
+            broker.close()
+            db.close(), odb.close()
+    # }}}
+
     def test_last_read_cache(self):  # {{{
         from calibre.srv.last_read import last_read_cache, path_cache
         path_cache.clear()
@@ -281,4 +435,100 @@ def test_last_read_cache(self):  # {{{
         for book_id in range(2, 7):
             lrc.add_last_read_position('lib', book_id, 'FMT', 'user', 'epubcfi(/)', 0.1, 'tt')
         self.ae(len(lrc.get_recently_read('user')), lrc.limit)
+        lrc.add_last_read_position('lib', 3, 'FMT', 'user', 'epubcfi(/)', 0.1, 'tt')
+        lrc.add_last_read_position('lib', 9, 'FMT', 'other', 'epubcfi(/)', 0.1, 'tt')
+        self.ae(lrc.get_most_recently_read(3), (('lib', 9, 'FMT'), ('lib', 3, 'FMT'), ('lib', 6, 'FMT')))
+    # }}}
+
+    def test_render_cache(self):  # {{{
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.books import MANIFEST_NAME, RenderCache
+
+        def render(bhash, size):
+            os.makedirs(os.path.join(tdir, bhash))
+            with open(os.path.join(tdir, bhash, MANIFEST_NAME), 'wb') as f:
+                f.write(b'x' * size)
+
+        with TemporaryDirectory() as tdir:
+            for i, bhash in enumerate('abc'):
+                render(bhash, 100)
+                os.utime(os.path.join(tdir, bhash, MANIFEST_NAME), (i, i))
+            os.mkdir(os.path.join(tdir, 'incomplete'))
+            rc = RenderCache(tdir)
+            self.ae(tuple(rc.ensure_scanned()), ('a', 'b', 'c'))
+            self.ae(rc.total_size, 300)
+            self.assertFalse(os.path.exists(os.path.join(tdir, 'incomplete')))
+            # Least recently used books are evicted first
+            rc.hit('a')
+            render('d', 100)
+            rc.add('d', 350)
+            self.ae(tuple(rc.entries), ('c', 'a', 'd'))
+            self.assertFalse(os.path.exists(os.path.join(tdir, 'b')))
+            # The newly rendered book is kept even if it is larger than the cache
+            render('e', 500)
+            rc.add('e', 350)
+            self.ae(tuple(rc.entries), ('e',))
+            self.ae((rc.total_size, rc.evicted), (500, 4))
+            # Books rendered because they were opened count as a miss, not a hit
+            rc.miss('f')
+            render('f', 10)
+            rc.add('f')
+            rc.hit('f'), rc.hit('f')
+            self.ae({k: v for k, v in rc.stats().items() if k in ('hits', 'misses', 'hit_rate', 'num_of_books')}, {
+                'hits': 2, 'misses': 1, 'hit_rate': 2/3, 'num_of_books': 2})
+            # Books rendered by other server processes count towards the size of the cache
+            other = RenderCache(tdir)
+            render('g', 100)
+            other.add('g')
+            os.utime(os.path.join(tdir, 'g', MANIFEST_NAME), (1, 1))
+            render('h', 100)
+            rc.add('h', 700)
+            self.ae(tuple(rc.entries), ('e', 'f', 'h'))
+            self.assertFalse(os.path.exists(os.path.join(tdir, 'g')))
+    # }}}
+
+    def test_opds(self):  # {{{
+        'Test caching of OPDS feeds'
+        from calibre.srv.opds import opds_cache
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            db = ctx.library_broker.get(None)
+            conn = server.connect()
+
+            def get(path, headers={}):
+                conn.request('GET', path, headers=headers)
+                r = conn.getresponse()
+                return r, r.read()
+
+            r, data = get('/opds')
+            self.ae(r.status, http_client.OK)
+            self.assertTrue(r.getheader('Content-Type').startswith('application/atom+xml'))
+            self.assertIsNotNone(r.getheader('Last-Modified'))
+            etag = r.getheader('ETag')
+            r, data2 = get('/opds', {'If-None-Match': etag})
+            self.ae(r.status, http_client.NOT_MODIFIED)
+            self.ae(get('/opds')[1], data)
+            cache = opds_cache(ctx, db)
+            self.ae(len(cache.feeds), 1)
+
+            path = '/opds/navcatalog/4f7469746c65'  # Otitle
+            r, data = get(path)
+            self.ae(r.status, http_client.OK)
+            self.assertIn(db.field_for('title', 1).encode('utf-8'), data)
+            self.ae(len(cache.entries), len(db.all_book_ids()))
+            etag = r.getheader('ETag')
+            self.ae(get(path, {'If-None-Match': etag})[0].status, http_client.NOT_MODIFIED)
+            self.ae(get('/opds/navcatalog/4f78')[0].status, http_client.NOT_FOUND)
+
+            # Changing a book invalidates the feeds and its entry
+            def entries():
+                return {k[0]: v[1] for k, v in cache.entries.items()}
+            before = entries()
+            db.set_field('title', {1: 'changed title'})
+            r, data = get(path, {'If-None-Match': etag})
+            self.ae(r.status, http_client.OK)
+            self.assertIn(b'changed title', data)
+            after = entries()
+            self.assertIsNot(after[1], before[1])
+            self.assertIs(after[2], before[2])
     # }}}
@@ -10,7 +10,7 @@
 import time
 import zlib
 from io import BytesIO
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 from calibre import guess_type
 from calibre.srv.tests.base import BaseTest, TestServer
@@ -306,6 +306,78 @@ def handler(data):
             self.assertIn(b'Request Timeout', eintr_retry_call(conn.sock.recv, 500))
     # }}}
 
+    def test_compressed_responses(self):  # {{{
+        'Test caching of compressed responses and precompressed files'
+        from unittest.mock import patch
+
+        from calibre.srv.http_response import precompress
+        raw = b'a' * 20000
+
+        def get(conn, encoding='gzip'):
+            conn.request('GET', '/x', headers={'Accept-Encoding': encoding})
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK)
+            return r, r.read()
+
+        with TestServer(lambda data: raw, compress_min_size=0) as server:
+            conn = server.connect()
+            r, data = get(conn)
+            self.ae(r.getheader('Transfer-Encoding'), 'chunked')
+            self.ae(r.getheader('Vary'), 'Accept-Encoding')
+            self.ae(zlib.decompress(data, 16+zlib.MAX_WBITS), raw)
+            # Served from the cache
+            r, data = get(conn)
+            self.ae(r.getheader('Content-Encoding'), 'gzip')
+            self.ae(int(r.getheader('Content-Length')), len(data))
+            self.ae(zlib.decompress(data, 16+zlib.MAX_WBITS), raw)
+            r, data = get(conn, 'identity')
+            self.assertIsNone(r.getheader('Content-Encoding'))
+            self.ae(r.getheader('Vary'), 'Accept-Encoding')
+            self.ae(data, raw)
+
+        # Different resources that share an ETag must not share cache entries
+        with TemporaryDirectory() as tdir:
+            for name in 'ab':
+                with open(os.path.join(tdir, name + '.js'), 'wb') as f:
+                    f.write(name.encode() * 20000)
+
+            def shared_etag(conn):
+                return conn.filesystem_file_with_constant_etag(open(os.path.join(tdir, conn.path[-1]), 'rb'), 'same-etag')
+            with TestServer(shared_etag, compress_min_size=0) as server:
+                conn = server.connect()
+                for path in ('/a.js', '/b.js', '/a.js', '/b.js'):
+                    conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), path[1:2].encode() * 20000)
+
+        with NamedTemporaryFile(suffix='.js') as f:
+            f.write(raw), f.flush()
+            variants = dict(precompress(raw))
+            for ext, data in variants.items():
+                with open(f.name + ext, 'wb') as pf:
+                    pf.write(data)
+            try:
+                with patch('calibre.srv.http_response.is_precompressible_resource', lambda path: True), \
+                        TestServer(lambda data: open(f.name, 'rb'), compress_min_size=0) as server:
+                    conn = server.connect()
+                    r, data = get(conn)
+                    self.ae(r.getheader('Content-Encoding'), 'gzip')
+                    self.ae(data, variants['.gz'])
+                    if '.br' in variants:
+                        r, data = get(conn, 'br, gzip')
+                        self.ae(r.getheader('Content-Encoding'), 'br')
+                        self.ae(data, variants['.br'])
+                    # Out of date precompressed files are ignored
+                    os.utime(f.name + '.gz', (1, 1))
+                    r, data = get(conn)
+                    self.ae(r.getheader('Transfer-Encoding'), 'chunked')
+                    self.ae(zlib.decompress(data, 16+zlib.MAX_WBITS), raw)
+            finally:
+                for ext in variants:
+                    os.remove(f.name + ext)
+    # }}}
+
     def test_http_response(self):  # {{{
         'Test HTTP protocol responses'
         from calibre.srv.http_response import parse_multipart_byterange
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import socket
+import ssl
+import zlib
+from collections import namedtuple
+from io import BytesIO
+from struct import pack, unpack_from
+from threading import Event
+
+from calibre.srv.hpack import Decoder, Encoder, HeaderListTooLarge, HPACKError, encode_string
+from calibre.srv.http2 import (
+    ACK,
+    DATA,
+    END_HEADERS,
+    END_STREAM,
+    FRAME_HEADER,
+    GOAWAY,
+    HEADERS,
+    PING,
+    PREFACE,
+    PROTOCOL_ERROR,
+    RST_STREAM,
+    SETTINGS,
+    SETTINGS_INITIAL_WINDOW_SIZE,
+    WINDOW_UPDATE,
+)
+from calibre.srv.tests.base import BaseTest, TestServer
+from polyglot import http_client
+
+Frame = namedtuple('Frame', 'type flags stream_id payload')
+Response = namedtuple('Response', 'headers body')
+
+
+class H2Client:
+
+    def __init__(self, sock, settings=()):
+        self.socket = sock
+        self.encoder, self.decoder = Encoder(), Decoder()
+        self.read_buf = b''
+        self.frames = []
+        self.socket.sendall(PREFACE)
+        self.send_frame(SETTINGS, 0, 0, b''.join(pack('!HL', k, v) for k, v in settings))
+
+    def send_frame(self, ftype, flags, stream_id, payload=b''):
+        n = len(payload)
+        self.socket.sendall(FRAME_HEADER.pack(n >> 8, n & 0xff, ftype, flags, stream_id) + payload)
+
+    def request(self, stream_id, path, method='GET', body=b'', headers=()):
+        h = [(b':method', method.encode('ascii')), (b':scheme', b'http'), (b':path', path.encode('utf-8')), (b':authority', b'localhost')]
+        h.extend(headers)
+        self.send_frame(HEADERS, END_HEADERS | (0 if body else END_STREAM), stream_id, self.encoder.encode(h))
+        if body:
+            self.send_frame(DATA, END_STREAM, stream_id, body)
+
+    def read_frame(self):
+        while len(self.read_buf) < FRAME_HEADER.size or len(self.read_buf) < FRAME_HEADER.size + int.from_bytes(self.read_buf[:3], 'big'):
+            data = self.socket.recv(65536)
+            if not data:
+                return None
+            self.read_buf += data
+        hi, lo, ftype, flags, stream_id = FRAME_HEADER.unpack_from(self.read_buf)
+        end = FRAME_HEADER.size + ((hi << 8) | lo)
+        ans = Frame(ftype, flags, stream_id, self.read_buf[FRAME_HEADER.size:end])
+        self.read_buf = self.read_buf[end:]
+        self.frames.append(ans)
+        return ans
+
+    def responses(self, *stream_ids):
+        ' Read frames till the responses for all stream_ids are complete, sending WINDOW_UPDATEs for received data '
+        ans = {sid: Response({}, b'') for sid in stream_ids}
+        pending = set(stream_ids)
+        while pending:
+            f = self.read_frame()
+            if f is None:
+                raise EOFError('Connection closed by server')
+            if f.type == HEADERS:
+                ans[f.stream_id] = Response({k.decode('ascii'): v.decode('utf-8') for k, v in self.decoder.decode(f.payload)}, b'')
+            elif f.type == DATA:
+                ans[f.stream_id] = ans[f.stream_id]._replace(body=ans[f.stream_id].body + f.payload)
+                if f.payload:
+                    self.send_frame(WINDOW_UPDATE, 0, 0, pack('!L', len(f.payload)))
+                    if not f.flags & END_STREAM:
+                        self.send_frame(WINDOW_UPDATE, 0, f.stream_id, pack('!L', len(f.payload)))
+            elif f.type == RST_STREAM:
+                raise ValueError(f'Stream {f.stream_id} reset with error code: {unpack_from("!L", f.payload)[0]}')
+            elif f.type == GOAWAY:
+                raise ValueError(f'Server sent GOAWAY: {f.payload}')
+            if f.type in (HEADERS, DATA) and f.flags & END_STREAM:
+                pending.discard(f.stream_id)
+        return ans
+
+
+class HTTP2Test(BaseTest):
+
+    def test_hpack(self):
+        'Test HPACK header compression'
+        d = Decoder()
+        # The request examples from Appendix C.4 of RFC 7541
+        self.ae(d.decode(bytes.fromhex('828684418cf1e3c2e5f23a6ba0ab90f4ff')), [
+            (b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'), (b':authority', b'www.example.com')])
+        self.ae(d.decode(bytes.fromhex('828684be5886a8eb10649cbf'))[-2:], [(b':authority', b'www.example.com'), (b'cache-control', b'no-cache')])
+        self.ae(d.decode(bytes.fromhex('828785bf408825a849e95ba97d7f8925a849e95bb8e8b4bf'))[-1], (b'custom-key', b'custom-value'))
+        self.ae(d.table_size, 164)
+        headers = [(b':status', b'200'), (b':status', b'302'), (b'content-type', b'text/html'), (b'x-custom', 'é'.encode('utf-8') * 100)]
+        self.ae(Decoder().decode(Encoder().encode(headers)), headers)
+        for bad in ('80', '7f00', 'bf', '41', '4182ffff', '3fe21f'):
+            self.assertRaises(HPACKError, Decoder().decode, bytes.fromhex(bad))
+        # The size of the decoded header list is limited, references to a large
+        # entry in the dynamic table do not expand the block without bound
+        big = (b'x-big', b'a' * 4000)
+        bomb = b'\x40' + encode_string(big[0]) + encode_string(big[1]) + b'\xbe' * 100
+        d = Decoder()
+        self.assertRaises(HeaderListTooLarge, d.decode, bomb, max_size=10000)
+        self.ae(d.decode(b'\xbe'), [big])
+        self.ae(len(Decoder().decode(bomb)), 101)
+
+    def test_http2(self):
+        'Test serving requests over HTTP/2'
+        release = Event()
+
+        def handler(data):
+            if data.path[0] == 'wait':
+                return 'released' if release.wait(5) else 'timed out'
+            if data.path[0] == 'release':
+                release.set()
+                return 'ok'
+            if data.path[0] == 'echo':
+                return data.method + ':' + data.read().decode('utf-8') + ':' + data.inheaders.get('X-Test', '')
+            if data.path[0] == 'file':
+                return BytesIO(b'0123456789')
+            if data.path[0] == 'text':
+                data.outheaders['Content-Type'] = 'text/plain'
+                return 'a' * 10000
+            raise http_client.HTTPException()
+
+        with TestServer(handler, use_http2=True) as server:
+            with socket.create_connection(server.address, timeout=5) as sock:
+                c = H2Client(sock)
+                # Requests are processed in parallel
+                c.request(1, '/wait')
+                c.request(3, '/release')
+                r = c.responses(1, 3)
+                self.ae(r[1].body, b'released')
+                self.ae(r[1].headers[':status'], '200')
+                self.ae(r[3].body, b'ok')
+                self.assertNotIn('connection', r[1].headers)
+                self.assertNotIn('keep-alive', r[1].headers)
+
+                c.request(5, '/echo', 'POST', b'a body', headers=[(b'x-test', b'x')])
+                c.request(7, '/echo', 'HEAD')
+                c.request(9, '/file', headers=[(b'range', b'bytes=2-4')])
+                c.request(11, '/text', headers=[(b'accept-encoding', b'gzip')])
+                c.request(13, '/missing/é')
+                r = c.responses(5, 7, 9, 11, 13)
+                self.ae(r[5].body, b'POST:a body:x')
+                self.ae((r[7].headers[':status'], r[7].body), ('200', b''))
+                self.ae((r[9].headers[':status'], r[9].headers['content-range'], r[9].body), ('206', 'bytes 2-4/10', b'234'))
+                self.ae(r[11].headers['content-encoding'], 'gzip')
+                self.ae(zlib.decompress(r[11].body, 16 + zlib.MAX_WBITS), b'a' * 10000)
+                self.ae(r[13].headers[':status'], '500')
+
+                c.send_frame(PING, 0, 0, b'12345678')
+                while (f := c.read_frame()).type != PING:
+                    pass
+                self.ae((f.flags, f.payload), (ACK, b'12345678'))
+
+                # Header lists that are too large once decoded are refused
+                # without closing the connection
+                bomb = b'\x40' + encode_string(b'x-big') + encode_string(b'a' * 4000) + b'\xbe' * 100
+                c.send_frame(HEADERS, END_HEADERS | END_STREAM, 15, bomb)
+                c.request(17, '/echo', 'POST', b'after')
+                r = c.responses(15, 17)
+                self.ae(r[15].headers[':status'], '431')
+                self.ae(r[17].body, b'POST:after:')
+
+            # Flow control
+            with socket.create_connection(server.address, timeout=5) as sock:
+                c = H2Client(sock, settings=((SETTINGS_INITIAL_WINDOW_SIZE, 1000),))
+                c.request(1, '/text')
+                received = 0
+                while received < 1000:
+                    f = c.read_frame()
+                    if f.type == DATA:
+                        received += len(f.payload)
+                self.ae(received, 1000)
+                c.send_frame(PING, 0, 0, b'12345678')
+                while (f := c.read_frame()).type != PING:
+                    self.assertNotEqual(f.type, DATA)
+                c.send_frame(WINDOW_UPDATE, 0, 1, pack('!L', 10000))
+                self.ae(len(c.responses(1)[1].body), 9000)
+
+            # Protocol errors
+            with socket.create_connection(server.address, timeout=5) as sock:
+                c = H2Client(sock)
+                c.request(2, '/text')
+                while (f := c.read_frame()).type != GOAWAY:
+                    pass
+                self.ae(unpack_from('!LL', f.payload), (0, PROTOCOL_ERROR))
+                self.assertIsNone(c.read_frame())
+
+        with TestServer(lambda data: 'ok') as server:
+            # HTTP/2 is not used unless enabled
+            with socket.create_connection(server.address, timeout=5) as sock:
+                sock.sendall(PREFACE)
+                self.assertTrue(sock.recv(1024).startswith(b'HTTP/1.0 400 '))
+
+    def test_http2_coroutines(self):
+        'Test HTTP/2 with coroutine request handlers'
+        import asyncio
+
+        async def handler(data):
+            await asyncio.sleep(0.01)
+            return '/'.join(data.path)
+
+        for event_loop in ('selectors', 'asyncio'):
+            with TestServer(handler, use_http2=True, event_loop=event_loop) as server:
+                with socket.create_connection(server.address, timeout=5) as sock:
+                    c = H2Client(sock)
+                    for i in range(1, 20, 2):
+                        c.request(i, f'/{i}')
+                    r = c.responses(*range(1, 20, 2))
+                    for i in range(1, 20, 2):
+                        self.ae(r[i].body, str(i).encode('ascii'))
+
+    def test_http2_ssl(self):
+        'Test negotiating HTTP/2 with ALPN'
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.utils.certgen import create_server_cert
+        address = '127.0.0.1'
+        with TemporaryDirectory('srv-test-http2') as tdir:
+            cert_file, key_file, ca_file = (os.path.join(tdir, x) for x in 'cka')
+            create_server_cert(address, ca_file, cert_file, key_file, key_size=2048)
+            ctx = ssl.create_default_context(cafile=ca_file)
+            ctx.set_alpn_protocols(['h2', 'http/1.1'])
+            with TestServer(lambda data: data.path[0], use_http2=True, ssl_certfile=cert_file, ssl_keyfile=key_file, listen_on=address, port=0) as server:
+                with ctx.wrap_socket(socket.create_connection(server.address, timeout=5), server_hostname=address) as sock:
+                    self.ae(sock.selected_alpn_protocol(), 'h2')
+                    c = H2Client(sock)
+                    c.request(1, '/test')
+                    self.ae(c.responses(1)[1].body, b'test')
+                # HTTP/1.1 clients continue to work
+                conn = http_client.HTTPSConnection(address, server.address[1], context=ssl.create_default_context(cafile=ca_file))
+                conn.request('GET', '/test')
+                self.ae(conn.getresponse().read(), b'test')
@@ -193,6 +193,93 @@ def set(data, rpos, wpos, state):
         set(b'123456\n7', 4, 2, READ)
         self.ae(buf.readline(), b'56\n')
 
+    def test_timer_wheel(self):
+        'Test the timer wheel used for connection timeouts'
+        from calibre.srv.loop import TimerWheel
+        w = TimerWheel(10, num_slots=12, now=0)
+        self.ae(w.resolution, 1)
+        self.assertIsNone(w.time_to_next_expiry(0))
+        w.add('a', 2.5), w.add('b', 5), w.add('c', 5.5)
+        self.ae(len(w), 3)
+        self.ae(w.time_to_next_expiry(0), 3)
+        self.ae(w.expired(2), [])
+        self.ae(w.expired(3), ['a'])
+        self.ae(sorted(w.expired(6)), ['b', 'c'])
+        self.ae(len(w), 0)
+        # Keys are never expired early and can be removed or re-added
+        w.add('a', 7), w.add('b', 7), w.remove('b')
+        w.add('c', 8), w.add('c', 9)
+        self.assertNotIn('b', w)
+        self.ae(w.expired(7.9), [])
+        self.ae(w.expired(8), ['a'])
+        self.ae(w.expired(9.9), [])
+        self.ae(w.expired(10), ['c'])
+        # Deadlines past the span of the wheel expire after span
+        w.add('far', 1000)
+        self.ae(w.expired(20), [])
+        self.ae(w.expired(21), ['far'])
+        # Large jumps in time expire everything
+        w.add('x', 25), w.add('y', 29)
+        self.ae(sorted(w.expired(500)), ['x', 'y'])
+        self.ae(w.expired(500), [])
+
+    def test_many_connections(self):
+        'Test handling of many simultaneous connections'
+        from calibre.srv.tests.benchmark import run_benchmark
+        with TestServer(lambda data: 'ok', worker_count=4) as server:
+            results = run_benchmark(server.address, concurrency=200, duration=1)
+            self.ae(results['failures'], 0)
+            self.assertGreater(results['connections'], 200)
+            self.ae(server.loop.num_active_connections, 0)
+
+    def test_asyncio_loop(self):
+        'Test the asyncio server loop and coroutine request handlers'
+        import asyncio
+
+        from calibre.srv.async_loop import AsyncServerLoop, run_blocking
+        from calibre.srv.errors import HTTPNotFound
+
+        event_loops = []
+
+        async def handler(data):
+            if data.path[0] == 'missing':
+                raise HTTPNotFound('missing')
+            event_loops.append(asyncio.get_running_loop())
+            await asyncio.sleep(0.3)
+            return await run_blocking(lambda: data.path[0])
+
+        for event_loop, num in (('asyncio', 10), ('selectors', 2)):
+            with TestServer(handler, worker_count=1, event_loop=event_loop) as server:
+                self.ae(isinstance(server.loop, AsyncServerLoop), event_loop == 'asyncio')
+                conns = [server.connect() for i in range(num)]
+                st = monotonic()
+                for i, conn in enumerate(conns):
+                    conn.request('GET', f'/{i}')
+                for i, conn in enumerate(conns):
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), str(i).encode())
+                if event_loop == 'asyncio':
+                    # The requests wait simultaneously, even though there is
+                    # only a single worker thread
+                    self.assertLess(monotonic() - st, num * 0.3)
+                # A single event loop is used for all requests
+                self.ae(len(set(event_loops)), 1)
+                del event_loops[:]
+                conn = conns[0]
+                conn.request('GET', '/missing')
+                r = conn.getresponse()
+                self.ae(r.status, http_client.NOT_FOUND)
+                r.read()
+                for conn in conns:
+                    conn.close()
+                server.loop.wakeup()
+                for i in range(100):
+                    if server.loop.num_active_connections == 0:
+                        break
+                    time.sleep(0.01)
+                self.ae(server.loop.num_active_connections, 0)
+
     def test_ssl(self):
         'Test serving over SSL'
         address = '127.0.0.1'
@@ -261,6 +348,7 @@ def job_status(jid):
 
         # Start jobs
         job_id1 = jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
+        self.assertEqual(jm.idle_time(), 0)
         job_id2 = jm.start_job('t2', 'calibre.srv.jobs', 'sleep_test', args=(3,))
         job_id3 = jm.start_job('err test', 'calibre.srv.jobs', 'error_test')
 
@@ -299,9 +387,27 @@ def job_status(jid):
         self.assertFalse(was_aborted)
         self.assertTrue(tb)
         self.assertIn('a testing error', tb)
+        time.sleep(0.01)
+        self.assertGreater(jm.idle_time(), 0)
         jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
         jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
 
+        # Worker processes are reused, with the output of each job captured separately
+        jm = JobsManager(O(1, 5), FakeLog())
+        jm.worker_pool.max_jobs_per_worker = 2
+        logs = {}
+        job_ids = [jm.start_job('print test', 'calibre.srv.jobs', 'print_test', args=(f'job {i}',),
+                                job_done_callback=lambda job: logs.__setitem__(job.job_id, job.read_log())) for i in range(3)]
+        for job_id in job_ids:
+            while job_status(job_id) in s:
+                time.sleep(0.01)
+        pids = [jm.job_status(job_id)[1] for job_id in job_ids]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        for i, job_id in enumerate(job_ids):
+            self.assertEqual(logs[job_id].strip(), f'job {i}')
+        jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
+
 
 def find_tests():
     import unittest
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import json
+import os
+import socket
+from threading import Thread
+from unittest import skipUnless
+
+from calibre.srv.prefork import is_supported
+from calibre.srv.tests.base import LibraryBaseTest, TestServer
+from polyglot import http_client
+
+
+class PreforkTest(LibraryBaseTest):
+
+    @skipUnless(is_supported, 'Multiple server processes are not supported on this platform')
+    def test_write_forwarding(self):
+        'Test forwarding of requests to the main server process'
+        from calibre.srv.opts import Options
+        from calibre.srv.prefork import WriteForwarder, forwarding_loop
+        from calibre.srv.utils import ServerLog
+
+        def writer(data):
+            data.status_code = http_client.UNPROCESSABLE_ENTITY
+            data.outheaders['X-Written'] = 'yes'
+            return json.dumps({
+                'method': data.method, 'path': data.path, 'query': data.query.get('q'), 'body': data.read().decode('utf-8'),
+                'remote_addr': data.remote_addr, 'is_trusted_ip': data.is_trusted_ip, 'header': data.inheaders.get('X-Test'),
+            })
+
+        tdir = self.mkdtemp()
+        address = os.path.join(tdir, 'writer')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+        sock.listen(5)
+        log = ServerLog(level=ServerLog.DEBUG)
+        loop = forwarding_loop(writer, sock, Options(shutdown_timeout=0.1, userdb=':memory:'), log)
+        t = Thread(target=loop.serve_forever, daemon=True)
+        t.start()
+        try:
+            with TestServer(WriteForwarder(address, 5), local_write=True) as server:
+                conn = server.connect()
+                conn.request('POST', '/some/path?q=%C3%A9', body='a body', headers={
+                    'X-Test': 'x', 'X-Calibre-Forwarded-Client': json.dumps(['1.1.1.1', 1, False])})
+                r = conn.getresponse()
+                self.ae(r.status, http_client.UNPROCESSABLE_ENTITY)
+                self.ae(r.getheader('X-Written'), 'yes')
+                self.ae(json.loads(r.read()), {
+                    'method': 'POST', 'path': ['some', 'path'], 'query': 'é', 'body': 'a body',
+                    'remote_addr': '127.0.0.1', 'is_trusted_ip': True, 'header': 'x'})
+        finally:
+            loop.stop()
+            t.join(5)
+            loop.close_control_connection()
+            log.close()
+
+    def test_reload_after_external_changes(self):
+        'Test applying the changes made to libraries by other processes'
+        from calibre.srv.library_broker import LibraryBroker, init_library
+        broker = LibraryBroker([self.library_path])
+        broker.external_changes_check_interval = 0
+        try:
+            db = broker.get()
+            self.assertIs(broker.get(), db)
+            broker.search_caches[db.server_library_id]['x'] = 1
+            other = init_library(self.library_path, False)
+            other.set_field('title', {1: 'changed externally'})
+            other.set_field('tags', {2: ('external tag',)})
+            # Changed fields are re-read without re-opening the library
+            self.assertIs(broker.get(), db)
+            self.ae(db.field_for('title', 1), 'changed externally')
+            self.ae(db.field_for('sort', 1), 'changed externally')
+            self.ae(db.field_for('tags', 2), ('external tag',))
+            self.assertNotIn('x', broker.search_caches[db.server_library_id])
+            # Changes to custom columns require re-opening the library
+            other.create_custom_column('external', 'External', 'text', False)
+            other.close()
+            ndb = broker.get()
+            self.assertIsNot(ndb, db)
+            self.ae(ndb.field_for('title', 1), 'changed externally')
+            self.assertIs(broker.get(), ndb)
+            broker.close_unloaded_libraries(delay=0)
+            self.assertTrue(db.is_closed)
+        finally:
+            broker.close()
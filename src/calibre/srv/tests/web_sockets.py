@@ -32,24 +32,25 @@
 from polyglot.binary import as_base64_unicode
 
 HANDSHAKE_STR = '''\
-GET / HTTP/1.1\r
+GET {} HTTP/1.1\r
 Upgrade: websocket\r
 Connection: Upgrade\r
 Sec-WebSocket-Key: {}\r
 Sec-WebSocket-Version: 13\r
-''' + '\r\n'
+{}''' + '\r\n'
 
 Frame = namedtuple('Frame', 'fin opcode payload')
 
 
 class WSClient:
 
-    def __init__(self, port, timeout=5):
+    def __init__(self, port, timeout=5, path='/', headers=None):
         self.timeout = timeout
         self.socket = socket.create_connection(('localhost', port), timeout)
         set_socket_inherit(self.socket, False)
         self.key = as_base64_unicode(os.urandom(8))
-        self.socket.sendall(HANDSHAKE_STR.format(self.key).encode('ascii'))
+        headers = ''.join(f'{k}: {v}\r\n' for k, v in (headers or {}).items())
+        self.socket.sendall(HANDSHAKE_STR.format(path, self.key, headers).encode('ascii'))
         self.read_buf = deque()
         self.read_upgrade_response()
         self.mask = memoryview(os.urandom(4))
@@ -14,6 +14,7 @@
 from calibre.constants import config_dir
 from calibre.utils.config import from_json, to_json
 from calibre.utils.localization import _
+from calibre.utils.monotonic import monotonic
 from polyglot.builtins import iteritems
 
 
@@ -95,6 +96,7 @@ def connect(path, exc_class=ValueError):
 class UserManager:
 
     lock = RLock()
+    check_for_changes_interval = 1
 
     @property
     def conn(self):
@@ -131,6 +133,32 @@ def conn(self):
     def __init__(self, path=None):
         self.path = os.path.join(config_dir, 'server-users.sqlite') if path is None else path
         self._conn = None
+        self.records = None
+        self.data_version = None
+        self.last_checked_for_changes = 0
+
+    def record(self, username):
+        '''
+        The cached (pw, restriction, readonly, misc_data) of the user, or None
+        if the user does not exist. The cache is reloaded after every write
+        through this object or any other connection to the database, so that
+        the server does not query the database for every request.
+        '''
+        with self.lock:
+            now = monotonic()
+            if self.records is not None and now - self.last_checked_for_changes > self.check_for_changes_interval:
+                self.last_checked_for_changes = now
+                # data_version changes whenever some other connection, for
+                # example, calibre-server --manage-users, modifies the database
+                if next(self.conn.cursor().execute('PRAGMA data_version'))[0] != self.data_version:
+                    self.records = None
+            if self.records is None:
+                c = self.conn.cursor()
+                self.data_version = next(c.execute('PRAGMA data_version'))[0]
+                self.records = {name: (pw, restriction, readonly == 'y', misc_data) for name, pw, restriction, readonly, misc_data in c.execute(
+                    'SELECT name,pw,restriction,readonly,misc_data FROM users')}
+                self.last_checked_for_changes = now
+            return self.records.get(username)
 
     def get_session_data(self, username):
         with self.lock:
@@ -150,10 +178,9 @@ def set_session_data(self, username, data):
 
     def get(self, username):
         ' Get password for user, or None if user does not exist '
-        with self.lock:
-            for pw, in self.conn.cursor().execute(
-                    'SELECT pw FROM users WHERE name=?', (username,)):
-                return pw
+        r = self.record(username)
+        if r is not None:
+            return r[0]
 
     def has_user(self, username):
         return self.get(username) is not None
@@ -176,10 +203,12 @@ def add_user(self, username, pw, restriction=None, readonly=False, allow_change_
             self.conn.cursor().execute(
                 'INSERT INTO users (name, pw, restriction, readonly, misc_data) VALUES (?, ?, ?, ?, ?)',
                 (username, pw, serialize_restriction(restriction), ('y' if readonly else 'n'), json.dumps(misc_data)))
+            self.refresh()
 
     def remove_user(self, username):
         with self.lock:
             self.conn.cursor().execute('DELETE FROM users WHERE name=?', (username,))
+            self.refresh()
             return self.conn.changes() > 0
 
     @property
@@ -213,19 +242,18 @@ def user_data(self, users):
             self.refresh()
 
     def refresh(self):
-        pass  # legacy compat
+        with self.lock:
+            self.records = None
 
     def is_readonly(self, username):
-        with self.lock:
-            for readonly, in self.conn.cursor().execute(
-                    'SELECT readonly FROM users WHERE name=?', (username,)):
-                return readonly == 'y'
-            return False
+        r = self.record(username)
+        return r is not None and r[2]
 
     def set_readonly(self, username, value):
         with self.lock:
             self.conn.cursor().execute(
                 'UPDATE users SET readonly=? WHERE name=?', ('y' if value else 'n', username))
+            self.refresh()
 
     def change_password(self, username, pw):
         with self.lock:
@@ -234,12 +262,12 @@ def change_password(self, username, pw):
                 raise ValueError(msg)
             self.conn.cursor().execute(
                 'UPDATE users SET pw=? WHERE name=?', (pw, username))
+            self.refresh()
 
     def restrictions(self, username):
-        with self.lock:
-            for restriction, in self.conn.cursor().execute(
-                    'SELECT restriction FROM users WHERE name=?', (username,)):
-                return parse_restriction(restriction).copy()
+        r = self.record(username)
+        if r is not None:
+            return parse_restriction(r[1]).copy()
 
     def allowed_library_names(self, username, all_library_names):
         ' Get allowed library names for specified user from set of all library names '
@@ -260,6 +288,7 @@ def update_user_restrictions(self, username, restrictions):
         with self.lock:
             self.conn.cursor().execute(
                 'UPDATE users SET restriction=? WHERE name=?', (serialize_restriction(restrictions), username))
+            self.refresh()
 
     def library_restriction(self, username, library_path):
         r = self.restrictions(username)
@@ -269,11 +298,10 @@ def library_restriction(self, username, library_path):
         return r['library_restrictions'].get(library_name) or ''
 
     def misc_data(self, username):
-        with self.lock:
-            for misc_data, in self.conn.cursor().execute(
-                    'SELECT misc_data FROM users WHERE name=?', (username,)):
-                return json.loads(misc_data)
-        return {}
+        r = self.record(username)
+        if r is None:
+            return {}
+        return json.loads(r[3])
 
     def is_allowed_to_change_password_via_http(self, username: str) -> bool:
         return bool(self.misc_data(username).get('allow_change_password_via_http', True))
@@ -284,3 +312,4 @@ def set_allowed_to_change_password_via_http(self, username: str, allow: bool = T
             md['allow_change_password_via_http'] = allow
             self.conn.cursor().execute(
                 'UPDATE users SET misc_data=? WHERE name=?', (json.dumps(md), username))
+            self.refresh()
@@ -137,12 +137,12 @@ def error_codes(*errnames):
 
 
 def start_cork(sock):
-    if hasattr(socket, 'TCP_CORK'):
+    if hasattr(socket, 'TCP_CORK') and sock.family != socket.AF_UNIX:
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
 
 
 def stop_cork(sock):
-    if hasattr(socket, 'TCP_CORK'):
+    if hasattr(socket, 'TCP_CORK') and sock.family != socket.AF_UNIX:
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
 
 
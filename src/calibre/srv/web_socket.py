@@ -12,6 +12,7 @@
 from threading import Lock
 
 from calibre import as_unicode
+from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_response import HTTPConnection, create_http_handler
 from calibre.srv.loop import RDWR, READ, WRITE, Connection, HandleInterrupt, ServerLoop
 from calibre.srv.utils import DESIRED_SEND_BUFFER_SIZE
@@ -20,6 +21,7 @@
 from calibre_extensions.speedup import websocket_mask as fast_mask
 from polyglot import http_client
 from polyglot.binary import as_base64_unicode
+from polyglot.builtins import reraise
 from polyglot.queue import Empty, Queue
 
 HANDSHAKE_STR = (
@@ -270,6 +272,7 @@ def __init__(self, *args, **kwargs):
         conn_id += 1
         self.websocket_connection_id = conn_id
         self.stop_reading = False
+        self.pending_websocket_upgrade = None
 
     def finalize_headers(self, inheaders):
         upgrade = inheaders.get('Upgrade', '')
@@ -286,7 +289,31 @@ def finalize_headers(self, inheaders):
             return self.simple_response(http_client.BAD_REQUEST, f'Unsupported WebSocket protocol version: {ver}')
         if self.method != 'GET':
             return self.simple_response(http_client.BAD_REQUEST, f'Invalid WebSocket method: {self.method}')
-
+        self.forwarded_for = inheaders.get('X-Forwarded-For')
+        check = getattr(self.websocket_handler, 'check_websocket_upgrade', None)
+        if check is not None:
+            # Lets handlers refuse connections, for example, to unknown paths
+            # or unauthenticated users. The check can be slow, so it is run in
+            # a worker thread, not in the server loop.
+            self.pending_websocket_upgrade = key, inheaders
+            return self.queue_job(check, self.websocket_connection_id, self, inheaders)
+        self.accept_websocket_upgrade(key, inheaders)
+
+    def job_done(self, ok, result):
+        pending, self.pending_websocket_upgrade = self.pending_websocket_upgrade, None
+        if pending is None:
+            return HTTPConnection.job_done(self, ok, result)
+        if not ok:
+            etype, e, tb = result
+            if not isinstance(e, HTTPSimpleResponse):
+                reraise(etype, e, tb)
+            if e.log:
+                self.log.warn(e.log)
+            extra_headers = {'WWW-Authenticate': e.authenticate} if e.authenticate else None
+            return self.simple_response(e.http_code, str(e), extra_headers=extra_headers)
+        self.accept_websocket_upgrade(*pending)
+
+    def accept_websocket_upgrade(self, key, inheaders):
         response = HANDSHAKE_STR % as_base64_unicode(sha1((key + GUID_STR).encode('utf-8')).digest())
         self.optimize_for_sending_packet()
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
@@ -508,6 +508,9 @@ def compile_srv():
         html = f.read().replace(b'RESET_STYLES', reset, 1).replace(b'ICONS', icons, 1).replace(b'MAIN_JS', js, 1)
 
     atomic_write(base, 'index-generated.html', html)
+    from calibre.srv.http_response import precompress
+    for ext, data in precompress(html):
+        atomic_write(base, 'index-generated.html' + ext, data)
 
 # }}}
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A read-only, seekable file that is a ZIP file with some of its entries
+replaced, without writing a new ZIP file. The entries that are not replaced
+are read, still compressed, from the original file as they are needed, so the
+cost of replacing a few small entries does not depend on the size of the ZIP
+file.
+'''
+
+import os
+import struct
+import time
+import zlib
+from bisect import bisect_right
+
+from calibre.utils.zipfile import (
+    _CD_COMMENT_LENGTH,
+    _CD_COMPRESS_TYPE,
+    _CD_COMPRESSED_SIZE,
+    _CD_CRC,
+    _CD_EXTRA_FIELD_LENGTH,
+    _CD_FILENAME_LENGTH,
+    _CD_FLAG_BITS,
+    _CD_LOCAL_HEADER_OFFSET,
+    _CD_UNCOMPRESSED_SIZE,
+    _ECD_COMMENT,
+    _ECD_ENTRIES_TOTAL,
+    _ECD_LOCATION,
+    _ECD_OFFSET,
+    _ECD_SIZE,
+    _FH_COMPRESSED_SIZE,
+    _FH_COMPRESSION_METHOD,
+    _FH_CRC,
+    _FH_EXTRA_FIELD_LENGTH,
+    _FH_FILENAME_LENGTH,
+    _FH_GENERAL_PURPOSE_FLAG_BITS,
+    _FH_UNCOMPRESSED_SIZE,
+    ZIP64_LIMIT,
+    ZIP_DEFLATED,
+    ZIP_FILECOUNT_LIMIT,
+    ZIP_STORED,
+    BadZipfile,
+    _EndRecData,
+    sizeCentralDir,
+    sizeFileHeader,
+    stringCentralDir,
+    stringEndArchive,
+    stringFileHeader,
+    structCentralDir,
+    structEndArchive,
+    structFileHeader,
+)
+
+ENCRYPTED, DATA_DESCRIPTOR, UTF8_NAME = 0x1, 0x8, 0x800
+
+
+def dos_time(t=None):
+    t = time.localtime(t)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def compressed(data, compress_type):
+    if compress_type == ZIP_STORED:
+        return data
+    c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush()
+
+
+class SplicedZipFile:
+
+    '''
+    The ZIP file in stream, with the entries named in replacements replaced
+    by the specified bytes. Names that are not in the ZIP file are added at
+    its end, with mtime, the modification time of the ZIP file by default, as
+    their timestamp, so that splicing the same file always gives the same
+    bytes. Raises BadZipfile if the ZIP file cannot be spliced, for example
+    if it uses ZIP64 extensions or has a prefix. The stream must remain open
+    as long as this file is used and is closed by :meth:`close`.
+    '''
+
+    def __init__(self, stream, replacements, name='', mtime=None):
+        self.stream, self.name = stream, name
+        self.starts, self.parts = [], []
+        self.pos = self.sz = 0
+        endrec = _EndRecData(stream)
+        if endrec is None:
+            raise BadZipfile('File is not a zip file')
+        size_cd, offset_cd, count = endrec[_ECD_SIZE], endrec[_ECD_OFFSET], endrec[_ECD_ENTRIES_TOTAL]
+        if endrec[_ECD_LOCATION] != offset_cd + size_cd:
+            raise BadZipfile('ZIP files with a prefix or ZIP64 extensions cannot be spliced')
+        stream.seek(offset_cd)
+        cdir = stream.read(size_cd)
+        records, pos = [], 0
+        for _ in range(count):
+            centdir = list(struct.unpack(structCentralDir, cdir[pos:pos + sizeCentralDir]))
+            if centdir[0] != stringCentralDir:
+                raise BadZipfile('Bad magic number for central directory')
+            n = sizeCentralDir + centdir[_CD_FILENAME_LENGTH]
+            fname = cdir[pos + sizeCentralDir:pos + n]
+            fname = fname.decode('utf-8' if centdir[_CD_FLAG_BITS] & UTF8_NAME else 'cp437')
+            end = n + centdir[_CD_EXTRA_FIELD_LENGTH] + centdir[_CD_COMMENT_LENGTH]
+            if 0xffffffff in (centdir[_CD_LOCAL_HEADER_OFFSET], centdir[_CD_COMPRESSED_SIZE], centdir[_CD_UNCOMPRESSED_SIZE]):
+                raise BadZipfile('ZIP files with ZIP64 extensions cannot be spliced')
+            records.append((centdir[_CD_LOCAL_HEADER_OFFSET], fname, centdir, cdir[pos + sizeCentralDir:pos + end]))
+            pos += end
+        records.sort(key=lambda r: r[0])
+        cd_parts = []
+        for i, (offset, fname, centdir, tail) in enumerate(records):
+            entry_end = records[i + 1][0] if i + 1 < len(records) else offset_cd
+            centdir[_CD_LOCAL_HEADER_OFFSET] = self.sz
+            data = replacements.get(fname)
+            if data is None:
+                self.add_part((offset, entry_end - offset))
+            else:
+                if centdir[_CD_FLAG_BITS] & ENCRYPTED:
+                    raise BadZipfile(f'Cannot replace the encrypted entry: {fname}')
+                stream.seek(offset)
+                fheader = list(struct.unpack(structFileHeader, stream.read(sizeFileHeader)))
+                if fheader[0] != stringFileHeader:
+                    raise BadZipfile(f'Bad magic number for file header of: {fname}')
+                name_and_extra = stream.read(fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH])
+                compress_type = ZIP_STORED if centdir[_CD_COMPRESS_TYPE] == ZIP_STORED else ZIP_DEFLATED
+                cdata = compressed(data, compress_type)
+                crc = zlib.crc32(data) & 0xffffffff
+                flags = centdir[_CD_FLAG_BITS] & ~DATA_DESCRIPTOR
+                for rec, idx in ((fheader, (_FH_GENERAL_PURPOSE_FLAG_BITS, _FH_COMPRESSION_METHOD, _FH_CRC, _FH_COMPRESSED_SIZE, _FH_UNCOMPRESSED_SIZE)),
+                                 (centdir, (_CD_FLAG_BITS, _CD_COMPRESS_TYPE, _CD_CRC, _CD_COMPRESSED_SIZE, _CD_UNCOMPRESSED_SIZE))):
+                    for j, val in zip(idx, (flags, compress_type, crc, len(cdata), len(data))):
+                        rec[j] = val
+                self.add_part(struct.pack(structFileHeader, *fheader) + name_and_extra)
+                self.add_part(cdata)
+            cd_parts.append(struct.pack(structCentralDir, *centdir) + tail)
+        existing = {r[1] for r in records}
+        if mtime is None:
+            try:
+                mtime = os.fstat(stream.fileno()).st_mtime
+            except Exception:
+                mtime = 0
+        t, d = dos_time(mtime)
+        for fname, data in replacements.items():
+            if fname in existing:
+                continue
+            bname = fname.encode('utf-8')
+            flags = 0 if bname.isascii() else UTF8_NAME
+            cdata = compressed(data, ZIP_DEFLATED)
+            crc = zlib.crc32(data) & 0xffffffff
+            offset = self.sz
+            self.add_part(struct.pack(structFileHeader, stringFileHeader, 20, 0, flags, ZIP_DEFLATED, t, d, crc, len(cdata), len(data), len(bname), 0) + bname)
+            self.add_part(cdata)
+            cd_parts.append(struct.pack(
+                structCentralDir, stringCentralDir, 20, 0, 20, 0, flags, ZIP_DEFLATED, t, d, crc, len(cdata), len(data),
+                len(bname), 0, 0, 0, 0, 0, offset) + bname)
+        if len(cd_parts) > ZIP_FILECOUNT_LIMIT:
+            raise BadZipfile('Too many entries to splice without ZIP64 extensions')
+        cd = b''.join(cd_parts)
+        offset_cd = self.sz
+        self.add_part(cd)
+        comment = endrec[_ECD_COMMENT]
+        self.add_part(struct.pack(structEndArchive, stringEndArchive, 0, 0, len(cd_parts), len(cd_parts), len(cd), offset_cd, len(comment)) + comment)
+        if self.sz > ZIP64_LIMIT:
+            raise BadZipfile('The spliced ZIP file is too large to not use ZIP64 extensions')
+
+    def reopen(self, stream):
+        '''
+        Return a new file with the same contents as this one, reading from
+        stream, which must be the same, unchanged, ZIP file. Avoids parsing
+        the ZIP file and compressing the replacements again.
+        '''
+        ans = self.__class__.__new__(self.__class__)
+        ans.stream, ans.name = stream, self.name
+        ans.starts, ans.parts, ans.sz, ans.pos = self.starts, self.parts, self.sz, 0
+        return ans
+
+    def add_part(self, part):
+        size = len(part) if isinstance(part, bytes) else part[1]
+        if size:
+            self.starts.append(self.sz)
+            self.parts.append(part)
+            self.sz += size
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n=None):
+        if n is None or n < 0:
+            n = self.sz - self.pos
+        ans = []
+        while n > 0 and self.pos < self.sz:
+            # Reads from the stream can be short, so the part is found from the
+            # position every time rather than assuming the next part follows
+            idx = bisect_right(self.starts, self.pos) - 1
+            part, skip = self.parts[idx], self.pos - self.starts[idx]
+            if isinstance(part, bytes):
+                data = part[skip:skip + n]
+            else:
+                offset, size = part
+                self.stream.seek(offset + skip)
+                data = self.stream.read(min(n, size - skip))
+                if not data:
+                    raise BadZipfile('The ZIP file was truncated while being read')
+            ans.append(data)
+            self.pos += len(data)
+            n -= len(data)
+        return b''.join(ans)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = pos
+        elif whence == os.SEEK_END:
+            self.pos = self.sz + pos
+        else:
+            self.pos += pos
+        self.pos = max(0, min(self.pos, self.sz))
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()